@@ -1,25 +1,82 @@
 from django.contrib import admin
-from .models import AnalysisJob, UploadedFile, AnalysisResult
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html
+from .models import AnalysisJob, UploadedFile, DirectUpload, AnalysisResult, ProcessMetric, Profile
 
 
 @admin.register(AnalysisJob)
 class AnalysisJobAdmin(admin.ModelAdmin):
     list_display = ['job_id', 'project_name', 'email', 'status', 'data_type', 'created_at']
-    list_filter = ['status', 'data_type', 'created_at']
+    list_filter = ['status', 'data_type', 'primer_set', 'profile', 'created_at']
     search_fields = ['project_name', 'email', 'job_id']
     readonly_fields = ['job_id', 'created_at', 'updated_at']
 
 
 @admin.register(UploadedFile)
 class UploadedFileAdmin(admin.ModelAdmin):
-    list_display = ['file_name', 'job', 'file_size', 'uploaded_at']
+    list_display = ['file_name', 'job', 'file_size', 'read_count', 'mean_quality', 'uploaded_at']
     list_filter = ['uploaded_at']
     search_fields = ['file_name', 'job__project_name']
 
 
+@admin.register(DirectUpload)
+class DirectUploadAdmin(admin.ModelAdmin):
+    list_display = ['file_name', 'job', 'file_size', 'status', 'created_at']
+    list_filter = ['status', 'created_at']
+    search_fields = ['file_name', 'key', 'job__project_name']
+    readonly_fields = ['upload_id', 'etag', 'created_at', 'completed_at']
+
+
 @admin.register(AnalysisResult)
 class AnalysisResultAdmin(admin.ModelAdmin):
     list_display = ['job', 'execution_time', 'created_at']
     list_filter = ['created_at']
     search_fields = ['job__project_name']
     readonly_fields = ['created_at']
+
+
+@admin.register(ProcessMetric)
+class ProcessMetricAdmin(admin.ModelAdmin):
+    list_display = ['process', 'job', 'status', 'attempt', 'realtime', 'cpu_percent', 'peak_rss']
+    list_filter = ['status', 'process']
+    search_fields = ['name', 'job__project_name']
+
+
+@admin.register(Profile)
+class ProfileAdmin(admin.ModelAdmin):
+    list_display = ['name', 'kind', 'duration', 'status_code', 'profiler', 'user', 'created_at']
+    list_filter = ['kind', 'profiler', 'created_at']
+    search_fields = ['name', 'path', 'user', 'job__project_name']
+    exclude = ['report_html']
+    readonly_fields = [
+        'kind', 'name', 'job', 'user', 'method', 'path', 'status_code', 'profiler',
+        'duration', 'html_report_link', 'report', 'memory_peak', 'memory_top', 'created_at'
+    ]
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def get_urls(self):
+        urls = [
+            path(
+                '<int:profile_id>/html/',
+                self.admin_site.admin_view(self.html_report_view),
+                name='analysis_profile_html',
+            ),
+        ]
+        return urls + super().get_urls()
+    
+    def html_report_view(self, request, profile_id):
+        profile = get_object_or_404(Profile, pk=profile_id)
+        return HttpResponse(profile.report_html or 'No HTML report', content_type='text/html')
+    
+    @admin.display(description='HTML report')
+    def html_report_link(self, obj):
+        if not obj.report_html:
+            return '-'
+        return format_html(
+            '<a href="{}" target="_blank">Open interactive report</a>',
+            reverse('admin:analysis_profile_html', args=[obj.pk]),
+        )
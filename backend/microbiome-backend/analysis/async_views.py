@@ -0,0 +1,140 @@
+"""
+Async read endpoints for polling clients
+
+Native async versions of the job detail, status, results and bacteria
+endpoints, mounted under /api/async/jobs/. Served by an ASGI server
+(uvicorn), a request to them holds no worker thread while it waits: the
+ORM runs through Django's async query API and file reads and table parsing
+through asyncio.to_thread, so one process can keep many more pollers
+connected than it has threads. Responses are the same as those of the
+DRF endpoints under /api/jobs/.
+
+Under WSGI these views still work, each one run to completion on the
+request's thread.
+"""
+import asyncio
+import logging
+from django.core.exceptions import ValidationError
+from django.http import JsonResponse
+from django.views.decorators.http import require_GET
+from rest_framework import status
+from rest_framework.utils.encoders import JSONEncoder
+from .models import AnalysisJob, AnalysisResult
+from .serializers import AnalysisJobSerializer, AnalysisResultSerializer
+from .utils.taxonomy import bacteria_taxonomy_file, genus_composition
+
+logger = logging.getLogger(__name__)
+
+STATUS_FIELDS = ['job_id', 'status', 'created_at', 'updated_at', 'completed_at', 'error_message']
+
+
+def api_response(data, status=status.HTTP_200_OK):
+    """JSON response encoded the way DRF encodes it (dates, UUIDs, decimals)"""
+    return JsonResponse(data, status=status, encoder=JSONEncoder, safe=False)
+
+
+def not_found():
+    return api_response({'detail': 'No AnalysisJob matches the given query.'}, status=status.HTTP_404_NOT_FOUND)
+
+
+async def get_job(queryset, job_id):
+    """The job with job_id from queryset, or None (also for a malformed id)"""
+    try:
+        return await queryset.aget(job_id=job_id)
+    except (AnalysisJob.DoesNotExist, ValidationError):
+        return None
+
+
+def get_result(job):
+    """The job's result (loaded by select_related), or None"""
+    try:
+        return job.result
+    except AnalysisResult.DoesNotExist:
+        return None
+
+
+@require_GET
+async def job_detail(request, job_id):
+    """
+    Get an analysis job with its files and result
+    GET /api/async/jobs/{job_id}/
+    """
+    queryset = AnalysisJob.objects.select_related('result').prefetch_related('files')
+    job = await get_job(queryset, job_id)
+    if job is None:
+        return not_found()
+    return api_response(AnalysisJobSerializer(job, context={'request': request}).data)
+
+
+@require_GET
+async def job_status(request, job_id):
+    """
+    Get the status of an analysis job
+    GET /api/async/jobs/{job_id}/status/
+    """
+    job = await get_job(AnalysisJob.objects.only(*STATUS_FIELDS), job_id)
+    if job is None:
+        return not_found()
+    return api_response({
+        'job_id': str(job.job_id),
+        'status': job.status,
+        'created_at': job.created_at,
+        'updated_at': job.updated_at,
+        'completed_at': job.completed_at,
+        'error_message': job.error_message
+    })
+
+
+@require_GET
+async def job_results(request, job_id):
+    """
+    Get the results of a completed analysis job
+    GET /api/async/jobs/{job_id}/results/
+    """
+    job = await get_job(AnalysisJob.objects.select_related('result'), job_id)
+    if job is None:
+        return not_found()
+    if job.status != 'completed':
+        return api_response({'error': 'Analysis not completed yet'}, status=status.HTTP_400_BAD_REQUEST)
+
+    result = get_result(job)
+    if result is None:
+        return api_response({'error': 'No results found'}, status=status.HTTP_404_NOT_FOUND)
+    return api_response(AnalysisResultSerializer(result, context={'request': request}).data)
+
+
+@require_GET
+async def job_bacteria(request, job_id):
+    """
+    Get bacteria composition data from taxonomy summary
+    GET /api/async/jobs/{job_id}/bacteria/
+    """
+    job = await get_job(AnalysisJob.objects.select_related('result'), job_id)
+    if job is None:
+        return not_found()
+    if job.status != 'completed':
+        return api_response({'error': 'Analysis not completed yet'}, status=status.HTTP_400_BAD_REQUEST)
+
+    result = get_result(job)
+    if result is None:
+        return api_response({'error': 'No results found'}, status=status.HTTP_404_NOT_FOUND)
+
+    try:
+        taxonomy_file = await asyncio.to_thread(bacteria_taxonomy_file, job, result)
+        if taxonomy_file is None:
+            return api_response({'error': 'No bacteria data available'}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            bacteria_list = await asyncio.to_thread(genus_composition, taxonomy_file)
+        except ValueError as e:
+            return api_response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    except Exception as e:
+        logger.error(f"Error reading bacteria data: {e}")
+        return api_response(
+            {'error': f'Failed to read bacteria data: {str(e)}'},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+    return api_response({
+        'bacteria': bacteria_list,
+        'total_count': len(bacteria_list)
+    })
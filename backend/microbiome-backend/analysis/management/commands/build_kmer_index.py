@@ -0,0 +1,29 @@
+"""
+Add completed jobs to the cross-job k-mer index
+
+Jobs are indexed as they are ingested; this backfills older jobs, or
+rebuilds the index (e.g. after changing KMER_SIZE). ASVs of jobs that added
+samples to a study are indexed under the study.
+
+Usage:
+    python manage.py build_kmer_index             # completed jobs not indexed yet
+    python manage.py build_kmer_index --rebuild
+"""
+from django.core.management.base import BaseCommand
+from analysis.models import AnalysisJob
+from analysis.utils.kmer_index import index_job, rebuild
+
+
+class Command(BaseCommand):
+    help = 'Index the ASV sequences of completed jobs for cross-job sequence search'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Discard the index and index every job again')
+
+    def handle(self, *args, **options):
+        jobs = AnalysisJob.objects.filter(status='completed', parent__isnull=True).order_by('created_at')
+        if options['rebuild']:
+            asvs = rebuild(jobs.iterator())
+        else:
+            asvs = sum(index_job(job) for job in jobs.iterator())
+        self.stdout.write(f"indexed_asvs={asvs}")
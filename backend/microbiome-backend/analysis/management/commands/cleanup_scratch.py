@@ -0,0 +1,54 @@
+"""
+Remove Nextflow scratch (work/, .nextflow, conda) that finished jobs no longer need
+
+Usage:
+    python manage.py cleanup_scratch                   # loop every hour
+    python manage.py cleanup_scratch --once
+    python manage.py cleanup_scratch --once --dry-run
+    python manage.py cleanup_scratch --budget-gb 20 --grace-hours 24
+"""
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from analysis.utils.scratch import cleanup_scratch
+
+
+class Command(BaseCommand):
+    help = 'Delete Nextflow work directories of finished jobs and keep scratch under the disk budget'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run a single cleanup pass')
+        parser.add_argument('--interval', type=float, default=3600.0, help='Seconds between passes')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be removed')
+        parser.add_argument('--budget-gb', type=float, help='Override SCRATCH_DISK_BUDGET_BYTES')
+        parser.add_argument('--grace-hours', type=float, help='Override SCRATCH_FAILED_GRACE_HOURS')
+
+    def handle(self, *args, **options):
+        budget_bytes = None
+        if options['budget_gb'] is not None:
+            budget_bytes = int(options['budget_gb'] * 1024 ** 3)
+        failed_grace = None
+        if options['grace_hours'] is not None:
+            failed_grace = timedelta(hours=options['grace_hours'])
+
+        while True:
+            try:
+                stats = cleanup_scratch(
+                    budget_bytes=budget_bytes,
+                    failed_grace=failed_grace,
+                    dry_run=options['dry_run'],
+                )
+                self.stdout.write(
+                    f"scanned={stats['scanned']} removed={len(stats['removed'])} "
+                    f"reclaimed={stats['reclaimed_bytes'] / 1024 ** 2:.1f}MB "
+                    f"remaining={stats['remaining_bytes'] / 1024 ** 2:.1f}MB"
+                    + (" (dry run)" if options['dry_run'] else "")
+                )
+            except Exception as e:
+                self.stderr.write(f"Cleanup pass failed: {e}")
+                if options['once']:
+                    raise
+
+            if options['once']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,49 @@
+"""
+Build the faidx index of completed jobs' ASV_seqs.fasta
+
+New jobs are indexed on ingestion; this backfills jobs completed before
+sequence lookups existed, or re-indexes them.
+
+Usage:
+    python manage.py index_sequences                 # jobs without a current index
+    python manage.py index_sequences --force
+    python manage.py index_sequences --job <job_id>
+"""
+from django.core.management.base import BaseCommand
+from analysis.models import AnalysisJob
+from analysis.utils.sequences import SequenceIndexError, build_index, fasta_path, load_index
+
+
+class Command(BaseCommand):
+    help = 'Index the ASV sequences of completed jobs for random access'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--job', action='append', help='Only this job (repeatable)')
+        parser.add_argument('--force', action='store_true', help='Rebuild indexes that are up to date')
+
+    def handle(self, *args, **options):
+        jobs = AnalysisJob.objects.filter(status='completed')
+        if options['job']:
+            jobs = jobs.filter(job_id__in=options['job'])
+
+        indexed = skipped = failed = 0
+        for job in jobs.iterator():
+            path = fasta_path(job)
+            if not path.exists():
+                continue
+            if not options['force']:
+                try:
+                    load_index(path)
+                    skipped += 1
+                    continue
+                except SequenceIndexError:
+                    pass
+            try:
+                records = build_index(path)
+                indexed += 1
+                self.stdout.write(f"{job.job_id}: {records} sequences")
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"{job.job_id}: {e}")
+
+        self.stdout.write(f"indexed={indexed} skipped={skipped} failed={failed}")
@@ -0,0 +1,33 @@
+"""
+Fill the cross-job taxon index (TaxonAbundance) of completed jobs
+
+Jobs are indexed as they are ingested; this backfills jobs completed
+before the index existed.
+
+Usage:
+    python manage.py index_taxa              # completed jobs without rows
+    python manage.py index_taxa --all        # re-index every completed job
+"""
+from django.core.management.base import BaseCommand
+from analysis.models import AnalysisJob
+from analysis.utils.taxon_index import index_job_taxa
+
+
+class Command(BaseCommand):
+    help = 'Index reads per taxon of completed jobs for cross-job taxon search'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Also re-index jobs that have rows')
+
+    def handle(self, *args, **options):
+        jobs = AnalysisJob.objects.filter(status='completed', parent__isnull=True)
+        if not options['all']:
+            jobs = jobs.filter(taxon_abundances__isnull=True)
+
+        indexed = rows = 0
+        for job in jobs.iterator():
+            count = index_job_taxa(job)
+            if count:
+                indexed += 1
+                rows += count
+        self.stdout.write(f"jobs={indexed} rows={rows}")
@@ -0,0 +1,36 @@
+"""
+Periodically sync AWS Batch job state to AnalysisJob rows
+
+Usage:
+    python manage.py reconcile_batch_jobs              # loop every 30s
+    python manage.py reconcile_batch_jobs --once
+    python manage.py reconcile_batch_jobs --interval 60
+"""
+import time
+from django.core.management.base import BaseCommand
+from analysis.utils.batch_reconciler import reconcile_batch_jobs
+
+
+class Command(BaseCommand):
+    help = 'Sync in-flight AWS Batch jobs back to analysis jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run a single reconciliation pass')
+        parser.add_argument('--interval', type=float, default=30.0, help='Seconds between passes')
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                stats = reconcile_batch_jobs()
+                self.stdout.write(
+                    f"checked={stats['checked']} updated={stats['updated']} "
+                    f"completed={stats['completed']} failed={stats['failed']} missing={stats['missing']}"
+                )
+            except Exception as e:
+                self.stderr.write(f"Reconciliation pass failed: {e}")
+                if options['once']:
+                    raise
+            
+            if options['once']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,205 @@
+"""
+Request instrumentation
+
+The middleware here runs under both WSGI and ASGI. Under ASGI each one
+stays async (see __acall__), so requests to async views are never pushed
+onto a thread just to pass through the middleware stack. The security,
+session and authentication middleware at the end are Django's, with their
+hooks run on the event loop, for ASYNC_MIDDLEWARE.
+"""
+import random
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib.auth import middleware as auth_middleware
+from django.contrib.sessions import middleware as session_middleware
+from django.middleware import security
+from whitenoise.middleware import WhiteNoiseMiddleware
+from .utils.instrumentation import observe_request
+from .utils.profiling import profiling, save_profile
+
+
+class PrometheusMetricsMiddleware:
+    """Time every request and record it per view and DRF action"""
+    sync_capable = True
+    async_capable = True
+    
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+    
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        response = self.get_response(request)
+        observe_request(request, response, time.perf_counter() - started)
+        return response
+    
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        observe_request(request, response, time.perf_counter() - started)
+        return response
+
+
+class ProfilingMiddleware:
+    """
+    Profile a request when an admin asks for it (X-Profile: 1 header or
+    ?profile=1) or when it is picked by PROFILING_SAMPLE_RATE
+    
+    Under ASGI the profile of an async view also records whatever else the
+    event loop ran while the view was awaiting.
+    """
+    sync_capable = True
+    async_capable = True
+    
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+    
+    @staticmethod
+    def requested(request):
+        return request.headers.get('X-Profile') == '1' or request.GET.get('profile') == '1'
+    
+    @staticmethod
+    def sampled():
+        return settings.PROFILING_SAMPLE_RATE > 0 and random.random() < settings.PROFILING_SAMPLE_RATE
+    
+    def should_profile(self, request):
+        user = getattr(request, 'user', None)
+        if self.requested(request) and user is not None and user.is_staff:
+            return True
+        return self.sampled()
+    
+    async def should_profile_async(self, request):
+        if self.requested(request) and hasattr(request, 'auser'):
+            user = await request.auser()
+            if user.is_staff:
+                return True
+        return self.sampled()
+    
+    @staticmethod
+    def profile_fields(request, response, user):
+        return {
+            'user': user.get_username() if user is not None and user.is_authenticated else '',
+            'method': request.method,
+            'path': request.get_full_path()[:1024],
+            'status_code': response.status_code,
+        }
+    
+    @staticmethod
+    def add_profile_id(response, profile, user):
+        # Only staff can look profiles up; sampled requests of anyone else stay unmarked
+        if profile is not None and user is not None and user.is_staff:
+            response['X-Profile-Id'] = str(profile.pk)
+    
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.should_profile(request):
+            return self.get_response(request)
+        
+        with profiling() as run:
+            response = self.get_response(request)
+        
+        if run is not None:
+            user = getattr(request, 'user', None)
+            fields = self.profile_fields(request, response, user)
+            profile = save_profile(run, 'request', f"{request.method} {request.path}", **fields)
+            self.add_profile_id(response, profile, user)
+        return response
+    
+    async def __acall__(self, request):
+        if not await self.should_profile_async(request):
+            return await self.get_response(request)
+        
+        with profiling() as run:
+            response = await self.get_response(request)
+        
+        if run is not None:
+            user = await request.auser() if hasattr(request, 'auser') else None
+            fields = self.profile_fields(request, response, user)
+            profile = await sync_to_async(save_profile)(run, 'request', f"{request.method} {request.path}", **fields)
+            self.add_profile_id(response, profile, user)
+        return response
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+    """
+    WhiteNoiseMiddleware that can also run async
+
+    Static file lookups (a stat with autorefresh) are done on a thread; any
+    other request is passed straight on.
+    """
+    sync_capable = True
+    async_capable = True
+    
+    def __init__(self, get_response=None, *args, **kwargs):
+        super().__init__(get_response, *args, **kwargs)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+    
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+    
+    def find_static_file(self, request):
+        if self.autorefresh:
+            return self.find_file(request.path_info)
+        return self.files.get(request.path_info)
+    
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = await sync_to_async(self.find_static_file, thread_sensitive=False)(request)
+        else:
+            static_file = self.find_static_file(request)
+        if static_file is not None:
+            return await sync_to_async(self.serve, thread_sensitive=False)(static_file, request)
+        return await self.get_response(request)
+
+
+class EventLoopMiddlewareMixin:
+    """
+    Run a MiddlewareMixin's process_request / process_response on the event
+    loop under ASGI
+
+    For middleware whose hooks do no I/O: Django's MiddlewareMixin runs each
+    hook on a thread. A hook that may block (response_blocks) still does.
+    """
+    
+    def response_blocks(self, request):
+        return False
+    
+    async def __acall__(self, request):
+        response = self.process_request(request) if hasattr(self, 'process_request') else None
+        response = response or await self.get_response(request)
+        if not hasattr(self, 'process_response'):
+            return response
+        if self.response_blocks(request):
+            return await sync_to_async(self.process_response, thread_sensitive=True)(request, response)
+        return self.process_response(request, response)
+
+
+class SecurityMiddleware(EventLoopMiddlewareMixin, security.SecurityMiddleware):
+    """SecurityMiddleware (SSL redirect, HSTS and other headers) on the event loop"""
+
+
+class SessionMiddleware(EventLoopMiddlewareMixin, session_middleware.SessionMiddleware):
+    """
+    SessionMiddleware on the event loop
+
+    The session is loaded lazily (request.session.aget() stays async); only
+    saving a modified session goes to a thread.
+    """
+    
+    def response_blocks(self, request):
+        session = getattr(request, 'session', None)
+        return session is not None and (session.modified or settings.SESSION_SAVE_EVERY_REQUEST)
+
+
+class AuthenticationMiddleware(EventLoopMiddlewareMixin, auth_middleware.AuthenticationMiddleware):
+    """AuthenticationMiddleware on the event loop: request.user and request.auser are lazy"""
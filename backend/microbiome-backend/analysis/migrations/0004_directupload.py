@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0003_analysisjob_is_test_data_alter_analysisjob_data_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirectUpload',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_name', models.CharField(max_length=255)),
+                ('file_size', models.BigIntegerField()),
+                ('key', models.CharField(max_length=1024)),
+                ('upload_id', models.CharField(max_length=1024)),
+                ('part_size', models.BigIntegerField()),
+                ('etag', models.CharField(blank=True, max_length=255)),
+                ('status', models.CharField(choices=[('uploading', 'Uploading'), ('completed', 'Completed'), ('aborted', 'Aborted')], default='uploading', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='direct_uploads', to='analysis.analysisjob')),
+            ],
+            options={
+                'ordering': ['created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0005_analysisjob_batch_job_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysisjob',
+            name='executor',
+            field=models.CharField(blank=True, choices=[('local', 'Local process'), ('container', 'Local container'), ('batch', 'AWS Batch')], default='', max_length=20),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0006_analysisjob_executor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessMetric',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_id', models.IntegerField()),
+                ('process', models.CharField(db_index=True, max_length=255)),
+                ('name', models.CharField(max_length=512)),
+                ('status', models.CharField(max_length=20)),
+                ('exit_status', models.IntegerField(blank=True, null=True)),
+                ('attempt', models.IntegerField(default=1)),
+                ('duration', models.FloatField(blank=True, null=True)),
+                ('realtime', models.FloatField(blank=True, null=True)),
+                ('cpu_percent', models.FloatField(blank=True, null=True)),
+                ('peak_rss', models.BigIntegerField(blank=True, null=True)),
+                ('peak_vmem', models.BigIntegerField(blank=True, null=True)),
+                ('read_bytes', models.BigIntegerField(blank=True, null=True)),
+                ('write_bytes', models.BigIntegerField(blank=True, null=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='process_metrics', to='analysis.analysisjob')),
+            ],
+            options={
+                'ordering': ['job', 'task_id'],
+                'unique_together': {('job', 'task_id')},
+            },
+        ),
+    ]
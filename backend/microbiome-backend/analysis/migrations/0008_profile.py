@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-19 16:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0007_processmetric'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysisjob',
+            name='profile',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='Profile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('request', 'Request'), ('job', 'Job stage')], max_length=20)),
+                ('name', models.CharField(max_length=255)),
+                ('user', models.CharField(blank=True, max_length=150)),
+                ('method', models.CharField(blank=True, max_length=10)),
+                ('path', models.CharField(blank=True, max_length=1024)),
+                ('status_code', models.IntegerField(blank=True, null=True)),
+                ('profiler', models.CharField(max_length=20)),
+                ('duration', models.FloatField()),
+                ('report', models.TextField(blank=True)),
+                ('report_html', models.TextField(blank=True)),
+                ('memory_peak', models.BigIntegerField(blank=True, null=True)),
+                ('memory_top', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('job', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='profiles', to='analysis.analysisjob')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
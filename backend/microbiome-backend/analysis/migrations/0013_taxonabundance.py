@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-19 16:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0012_analysisjob_parent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaxonAbundance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.CharField(choices=[('phylum', 'Phylum'), ('class', 'Class'), ('order', 'Order'), ('family', 'Family'), ('genus', 'Genus'), ('species', 'Species')], max_length=10)),
+                ('taxon', models.CharField(max_length=255)),
+                ('taxon_key', models.CharField(max_length=255)),
+                ('reads', models.BigIntegerField()),
+                ('relative_abundance', models.FloatField()),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='taxon_abundances', to='analysis.analysisjob')),
+            ],
+            options={
+                'ordering': ['rank', 'taxon_key', '-relative_abundance', 'id'],
+                'indexes': [models.Index(fields=['rank', 'taxon_key', '-relative_abundance', 'id'], name='taxon_search_idx')],
+                'constraints': [models.UniqueConstraint(fields=('job', 'rank', 'taxon'), name='unique_job_rank_taxon')],
+            },
+        ),
+    ]
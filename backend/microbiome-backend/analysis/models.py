@@ -19,6 +19,39 @@ class AnalysisJob(models.Model):
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     send_email = models.BooleanField(default=True)
     is_test_data = models.BooleanField(default=False)  # Track if using test data
+    profile = models.BooleanField(default=False)  # Profile orchestration stages (see utils/profiling.py)
+    
+    # Execution backend chosen for the run (see analysis/utils/executors.py)
+    executor = models.CharField(max_length=20, blank=True, default='', choices=[
+        ('local', 'Local process'),
+        ('container', 'Local container'),
+        ('batch', 'AWS Batch'),
+    ])
+    
+    # Amplicon primers detected from the reads (see analysis/utils/primers.py);
+    # empty means the default 515F-806R pair
+    primer_set = models.CharField(max_length=50, blank=True, default='')
+    primer_match_fraction = models.FloatField(null=True, blank=True)  # reads starting with the chosen primers
+    
+    # Quick-look run on subsampled reads before the full run (see analysis/utils/preview.py)
+    preview = models.BooleanField(default=False)
+    preview_status = models.CharField(max_length=20, blank=True, default='', choices=[
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    ])
+    preview_composition = models.JSONField(null=True, blank=True)  # [{genus, family, phylum, reads, percent}]
+    preview_completed_at = models.DateTimeField(null=True, blank=True)
+    
+    # Samples added to a finished study (see analysis/utils/incremental.py): the
+    # increment job holds only the new samples and merges into its parent
+    parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='increments')
+    new_asv_count = models.IntegerField(null=True, blank=True)  # ASVs the increment added to the study
+    
+    # AWS Batch execution (empty for jobs run locally)
+    batch_job_id = models.CharField(max_length=64, blank=True, null=True, db_index=True)
+    batch_status = models.CharField(max_length=20, blank=True, null=True)  # SUBMITTED, RUNNABLE, RUNNING, ...
     
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -42,6 +75,15 @@ class UploadedFile(models.Model):
     file_size = models.BigIntegerField()  # Size in bytes
     uploaded_at = models.DateTimeField(auto_now_add=True)
     
+    # Read statistics from the FASTQ preflight (see utils/fastq.py)
+    read_count = models.BigIntegerField(null=True, blank=True)
+    base_count = models.BigIntegerField(null=True, blank=True)
+    min_read_length = models.IntegerField(null=True, blank=True)
+    max_read_length = models.IntegerField(null=True, blank=True)
+    mean_quality = models.FloatField(null=True, blank=True)  # mean Phred score over all bases
+    read_length_histogram = models.JSONField(null=True, blank=True)  # {"<length>": reads}
+    preflight_error = models.TextField(blank=True, null=True)
+    
     def __str__(self):
         return f"{self.file_name} - {self.job.project_name}"
     
@@ -49,6 +91,34 @@ class UploadedFile(models.Model):
         ordering = ['uploaded_at']
 
 
+class DirectUpload(models.Model):
+    """Track a presigned multipart upload of one input file to S3"""
+    
+    STATUS_CHOICES = [
+        ('uploading', 'Uploading'),
+        ('completed', 'Completed'),
+        ('aborted', 'Aborted'),
+    ]
+    
+    job = models.ForeignKey(AnalysisJob, on_delete=models.CASCADE, related_name='direct_uploads')
+    file_name = models.CharField(max_length=255)
+    file_size = models.BigIntegerField()  # Declared size in bytes
+    key = models.CharField(max_length=1024)  # S3 object key
+    upload_id = models.CharField(max_length=1024)  # S3 multipart UploadId
+    part_size = models.BigIntegerField()
+    etag = models.CharField(max_length=255, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='uploading')
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    
+    def __str__(self):
+        return f"{self.file_name} ({self.status}) - {self.job.project_name}"
+    
+    class Meta:
+        ordering = ['created_at']
+
+
 class AnalysisResult(models.Model):
     """Store analysis results and output files"""
     
@@ -76,3 +146,99 @@ class AnalysisResult(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+
+
+class ProcessMetric(models.Model):
+    """One task of a Nextflow run, parsed from its execution trace"""
+    
+    job = models.ForeignKey(AnalysisJob, on_delete=models.CASCADE, related_name='process_metrics')
+    task_id = models.IntegerField()
+    process = models.CharField(max_length=255, db_index=True)  # e.g. DADA2_TAXONOMY
+    name = models.CharField(max_length=512)  # full task name, including workflow path and tag
+    status = models.CharField(max_length=20)  # COMPLETED, FAILED, CACHED, ABORTED
+    exit_status = models.IntegerField(null=True, blank=True)
+    attempt = models.IntegerField(default=1)
+    
+    duration = models.FloatField(null=True, blank=True)  # seconds, submission to completion
+    realtime = models.FloatField(null=True, blank=True)  # seconds of wall time running
+    cpu_percent = models.FloatField(null=True, blank=True)
+    peak_rss = models.BigIntegerField(null=True, blank=True)  # bytes
+    peak_vmem = models.BigIntegerField(null=True, blank=True)  # bytes
+    read_bytes = models.BigIntegerField(null=True, blank=True)  # rchar
+    write_bytes = models.BigIntegerField(null=True, blank=True)  # wchar
+    
+    def __str__(self):
+        return f"{self.name} ({self.status}) - {self.job_id}"
+    
+    class Meta:
+        ordering = ['job', 'task_id']
+        unique_together = [('job', 'task_id')]
+
+
+class Profile(models.Model):
+    """A stored profile of one request or one job stage"""
+    
+    KIND_CHOICES = [
+        ('request', 'Request'),
+        ('job', 'Job stage'),
+    ]
+    
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    name = models.CharField(max_length=255)  # "GET /api/jobs/{id}/bacteria/" or "ingest (<job_id>)"
+    job = models.ForeignKey(AnalysisJob, on_delete=models.CASCADE, null=True, blank=True, related_name='profiles')
+    
+    # Request profiles
+    user = models.CharField(max_length=150, blank=True)
+    method = models.CharField(max_length=10, blank=True)
+    path = models.CharField(max_length=1024, blank=True)
+    status_code = models.IntegerField(null=True, blank=True)
+    
+    profiler = models.CharField(max_length=20)  # pyinstrument or cprofile
+    duration = models.FloatField()  # seconds
+    report = models.TextField(blank=True)  # text call tree / pstats listing
+    report_html = models.TextField(blank=True)  # pyinstrument HTML, if available
+    
+    # Job stage profiles (tracemalloc)
+    memory_peak = models.BigIntegerField(null=True, blank=True)  # bytes
+    memory_top = models.TextField(blank=True)  # top allocation sites
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"{self.name} ({self.duration:.2f}s)"
+    
+    class Meta:
+        ordering = ['-created_at']
+
+
+class TaxonAbundance(models.Model):
+    """Reads of one taxon in one completed job, for searching taxa across jobs (see analysis/utils/taxon_index.py)"""
+    
+    RANK_CHOICES = [
+        ('phylum', 'Phylum'),
+        ('class', 'Class'),
+        ('order', 'Order'),
+        ('family', 'Family'),
+        ('genus', 'Genus'),
+        ('species', 'Species'),
+    ]
+    
+    job = models.ForeignKey(AnalysisJob, on_delete=models.CASCADE, related_name='taxon_abundances')
+    rank = models.CharField(max_length=10, choices=RANK_CHOICES)
+    taxon = models.CharField(max_length=255)
+    taxon_key = models.CharField(max_length=255)  # lowercased taxon, for case-insensitive prefix search
+    reads = models.BigIntegerField()
+    relative_abundance = models.FloatField()  # fraction of the job's reads
+    
+    def __str__(self):
+        return f"{self.rank} {self.taxon}: {self.relative_abundance:.2%} - {self.job_id}"
+    
+    class Meta:
+        ordering = ['rank', 'taxon_key', '-relative_abundance', 'id']
+        indexes = [
+            # Search order: prefix range on taxon_key, then abundance; id breaks ties for keyset pages
+            models.Index(fields=['rank', 'taxon_key', '-relative_abundance', 'id'], name='taxon_search_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['job', 'rank', 'taxon'], name='unique_job_rank_taxon'),
+        ]
@@ -1,11 +1,14 @@
 from rest_framework import serializers
-from .models import AnalysisJob, UploadedFile, AnalysisResult
+from .models import AnalysisJob, UploadedFile, DirectUpload, AnalysisResult, ProcessMetric, TaxonAbundance
 
 
 class UploadedFileSerializer(serializers.ModelSerializer):
     class Meta:
         model = UploadedFile
-        fields = ['id', 'file_name', 'file_size', 'uploaded_at']
+        fields = [
+            'id', 'file_name', 'file_size', 'uploaded_at', 'read_count', 'base_count',
+            'min_read_length', 'max_read_length', 'mean_quality', 'preflight_error'
+        ]
 
 
 class AnalysisResultSerializer(serializers.ModelSerializer):
@@ -27,9 +30,14 @@ class AnalysisJobSerializer(serializers.ModelSerializer):
         fields = [
             'job_id', 'project_name', 'email', 'data_type', 'status',
             'send_email', 'created_at', 'updated_at', 'completed_at',
-            'error_message', 'files', 'result'
+            'error_message', 'primer_set', 'primer_match_fraction', 'preview', 'preview_status',
+            'parent', 'new_asv_count', 'files', 'result'
+        ]
+        read_only_fields = [
+            'job_id', 'status', 'created_at', 'updated_at', 'completed_at',
+            'primer_set', 'primer_match_fraction', 'preview', 'preview_status',
+            'parent', 'new_asv_count'
         ]
-        read_only_fields = ['job_id', 'status', 'created_at', 'updated_at', 'completed_at']
 
 
 class UploadRequestSerializer(serializers.Serializer):
@@ -39,6 +47,8 @@ class UploadRequestSerializer(serializers.Serializer):
     data_type = serializers.ChoiceField(choices=['single-end', 'paired-end'], required=False)
     send_email = serializers.BooleanField(default=True)
     use_test_data = serializers.BooleanField(default=False, required=False)
+    profile = serializers.BooleanField(default=False, required=False)  # honoured for staff users only
+    preview = serializers.BooleanField(default=False, required=False)  # quick-look run on subsampled reads first
     files = serializers.ListField(
         child=serializers.FileField(),
         allow_empty=True,
@@ -54,3 +64,75 @@ class UploadRequestSerializer(serializers.Serializer):
             raise serializers.ValidationError("Either provide files or select use_test_data")
         
         return data
+
+
+class AddSamplesRequestSerializer(serializers.Serializer):
+    """Serializer for adding samples to a completed job"""
+    send_email = serializers.BooleanField(default=True)
+    files = serializers.ListField(child=serializers.FileField(), allow_empty=False)
+
+
+class DirectUploadFileSerializer(serializers.Serializer):
+    """A file the client intends to upload directly to S3"""
+    file_name = serializers.CharField(max_length=255)
+    file_size = serializers.IntegerField(min_value=1)
+    
+    def validate_file_name(self, value):
+        if '/' in value or '\\' in value or value in ('.', '..'):
+            raise serializers.ValidationError("File name must not contain path separators")
+        return value
+
+
+class UploadSessionRequestSerializer(serializers.Serializer):
+    """Serializer for starting a direct-to-S3 upload session"""
+    project_name = serializers.CharField(max_length=255)
+    email = serializers.EmailField()
+    data_type = serializers.ChoiceField(choices=['single-end', 'paired-end'], required=False)
+    send_email = serializers.BooleanField(default=True)
+    files = DirectUploadFileSerializer(many=True, allow_empty=False)
+    
+    def validate_files(self, value):
+        names = [f['file_name'] for f in value]
+        if len(names) != len(set(names)):
+            raise serializers.ValidationError("File names must be unique")
+        return value
+
+
+class CompletedPartSerializer(serializers.Serializer):
+    part_number = serializers.IntegerField(min_value=1)
+    etag = serializers.CharField(max_length=255)
+
+
+class CompletedFileSerializer(serializers.Serializer):
+    file_name = serializers.CharField(max_length=255)
+    parts = CompletedPartSerializer(many=True, allow_empty=False)
+
+
+class UploadSessionCompleteSerializer(serializers.Serializer):
+    """Serializer for the upload session completion callback"""
+    files = CompletedFileSerializer(many=True, allow_empty=False)
+
+
+class DirectUploadSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DirectUpload
+        fields = ['file_name', 'file_size', 'key', 'upload_id', 'part_size', 'status']
+
+
+class ProcessMetricSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ProcessMetric
+        fields = [
+            'task_id', 'process', 'name', 'status', 'exit_status', 'attempt',
+            'duration', 'realtime', 'cpu_percent', 'peak_rss', 'peak_vmem',
+            'read_bytes', 'write_bytes'
+        ]
+
+
+class TaxonAbundanceSerializer(serializers.ModelSerializer):
+    job_id = serializers.UUIDField(source='job.job_id')
+    project_name = serializers.CharField(source='job.project_name')
+    
+    class Meta:
+        model = TaxonAbundance
+        fields = ['job_id', 'project_name', 'rank', 'taxon', 'reads', 'relative_abundance']
@@ -10,6 +10,7 @@ Test Coverage:
 """
 
 from django.test import TestCase, TransactionTestCase, override_settings
+from unittest import mock, skipUnless
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.utils import timezone
 from rest_framework.test import APIClient
@@ -19,11 +20,43 @@ import tempfile
 import shutil
 import uuid
 import json
+import gzip
+import io
+import os
+import sys
+import tarfile
+import time
+import zipfile
+import numpy as np
+from datetime import timedelta
 
-from .models import AnalysisJob, UploadedFile, AnalysisResult
+try:
+    import boto3
+    import requests
+    from moto import mock_aws
+except ImportError:  # moto/boto3 are only needed for the S3 tests
+    mock_aws = None
+
+from .models import AnalysisJob, UploadedFile, DirectUpload, AnalysisResult, ProcessMetric, Profile
 from .views import run_nextflow_analysis
 
 
+# Concrete 515F/806R primers (IUPAC codes resolved)
+V4_FORWARD = 'GTGCCAGCAGCCGCGGTAA'
+V4_REVERSE = 'GGACTACAAGGGTATCTAAT'
+
+
+def make_fastq(reads=3, mate=1, length=10, quality='I', prefix=''):
+    """Gzipped FASTQ content with Illumina-style headers; reads start with prefix"""
+    insert = length - len(prefix)
+    seq = prefix + 'ACGT' * (insert // 4) + 'A' * (insert % 4)
+    records = [
+        f"@M00123:1:000:1:1101:{i}:1 {mate}:N:0:1\n{seq}\n+\n{quality * length}\n"
+        for i in range(reads)
+    ]
+    return gzip.compress(''.join(records).encode())
+
+
 class AnalysisJobModelTest(TestCase):
     """Test AnalysisJob model"""
     
@@ -386,6 +419,2181 @@ class BacteriaAPITest(TransactionTestCase):
         self.assertIn('error', response.data)
 
 
+class JobArchiveAPITest(TestCase):
+    """Test results archive download endpoint"""
+    
+    def setUp(self):
+        self.client = APIClient()
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        
+        self.job = AnalysisJob.objects.create(
+            project_name='Test Project',
+            email='test@example.com',
+            data_type='paired-end',
+            status='completed',
+        )
+        results_dir = Path(self.media_root) / 'uploads' / str(self.job.job_id) / 'results'
+        (results_dir / 'dada2').mkdir(parents=True)
+        (results_dir / 'multiqc').mkdir()
+        (results_dir / 'dada2' / 'ASV_table.tsv').write_text('ASV_ID\tsample1\nabc\t10\n' * 100)
+        (results_dir / 'dada2' / 'DADA2_table.rds').write_bytes(b'\x1f\x8b' + b'x' * 512)
+        (results_dir / 'multiqc' / 'multiqc_report.html').write_text('<html></html>')
+        self.archive_url = f'/api/jobs/{self.job.job_id}/archive/'
+    
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+    
+    def test_zip_archive(self):
+        """Test streaming the full results tree as zip"""
+        response = self.client.get(self.archive_url)
+        
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        content = b''.join(response.streaming_content)
+        
+        with zipfile.ZipFile(io.BytesIO(content)) as zf:
+            root = f'results_{self.job.job_id}'
+            self.assertEqual(sorted(zf.namelist()), [
+                f'{root}/dada2/ASV_table.tsv',
+                f'{root}/dada2/DADA2_table.rds',
+                f'{root}/multiqc/multiqc_report.html',
+            ])
+            # Already-compressed files are stored, text files are deflated
+            self.assertEqual(zf.getinfo(f'{root}/dada2/DADA2_table.rds').compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(zf.getinfo(f'{root}/dada2/ASV_table.tsv').compress_type, zipfile.ZIP_DEFLATED)
+            self.assertIsNone(zf.testzip())
+    
+    def test_tar_gz_archive_with_filters(self):
+        """Test tar.gz export restricted by include/exclude filters"""
+        response = self.client.get(self.archive_url, {
+            'archive_format': 'tar.gz',
+            'include': 'dada2',
+            'exclude': 'dada2/DADA2_table.rds',
+        })
+        
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        content = b''.join(response.streaming_content)
+        
+        with tarfile.open(fileobj=io.BytesIO(content), mode='r:gz') as tf:
+            names = tf.getnames()
+            self.assertEqual(names, [f'results_{self.job.job_id}/dada2/ASV_table.tsv'])
+            data = tf.extractfile(names[0]).read()
+            self.assertEqual(data, b'ASV_ID\tsample1\nabc\t10\n' * 100)
+    
+    def test_repeat_download_served_from_cache(self):
+        """Test finished archives are cached by catalog checksum"""
+        first = b''.join(self.client.get(self.archive_url).streaming_content)
+        
+        cache_dir = Path(self.media_root) / 'archives' / str(self.job.job_id)
+        self.assertEqual(len(list(cache_dir.glob('*.zip'))), 1)
+        
+        response = self.client.get(self.archive_url)
+        self.assertIn('attachment', response['Content-Disposition'])
+        second = b''.join(response.streaming_content)
+        response.close()
+        self.assertEqual(first, second)
+    
+    def test_concurrent_first_downloads(self):
+        """Test overlapping first downloads of an archive each cache a whole copy of their own"""
+        from .utils.archive import get_results_archive
+        first = iter(get_results_archive(self.job)['stream'])
+        second = iter(get_results_archive(self.job)['stream'])
+        aborted = iter(get_results_archive(self.job)['stream'])
+        first_chunks, second_chunks = [next(first)], [next(second)]
+        next(aborted)
+        aborted.close()  # client went away: removes its own partial file only
+        first_chunks.extend(first)
+        second_chunks.extend(second)
+        
+        cache_dir = Path(self.media_root) / 'archives' / str(self.job.job_id)
+        cached = list(cache_dir.iterdir())
+        self.assertEqual(len(cached), 1)
+        self.assertEqual(b''.join(first_chunks), b''.join(second_chunks))
+        self.assertEqual(cached[0].read_bytes(), b''.join(first_chunks))
+        with zipfile.ZipFile(cached[0]) as zf:
+            self.assertIsNone(zf.testzip())
+    
+    def test_archive_invalid_filter(self):
+        """Test path traversal in filters is rejected"""
+        response = self.client.get(self.archive_url, {'include': '../secrets'})
+        
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+    
+    def test_archive_not_completed(self):
+        """Test archive for non-completed job"""
+        self.job.status = 'processing'
+        self.job.save()
+        
+        response = self.client.get(self.archive_url)
+        
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@skipUnless(mock_aws, "moto is not installed")
+@override_settings(
+    AWS_STORAGE_BUCKET_NAME='test-uploads', AWS_S3_REGION_NAME='us-east-1',
+    AWS_S3_ENDPOINT_URL='', DIRECT_UPLOAD_PART_SIZE=5 * 1024 * 1024,
+)
+class UploadSessionAPITest(TestCase):
+    """Test presigned direct-to-S3 upload sessions against moto"""
+    
+    PART = 5 * 1024 * 1024
+    
+    def setUp(self):
+        from .utils.s3_uploads import direct_upload_client
+        
+        env = {'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing'}
+        self.env_patch = mock.patch.dict(os.environ, env)
+        self.env_patch.start()
+        self.mock = mock_aws()
+        self.mock.start()
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='test-uploads')
+        direct_upload_client._s3 = None
+        
+        self.client = APIClient()
+        self.start_patch = mock.patch('analysis.views.start_analysis')
+        self.start_analysis = self.start_patch.start()
+        
+        self.r1 = os.urandom(self.PART + 1024)  # two parts
+        self.r2 = os.urandom(2048)  # one part
+        self.session_data = {
+            'project_name': 'Direct Upload',
+            'email': 'test@example.com',
+            'data_type': 'paired-end',
+            'files': [
+                {'file_name': 'sample_R1.fastq.gz', 'file_size': len(self.r1)},
+                {'file_name': 'sample_R2.fastq.gz', 'file_size': len(self.r2)},
+            ],
+        }
+    
+    def tearDown(self):
+        self.start_patch.stop()
+        self.mock.stop()
+        self.env_patch.stop()
+    
+    def _upload_parts(self, session_file, data):
+        parts = []
+        for part in session_file['parts']:
+            offset = (part['part_number'] - 1) * session_file['part_size']
+            response = requests.put(part['url'], data=data[offset:offset + session_file['part_size']])
+            self.assertEqual(response.status_code, 200)
+            parts.append({'part_number': part['part_number'], 'etag': response.headers['ETag']})
+        return {'file_name': session_file['file_name'], 'parts': parts}
+    
+    def test_create_session(self):
+        """Test session hands out one presigned URL per part"""
+        response = self.client.post('/api/upload-sessions/', self.session_data, format='json')
+        
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        files = {f['file_name']: f for f in response.data['files']}
+        self.assertEqual(len(files['sample_R1.fastq.gz']['parts']), 2)
+        self.assertEqual(len(files['sample_R2.fastq.gz']['parts']), 1)
+        self.assertIn('uploadId=', files['sample_R1.fastq.gz']['parts'][0]['url'])
+        self.assertEqual(DirectUpload.objects.count(), 2)
+        self.assertFalse(UploadedFile.objects.exists())
+    
+    def test_complete_session(self):
+        """Test completion verifies parts, registers files and enqueues the job"""
+        session = self.client.post('/api/upload-sessions/', self.session_data, format='json').data
+        files = {f['file_name']: f for f in session['files']}
+        completed = [
+            self._upload_parts(files['sample_R1.fastq.gz'], self.r1),
+            self._upload_parts(files['sample_R2.fastq.gz'], self.r2),
+        ]
+        
+        response = self.client.post(
+            f"/api/upload-sessions/{session['job_id']}/complete/",
+            {'files': completed}, format='json'
+        )
+        
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data['files']), 2)
+        self.start_analysis.assert_called_once()
+        
+        s3 = boto3.client('s3', region_name='us-east-1')
+        obj = s3.get_object(Bucket='test-uploads', Key=f"uploads/{session['job_id']}/sample_R1.fastq.gz")
+        self.assertEqual(obj['Body'].read(), self.r1)
+        self.assertFalse(DirectUpload.objects.filter(status='uploading').exists())
+    
+    def test_complete_rejects_wrong_etag(self):
+        """Test completion fails when a part ETag doesn't match"""
+        session = self.client.post('/api/upload-sessions/', self.session_data, format='json').data
+        files = {f['file_name']: f for f in session['files']}
+        completed = [
+            self._upload_parts(files['sample_R1.fastq.gz'], self.r1),
+            self._upload_parts(files['sample_R2.fastq.gz'], self.r2),
+        ]
+        completed[1]['parts'][0]['etag'] = '"0123456789abcdef0123456789abcdef"'
+        
+        response = self.client.post(
+            f"/api/upload-sessions/{session['job_id']}/complete/",
+            {'files': completed}, format='json'
+        )
+        
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('ETag mismatch', response.data['error'])
+        self.start_analysis.assert_not_called()
+        self.assertFalse(UploadedFile.objects.exists())
+    
+    def test_complete_rejects_missing_part(self):
+        """Test completion fails when a part was never uploaded"""
+        session = self.client.post('/api/upload-sessions/', self.session_data, format='json').data
+        files = {f['file_name']: f for f in session['files']}
+        r1 = self._upload_parts(files['sample_R1.fastq.gz'], self.r1)
+        r2 = {'file_name': 'sample_R2.fastq.gz', 'parts': [{'part_number': 1, 'etag': '"abc"'}]}
+        
+        response = self.client.post(
+            f"/api/upload-sessions/{session['job_id']}/complete/",
+            {'files': [r1, r2]}, format='json'
+        )
+        
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('never uploaded', response.data['error'])
+    
+    @override_settings(PRIMER_DETECTION_ENABLED=False, FASTQ_PREFLIGHT_ENABLED=True)
+    @mock.patch('analysis.views.get_executor_for_job')
+    def test_completed_session_runs_locally(self, mock_executor):
+        """Test a local run downloads the uploaded objects and lists them in the samplesheet"""
+        from types import SimpleNamespace
+        self.r1, self.r2 = make_fastq(reads=5), make_fastq(reads=5, mate=2)
+        self.session_data['files'] = [
+            {'file_name': 'sample_R1.fastq.gz', 'file_size': len(self.r1)},
+            {'file_name': 'sample_R2.fastq.gz', 'file_size': len(self.r2)},
+        ]
+        executor = mock_executor.return_value
+        executor.name, executor.is_remote = 'local', False
+        executor.wait.return_value = SimpleNamespace(returncode=1, stdout='', stderr='stopped')
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        
+        session = self.client.post('/api/upload-sessions/', self.session_data, format='json').data
+        files = {f['file_name']: f for f in session['files']}
+        completed = [
+            self._upload_parts(files['sample_R1.fastq.gz'], self.r1),
+            self._upload_parts(files['sample_R2.fastq.gz'], self.r2),
+        ]
+        self.client.post(f"/api/upload-sessions/{session['job_id']}/complete/", {'files': completed}, format='json')
+        from .utils import s3_transfer
+        with override_settings(MEDIA_ROOT=media_root), mock.patch.object(s3_transfer, '_client', None):
+            run_nextflow_analysis(session['job_id'])
+        
+        job_dir = Path(media_root) / 'uploads' / session['job_id']
+        self.assertEqual((job_dir / 'sample_R1.fastq.gz').read_bytes(), self.r1)
+        samplesheet = (job_dir / 'samplesheet.csv').read_text().splitlines()
+        self.assertEqual(samplesheet[1].split(','), [
+            'sample1', str(job_dir / 'sample_R1.fastq.gz'), str(job_dir / 'sample_R2.fastq.gz'), 'A'
+        ])
+        self.assertEqual(UploadedFile.objects.get(file_name='sample_R1.fastq.gz').read_count, 5)  # preflight read it
+        executor.submit.assert_called_once()
+    
+    def test_abort_session(self):
+        """Test aborting a session"""
+        session = self.client.post('/api/upload-sessions/', self.session_data, format='json').data
+        
+        response = self.client.delete(f"/api/upload-sessions/{session['job_id']}/")
+        
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(DirectUpload.objects.filter(status='aborted').count(), 2)
+        self.assertEqual(AnalysisJob.objects.get(job_id=session['job_id']).status, 'failed')
+
+
+@skipUnless(mock_aws, "moto is not installed")
+@override_settings(AWS_S3_REGION_NAME='us-east-1')
+class BatchReconcilerTest(TestCase):
+    """Test bulk AWS Batch status reconciliation against moto"""
+    
+    def setUp(self):
+        env = {'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing', 'AWS_DEFAULT_REGION': 'us-east-1'}
+        self.env_patch = mock.patch.dict(os.environ, env)
+        self.env_patch.start()
+        self.mock = mock_aws(config={'batch': {'use_docker': False}})
+        self.mock.start()
+        
+        iam = boto3.client('iam')
+        self.batch = boto3.client('batch')
+        role = iam.create_role(RoleName='batch-role', AssumeRolePolicyDocument='{}')['Role']['Arn']
+        ce = self.batch.create_compute_environment(
+            computeEnvironmentName='test-ce', type='UNMANAGED', state='ENABLED', serviceRole=role
+        )['computeEnvironmentArn']
+        self.batch.create_job_queue(
+            jobQueueName='test-queue', state='ENABLED', priority=1,
+            computeEnvironmentOrder=[{'order': 1, 'computeEnvironment': ce}]
+        )
+        self.batch.register_job_definition(
+            jobDefinitionName='test-def', type='container',
+            containerProperties={'image': 'busybox', 'vcpus': 1, 'memory': 128, 'command': ['true']}
+        )
+        
+        from .utils.aws_batch import AWSBatchClient
+        self.client = AWSBatchClient()
+    
+    def tearDown(self):
+        self.mock.stop()
+        self.env_patch.stop()
+    
+    def _create_batch_jobs(self, count):
+        jobs = []
+        for i in range(count):
+            batch_job_id = self.batch.submit_job(
+                jobName=f'job-{i}', jobQueue='test-queue', jobDefinition='test-def'
+            )['jobId']
+            jobs.append(AnalysisJob.objects.create(
+                project_name=f'Batch {i}',
+                email='test@example.com',
+                data_type='paired-end',
+                status='pending',
+                batch_job_id=batch_job_id,
+                batch_status='SUBMITTED',
+            ))
+        return jobs
+    
+    def _wait_for_batch(self, jobs, final_status):
+        ids = [job.batch_job_id for job in jobs]
+        for _ in range(50):
+            statuses = {d['status'] for d in self.client.describe_jobs(ids).values()}
+            if statuses == {final_status}:
+                return
+            time.sleep(0.1)
+        self.fail(f"Batch jobs never reached {final_status}")
+    
+    def test_describe_calls_scale_with_chunks(self):
+        """Test 250 jobs are described in 3 API calls and ingested on success"""
+        jobs = self._create_batch_jobs(250)
+        self._wait_for_batch(jobs, 'SUCCEEDED')
+        ingested = []
+        
+        from .utils.batch_reconciler import reconcile_batch_jobs
+        with mock.patch.object(self.client.batch, 'describe_jobs', wraps=self.client.batch.describe_jobs) as describe:
+            stats = reconcile_batch_jobs(client=self.client, on_success=lambda job, desc: ingested.append(job.job_id))
+        
+        self.assertEqual(describe.call_count, 3)
+        self.assertEqual(stats['checked'], 250)
+        self.assertEqual(stats['completed'], 250)
+        self.assertEqual(len(ingested), 250)
+        self.assertEqual(AnalysisJob.objects.filter(status='completed', batch_status='SUCCEEDED').count(), 250)
+        self.assertFalse(AnalysisJob.objects.filter(completed_at__isnull=True).exists())
+    
+    def test_failed_and_missing_jobs(self):
+        """Test terminated jobs are marked failed and unknown IDs are skipped"""
+        with mock.patch.dict(os.environ, {'MOTO_SIMPLE_BATCH_FAIL_AFTER': '0'}):
+            failed, = self._create_batch_jobs(1)
+            self._wait_for_batch([failed], 'FAILED')
+        unknown = AnalysisJob.objects.create(
+            project_name='Unknown', email='test@example.com', data_type='paired-end',
+            status='processing', batch_job_id=str(uuid.uuid4()),
+        )
+        
+        from .utils.batch_reconciler import reconcile_batch_jobs
+        stats = reconcile_batch_jobs(client=self.client, on_success=lambda job, desc: None)
+        
+        failed.refresh_from_db()
+        unknown.refresh_from_db()
+        self.assertEqual(stats['failed'], 1)
+        self.assertEqual(stats['missing'], 1)
+        self.assertEqual(failed.status, 'failed')
+        self.assertEqual(failed.batch_status, 'FAILED')
+        self.assertTrue(failed.error_message.startswith('AWS Batch error'))
+        self.assertEqual(unknown.status, 'processing')
+    
+    def test_ingestion_failure_marks_job_failed(self):
+        """Test a succeeded Batch job whose results can't be ingested is failed"""
+        job, = self._create_batch_jobs(1)
+        self._wait_for_batch([job], 'SUCCEEDED')
+        
+        from .utils.batch_reconciler import reconcile_batch_jobs
+        with override_settings(MEDIA_ROOT=tempfile.mkdtemp()):
+            reconcile_batch_jobs(client=self.client)
+        
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertIn('Result ingestion failed', job.error_message)
+    
+    def test_describe_jobs_retries_throttling(self):
+        """Test throttled describe_jobs calls are retried with backoff"""
+        from botocore.exceptions import ClientError
+        throttled = ClientError({'Error': {'Code': 'TooManyRequestsException'}}, 'DescribeJobs')
+        
+        with mock.patch.object(self.client.batch, 'describe_jobs', side_effect=[throttled, {'jobs': []}]) as describe, \
+                mock.patch('analysis.utils.aws_batch.time.sleep') as sleep:
+            self.assertEqual(self.client.describe_jobs(['abc']), {})
+        
+        self.assertEqual(describe.call_count, 2)
+        sleep.assert_called_once()
+
+
+@skipUnless(mock_aws, "moto is not installed")
+@override_settings(
+    AWS_STORAGE_BUCKET_NAME='test-results', AWS_S3_REGION_NAME='us-east-1',
+    AWS_S3_ENDPOINT_URL='',
+)
+class S3TransferTest(TestCase):
+    """Test parallel S3 sync of job inputs and results against moto"""
+    
+    PART = 5 * 1024 * 1024
+    
+    def setUp(self):
+        env = {'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing'}
+        self.env_patch = mock.patch.dict(os.environ, env)
+        self.env_patch.start()
+        self.mock = mock_aws()
+        self.mock.start()
+        self.s3 = boto3.client('s3', region_name='us-east-1')
+        self.s3.create_bucket(Bucket='test-results')
+        
+        from .utils.s3_transfer import S3Transfer
+        self.transfer = S3Transfer(client=self.s3, part_size=self.PART, concurrency=4, file_concurrency=2)
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        
+        self.job = AnalysisJob.objects.create(
+            project_name='Transfer', email='test@example.com', data_type='paired-end'
+        )
+        job_dir = Path(self.media_root) / 'uploads' / str(self.job.job_id)
+        job_dir.mkdir(parents=True)
+        self.inputs = {
+            'sample_R1.fastq.gz': os.urandom(2 * self.PART + 100),  # multipart
+            'sample_R2.fastq.gz': os.urandom(1000),  # single part
+        }
+        for name, data in self.inputs.items():
+            (job_dir / name).write_bytes(data)
+            UploadedFile.objects.create(
+                job=self.job, file=f'uploads/{self.job.job_id}/{name}', file_name=name, file_size=len(data)
+            )
+    
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+        self.mock.stop()
+        self.env_patch.stop()
+    
+    def test_sync_inputs_skips_unchanged(self):
+        """Test inputs are uploaded once and skipped when ETag and size match"""
+        from .utils.s3_transfer import sync_job_inputs
+        
+        first = sync_job_inputs(self.job, transfer=self.transfer)
+        self.assertEqual(first.files_transferred, 2)
+        self.assertEqual(first.bytes_transferred, sum(len(d) for d in self.inputs.values()))
+        self.assertGreater(first.as_dict()['throughput_mb_s'], 0)
+        
+        head = self.s3.head_object(Bucket='test-results', Key=f'uploads/{self.job.job_id}/sample_R1.fastq.gz')
+        self.assertTrue(head['ETag'].endswith('-3"'))
+        
+        second = sync_job_inputs(self.job, transfer=self.transfer)
+        self.assertEqual(second.files_transferred, 0)
+        self.assertEqual(second.files_skipped, 2)
+        
+        # A changed file of the same size is uploaded again
+        path = Path(self.media_root) / 'uploads' / str(self.job.job_id) / 'sample_R2.fastq.gz'
+        path.write_bytes(os.urandom(1000))
+        third = sync_job_inputs(self.job, transfer=self.transfer)
+        self.assertEqual(third.files_transferred, 1)
+        self.assertEqual(third.files_skipped, 1)
+    
+    def test_sync_inputs_skips_direct_uploads(self):
+        """Test objects uploaded straight to S3 are not uploaded again from MEDIA_ROOT"""
+        from .utils.s3_transfer import sync_job_inputs
+        key = f'uploads/{self.job.job_id}/direct_R1.fastq.gz'
+        self.s3.put_object(Bucket='test-results', Key=key, Body=b'direct')
+        DirectUpload.objects.create(
+            job=self.job, file_name='direct_R1.fastq.gz', file_size=6, key=key,
+            upload_id='upload', part_size=self.PART, status='completed'
+        )
+        UploadedFile.objects.create(job=self.job, file=key, file_name='direct_R1.fastq.gz', file_size=6)
+        
+        stats = sync_job_inputs(self.job, transfer=self.transfer)
+        
+        self.assertEqual(stats.files_transferred, 2)
+        self.assertFalse(stats.errors)
+        self.assertEqual(self.s3.get_object(Bucket='test-results', Key=key)['Body'].read(), b'direct')
+    
+    def test_download_selected_subtrees(self):
+        """Test only selected result subtrees are downloaded, and only once"""
+        from .utils.s3_transfer import download_job_results
+        prefix = f'results/{self.job.job_id}/'
+        self.s3.put_object(Bucket='test-results', Key=prefix + 'dada2/ASV_table.tsv', Body=b'ASV_ID\ts1\n')
+        self.s3.put_object(Bucket='test-results', Key=prefix + 'dada2/QC/err.pdf', Body=b'%PDF')
+        self.s3.put_object(Bucket='test-results', Key=prefix + 'qiime2/big.qza', Body=b'x' * 100)
+        
+        stats = download_job_results(self.job, subtrees=['dada2'], transfer=self.transfer)
+        
+        results_dir = Path(self.media_root) / 'uploads' / str(self.job.job_id) / 'results'
+        self.assertEqual(stats.files_transferred, 2)
+        self.assertEqual((results_dir / 'dada2' / 'ASV_table.tsv').read_bytes(), b'ASV_ID\ts1\n')
+        self.assertTrue((results_dir / 'dada2' / 'QC' / 'err.pdf').exists())
+        self.assertFalse((results_dir / 'qiime2').exists())
+        
+        again = download_job_results(self.job, subtrees=['dada2'], transfer=self.transfer)
+        self.assertEqual(again.files_transferred, 0)
+        self.assertEqual(again.files_skipped, 2)
+
+
+class ExecutorSelectionTest(TestCase):
+    """Test execution backend selection and lazy client creation"""
+    
+    def setUp(self):
+        self.job = AnalysisJob.objects.create(
+            project_name='Test Project',
+            email='test@example.com',
+            data_type='paired-end',
+        )
+        for name in ['sample_R1.fastq.gz', 'sample_R2.fastq.gz']:
+            UploadedFile.objects.create(job=self.job, file=f'uploads/{name}', file_name=name, file_size=600)
+    
+    @override_settings(PIPELINE_BATCH_ENABLED=True, PIPELINE_BATCH_MIN_INPUT_BYTES=1000)
+    def test_large_inputs_go_to_batch(self):
+        """Test jobs above the size threshold use AWS Batch"""
+        from .utils.executors import get_executor_for_job
+        
+        self.assertEqual(get_executor_for_job(self.job).name, 'batch')
+    
+    @override_settings(PIPELINE_BATCH_ENABLED=True, PIPELINE_BATCH_MIN_INPUT_BYTES=10000)
+    def test_small_inputs_stay_local(self):
+        """Test jobs below the size threshold run on this host"""
+        from .utils.executors import get_executor_for_job
+        
+        self.assertEqual(get_executor_for_job(self.job).name, 'local')
+        with override_settings(PIPELINE_LOCAL_EXECUTOR='container'):
+            self.assertEqual(get_executor_for_job(self.job).name, 'container')
+    
+    @override_settings(PIPELINE_BATCH_ENABLED=False, PIPELINE_BATCH_MIN_INPUT_BYTES=1000)
+    def test_batch_disabled(self):
+        """Test nothing goes to Batch unless it is enabled"""
+        from .utils.executors import get_executor_for_job
+        
+        self.assertEqual(get_executor_for_job(self.job).name, 'local')
+    
+    def test_batch_clients_created_lazily(self):
+        """Test boto3 clients are only created when Batch is used"""
+        fake_boto3 = mock.MagicMock()
+        with mock.patch.dict(sys.modules, {'boto3': fake_boto3}):
+            from .utils.aws_batch import AWSBatchClient
+            client = AWSBatchClient()
+            fake_boto3.client.assert_not_called()
+            
+            client.batch
+            client.batch
+            fake_boto3.client.assert_called_once_with('batch', region_name=mock.ANY)
+    
+    def test_local_process_executor(self):
+        """Test submit / poll / wait / cancel of local processes"""
+        from .utils.executors import LocalProcessExecutor, RUNNING
+        executor = LocalProcessExecutor()
+        
+        executor.submit(self.job, ['sh', '-c', 'echo Completed'])
+        result = executor.wait(self.job, timeout=30)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout.strip(), 'Completed')
+        
+        executor.submit(self.job, ['sleep', '30'])
+        self.assertEqual(executor.poll(self.job), RUNNING)
+        self.assertTrue(executor.cancel(self.job))
+        self.assertNotEqual(executor.wait(self.job).returncode, 0)
+
+
+class ScratchCleanupTest(TestCase):
+    """Test Nextflow work directory lifecycle and disk-budget eviction"""
+    
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+    
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+    
+    def make_job(self, status, scratch_bytes, hours_ago=0, with_result=False):
+        job = AnalysisJob.objects.create(
+            project_name='Scratch', email='test@example.com', data_type='paired-end', status=status
+        )
+        job_dir = Path(self.media_root) / 'uploads' / str(job.job_id)
+        (job_dir / 'work' / 'ab' / 'cdef').mkdir(parents=True)
+        (job_dir / 'work' / 'ab' / 'cdef' / 'out.tsv').write_bytes(b'x' * scratch_bytes)
+        (job_dir / '.nextflow.log').write_bytes(b'log')
+        (job_dir / 'results').mkdir()
+        (job_dir / 'results' / 'ASV_table.tsv').write_bytes(b'ASV_ID')
+        (job_dir / 'sample_R1.fastq.gz').write_bytes(b'reads')
+        # Nextflow links task inputs back to the uploads; they must not be counted
+        os.symlink(job_dir / 'sample_R1.fastq.gz', job_dir / 'work' / 'ab' / 'cdef' / 'sample_R1.fastq.gz')
+        if with_result:
+            AnalysisResult.objects.create(job=job)
+        AnalysisJob.objects.filter(pk=job.pk).update(
+            updated_at=timezone.now() - timedelta(hours=hours_ago)
+        )
+        return job, job_dir
+    
+    def test_lifecycle_rules(self):
+        """Test completed scratch goes, failed scratch stays for the grace period"""
+        from .utils.scratch import cleanup_scratch
+        completed, completed_dir = self.make_job('completed', 1000, with_result=True)
+        unregistered, unregistered_dir = self.make_job('completed', 1000)
+        recent_failure, recent_dir = self.make_job('failed', 1000, hours_ago=1)
+        old_failure, old_dir = self.make_job('failed', 1000, hours_ago=100)
+        running, running_dir = self.make_job('processing', 1000, hours_ago=200)
+        
+        stats = cleanup_scratch(budget_bytes=10 ** 9, failed_grace=timedelta(hours=72))
+        
+        self.assertEqual(stats['scanned'], 5)
+        self.assertCountEqual(stats['removed'], [str(completed.job_id), str(old_failure.job_id)])
+        # work/ file + .nextflow.log + the symlink itself, never its 5-byte target
+        link_size = len(os.fsencode(completed_dir / 'sample_R1.fastq.gz'))
+        self.assertEqual(stats['reclaimed_bytes'], 2 * (1000 + 3 + link_size))
+        for job_dir in [completed_dir, old_dir]:
+            self.assertFalse((job_dir / 'work').exists())
+            self.assertFalse((job_dir / '.nextflow.log').exists())
+            self.assertTrue((job_dir / 'results' / 'ASV_table.tsv').exists())
+            self.assertEqual((job_dir / 'sample_R1.fastq.gz').read_bytes(), b'reads')
+        for job_dir in [unregistered_dir, recent_dir, running_dir]:
+            self.assertTrue((job_dir / 'work').exists())
+    
+    def test_budget_evicts_oldest_first(self):
+        """Test eviction over budget goes oldest first and spares active jobs"""
+        from .utils.scratch import cleanup_scratch
+        oldest, oldest_dir = self.make_job('failed', 5000, hours_ago=10)
+        newer, newer_dir = self.make_job('failed', 5000, hours_ago=5)
+        running, running_dir = self.make_job('processing', 5000, hours_ago=50)
+        
+        stats = cleanup_scratch(budget_bytes=12000, failed_grace=timedelta(hours=72))
+        
+        self.assertEqual(stats['removed'], [str(oldest.job_id)])
+        self.assertFalse((oldest_dir / 'work').exists())
+        self.assertTrue((newer_dir / 'work').exists())
+        self.assertTrue((running_dir / 'work').exists())
+        self.assertLessEqual(stats['remaining_bytes'], 12000)
+    
+    def test_dry_run_and_command(self):
+        """Test dry runs only report, and the management command runs a pass"""
+        from django.core.management import call_command
+        from .utils.scratch import cleanup_scratch
+        job, job_dir = self.make_job('completed', 2000, with_result=True)
+        
+        stats = cleanup_scratch(dry_run=True)
+        self.assertEqual(stats['removed'], [str(job.job_id)])
+        self.assertTrue((job_dir / 'work').exists())
+        
+        out = io.StringIO()
+        call_command('cleanup_scratch', '--once', stdout=out)
+        self.assertIn('removed=1', out.getvalue())
+        self.assertFalse((job_dir / 'work').exists())
+
+
+class ProcessMetricTest(TestCase):
+    """Test Nextflow trace parsing and the process metrics API"""
+    
+    # nf-core default trace: human-readable values, no process/attempt columns
+    HUMAN_TRACE = (
+        "task_id\thash\tnative_id\tname\tstatus\texit\tsubmit\tduration\trealtime\t%cpu\tpeak_rss\tpeak_vmem\trchar\twchar\n"
+        "1\tab/123456\t101\tNFCORE_AMPLISEQ:AMPLISEQ:DADA2_TAXONOMY_WF:DADA2_TAXONOMY (ASV_seqs)\tCOMPLETED\t0\t2025-01-01 10:00:00.000\t1h 2m 3s\t1h 1m\t226.3%\t16.9 MB\t1 GB\t2 KB\t512 B\n"
+        "2\tcd/654321\t102\tNFCORE_AMPLISEQ:AMPLISEQ:DADA2_TAXONOMY_WF:DADA2_ADDSPECIES (ASV_seqs)\tFAILED\t137\t2025-01-01 10:00:00.000\t57.5s\t-\t-\t-\t-\t-\t-\n"
+    )
+    # Trace written with metrics.config (raw = true)
+    RAW_TRACE = (
+        "task_id\thash\tnative_id\tprocess\tname\tstatus\texit\tattempt\tsubmit\tduration\trealtime\t%cpu\tpeak_rss\tpeak_vmem\trchar\twchar\n"
+        "1\tab/1\t1\tNFCORE_AMPLISEQ:AMPLISEQ:CUTADAPT_BASIC\tCUTADAPT_BASIC (s1)\tCOMPLETED\t0\t1\t0\t12000\t10000\t95.0\t1000\t2000\t300\t400\n"
+        "2\tab/2\t2\tNFCORE_AMPLISEQ:AMPLISEQ:CUTADAPT_BASIC\tCUTADAPT_BASIC (s2)\tCOMPLETED\t0\t2\t0\t32000\t30000\t105.0\t3000\t4000\t500\t600\n"
+        "3\tab/3\t3\tNFCORE_AMPLISEQ:AMPLISEQ:DADA2_TAXONOMY_WF:DADA2_TAXONOMY\tDADA2_TAXONOMY (ASV_seqs)\tCOMPLETED\t0\t1\t0\t3610000\t3600000\t400.0\t8000\t9000\t700\t800\n"
+    )
+    
+    def setUp(self):
+        self.client = APIClient()
+        self.temp_dir = tempfile.mkdtemp()
+        self.job = AnalysisJob.objects.create(
+            project_name='Metrics', email='test@example.com', data_type='paired-end', status='completed'
+        )
+    
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def write_trace(self, content, name='execution_trace.txt'):
+        pipeline_info = Path(self.temp_dir) / 'results' / 'pipeline_info'
+        pipeline_info.mkdir(parents=True, exist_ok=True)
+        (pipeline_info / name).write_text(content)
+        return pipeline_info / name
+    
+    def test_parse_human_readable_trace(self):
+        """Test nf-core's default trace format is parsed to seconds and bytes"""
+        from .utils.nextflow_trace import parse_trace
+        taxonomy, addspecies = parse_trace(self.write_trace(self.HUMAN_TRACE, 'execution_trace_2025.txt'))
+        
+        self.assertEqual(taxonomy.process, 'DADA2_TAXONOMY')
+        self.assertEqual(taxonomy.duration, 3723.0)
+        self.assertEqual(taxonomy.realtime, 3660.0)
+        self.assertEqual(taxonomy.cpu_percent, 226.3)
+        self.assertEqual(taxonomy.peak_rss, int(16.9 * 1024 ** 2))
+        self.assertEqual(taxonomy.peak_vmem, 1024 ** 3)
+        self.assertEqual((taxonomy.read_bytes, taxonomy.write_bytes), (2048, 512))
+        self.assertEqual(taxonomy.attempt, 1)
+        
+        self.assertEqual(addspecies.process, 'DADA2_ADDSPECIES')
+        self.assertEqual(addspecies.status, 'FAILED')
+        self.assertEqual(addspecies.exit_status, 137)
+        self.assertEqual(addspecies.duration, 57.5)
+        self.assertIsNone(addspecies.realtime)
+        self.assertIsNone(addspecies.peak_rss)
+    
+    def test_ingest_imports_trace(self):
+        """Test ingesting results stores wall time and replaces trace records"""
+        from .utils.ingest import ingest_results
+        self.write_trace(self.RAW_TRACE)
+        
+        with override_settings(MEDIA_ROOT=self.temp_dir):
+            ingest_results(self.job, Path(self.temp_dir) / 'results', execution_time=3725.4)
+            ingest_results(self.job, Path(self.temp_dir) / 'results', execution_time=3725.4)
+        
+        self.assertEqual(AnalysisResult.objects.get(job=self.job).execution_time, 3725.4)
+        self.assertEqual(self.job.process_metrics.count(), 3)
+        # Re-ingesting replaced the rows, none are left behind
+        self.assertEqual(ProcessMetric.objects.count(), 3)
+        self.assertEqual(
+            sorted(ProcessMetric.objects.values_list('process', flat=True)),
+            ['CUTADAPT_BASIC', 'CUTADAPT_BASIC', 'DADA2_TAXONOMY']
+        )
+        retried = self.job.process_metrics.get(task_id=2)
+        self.assertEqual((retried.attempt, retried.realtime, retried.peak_rss), (2, 30.0, 3000))
+    
+    def test_process_metrics_api(self):
+        """Test per-job and aggregate per-process percentiles"""
+        from .utils.nextflow_trace import import_trace
+        import_trace(self.job, self.write_trace(self.RAW_TRACE))
+        
+        response = self.client.get(f'/api/jobs/{self.job.job_id}/process-metrics/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['tasks']), 3)
+        processes = response.data['processes']
+        # Slowest process (by total realtime) first
+        self.assertEqual([p['process'] for p in processes], ['DADA2_TAXONOMY', 'CUTADAPT_BASIC'])
+        cutadapt = processes[1]
+        self.assertEqual((cutadapt['tasks'], cutadapt['retried']), (2, 1))
+        self.assertEqual(cutadapt['realtime']['p50'], 20.0)
+        self.assertEqual(cutadapt['realtime']['max'], 30.0)
+        
+        other = AnalysisJob.objects.create(project_name='Other', email='test@example.com', data_type='paired-end')
+        import_trace(other, self.write_trace(self.RAW_TRACE))
+        
+        response = self.client.get('/api/process-metrics/', {'process': 'DADA2_TAXONOMY'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['jobs'], 2)
+        self.assertEqual(len(response.data['processes']), 1)
+        self.assertEqual(response.data['processes'][0]['tasks'], 2)
+        self.assertEqual(response.data['processes'][0]['realtime']['p95'], 3600.0)
+        
+        response = self.client.get('/api/process-metrics/', {'days': 'soon'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class PrometheusMetricsTest(TestCase):
+    """Test the /metrics endpoint and request instrumentation"""
+    
+    def setUp(self):
+        self.client = APIClient()
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root, METRICS_AUTH_TOKEN='')
+        self.settings_override.enable()
+    
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+    
+    def sample(self, name, labels=None):
+        from prometheus_client import REGISTRY
+        return REGISTRY.get_sample_value(name, labels or {}) or 0
+    
+    def test_request_latency_per_action(self):
+        """Test requests are recorded per viewset action"""
+        job = AnalysisJob.objects.create(project_name='Metrics', email='test@example.com', data_type='paired-end')
+        labels = {'view': 'AnalysisJobViewSet', 'action': 'get_status', 'method': 'GET', 'status': '200'}
+        before = self.sample('microbiome_http_request_duration_seconds_count', labels)
+        
+        self.client.get(f'/api/jobs/{job.job_id}/status/')
+        self.client.get(f'/api/jobs/{job.job_id}/status/')
+        
+        self.assertEqual(self.sample('microbiome_http_request_duration_seconds_count', labels), before + 2)
+    
+    def test_metrics_endpoint(self):
+        """Test job state gauges and event metrics are exposed"""
+        AnalysisJob.objects.create(project_name='A', email='test@example.com', data_type='paired-end')
+        AnalysisJob.objects.create(
+            project_name='B', email='test@example.com', data_type='paired-end',
+            status='processing', executor='local'
+        )
+        AnalysisJob.objects.create(
+            project_name='C', email='test@example.com', data_type='paired-end', status='completed'
+        )
+        (Path(self.media_root) / 'uploads').mkdir()
+        (Path(self.media_root) / 'uploads' / 'reads.fastq').write_bytes(b'x' * 1234)
+        
+        from .utils.instrumentation import _disk_usage_cache, count_upload_bytes
+        _disk_usage_cache._value = None
+        count_upload_bytes('api', 100)
+        
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        body = response.content.decode()
+        self.assertIn('microbiome_jobs{status="pending"} 1.0', body)
+        self.assertIn('microbiome_jobs{status="failed"} 0.0', body)
+        self.assertIn('microbiome_queue_depth 1.0', body)
+        self.assertIn('microbiome_pipelines_running{executor="local"} 1.0', body)
+        self.assertIn('microbiome_media_bytes 1234.0', body)
+        self.assertIn('microbiome_upload_bytes_total{source="api"}', body)
+        self.assertIn('microbiome_http_request_duration_seconds_bucket', body)
+    
+    def test_metrics_token(self):
+        """Test the scrape token is enforced when configured"""
+        with override_settings(METRICS_AUTH_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics').status_code, 401)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
+
+
+class ProfilingTest(TestCase):
+    """Test opt-in request profiling and per-job stage profiles"""
+    
+    def setUp(self):
+        from django.contrib.auth.models import User
+        self.client = APIClient()
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.user = User.objects.create_user('user', 'user@example.com', 'password')
+        self.job = AnalysisJob.objects.create(
+            project_name='Profiled', email='test@example.com', data_type='paired-end'
+        )
+        self.url = f'/api/jobs/{self.job.job_id}/status/'
+    
+    def test_flag_ignored_for_non_staff(self):
+        """Test the profile header/query flag does nothing for normal users"""
+        self.client.get(self.url, HTTP_X_PROFILE='1')
+        self.client.force_login(self.user)
+        response = self.client.get(self.url, {'profile': '1'})
+        
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('X-Profile-Id', response)
+        self.assertEqual(Profile.objects.count(), 0)
+    
+    def test_staff_request_profiled(self):
+        """Test admins get a stored profile for flagged requests"""
+        self.client.force_login(self.admin)
+        response = self.client.get(self.url, HTTP_X_PROFILE='1')
+        
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        profile = Profile.objects.get(pk=response['X-Profile-Id'])
+        self.assertEqual(profile.kind, 'request')
+        self.assertEqual(profile.name, f'GET {self.url}')
+        self.assertEqual((profile.user, profile.status_code), ('admin', 200))
+        self.assertEqual(profile.profiler, 'pyinstrument')  # from requirements.txt
+        self.assertTrue(profile.report)
+        
+        # Browsable from the admin
+        response = self.client.get(f'/admin/analysis/profile/{profile.pk}/change/')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(f'/admin/analysis/profile/{profile.pk}/html/')
+        self.assertEqual(response.status_code, 200)
+    
+    @override_settings(PROFILING_SAMPLE_RATE=1.0)
+    def test_sampled_requests_profiled(self):
+        """Test the sampling rate profiles requests without any flag, telling only staff the profile id"""
+        response = self.client.get(self.url)
+        self.assertEqual(Profile.objects.filter(kind='request').count(), 1)
+        self.assertNotIn('X-Profile-Id', response)
+        
+        self.client.force_login(self.user)
+        self.assertNotIn('X-Profile-Id', self.client.get(self.url))
+        
+        self.client.force_login(self.admin)
+        response = self.client.get(self.url)
+        self.assertTrue(Profile.objects.filter(pk=response['X-Profile-Id']).exists())
+    
+    @override_settings(PROFILING_SAMPLE_RATE=1.0)
+    async def test_sampled_async_requests_unmarked(self):
+        """Test sampled async requests of anonymous users do not get the profile id"""
+        from django.test import AsyncClient
+        response = await AsyncClient().get(f'/api/async/jobs/{self.job.job_id}/status/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('X-Profile-Id', response)
+        self.assertEqual(await Profile.objects.filter(kind='request').acount(), 1)
+    
+    def test_job_stage_profile(self):
+        """Test job stages are profiled with tracemalloc only when switched on"""
+        from .utils.profiling import profile_stage
+        
+        with profile_stage(self.job, 'plot generation'):
+            [bytes(1024) for _ in range(100)]
+        self.assertEqual(Profile.objects.count(), 0)
+        
+        self.job.profile = True
+        with self.assertRaises(ValueError):
+            with profile_stage(self.job, 'samplesheet'):
+                data = [bytes(1024) for _ in range(1000)]
+                raise ValueError("Could not find R1 and R2 files")
+        
+        profile = self.job.profiles.get()
+        self.assertEqual(profile.kind, 'job')
+        self.assertTrue(profile.name.startswith('samplesheet'))
+        self.assertGreater(profile.memory_peak, 1000 * 1024)
+        self.assertIn('tests.py', profile.memory_top)
+
+
+class FastqPreflightTest(TestCase):
+    """Test FASTQ validation and read statistics before a pipeline starts"""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.temp_dir)
+        self.settings_override.enable()
+        self.job = AnalysisJob.objects.create(
+            project_name='Preflight', email='test@example.com', data_type='paired-end'
+        )
+    
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def add_files(self, r1, r2):
+        for name, content in [('s_R1.fastq.gz', r1), ('s_R2.fastq.gz', r2)]:
+            UploadedFile.objects.create(
+                job=self.job, file=SimpleUploadedFile(name, content), file_name=name, file_size=len(content)
+            )
+    
+    def test_valid_pair_statistics(self):
+        """Test read statistics are stored for a valid pair"""
+        from .utils.fastq import preflight_job
+        self.add_files(make_fastq(reads=5, mate=1, length=12), make_fastq(reads=5, mate=2, length=10, quality='5'))
+        
+        self.assertEqual(preflight_job(self.job), [])
+        r1, r2 = self.job.files.order_by('file_name')
+        self.assertEqual((r1.read_count, r1.base_count), (5, 60))
+        self.assertEqual((r1.min_read_length, r1.max_read_length), (12, 12))
+        self.assertEqual(r1.mean_quality, 40.0)  # 'I'
+        self.assertEqual(r2.mean_quality, 20.0)  # '5'
+        self.assertEqual(r2.read_length_histogram, {'10': 5})
+        self.assertIsNone(r1.preflight_error)
+    
+    def test_invalid_files(self):
+        """Test truncated gzip, non-FASTQ content and malformed records are reported"""
+        from .utils.fastq import FastqError, scan_fastq
+        path = Path(self.temp_dir) / 'reads.fastq.gz'
+        cases = [
+            (make_fastq(reads=50)[:-20], 'truncated gzip'),
+            (gzip.compress(b'sampleID,forwardReads\n'), 'not a FASTQ file'),
+            (gzip.compress(b'@r1\nACGT\n+\nIII\n'), '4 bases but 3 quality scores'),
+            (gzip.compress(b'@r1\nACGT\n+\nIIII\n@r2\nAC'), 'truncated record 2'),
+            (gzip.compress(b'@r1\nACXT\n+\nIIII\n'), "invalid base 'X'"),
+            (b'', 'contains no reads'),
+            (gzip.compress(b'@r1\n\n+\n\n@r2\n\n+\n\n'), 'all 2 reads are empty'),
+        ]
+        for content, message in cases:
+            path.write_bytes(content)
+            with self.assertRaises(FastqError, msg=message) as cm:
+                scan_fastq(path)
+            self.assertIn(message, str(cm.exception))
+    
+    def test_pairing_mismatch(self):
+        """Test R1/R2 files with different read counts or IDs are rejected"""
+        from .utils.fastq import preflight_job
+        self.add_files(make_fastq(reads=5), make_fastq(reads=4, mate=2))
+        self.assertIn('has 5 reads but', preflight_job(self.job)[0])
+        
+        self.job.files.all().delete()
+        other_ids = gzip.compress(b''.join(f'@other:{i} 2:N:0:1\nACGT\n+\nIIII\n'.encode() for i in range(3)))
+        self.add_files(make_fastq(reads=3, length=4), other_ids)
+        self.assertIn('Read IDs', preflight_job(self.job)[0])
+    
+    def test_bundled_test_data_passes(self):
+        """Test the bundled test_input pair (SRA-style read IDs) passes preflight"""
+        from django.conf import settings
+        from .utils.fastq import preflight_job
+        test_input = Path(settings.BASE_DIR).parent.parent / 'analysis_bioinf' / 'test_input'
+        for name in ['1a_S103_L001_R1_001.fastq.gz', '1a_S103_L001_R2_001.fastq.gz']:
+            content = (test_input / name).read_bytes()
+            UploadedFile.objects.create(
+                job=self.job, file=SimpleUploadedFile(name, content), file_name=name, file_size=len(content)
+            )
+        
+        self.assertEqual(preflight_job(self.job), [])
+        self.assertEqual([f.read_count for f in self.job.files.all()], [2500, 2500])
+    
+    def test_reservoir_sample_keeps_pairs(self):
+        """Test R1 and R2 sampled with the same seed keep the same read pairs"""
+        from .utils.fastq import scan_fastq
+        for mate in (1, 2):
+            (Path(self.temp_dir) / f'R{mate}.fastq.gz').write_bytes(make_fastq(reads=1000, mate=mate))
+        r1 = scan_fastq(Path(self.temp_dir) / 'R1.fastq.gz', sample_size=50, seed=7)['sample']
+        r2 = scan_fastq(Path(self.temp_dir) / 'R2.fastq.gz', sample_size=50, seed=7)['sample']
+        
+        self.assertEqual(len(r1), 50)
+        ids = [record[0].split()[0] for record in r1]
+        self.assertEqual(ids, [record[0].split()[0] for record in r2])
+        self.assertGreater(max(int(i.rsplit(b':', 2)[1]) for i in ids), 500)  # not just the first reads
+        self.assertTrue(all(record[1][:1] and record[2] == b'+' for record in r1))
+    
+    @mock.patch('analysis.views.get_executor_for_job')
+    def test_job_fails_before_pipeline(self, mock_executor):
+        """Test a job with invalid inputs fails without reaching an executor"""
+        self.add_files(make_fastq(reads=5), b'not gzip, not fastq')
+        
+        run_nextflow_analysis(self.job.job_id)
+        
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, 'failed')
+        self.assertIn('Input validation failed', self.job.error_message)
+        self.assertIn('s_R2.fastq.gz: not a FASTQ file', self.job.error_message)
+        mock_executor.return_value.submit.assert_not_called()
+
+
+class PrimerDetectionTest(TestCase):
+    """Test amplicon primer detection from the first reads"""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.temp_dir)
+        self.settings_override.enable()
+        self.job = AnalysisJob.objects.create(
+            project_name='Primers', email='test@example.com', data_type='paired-end'
+        )
+    
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def add_files(self, r1, r2):
+        for name, content in [('s_R1.fastq.gz', r1), ('s_R2.fastq.gz', r2)]:
+            UploadedFile.objects.create(
+                job=self.job, file=SimpleUploadedFile(name, content), file_name=name, file_size=len(content)
+            )
+    
+    def test_degenerate_primers_with_mismatches(self):
+        """Test IUPAC primers match with up to 10% mismatches, anchored at the read start"""
+        from .utils.primers import encode_reads, match_primer
+        reads = encode_reads([
+            b'GTGCCAGCAGCCGCGGTAATACG',  # exact (Y=C, M=A)
+            b'GTGTCAGCGGCCGCGGTAATACG',  # Y=T, one mismatch (G for M)
+            b'GTGTCAGCGGCCGCGCTAATACG',  # two mismatches
+            b'NTGCCAGCAGCCGCGGTAATACG',  # N in the read matches anything
+            b'AGTGCCAGCAGCCGCGGTAATAC',  # primer one base in: not anchored
+            b'GTGCCAGCAG',  # too short
+        ], 25)
+        matched = match_primer(reads, 'GTGYCAGCMGCCGCGGTAA', max_error_rate=0.1)
+        self.assertEqual(matched.tolist(), [True, True, False, True, False, False])
+    
+    def test_detects_v3_v4(self):
+        """Test the best pair is chosen and stored on the job"""
+        from .utils.primers import detect_job_primers
+        self.add_files(
+            make_fastq(reads=20, length=60, prefix='CCTACGGGAGGCAGCAG'),
+            make_fastq(reads=20, mate=2, length=60, prefix='GACTACCAGGGTATCTAATCC'),
+        )
+        
+        pair = detect_job_primers(self.job)
+        self.assertEqual((pair.name, pair.region), ('341F-805R', '16S V3-V4'))
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.primer_set, '341F-805R')
+        self.assertEqual(self.job.primer_match_fraction, 1.0)
+    
+    def test_unsupported_region_rejected(self):
+        """Test ITS amplicons are recognised and rejected with the reason"""
+        from .utils.primers import PrimerDetectionError, detect_job_primers
+        self.add_files(
+            make_fastq(reads=20, length=60, prefix='GTGAATCATCGAATCTTTG'),
+            make_fastq(reads=20, mate=2, length=60, prefix='TCCTCCGCTTATTGATATGC'),
+        )
+        with self.assertRaisesRegex(PrimerDetectionError, 'fITS7-ITS4 \\(fungal ITS2\\)'):
+            detect_job_primers(self.job)
+    
+    @mock.patch('analysis.views.get_executor_for_job')
+    def test_job_without_primers_fails_early(self, mock_executor):
+        """Test reads without known primers fail the job before the pipeline"""
+        self.add_files(make_fastq(reads=20, length=60), make_fastq(reads=20, mate=2, length=60))
+        
+        run_nextflow_analysis(self.job.job_id)
+        
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, 'failed')
+        self.assertIn('Primer detection failed: No known primer pair', self.job.error_message)
+        mock_executor.return_value.submit.assert_not_called()
+
+
+class IncrementalStudyTest(TestCase):
+    """Test adding samples to a completed job"""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.temp_dir)
+        self.settings_override.enable()
+        self.client = APIClient()
+        self.study = AnalysisJob.objects.create(
+            project_name='Study', email='test@example.com', data_type='paired-end', status='completed'
+        )
+        AnalysisResult.objects.create(job=self.study)
+        self.dada2 = Path(self.temp_dir) / 'uploads' / str(self.study.job_id) / 'results' / 'dada2'
+        self.write(self.dada2 / 'ASV_table.tsv', 'ASV_ID\tsample1\na\t10\nb\t5\n')
+        self.write(self.dada2 / 'ASV_seqs.fasta', '>a\nACGT\n>b\nAGGT\n')
+        self.write(self.dada2 / 'DADA2_stats.tsv', 'sample\tnonchim\nsample1\t15\n')
+        self.write(
+            self.dada2 / 'ASV_tax.gtdb.tsv',
+            'ASV_ID\tPhylum\tFamily\tGenus\na\tFirmicutes\tBacillaceae\tBacillus\n'
+            'b\tProteobacteria\tPseudomonadaceae\tPseudomonas\n'
+        )
+        self.write(
+            self.dada2.parent / 'bacteria_summary.tsv',
+            'Genus\tFamily\tPhylum\tsample1\tTotal\nBacillus\tBacillaceae\tFirmicutes\t10\t10\n'
+            'Pseudomonas\tPseudomonadaceae\tProteobacteria\t5\t5\n'
+        )
+    
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def write(self, path, text):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+    
+    def test_group_samples(self):
+        """Test read files are grouped into samples by name"""
+        from .utils.incremental import group_samples
+        samples = group_samples(
+            ['2a_S1_L001_R1_001.fastq.gz', '2a_S1_L001_R2_001.fastq.gz', 'soil-3_1.fq.gz', 'soil-3_2.fq.gz'],
+            'paired-end'
+        )
+        self.assertEqual(samples, {
+            's2a_S1_L001': ('2a_S1_L001_R1_001.fastq.gz', '2a_S1_L001_R2_001.fastq.gz'),
+            'soil_3': ('soil-3_1.fq.gz', 'soil-3_2.fq.gz'),
+        })
+        with self.assertRaisesRegex(ValueError, 'needs both an R1 and an R2'):
+            group_samples(['x_R1.fastq.gz'], 'paired-end')
+    
+    def make_increment(self, submitted):
+        """An increment with sample2 (ASVs a and c), and an executor whose taxonomy run classifies c"""
+        increment = AnalysisJob.objects.create(
+            project_name='Study', email='test@example.com', data_type='paired-end', parent=self.study
+        )
+        job_dir = Path(self.temp_dir) / 'uploads' / str(increment.job_id)
+        delta = job_dir / 'results' / 'dada2'
+        self.write(delta / 'ASV_table.tsv', 'ASV_ID\tsample2\na\t3\nc\t7\n')
+        self.write(delta / 'ASV_seqs.fasta', '>a\nACGT\n>c\nTTGA\n')
+        self.write(delta / 'DADA2_stats.tsv', 'sample\tnonchim\nsample2\t10\n')
+        
+        
+        def submit(job, cmd, cwd=None, env=None):
+            submitted.append(cmd)
+            fasta = Path(cmd[cmd.index('--input_fasta') + 1]).read_text()
+            self.assertEqual(fasta, '>c\nTTGA\n')
+            self.write(
+                Path(cmd[cmd.index('--outdir') + 1]) / 'dada2' / 'ASV_tax.gtdb.tsv',
+                'ASV_ID\tPhylum\tFamily\tGenus\nc\tFirmicutes\tBacillaceae\tBacillus\n'
+            )
+        
+        executor = mock.Mock(submit=submit)
+        executor.wait.return_value = mock.Mock(returncode=0, stderr='')
+        cmd = ['nextflow', 'run', 'nf-core/ampliseq', '--input', 'samplesheet.csv', '--outdir', str(delta.parent),
+               '--FW_primer', 'GTG', '--RV_primer', 'GGA', '--skip_taxonomy']
+        return increment, job_dir, delta, cmd, executor
+    
+    def test_merge_classifies_only_new_asvs(self):
+        """Test the delta merges by ASV_ID and only unseen ASVs go through taxonomy"""
+        from .utils.incremental import merge_increment
+        submitted = []
+        increment, job_dir, delta, cmd, executor = self.make_increment(submitted)
+        
+        self.assertEqual(merge_increment(increment, delta.parent, cmd, executor, cwd=job_dir), 1)
+        
+        self.assertNotIn('--skip_taxonomy', submitted[0])
+        self.assertNotIn('--FW_primer', submitted[0])
+        self.assertEqual(
+            (self.dada2 / 'ASV_table.tsv').read_text(),
+            'ASV_ID\tsample1\tsample2\na\t10\t3\nb\t5\t0\nc\t0\t7\n'
+        )
+        self.assertEqual((self.dada2 / 'ASV_tax.gtdb.tsv').read_text().count('\nc\t'), 1)
+        self.assertTrue((self.dada2 / 'ASV_seqs.fasta').read_text().endswith('>c\nTTGA\n'))
+        self.assertIn('sample2\t10', (self.dada2 / 'DADA2_stats.tsv').read_text())
+        self.assertEqual(
+            (self.dada2.parent / 'bacteria_summary.tsv').read_text(),
+            'Genus\tFamily\tPhylum\tsample1\tsample2\tTotal\n'
+            'Bacillus\tBacillaceae\tFirmicutes\t10\t10\t20\n'
+            'Pseudomonas\tPseudomonadaceae\tProteobacteria\t5\t0\t5\n'
+        )
+        self.study.result.refresh_from_db()
+        self.assertTrue(self.study.result.taxonomy_data)
+    
+    def test_failed_merge_leaves_study_unchanged(self):
+        """Test a merge that fails partway changes no study file, and a retry adds each record once"""
+        from .utils.incremental import merge_increment
+        study_files = sorted(path for path in self.dada2.parent.rglob('*') if path.is_file())
+        before = {path: path.read_text() for path in study_files}
+        increment, job_dir, delta, cmd, executor = self.make_increment([])
+        
+        with mock.patch('analysis.utils.incremental.update_genus_summary', side_effect=ValueError('broken')):
+            with self.assertRaises(ValueError):
+                merge_increment(increment, delta.parent, cmd, executor, cwd=job_dir)
+        self.assertEqual(sorted(path for path in self.dada2.parent.rglob('*') if path.is_file()), study_files)
+        self.assertEqual({path: path.read_text() for path in study_files}, before)
+        
+        self.assertEqual(merge_increment(increment, delta.parent, cmd, executor, cwd=job_dir), 1)
+        self.assertEqual((self.dada2 / 'ASV_seqs.fasta').read_text(), '>a\nACGT\n>b\nAGGT\n>c\nTTGA\n')
+        self.assertEqual((self.dada2 / 'ASV_tax.gtdb.tsv').read_text().count('\nc\t'), 1)
+        self.assertEqual((self.dada2 / 'ASV_seqs.fasta.fai').read_text().count('\n'), 3)
+    
+    @mock.patch('analysis.views.start_analysis')
+    def test_add_samples_api(self, mock_start):
+        """Test the add-samples endpoint creates a local increment job for the new samples"""
+        def files(*names):
+            return [SimpleUploadedFile(name, make_fastq()) for name in names]
+        
+        url = f'/api/jobs/{self.study.job_id}/samples/'
+        response = self.client.post(url, {'files': files('s2_R1.fastq.gz', 's2_R2.fastq.gz')}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['parent'], self.study.job_id)
+        increment = AnalysisJob.objects.get(job_id=response.data['job_id'])
+        self.assertEqual((increment.executor, increment.files.count()), ('local', 2))
+        mock_start.assert_called_once_with(increment)
+        
+        # One increment at a time
+        response = self.client.post(url, {'files': files('s3_R1.fastq.gz', 's3_R2.fastq.gz')}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        increment.status = 'completed'
+        increment.save()
+        
+        for names, message in [
+            (('sample1_R1.fastq.gz', 'sample1_R2.fastq.gz'), 'already in the study: sample1'),
+            (('s3_R1.fastq.gz',), 'needs both an R1 and an R2'),
+        ]:
+            response = self.client.post(url, {'files': files(*names)}, format='multipart')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn(message, response.data['error'])
+
+
+class CompareAPITest(TestCase):
+    """Test cross-job comparison of ASV tables"""
+    
+    def setUp(self):
+        from .utils.compare import clear_cache
+        clear_cache()
+        self.temp_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.temp_dir)
+        self.settings_override.enable()
+        self.client = APIClient()
+        self.jobs = [
+            self.make_job('ASV_ID\ts1\ts2\na\t6\t0\nb\t2\t2\n', {'a': 'Bacillus', 'b': 'Pseudomonas'}),
+            self.make_job('ASV_ID\ts1\nb\t5\nc\t5\n', {'b': 'Pseudomonas', 'c': 'Bacillus'}),
+        ]
+        self.url = f'/api/compare/?jobs={self.jobs[0].job_id},{self.jobs[1].job_id}'
+    
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def make_job(self, table, genera):
+        job = AnalysisJob.objects.create(
+            project_name='Compare', email='test@example.com', data_type='paired-end', status='completed'
+        )
+        dada2 = Path(self.temp_dir) / 'uploads' / str(job.job_id) / 'results' / 'dada2'
+        dada2.mkdir(parents=True)
+        (dada2 / 'ASV_table.tsv').write_text(table)
+        (dada2 / 'ASV_tax.gtdb.tsv').write_text(
+            'ASV_ID\tGenus\n' + ''.join(f'{asv}\t{genus}\n' for asv, genus in genera.items())
+        )
+        return job
+    
+    def test_load_counts_in_chunks(self):
+        """Test an ASV table read a few rows at a time gives the same sparse matrix"""
+        from .utils import compare
+        path = Path(self.temp_dir) / 'ASV_table.tsv'
+        counts = np.random.default_rng(0).integers(0, 3, size=(7, 4)) * (np.arange(7) % 3 == 0)[:, None]
+        path.write_text('ASV_ID\ts1\ts2\ts3\ts4\n' + ''.join(
+            f'asv{i}\t' + '\t'.join(map(str, row)) + '\n' for i, row in enumerate(counts)
+        ))
+        
+        with mock.patch.object(compare, 'LOAD_CHUNK_CELLS', 8):  # 2 rows of 4 samples
+            matrix = compare.load_counts(path)
+        
+        self.assertEqual(matrix.samples, ['s1', 's2', 's3', 's4'])
+        self.assertEqual(list(matrix.features), [f'asv{i}' for i in range(7)])
+        self.assertEqual(matrix.counts.nnz, np.count_nonzero(counts))
+        np.testing.assert_array_equal(matrix.counts.toarray(), counts.T)
+        
+        path.write_text('ASV_ID\ts1\ts2\n')
+        self.assertEqual(compare.load_counts(path).counts.shape, (2, 0))
+    
+    def test_compare_asvs(self):
+        """Test shared and unique ASVs, distances and the merged sparse table"""
+        response = self.client.get(self.url + '&table=true')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        
+        self.assertEqual((response.data['features'], response.data['shared_features']), (3, 1))
+        self.assertEqual([j['unique_features'] for j in response.data['jobs']], [1, 1])
+        self.assertEqual([j['total_reads'] for j in response.data['jobs']], [10, 10])
+        self.assertEqual(response.data['shared_matrix'], [[2, 1], [1, 2]])
+        # pooled a:6 b:4 vs b:5 c:5
+        self.assertEqual(response.data['distances']['bray_curtis'][0][1], 0.6)
+        self.assertAlmostEqual(response.data['distances']['jaccard'][0][1], 2 / 3, places=5)
+        
+        table = response.data['table']
+        self.assertEqual(table['features'], ['a', 'b', 'c'])
+        cells = sorted(zip(table['rows'], table['columns'], table['counts']))
+        self.assertEqual(cells, [(0, 0, 6), (0, 1, 2), (1, 1, 2), (2, 1, 5), (2, 2, 5)])
+    
+    def test_compare_at_rank(self):
+        """Test jobs are aligned on taxonomy at the chosen rank"""
+        response = self.client.get(self.url + '&rank=genus')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['features'], response.data['shared_features']), (2, 2))
+        self.assertEqual(response.data['distances']['bray_curtis'][0][1], 0.1)
+    
+    def test_counts_cached_until_table_changes(self):
+        """Test repeated comparisons reuse the loaded matrices"""
+        from .utils import compare
+        with mock.patch.object(compare, 'load_counts', wraps=compare.load_counts) as load:
+            self.client.get(self.url)
+            self.client.get(self.url + '&rank=genus')
+            self.assertEqual(load.call_count, 2)
+            
+            table = Path(self.temp_dir) / 'uploads' / str(self.jobs[1].job_id) / 'results' / 'dada2' / 'ASV_table.tsv'
+            table.write_text('ASV_ID\ts1\ts2\nb\t5\t1\nc\t5\t0\n')
+            response = self.client.get(self.url)
+            self.assertEqual(load.call_count, 3)
+            self.assertEqual(response.data['jobs'][1]['samples'], ['s1', 's2'])
+    
+    def test_invalid_requests(self):
+        """Test job list, rank and job state validation"""
+        pending = AnalysisJob.objects.create(project_name='P', email='test@example.com', data_type='paired-end')
+        first = self.jobs[0].job_id
+        for query, code in [
+            (f'jobs={first}', status.HTTP_400_BAD_REQUEST),
+            (f'jobs={first},{self.jobs[1].job_id}&rank=kingdom', status.HTTP_400_BAD_REQUEST),
+            (f'jobs={first},not-a-uuid', status.HTTP_400_BAD_REQUEST),
+            (f'jobs={first},{uuid.uuid4()}', status.HTTP_404_NOT_FOUND),
+            (f'jobs={first},{pending.job_id}', status.HTTP_400_BAD_REQUEST),
+        ]:
+            response = self.client.get(f'/api/compare/?{query}')
+            self.assertEqual(response.status_code, code, query)
+
+
+class DiversityTest(TestCase):
+    """Test alpha and beta diversity computed from the ASV table"""
+    
+    def counts(self):
+        from scipy import sparse
+        return sparse.csr_matrix([
+            [10, 0, 1, 1, 2],
+            [5, 5, 0, 0, 0],
+            [0, 0, 0, 0, 0],
+            [1, 0, 3, 0, 6],
+        ])
+    
+    def test_alpha_diversity(self):
+        """Test observed, Shannon, Simpson and Chao1 per sample"""
+        from .utils.diversity import alpha_diversity
+        alpha = alpha_diversity(self.counts())
+        
+        self.assertEqual(alpha['observed'].tolist(), [4, 2, 0, 3])
+        self.assertAlmostEqual(alpha['shannon'][1], 1.0)  # two equal ASVs: 1 bit
+        self.assertAlmostEqual(alpha['simpson'][1], 0.5)
+        self.assertAlmostEqual(alpha['simpson'][0], 1 - (100 + 1 + 1 + 4) / 196)
+        self.assertAlmostEqual(alpha['chao1'][0], 4 + 2 * 1 / (2 * 2))  # F1=2, F2=1
+        self.assertAlmostEqual(alpha['chao1'][3], 3.0)  # F1=1: no unseen estimate
+        self.assertTrue(np.isnan(alpha['shannon'][2]))
+    
+    def test_beta_diversity_matches_pairwise_definition(self):
+        """Test blocked Bray-Curtis and Jaccard against a direct computation"""
+        from .utils.diversity import beta_diversity
+        dense = self.counts().toarray()
+        
+        for block_elements in (1, 2, 10 ** 6):
+            bray_curtis, jaccard = beta_diversity(self.counts(), block_elements=block_elements)
+            for i in range(4):
+                for j in range(4):
+                    a, b = dense[i], dense[j]
+                    depth = a.sum() + b.sum()
+                    union = ((a > 0) | (b > 0)).sum()
+                    expected_bc = 1 - 2 * np.minimum(a, b).sum() / depth if depth else 0.0
+                    expected_jac = 1 - ((a > 0) & (b > 0)).sum() / union if union else 0.0
+                    self.assertAlmostEqual(bray_curtis[i, j], expected_bc)
+                    self.assertAlmostEqual(jaccard[i, j], expected_jac)
+    
+    @mock.patch('analysis.utils.ingest.generate_bacteria_plot', return_value=None)
+    def test_ingest_fills_diversity_fields(self, mock_plot):
+        """Test ingestion stores the alpha and beta diversity tables"""
+        from .utils.ingest import ingest_results
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, ignore_errors=True)
+        job = AnalysisJob.objects.create(project_name='Diversity', email='test@example.com', data_type='paired-end')
+        results_dir = Path(temp_dir) / 'results'
+        (results_dir / 'dada2').mkdir(parents=True)
+        (results_dir / 'dada2' / 'ASV_table.tsv').write_text('ASV_ID\ts1\ts2\ts3\na\t5\t0\t1\nb\t5\t4\t0\n')
+        
+        with override_settings(MEDIA_ROOT=temp_dir):
+            result = ingest_results(job, results_dir)
+            alpha = result.alpha_diversity_data.read().decode()
+            beta = result.beta_diversity_data.read().decode()
+        
+        self.assertEqual(alpha.splitlines()[0], 'sample\tobserved\tshannon\tsimpson\tchao1')
+        self.assertIn('s1\t2\t1\t0.5\t2', alpha)
+        self.assertEqual(beta.splitlines()[0], 'sample_a\tsample_b\tbray_curtis\tjaccard')
+        self.assertEqual(len(beta.splitlines()), 4)  # 3 pairs
+        self.assertIn('s2\ts3\t1\t1', beta)
+
+
+class RarefactionTest(TestCase):
+    """Test native alpha rarefaction curves"""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.temp_dir)
+        self.settings_override.enable()
+        self.client = APIClient()
+        self.job = AnalysisJob.objects.create(
+            project_name='Rarefaction', email='test@example.com', data_type='paired-end', status='completed'
+        )
+        dada2 = Path(self.temp_dir) / 'uploads' / str(self.job.job_id) / 'results' / 'dada2'
+        dada2.mkdir(parents=True)
+        (dada2 / 'ASV_table.tsv').write_text('ASV_ID\ts1\ts2\na\t50\t10\nb\t50\t0\nc\t1\t10\n')
+    
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_curve_endpoints(self):
+        """Test full-depth subsamples reproduce the sample and deeper depths are empty"""
+        from .utils.rarefaction import rarefy_sample
+        curve = rarefy_sample([50, 50, 1], [1, 20, 101, 200], iterations=5, seed=1)
+        observed_mean, observed_sd = curve[0]
+        self.assertEqual(observed_mean[0], 1.0)
+        self.assertEqual((observed_mean[2], observed_sd[2]), (3.0, 0.0))
+        self.assertTrue(np.isnan(observed_mean[3]))
+    
+    @override_settings(RAREFACTION_PARALLEL_MIN_SAMPLES=2)
+    def test_seeded_results_independent_of_workers(self):
+        """Test the same seed gives the same curves in-process and in a process pool"""
+        from scipy import sparse
+        from .utils.rarefaction import depth_grid, rarefaction_curves
+        counts = sparse.csr_matrix(np.random.default_rng(0).integers(0, 20, size=(6, 30)))
+        depths = depth_grid(100, 5)
+        
+        serial = rarefaction_curves(counts, list('abcdef'), depths, iterations=4, seed=7, workers=1)
+        parallel = rarefaction_curves(counts, list('abcdef'), depths, iterations=4, seed=7, workers=2)
+        self.assertEqual(serial, parallel)
+        self.assertNotEqual(serial, rarefaction_curves(counts, list('abcdef'), depths, iterations=4, seed=8))
+    
+    def test_rarefaction_api(self):
+        """Test the endpoint returns compact curves and caches them"""
+        url = f'/api/jobs/{self.job.job_id}/rarefaction/?steps=3&iterations=2'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['depths'], [1, 51, 101])
+        self.assertEqual(response.data['samples'], ['s1', 's2'])
+        self.assertEqual(response.data['observed']['mean'][1], [1.0, None, None])  # s2 has 20 reads
+        
+        with mock.patch('analysis.utils.rarefaction.rarefaction_curves') as curves:
+            self.assertEqual(self.client.get(url).data, response.data)
+            curves.assert_not_called()
+        
+        response = self.client.get(f'/api/jobs/{self.job.job_id}/rarefaction/?steps=1000')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+    
+    @override_settings(RAREFACTION_CACHE_SIZE=2)
+    def test_cache_is_bounded(self):
+        """Test the cache keeps the most recently used parameter sets of the current table only"""
+        from .utils.rarefaction import get_job_rarefaction
+        cache_dir = Path(self.temp_dir) / 'uploads' / str(self.job.job_id) / 'results' / 'rarefaction'
+        get_job_rarefaction(self.job, steps=3, iterations=2, seed=0)
+        for seed in range(1, 5):
+            get_job_rarefaction(self.job, steps=3, iterations=2, seed=seed)
+        self.assertEqual(len(list(cache_dir.iterdir())), 2)
+        
+        table = cache_dir.parent / 'dada2' / 'ASV_table.tsv'
+        table.write_text('ASV_ID\ts1\ts2\na\t5\t10\nb\t5\t0\n')
+        curves = get_job_rarefaction(self.job, steps=3, iterations=2, seed=4)
+        self.assertEqual(curves['depths'], [1, 6, 10])
+        self.assertEqual(len(list(cache_dir.iterdir())), 1)
+
+
+class TaxonomyLoaderTest(TestCase):
+    """Test the shared categorical taxonomy loader"""
+    
+    def setUp(self):
+        from .utils.taxonomy import clear_cache
+        clear_cache()
+        self.temp_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.temp_dir)
+        self.settings_override.enable()
+        self.job = AnalysisJob.objects.create(
+            project_name='Taxonomy', email='test@example.com', data_type='paired-end', status='completed'
+        )
+        AnalysisResult.objects.create(job=self.job)
+        dada2 = Path(self.temp_dir) / 'uploads' / str(self.job.job_id) / 'results' / 'dada2'
+        dada2.mkdir(parents=True)
+        self.path = dada2 / 'ASV_tax.gtdb.tsv'
+        self.path.write_text(
+            'ASV_ID\tKingdom\tPhylum\tClass\tOrder\tFamily\tGenus\tSpecies\tconfidence\tsequence\n'
+            'a\tBacteria\tFirmicutes\tBacilli\tBacillales\tBacillaceae\tBacillus\t\t1.0\tACGT\n'
+            'b\tBacteria\tFirmicutes\tBacilli\tBacillales\tBacillaceae\tBacillus\t\t1.0\tACGA\n'
+            'c\tBacteria\tProteobacteria\tGamma\tPseudomonadales\tPseudomonadaceae\tPseudomonas\t\t1.0\tTTGA\n'
+            'd\tBacteria\tProteobacteria\tGamma\t\t\t\t\t0.8\tTTGC\n'
+        )
+    
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_loads_requested_ranks_as_categoricals(self):
+        """Test only the requested ranks are loaded, as categoricals, without sequences"""
+        from .utils.taxonomy import load_taxonomy
+        table = load_taxonomy(self.path, ranks=['Phylum', 'Genus', 'Strain'])
+        self.assertEqual(list(table.columns), ['Phylum', 'Genus'])
+        self.assertEqual(table.index.name, 'ASV_ID')
+        self.assertEqual(str(table['Genus'].dtype), 'category')
+        self.assertEqual(list(table['Phylum'].cat.categories), ['Firmicutes', 'Proteobacteria'])
+        self.assertTrue(table['Genus'].isna()['d'])
+        
+        with_sequences = load_taxonomy(self.path, ranks=['Genus'], sequences=True)
+        self.assertEqual(with_sequences.loc['c', 'sequence'], 'TTGA')
+    
+    def test_cache_invalidated_on_change(self):
+        """Test parsed tables are reused until the file changes"""
+        from .utils.taxonomy import load_taxonomy
+        first = load_taxonomy(self.path)
+        self.assertIs(load_taxonomy(self.path), first)
+        
+        with open(self.path, 'a') as f:
+            f.write('e\tBacteria\tActinobacteriota\t\t\t\t\t\t0.9\tGGGG\n')
+        reloaded = load_taxonomy(self.path)
+        self.assertIsNot(reloaded, first)
+        self.assertEqual(len(reloaded), 5)
+    
+    def test_bacteria_endpoint(self):
+        """Test genus counts from the categorical table"""
+        response = APIClient().get(f'/api/jobs/{self.job.job_id}/bacteria/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['bacteria'][0], {
+            'genus': 'Bacillus', 'family': 'Bacillaceae', 'phylum': 'Firmicutes', 'total_reads': 2
+        })
+        self.assertEqual(response.data['total_count'], 2)
+
+
+class SequenceIndexTest(TestCase):
+    """Test the faidx index of ASV sequences and the sequence endpoints"""
+    
+    def setUp(self):
+        from .utils.sequences import clear_cache
+        clear_cache()
+        self.temp_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.temp_dir)
+        self.settings_override.enable()
+        self.client = APIClient()
+        self.job = AnalysisJob.objects.create(
+            project_name='Sequences', email='test@example.com', data_type='paired-end', status='completed'
+        )
+        dada2 = Path(self.temp_dir) / 'uploads' / str(self.job.job_id) / 'results' / 'dada2'
+        dada2.mkdir(parents=True)
+        self.fasta = dada2 / 'ASV_seqs.fasta'
+        # a: one line; b: wrapped at 4 bases
+        self.fasta.write_text('>a\nACGTACGTAC\n>b desc\nTTTT\nGGGG\nCC\n')
+        self.url = f'/api/jobs/{self.job.job_id}/asvs/'
+    
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_build_and_fetch(self):
+        """Test samtools-style index lines and reads of wrapped records"""
+        from .utils.sequences import SequenceIndexError, build_index, fetch_sequences, index_path
+        self.assertEqual(build_index(self.fasta), 2)
+        self.assertEqual(index_path(self.fasta).read_text(), 'a\t10\t3\t10\t11\nb\t10\t22\t4\t5\n')
+        
+        sequences, missing = fetch_sequences(self.fasta, ['b', 'x', 'a'])
+        self.assertEqual(sequences, {'a': 'ACGTACGTAC', 'b': 'TTTTGGGGCC'})
+        self.assertEqual(missing, ['x'])
+        
+        bad = Path(self.temp_dir) / 'bad.fasta'
+        bad.write_text('>c\nAC\nACGT\n')
+        with self.assertRaises(SequenceIndexError):
+            build_index(bad)
+    
+    def test_appended_records(self):
+        """Test only records appended after the indexed end are scanned"""
+        from .utils.sequences import SequenceIndexError, build_index, fetch_sequences
+        build_index(self.fasta)
+        indexed_size = self.fasta.stat().st_size
+        with open(self.fasta, 'a') as f:
+            f.write('>c\nAAAAT\n')
+        with self.assertRaises(SequenceIndexError):
+            fetch_sequences(self.fasta, ['c'])  # index does not reach the end of the file
+        
+        self.assertEqual(build_index(self.fasta, start=indexed_size), 1)
+        self.assertEqual(fetch_sequences(self.fasta, ['a', 'c'])[0], {'a': 'ACGTACGTAC', 'c': 'AAAAT'})
+    
+    def test_sequence_endpoints(self):
+        """Test single and bulk lookups, after backfilling the index"""
+        from django.core.management import call_command
+        response = self.client.get(f'{self.url}a/sequence/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)  # not indexed yet
+        
+        out = io.StringIO()
+        call_command('index_sequences', stdout=out)
+        self.assertIn('indexed=1 skipped=0', out.getvalue())
+        response = self.client.get(f'{self.url}b/sequence/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'asv_id': 'b', 'length': 10, 'sequence': 'TTTTGGGGCC'})
+        self.assertEqual(self.client.get(f'{self.url}x/sequence/').status_code, status.HTTP_404_NOT_FOUND)
+        
+        response = self.client.get(f'{self.url}sequences/?ids=a,x')
+        self.assertEqual(response.data['sequences'], {'a': 'ACGTACGTAC'})
+        self.assertEqual(response.data['missing'], ['x'])
+        response = self.client.post(f'{self.url}sequences/', {'ids': ['a', 'b']}, format='json')
+        self.assertEqual(set(response.data['sequences']), {'a', 'b'})
+        
+        with override_settings(SEQUENCE_LOOKUP_MAX_IDS=1):
+            response = self.client.post(f'{self.url}sequences/', {'ids': ['a', 'b']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class KmerIndexTest(TestCase):
+    """Test the cross-job k-mer index and sequence search"""
+    
+    SEQ_A = 'ACGTTGCAAGGCTTACCGATGCATGGACTTAGCCATGACG'
+    SEQ_B = 'TTGACCGTAGGCATCAGTTACGGATCCAAGTGCATTCAGG'
+    
+    def setUp(self):
+        from .utils.kmer_index import clear_cache
+        clear_cache()
+        self.temp_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.temp_dir, KMER_SIZE=11)
+        self.settings_override.enable()
+        self.client = APIClient()
+    
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def make_job(self, sequences):
+        job = AnalysisJob.objects.create(
+            project_name='Kmers', email='test@example.com', data_type='paired-end', status='completed'
+        )
+        dada2 = Path(self.temp_dir) / 'uploads' / str(job.job_id) / 'results' / 'dada2'
+        dada2.mkdir(parents=True)
+        (dada2 / 'ASV_seqs.fasta').write_text(''.join(f'>{a}\n{s}\n' for a, s in sequences.items()))
+        return job
+    
+    def test_encode_kmers(self):
+        """Test 2-bit k-mers skip windows across sequences and with ambiguous bases"""
+        from .utils.kmer_index import encode_kmers
+        kmers, owner = encode_kmers(['ACGT', 'TTNTT', 'GA'], 2)
+        # AC CG GT | TT TT (TN, NT skipped) | GA
+        self.assertEqual(kmers.tolist(), [0b0001, 0b0110, 0b1011, 0b1111, 0b1111, 0b1000])
+        self.assertEqual(owner.tolist(), [0, 0, 0, 1, 1, 2])
+    
+    def test_search_ranks_jobs(self):
+        """Test exact and one-mismatch queries find the job, and unrelated ones do not"""
+        from .utils.kmer_index import index_job, search
+        job_a = self.make_job({'a1': self.SEQ_A})
+        job_b = self.make_job({'b1': self.SEQ_B, 'b2': self.SEQ_A[:30] + self.SEQ_B[30:]})
+        self.assertEqual(index_job(job_a), 1)
+        self.assertEqual(index_job(job_b), 2)
+        self.assertEqual(index_job(job_a), 0)  # already indexed
+        
+        hits = search(self.SEQ_A)
+        self.assertEqual(hits['query_kmers'], 30)
+        self.assertEqual(hits['asvs'][0], (str(job_a.job_id), 'a1', 30))
+        self.assertEqual(hits['asvs'][1], (str(job_b.job_id), 'b2', 20))
+        self.assertEqual([job for job, _, _ in hits['jobs']], [str(job_a.job_id), str(job_b.job_id)])
+        
+        mutated = self.SEQ_A[:20] + 'T' + self.SEQ_A[21:]
+        self.assertEqual(search(mutated)['asvs'][0][1:], ('a1', 19))
+        self.assertEqual(search('CCCCCCCCCCCCCCCC')['asvs'], [])
+        with self.assertRaises(ValueError):
+            search('ACGT')
+    
+    @override_settings(KMER_MAX_SEGMENTS=2)
+    def test_segments_merged(self):
+        """Test merging segments keeps every job's postings"""
+        from .utils.kmer_index import index_job, load_index, search
+        jobs = [self.make_job({f'asv{i}': seq}) for i, seq in enumerate([self.SEQ_A, self.SEQ_B, self.SEQ_A[::-1]])]
+        for job in jobs:
+            index_job(job)
+        manifest, segments = load_index()
+        self.assertEqual(len(segments), 2)
+        self.assertEqual(len(manifest['jobs']), 3)
+        self.assertEqual(len(list((Path(self.temp_dir) / 'kmer_index').glob('seg-*'))), 2)
+        self.assertEqual(search(self.SEQ_B)['asvs'][0], (str(jobs[1].job_id), 'asv1', 30))
+        self.assertEqual(search(self.SEQ_A[::-1])['asvs'][0], (str(jobs[2].job_id), 'asv2', 30))
+    
+    @override_settings(KMER_MAX_POSTINGS=1)
+    def test_common_kmers_ignored(self):
+        """Test k-mers in more ASVs than KMER_MAX_POSTINGS do not score"""
+        from .utils.kmer_index import add_sequences, search
+        add_sequences('job', {'a': self.SEQ_A, 'b': self.SEQ_A[:20] + self.SEQ_B[20:]})
+        hits = search(self.SEQ_A)
+        self.assertEqual(hits['ignored_kmers'], 10)
+        self.assertEqual(hits['asvs'], [('job', 'a', 20)])
+    
+    def test_search_api(self):
+        """Test the endpoint, backfilled by the management command"""
+        from django.core.management import call_command
+        job = self.make_job({'a1': self.SEQ_A})
+        deleted = self.make_job({'x1': self.SEQ_A})
+        out = io.StringIO()
+        call_command('build_kmer_index', stdout=out)
+        self.assertIn('indexed_asvs=2', out.getvalue())
+        deleted.delete()
+        
+        response = self.client.get(f'/api/search/?sequence={self.SEQ_A}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['jobs'], [{
+            'job_id': str(job.job_id), 'project_name': 'Kmers',
+            'best_shared_kmers': 30, 'best_fraction': 1.0, 'matching_asvs': 1,
+        }])
+        self.assertEqual(response.data['asvs'][0]['asv_id'], 'a1')
+        
+        response = self.client.post('/api/search/', {'sequence': self.SEQ_A, 'limit': 1}, format='json')
+        self.assertEqual(len(response.data['asvs']), 1)
+        self.assertEqual(self.client.get('/api/search/?sequence=ACGT').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(f'/api/search/?sequence={self.SEQ_A}&limit=0').status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TaxonSearchTest(TestCase):
+    """Test the cross-job taxon index and its keyset-paginated search"""
+    
+    def setUp(self):
+        from .utils.compare import clear_cache
+        clear_cache()
+        self.temp_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.temp_dir)
+        self.settings_override.enable()
+        self.client = APIClient()
+    
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def make_job(self, counts, name='Taxa'):
+        """A completed job with one sample and an ASV per (phylum, genus): reads"""
+        job = AnalysisJob.objects.create(
+            project_name=name, email='test@example.com', data_type='paired-end', status='completed'
+        )
+        dada2 = Path(self.temp_dir) / 'uploads' / str(job.job_id) / 'results' / 'dada2'
+        dada2.mkdir(parents=True)
+        (dada2 / 'ASV_table.tsv').write_text(
+            'ASV_ID\ts1\n' + ''.join(f'asv{i}\t{reads}\n' for i, reads in enumerate(counts.values()))
+        )
+        (dada2 / 'ASV_tax.gtdb.tsv').write_text(
+            'ASV_ID\tPhylum\tGenus\n' + ''.join(f'asv{i}\t{p}\t{g}\n' for i, (p, g) in enumerate(counts))
+        )
+        return job
+    
+    def test_index_job_taxa(self):
+        """Test rows per rank with relative abundances, replaced on re-indexing"""
+        from .models import TaxonAbundance
+        from .utils.taxon_index import index_job_taxa
+        job = self.make_job({('Bacteroidota', 'Bacteroides'): 30, ('Bacteroidota', ''): 10, ('Bacillota', 'Bacillus'): 60})
+        self.assertEqual(index_job_taxa(job), 4)  # 2 phyla + 2 genera; the unnamed genus is left out
+        self.assertEqual(index_job_taxa(job), 4)
+        
+        genus = TaxonAbundance.objects.get(job=job, rank='genus', taxon='Bacteroides')
+        self.assertEqual((genus.reads, genus.relative_abundance, genus.taxon_key), (30, 0.3, 'bacteroides'))
+        self.assertEqual(TaxonAbundance.objects.get(job=job, rank='phylum', taxon='Bacteroidota').reads, 40)
+        self.assertEqual(index_job_taxa(AnalysisJob.objects.create(
+            project_name='Empty', email='test@example.com', data_type='paired-end', status='completed'
+        )), 0)
+    
+    def test_search_with_keyset_pages(self):
+        """Test prefix and abundance filters, and that pages follow one another without gaps"""
+        from .utils.taxon_index import index_job_taxa
+        jobs = [
+            self.make_job({('Bacteroidota', 'Bacteroides'): share, ('Bacillota', 'Bacillus'): 100 - share}, f'Study {share}')
+            for share in (2, 10, 40, 40, 90)
+        ]
+        for job in jobs:
+            index_job_taxa(job)
+        
+        url = '/api/taxa/?rank=genus&taxon=bacteroid&min_abundance=0.05&limit=2'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.data['results']
+        self.assertEqual([r['relative_abundance'] for r in results], [0.9, 0.4])
+        self.assertEqual(results[0]['project_name'], 'Study 90')
+        self.assertEqual(results[0]['taxon'], 'Bacteroides')
+        
+        while response.data['next_cursor']:
+            response = self.client.get(f"{url}&cursor={response.data['next_cursor']}")
+            results += response.data['results']
+        self.assertEqual([r['relative_abundance'] for r in results], [0.9, 0.4, 0.4, 0.1])
+        self.assertEqual(len({r['job_id'] for r in results}), 4)
+        
+        response = self.client.get('/api/taxa/?rank=genus&taxon=Bac')
+        self.assertEqual([r['taxon'] for r in response.data['results']][:6], ['Bacillus'] * 5 + ['Bacteroides'])
+        self.assertEqual(self.client.get('/api/taxa/?rank=kingdom').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get('/api/taxa/?cursor=nope').status_code, status.HTTP_400_BAD_REQUEST)
+    
+    def test_search_uses_composite_index(self):
+        """Test the search query is answered from the composite index"""
+        from django.db import connection
+        from .models import TaxonAbundance
+        rows = TaxonAbundance.objects.filter(
+            rank='genus', taxon_key__gte='bac', taxon_key__lt='bad', relative_abundance__gte=0.05
+        ).order_by('taxon_key', '-relative_abundance', 'id')
+        with connection.cursor() as cursor:
+            sql, params = rows.query.sql_with_params()
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            plan = ' '.join(str(row) for row in cursor.fetchall())
+        self.assertIn('taxon_search_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+class AsyncViewsTest(TestCase):
+    """Test the async read endpoints against their DRF counterparts"""
+    
+    def setUp(self):
+        from .utils.taxonomy import clear_cache
+        clear_cache()
+        self.temp_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.temp_dir)
+        self.settings_override.enable()
+        self.job = AnalysisJob.objects.create(
+            project_name='Async', email='test@example.com', data_type='paired-end', status='completed',
+            completed_at=timezone.now()
+        )
+        UploadedFile.objects.create(
+            job=self.job, file=SimpleUploadedFile('s1_R1.fastq.gz', b'reads'), file_name='s1_R1.fastq.gz', file_size=5
+        )
+        AnalysisResult.objects.create(job=self.job, execution_time=12.5)
+        dada2 = Path(self.temp_dir) / 'uploads' / str(self.job.job_id) / 'results' / 'dada2'
+        dada2.mkdir(parents=True)
+        (dada2 / 'ASV_tax.gtdb.tsv').write_text(
+            'ASV_ID\tKingdom\tPhylum\tClass\tOrder\tFamily\tGenus\tSpecies\tconfidence\tsequence\n'
+            'a\tBacteria\tFirmicutes\tBacilli\tBacillales\tBacillaceae\tBacillus\t\t1.0\tACGT\n'
+            'b\tBacteria\tFirmicutes\tBacilli\tBacillales\tBacillaceae\tBacillus\t\t1.0\tACGA\n'
+            'c\tBacteria\tProteobacteria\tGamma\tPseudomonadales\tPseudomonadaceae\tPseudomonas\t\t1.0\tTTGA\n'
+        )
+        self.pending = AnalysisJob.objects.create(
+            project_name='Pending', email='test@example.com', data_type='paired-end'
+        )
+    
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    async def assert_same_response(self, job, endpoint):
+        from django.test import AsyncClient
+        from asgiref.sync import sync_to_async
+        expected = await sync_to_async(APIClient().get)(f'/api/jobs/{job.job_id}/{endpoint}')
+        response = await AsyncClient().get(f'/api/async/jobs/{job.job_id}/{endpoint}')
+        self.assertEqual(response.status_code, expected.status_code)
+        self.assertEqual(response.json(), expected.json())
+        return response
+    
+    async def test_matches_sync_endpoints(self):
+        """Test detail, status, results and bacteria return what the DRF endpoints return"""
+        for endpoint in ['', 'status/', 'results/', 'bacteria/']:
+            with self.subTest(endpoint=endpoint):
+                response = await self.assert_same_response(self.job, endpoint)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+        
+        response = await self.assert_same_response(self.job, '')
+        self.assertEqual(response.json()['files'][0]['file_name'], 's1_R1.fastq.gz')
+        response = await self.assert_same_response(self.job, 'bacteria/')
+        self.assertEqual(response.json()['total_count'], 2)
+    
+    async def test_errors_match_sync_endpoints(self):
+        """Test incomplete jobs, missing results and unknown jobs"""
+        for endpoint in ['results/', 'bacteria/']:
+            with self.subTest(endpoint=endpoint):
+                response = await self.assert_same_response(self.pending, endpoint)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        
+        from django.test import AsyncClient
+        for job_id in [uuid.uuid4(), 'not-a-uuid']:
+            with self.subTest(job_id=job_id):
+                response = await AsyncClient().get(f'/api/async/jobs/{job_id}/status/')
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+                self.assertIn('detail', response.json())
+        
+        response = await AsyncClient().post(f'/api/async/jobs/{self.job.job_id}/status/')
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+    
+    def test_no_data(self):
+        """Test a completed job without a taxonomy table"""
+        shutil.rmtree(Path(self.temp_dir) / 'uploads')
+        from asgiref.sync import async_to_sync
+        response = async_to_sync(self.assert_same_response)(self.job, 'bacteria/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+    
+    def test_middleware_stays_async(self):
+        """Test no middleware forces ASGI requests onto a thread"""
+        from django.core.handlers.asgi import ASGIHandler
+        # Adapted middleware is only logged with DEBUG on
+        with override_settings(DEBUG=True), self.assertNoLogs('django.request', level='DEBUG'):
+            ASGIHandler().load_middleware(is_async=True)
+
+
+class AsyncHandlerTest(TransactionTestCase):
+    """Test the ASGI routing of /api/async/ (requests run on threads of their own, so data is committed)"""
+    
+    async def get(self, path, app=None, headers=()):
+        from asgiref.testing import ApplicationCommunicator
+        from mysite.asgi import application
+        communicator = ApplicationCommunicator(app or application, {
+            'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'scheme': 'http',
+            'headers': [(b'host', b'testserver'), *headers],
+        })
+        await communicator.send_input({'type': 'http.request'})
+        start, body = await communicator.receive_output(), b''
+        while True:
+            message = await communicator.receive_output()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                headers = {name.lower(): value for name, value in start['headers']}
+                return start['status'], headers, body
+    
+    async def test_async_api_skips_sync_middleware(self):
+        """Test /api/async/ is served by ASYNC_MIDDLEWARE only, and other paths by the full stack"""
+        from django.conf import settings
+        from mysite.asgi import AsyncAPIHandler
+        
+        job = await AnalysisJob.objects.acreate(
+            project_name='Async', email='test@example.com', data_type='paired-end', status='completed'
+        )
+        code, headers, body = await self.get(f'/api/async/jobs/{job.job_id}/status/')
+        self.assertEqual((code, json.loads(body)['status']), (200, 'completed'))
+        self.assertNotIn(b'x-frame-options', headers)  # XFrameOptionsMiddleware did not run
+        self.assertEqual(headers[b'x-content-type-options'], b'nosniff')  # SecurityMiddleware did
+        code, headers, body = await self.get('/api/no-such-endpoint/')
+        self.assertEqual(code, 404)
+        self.assertIn(b'x-frame-options', headers)
+        
+        middleware = list(settings.MIDDLEWARE)
+        with override_settings(DEBUG=True), self.assertNoLogs('django.request', level='DEBUG'):
+            AsyncAPIHandler()
+        self.assertEqual(settings.MIDDLEWARE, middleware)
+        # Each request keeps its own ThreadSensitiveContext (a thread for its ORM calls)
+        from django.core.handlers.asgi import ASGIHandler
+        self.assertIs(AsyncAPIHandler.__call__, ASGIHandler.__call__)
+    
+    async def test_async_api_security_and_staff_profiling(self):
+        """Test /api/async/ keeps the SSL redirect and recognises staff users for profiling"""
+        from django.contrib.auth.models import User
+        from django.test import AsyncClient
+        from mysite.asgi import AsyncAPIHandler
+        
+        job = await AnalysisJob.objects.acreate(
+            project_name='Async', email='test@example.com', data_type='paired-end', status='completed'
+        )
+        url = f'/api/async/jobs/{job.job_id}/status/'
+        with override_settings(SECURE_SSL_REDIRECT=True):
+            code, headers, _ = await self.get(url, app=AsyncAPIHandler())
+        self.assertEqual((code, headers[b'location']), (301, f'https://testserver{url}'.encode()))
+        
+        admin = await User.objects.acreate_superuser('admin', 'admin@example.com', 'password')
+        client = AsyncClient()
+        await client.aforce_login(admin)
+        cookie = f"sessionid={client.cookies['sessionid'].value}".encode()
+        code, headers, _ = await self.get(url, headers=[(b'cookie', cookie), (b'x-profile', b'1')])
+        self.assertEqual(code, 200)
+        self.assertTrue(await Profile.objects.filter(pk=int(headers[b'x-profile-id'])).aexists())
+
+
+class JobWritesTest(TransactionTestCase):
+    """Test job state writes through the coalescing writer"""
+    
+    def sample(self, name):
+        from prometheus_client import REGISTRY
+        return REGISTRY.get_sample_value(name) or 0
+    
+    def make_job(self, name='Writes'):
+        return AnalysisJob.objects.create(project_name=name, email='test@example.com', data_type='paired-end')
+    
+    def in_thread(self, target, *args, **kwargs):
+        """Run target on a thread with its own database connection"""
+        from django.db import connection
+        import threading
+        errors = []
+        
+        def run():
+            try:
+                target(*args, **kwargs)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+        
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread, errors
+    
+    def test_no_lost_updates(self):
+        """Test writers holding stale copies of a job keep each other's fields"""
+        from .utils.job_writes import update_job
+        job = self.make_job()
+        stale = AnalysisJob.objects.get(pk=job.pk)
+        
+        update_job(job, status='processing', executor='local')
+        update_job(stale, preview_status='running')
+        
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.executor, job.preview_status), ('processing', 'local', 'running'))
+        self.assertEqual(stale.status, 'pending')  # only the given fields are set on the instance
+    
+    def test_concurrent_updates_share_a_commit(self):
+        """Test updates queued while the writer is busy are written in one transaction"""
+        from .utils import job_writes
+        jobs = [self.make_job(f'Job {i}') for i in range(5)]
+        before = self.sample('microbiome_job_write_batch_jobs_count')
+        
+        with job_writes._writer_lock:
+            threads = [self.in_thread(job_writes.update_job, job, status='processing') for job in jobs]
+            deadline = time.monotonic() + 5
+            while len(job_writes._pending) < len(jobs) and time.monotonic() < deadline:
+                time.sleep(0.01)
+        for thread, errors in threads:
+            thread.join()
+            self.assertEqual(errors, [])
+        
+        self.assertEqual(self.sample('microbiome_job_write_batch_jobs_count'), before + 1)
+        self.assertEqual(AnalysisJob.objects.filter(status='processing').count(), len(jobs))
+    
+    @override_settings(JOB_WRITE_RETRIES=2)
+    def test_retries_when_locked(self):
+        """Test a locked database is retried, and counted"""
+        from django.db import OperationalError
+        from django.db.models import QuerySet
+        from .utils.job_writes import update_job
+        job = self.make_job()
+        update = QuerySet.update
+        attempts = []
+        
+        def locked_once(queryset, **kwargs):
+            attempts.append(kwargs)
+            if len(attempts) == 1:
+                raise OperationalError('database is locked')
+            return update(queryset, **kwargs)
+        
+        retries = self.sample('microbiome_db_lock_retries_total')
+        with mock.patch.object(QuerySet, 'update', locked_once), mock.patch('time.sleep'):
+            update_job(job, status='failed', error_message='Upload aborted')
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(self.sample('microbiome_db_lock_retries_total'), retries + 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        
+        errors = self.sample('microbiome_db_lock_errors_total')
+        with mock.patch.object(QuerySet, 'update', side_effect=OperationalError('database is locked')), \
+                mock.patch('time.sleep'):
+            with self.assertRaises(OperationalError):
+                update_job(job, status='completed')
+        self.assertEqual(self.sample('microbiome_db_lock_errors_total'), errors + 1)
+        
+        # The failed update is written with the next one
+        update_job(job, error_message='')
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error_message), ('completed', ''))
+    
+    def test_twenty_concurrent_jobs(self):
+        """Test 20 jobs moving through their states at once lose no update"""
+        from .utils.job_writes import update_job
+        jobs = [self.make_job(f'Job {i}') for i in range(20)]
+        
+        def lifecycle(job, stale):
+            update_job(job, primer_set='515F-806R', primer_match_fraction=0.9)
+            update_job(job, status='processing', executor='local')
+            for state in ['pending', 'running', 'completed']:
+                update_job(stale, preview_status=state)
+            update_job(job, status='completed', completed_at=timezone.now())
+        
+        # Stale copies, as another thread would hold. They are loaded up front:
+        # the test database is in-memory SQLite with a shared cache, where a
+        # read during a write fails at once
+        stale = [AnalysisJob.objects.get(pk=job.pk) for job in jobs]
+        threads = [self.in_thread(lifecycle, job, copy) for job, copy in zip(jobs, stale)]
+        for thread, errors in threads:
+            thread.join()
+            self.assertEqual(errors, [])
+        
+        for job in AnalysisJob.objects.all():
+            self.assertEqual(
+                (job.status, job.executor, job.primer_set, job.preview_status),
+                ('completed', 'local', '515F-806R', 'completed'),
+            )
+            self.assertIsNotNone(job.completed_at)
+
+
+STUB_NEXTFLOW = Path(__file__).resolve().parents[3] / 'benchmarks' / 'stub_nextflow' / 'nextflow'
+
+
+@skipUnless(STUB_NEXTFLOW.exists(), "benchmarks/stub_nextflow is not available")
+class StubNextflowRunTest(TestCase):
+    """Test the whole local orchestration path against the stub nextflow"""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.temp_dir, NEXTFLOW_BIN=str(STUB_NEXTFLOW))
+        self.settings_override.enable()
+        self.env = mock.patch.dict(os.environ, {'STUB_NEXTFLOW_DURATION': '0', 'STUB_NEXTFLOW_PUBLISH': 'symlink'})
+        self.env.start()
+        self.job = AnalysisJob.objects.create(
+            project_name='Stub run', email='test@example.com', data_type='paired-end'
+        )
+        for name in ['s1_R1_001.fastq.gz', 's1_R2_001.fastq.gz']:
+            if '_R1' in name:
+                content = make_fastq(mate=1, length=60, prefix=V4_FORWARD)
+            else:
+                content = make_fastq(mate=2, length=60, prefix=V4_REVERSE)
+            UploadedFile.objects.create(
+                job=self.job, file=SimpleUploadedFile(name, content), file_name=name, file_size=len(content)
+            )
+    
+    def tearDown(self):
+        self.env.stop()
+        self.settings_override.disable()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+    
+    def test_api_upload_runs_to_completion(self):
+        """Test an API upload (stored under uploads/%Y/%m/%d/) completes and is ingested"""
+        run_nextflow_analysis(self.job.job_id)
+        
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, 'completed', self.job.error_message)
+        self.assertIsNotNone(self.job.result.execution_time)
+        self.assertTrue(self.job.process_metrics.exists())
+        self.assertEqual(self.job.primer_set, '515F-806R')
+        samplesheet = (Path(self.temp_dir) / 'uploads' / str(self.job.job_id) / 'samplesheet.csv').read_text()
+        self.assertIn('s1_R1_001.fastq.gz', samplesheet)
+    
+    @override_settings(PREVIEW_READ_PAIRS=2)
+    def test_preview_then_full_run(self):
+        """Test a preview job publishes a genus composition from sampled reads, then completes"""
+        from .utils.fastq import scan_fastq
+        self.job.preview = True
+        self.job.preview_status = 'pending'
+        self.job.save()
+        
+        run_nextflow_analysis(self.job.job_id)
+        
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, 'completed', self.job.error_message)
+        self.assertEqual(self.job.preview_status, 'completed')
+        self.assertIsNotNone(self.job.preview_completed_at)
+        preview_dir = Path(self.temp_dir) / 'uploads' / str(self.job.job_id) / 'preview'
+        self.assertEqual(scan_fastq(preview_dir / 'reads' / 's1_R1_001.fastq.gz')['read_count'], 2)
+        self.assertTrue((preview_dir / 'results' / 'dada2' / 'ASV_table.tsv').exists())
+        
+        response = APIClient().get(f'/api/jobs/{self.job.job_id}/preview/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['read_pairs_sampled'], 2)
+        top = response.data['bacteria'][0]
+        self.assertEqual(set(top), {'genus', 'family', 'phylum', 'reads', 'percent'})
+        self.assertAlmostEqual(sum(b['percent'] for b in response.data['bacteria']), 100, delta=1)
+    
+    def test_pipeline_failure(self):
+        """Test a non-zero nextflow exit fails the job with its stderr"""
+        with mock.patch.dict(os.environ, {'STUB_NEXTFLOW_EXIT': '1'}):
+            run_nextflow_analysis(self.job.job_id)
+        
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, 'failed')
+        self.assertIn('Stub pipeline failed', self.job.error_message)
+
+
 class APIIntegrationTest(TestCase):
     """Integration tests for complete workflow"""
     
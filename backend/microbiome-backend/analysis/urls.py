@@ -1,10 +1,28 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import AnalysisJobViewSet
+from . import async_views
+from .views import (
+    AnalysisJobViewSet, UploadSessionViewSet, ProcessMetricViewSet, CompareViewSet,
+    SequenceSearchViewSet, TaxonSearchViewSet
+)
 
 router = DefaultRouter()
 router.register(r'jobs', AnalysisJobViewSet, basename='analysisjob')
+router.register(r'upload-sessions', UploadSessionViewSet, basename='uploadsession')
+router.register(r'process-metrics', ProcessMetricViewSet, basename='processmetric')
+router.register(r'compare', CompareViewSet, basename='compare')
+router.register(r'search', SequenceSearchViewSet, basename='search')
+router.register(r'taxa', TaxonSearchViewSet, basename='taxa')
+
+# Async versions of the read endpoints polled by clients (see async_views)
+async_urlpatterns = [
+    path('jobs/<str:job_id>/', async_views.job_detail, name='async-job-detail'),
+    path('jobs/<str:job_id>/status/', async_views.job_status, name='async-job-status'),
+    path('jobs/<str:job_id>/results/', async_views.job_results, name='async-job-results'),
+    path('jobs/<str:job_id>/bacteria/', async_views.job_bacteria, name='async-job-bacteria'),
+]
 
 urlpatterns = [
     path('', include(router.urls)),
+    path('async/', include(async_urlpatterns)),
 ]
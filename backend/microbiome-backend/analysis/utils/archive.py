@@ -0,0 +1,290 @@
+"""
+Streaming zip / tar.gz export of a job's results directory
+"""
+import hashlib
+import logging
+import os
+import tarfile
+import tempfile
+import zipfile
+import zlib
+from pathlib import Path
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FORMATS = {
+    'zip': 'application/zip',
+    'tar.gz': 'application/gzip',
+}
+
+# Files that are already compressed are stored as-is in zip archives
+PRECOMPRESSED_SUFFIXES = (
+    '.gz', '.bz2', '.xz', '.zip', '.png', '.jpg', '.jpeg', '.rds',
+    '.qza', '.qzv', '.parquet', '.pdf',
+)
+
+CHUNK_SIZE = 1024 * 1024  # 1 MB
+TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+TAR_RECORD_SIZE = tarfile.RECORDSIZE
+
+
+def get_results_dir(job):
+    """Results directory written by Nextflow for a job"""
+    return Path(settings.MEDIA_ROOT) / 'uploads' / str(job.job_id) / 'results'
+
+
+def get_archive_cache_dir(job):
+    """Directory holding finished archives for a job"""
+    return Path(settings.MEDIA_ROOT) / 'archives' / str(job.job_id)
+
+
+def _normalize_prefixes(prefixes):
+    """Turn 'dada2, qiime2/' style filters into clean relative prefixes"""
+    cleaned = []
+    for prefix in prefixes or []:
+        prefix = prefix.strip().strip('/')
+        if not prefix:
+            continue
+        if prefix.startswith('.') or '..' in Path(prefix).parts:
+            raise ValueError(f"Invalid subdirectory filter: {prefix}")
+        cleaned.append(prefix)
+    return cleaned
+
+
+def _matches(rel_path, prefixes):
+    return any(rel_path == p or rel_path.startswith(p + '/') for p in prefixes)
+
+
+def build_catalog(results_dir, include=None, exclude=None):
+    """
+    List the files to archive, honouring subdirectory filters.
+
+    Returns:
+        Sorted list of (relative_path, absolute_path, size, mtime_ns)
+    """
+    results_dir = Path(results_dir)
+    include = _normalize_prefixes(include)
+    exclude = _normalize_prefixes(exclude)
+
+    catalog = []
+    for root, dirs, files in os.walk(results_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = Path(root) / name
+            rel_path = path.relative_to(results_dir).as_posix()
+            if include and not _matches(rel_path, include):
+                continue
+            if exclude and _matches(rel_path, exclude):
+                continue
+            stat = path.stat()
+            catalog.append((rel_path, path, stat.st_size, stat.st_mtime_ns))
+    return catalog
+
+
+def catalog_checksum(catalog, archive_format):
+    """Checksum identifying an archive built from a given catalog"""
+    digest = hashlib.sha256(archive_format.encode())
+    for rel_path, _, size, mtime_ns in catalog:
+        digest.update(f"{rel_path}\0{size}\0{mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def is_precompressed(name):
+    return name.lower().endswith(PRECOMPRESSED_SUFFIXES)
+
+
+class _StreamBuffer:
+    """
+    Write-only file object used as the zipfile target.
+
+    It has tell() but no seek(), so zipfile writes data descriptors
+    instead of seeking back, and written bytes are drained by the
+    generator after every chunk.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_zip(catalog, root_name, chunk_size=CHUNK_SIZE):
+    """Yield a zip archive of the catalog chunk by chunk"""
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, mode='w', allowZip64=True) as zf:
+        for rel_path, path, _, _ in catalog:
+            zinfo = zipfile.ZipInfo.from_file(path, f"{root_name}/{rel_path}")
+            if is_precompressed(rel_path):
+                zinfo.compress_type = zipfile.ZIP_STORED
+            else:
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+            with open(path, 'rb') as src, zf.open(zinfo, mode='w') as dst:
+                while True:
+                    chunk = src.read(chunk_size)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            data = buffer.drain()
+            if data:
+                yield data
+    data = buffer.drain()
+    if data:
+        yield data
+
+
+def iter_tar_gz(catalog, root_name, chunk_size=CHUNK_SIZE):
+    """
+    Yield a gzip-compressed tar archive of the catalog chunk by chunk.
+
+    Members are written directly (header, data, block padding) so that
+    no file is ever held in memory as a whole.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31 = gzip container
+    written = 0
+    for rel_path, path, size, mtime_ns in catalog:
+        tarinfo = tarfile.TarInfo(f"{root_name}/{rel_path}")
+        tarinfo.size = size
+        tarinfo.mtime = mtime_ns // 1_000_000_000
+        tarinfo.mode = 0o644
+        header = tarinfo.tobuf(format=tarfile.PAX_FORMAT)
+        written += len(header)
+        yield compressor.compress(header)
+
+        remaining = size
+        with open(path, 'rb') as src:
+            while remaining > 0:
+                chunk = src.read(min(chunk_size, remaining))
+                if not chunk:
+                    raise IOError(f"{rel_path} shrank while being archived")
+                remaining -= len(chunk)
+                written += len(chunk)
+                data = compressor.compress(chunk)
+                if data:
+                    yield data
+
+        padding = -size % TAR_BLOCK_SIZE
+        if padding:
+            written += padding
+            yield compressor.compress(b'\0' * padding)
+
+    # End-of-archive marker, padded up to a full record like tarfile does
+    trailer = b'\0' * (2 * TAR_BLOCK_SIZE)
+    written += len(trailer)
+    trailer += b'\0' * (-written % TAR_RECORD_SIZE)
+    yield compressor.compress(trailer) + compressor.flush()
+
+
+def _cache_and_stream(chunks, cache_path):
+    """
+    Pass chunks through while writing them to the archive cache.
+
+    The cache file only appears under its final name once the archive is
+    complete; an interrupted download leaves nothing behind. Each download
+    writes its own temporary file, so concurrent first downloads of the
+    same archive never write into, or delete, each other's.
+    """
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        cache_file = tempfile.NamedTemporaryFile(
+            dir=cache_path.parent, prefix=f'.{cache_path.name}.', suffix='.part', delete=False
+        )
+        partial_path = Path(cache_file.name)
+    except OSError as e:
+        logger.warning(f"Archive cache unavailable ({e}), streaming without cache")
+        yield from chunks
+        return
+
+    completed = False
+    try:
+        with cache_file:
+            for chunk in chunks:
+                cache_file.write(chunk)
+                yield chunk
+        completed = True
+    finally:
+        if completed:
+            os.replace(partial_path, cache_path)
+            _evict_stale_archives(cache_path)
+            logger.info(f"Cached results archive {cache_path}")
+        else:
+            partial_path.unlink(missing_ok=True)
+
+
+def _evict_stale_archives(cache_path):
+    """Drop archives built from older catalogs with the same filters and format"""
+    filters_key, _, rest = cache_path.name.partition('-')
+    suffix = rest.partition('.')[2]
+    for other in cache_path.parent.glob(f"{filters_key}-*.{suffix}"):
+        if other != cache_path:
+            other.unlink(missing_ok=True)
+
+
+def get_results_archive(job, archive_format='zip', include=None, exclude=None, use_cache=True):
+    """
+    Prepare a results archive for a job.
+
+    Returns:
+        dict with filename, content_type and either 'path' (a cached
+        archive to serve directly) or 'stream' (a generator of bytes).
+
+    Raises:
+        ValueError: unknown format or invalid filters
+        FileNotFoundError: no results directory, or nothing matched
+    """
+    if archive_format not in ARCHIVE_FORMATS:
+        raise ValueError(f"Unsupported archive format: {archive_format}")
+
+    results_dir = get_results_dir(job)
+    if not results_dir.is_dir():
+        raise FileNotFoundError(f"No results directory for job {job.job_id}")
+
+    catalog = build_catalog(results_dir, include=include, exclude=exclude)
+    if not catalog:
+        raise FileNotFoundError("No result files matched the requested filters")
+
+    root_name = f"results_{job.job_id}"
+    filename = f"{root_name}.{archive_format}"
+    archive = {'filename': filename, 'content_type': ARCHIVE_FORMATS[archive_format]}
+
+    if archive_format == 'zip':
+        chunks = iter_zip(catalog, root_name)
+    else:
+        chunks = iter_tar_gz(catalog, root_name)
+
+    if not use_cache:
+        archive['stream'] = chunks
+        return archive
+
+    # Cached name: <filters key>-<catalog checksum>.<format>
+    checksum = catalog_checksum(catalog, archive_format)
+    filters_key = hashlib.sha256(
+        repr((sorted(_normalize_prefixes(include)), sorted(_normalize_prefixes(exclude)))).encode()
+    ).hexdigest()[:16]
+    cache_path = get_archive_cache_dir(job) / f"{filters_key}-{checksum[:32]}.{archive_format}"
+
+    if cache_path.exists():
+        logger.info(f"Serving cached results archive {cache_path}")
+        chunks.close()
+        archive['path'] = cache_path
+    else:
+        archive['stream'] = _cache_and_stream(chunks, cache_path)
+    return archive
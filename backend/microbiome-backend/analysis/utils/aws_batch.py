@@ -1,19 +1,51 @@
 """
 AWS Batch integration for running Nextflow pipelines
 """
-import boto3
 import logging
+import random
+import time
 from django.conf import settings
+from .job_writes import update_job
+from .primers import DEFAULT_PRIMER_PAIR, get_primer_pair
 
 logger = logging.getLogger(__name__)
 
+# describe_jobs accepts at most 100 job IDs per call
+DESCRIBE_JOBS_CHUNK_SIZE = 100
+
+# Error codes worth retrying with backoff
+RETRYABLE_ERRORS = {
+    'TooManyRequestsException',
+    'ThrottlingException',
+    'Throttling',
+    'RequestLimitExceeded',
+    'ServiceUnavailable',
+    'InternalServerError',
+}
+
 
 class AWSBatchClient:
     """Client for submitting and monitoring AWS Batch jobs"""
     
     def __init__(self):
-        self.batch = boto3.client('batch', region_name=settings.AWS_S3_REGION_NAME)
-        self.s3 = boto3.client('s3', region_name=settings.AWS_S3_REGION_NAME)
+        # boto3 clients are created on first use, so importing this module
+        # costs nothing on hosts that never run Batch jobs
+        self._batch = None
+        self._s3 = None
+    
+    @property
+    def batch(self):
+        if self._batch is None:
+            import boto3
+            self._batch = boto3.client('batch', region_name=settings.AWS_S3_REGION_NAME)
+        return self._batch
+    
+    @property
+    def s3(self):
+        if self._s3 is None:
+            import boto3
+            self._s3 = boto3.client('s3', region_name=settings.AWS_S3_REGION_NAME)
+        return self._s3
     
     def submit_nextflow_job(self, job_id, input_files, metadata):
         """
@@ -43,6 +75,8 @@ class AWSBatchClient:
                     '-profile', 'aws',
                     '--input', f's3://{settings.AWS_STORAGE_BUCKET_NAME}/uploads/{job_id}/',
                     '--outdir', f's3://{settings.AWS_STORAGE_BUCKET_NAME}/results/{job_id}/',
+                    '--FW_primer', metadata.get('fw_primer', DEFAULT_PRIMER_PAIR.forward),
+                    '--RV_primer', metadata.get('rv_primer', DEFAULT_PRIMER_PAIR.reverse),
                     '--max_cpus', '4',
                     '--max_memory', '8.GB',
                 ]
@@ -87,6 +121,42 @@ class AWSBatchClient:
             logger.error(f"Failed to get Batch job status for {batch_job_id}: {e}")
             return None
     
+    def describe_jobs(self, batch_job_ids, max_retries=5, base_delay=1.0):
+        """
+        Describe many Batch jobs with one API call per 100 IDs
+        
+        Throttled calls are retried with exponential backoff and jitter.
+        
+        Returns:
+            dict mapping Batch job ID -> job description (IDs unknown to
+            Batch are missing from the result)
+        """
+        from botocore.exceptions import ClientError
+        
+        batch_job_ids = list(dict.fromkeys(batch_job_ids))
+        descriptions = {}
+        
+        for start in range(0, len(batch_job_ids), DESCRIBE_JOBS_CHUNK_SIZE):
+            chunk = batch_job_ids[start:start + DESCRIBE_JOBS_CHUNK_SIZE]
+            attempt = 0
+            while True:
+                try:
+                    response = self.batch.describe_jobs(jobs=chunk)
+                    break
+                except ClientError as e:
+                    code = e.response.get('Error', {}).get('Code')
+                    if code not in RETRYABLE_ERRORS or attempt >= max_retries:
+                        raise
+                    delay = base_delay * (2 ** attempt) * random.uniform(0.5, 1.0)
+                    logger.warning(f"describe_jobs throttled ({code}), retrying in {delay:.1f}s")
+                    time.sleep(delay)
+                    attempt += 1
+            
+            for job in response.get('jobs', []):
+                descriptions[job['jobId']] = job
+        
+        return descriptions
+    
     def cancel_job(self, batch_job_id, reason="Cancelled by user"):
         """Cancel a running Batch job"""
         try:
@@ -101,5 +171,26 @@ class AWSBatchClient:
             return False
 
 
-# Singleton instance
+# Singleton instance (boto3 clients are created on first use)
 batch_client = AWSBatchClient()
+
+
+def submit_batch_analysis(job, client=None):
+    """
+    Submit an AnalysisJob to AWS Batch and persist the Batch job ID
+    so the reconciler can track it
+    """
+    client = client or batch_client
+    primers = get_primer_pair(job.primer_set)
+    batch_job_id = client.submit_nextflow_job(
+        job.job_id,
+        [f"s3://{settings.AWS_STORAGE_BUCKET_NAME}/uploads/{job.job_id}/{f.file_name}" for f in job.files.all()],
+        {
+            'project_name': job.project_name,
+            'data_type': job.data_type,
+            'fw_primer': primers.forward,
+            'rv_primer': primers.reverse,
+        },
+    )
+    update_job(job, batch_job_id=batch_job_id, batch_status='SUBMITTED')
+    return batch_job_id
@@ -0,0 +1,132 @@
+"""
+Sync AWS Batch job state back to AnalysisJob rows in bulk
+"""
+import logging
+from django.utils import timezone
+from ..models import AnalysisJob
+from .ingest import ingest_results
+
+logger = logging.getLogger(__name__)
+
+# AWS Batch status -> AnalysisJob status
+BATCH_STATUS_MAP = {
+    'SUBMITTED': 'pending',
+    'PENDING': 'pending',
+    'RUNNABLE': 'pending',
+    'STARTING': 'processing',
+    'RUNNING': 'processing',
+    'SUCCEEDED': 'completed',
+    'FAILED': 'failed',
+}
+
+IN_FLIGHT_STATUSES = ['pending', 'processing']
+
+
+def ingest_batch_results(job, description):
+    """
+    Default success hook: download and ingest the results of a finished Batch job
+    """
+    from .executors import get_executor
+    results_dir = get_executor('batch').fetch_outputs(job)
+    if not results_dir.is_dir():
+        raise FileNotFoundError(f"Results directory {results_dir} not found")
+    
+    execution_time = None
+    if description.get('startedAt') and description.get('stoppedAt'):
+        execution_time = (description['stoppedAt'] - description['startedAt']) / 1000.0
+    
+    ingest_results(job, results_dir, execution_time=execution_time)
+
+
+def reconcile_batch_jobs(client=None, on_success=None):
+    """
+    Poll every in-flight Batch job and sync its state to the database
+    
+    All jobs are described in chunks of 100 (one API call per chunk) and
+    state changes are written with bulk updates. Jobs that SUCCEEDED are
+    passed to on_success(job, description) before being marked completed;
+    if that raises, the job is marked failed.
+    
+    Returns:
+        dict with checked, updated, completed, failed and missing counts
+    """
+    if client is None:
+        from .aws_batch import batch_client as client
+    on_success = on_success or ingest_batch_results
+    
+    stats = {'checked': 0, 'updated': 0, 'completed': 0, 'failed': 0, 'missing': 0}
+    
+    jobs = {
+        job.batch_job_id: job
+        for job in AnalysisJob.objects.filter(
+            status__in=IN_FLIGHT_STATUSES,
+            batch_job_id__isnull=False,
+        ).exclude(batch_job_id='')
+    }
+    if not jobs:
+        return stats
+    
+    descriptions = client.describe_jobs(list(jobs))
+    stats['checked'] = len(jobs)
+    now = timezone.now()
+    
+    changed = []
+    succeeded = []
+    for batch_job_id, job in jobs.items():
+        description = descriptions.get(batch_job_id)
+        if description is None:
+            stats['missing'] += 1
+            logger.warning(f"Batch job {batch_job_id} for job {job.job_id} not found")
+            continue
+        
+        batch_status = description['status']
+        if batch_status == 'SUCCEEDED':
+            succeeded.append((job, description))
+            continue
+        
+        new_status = BATCH_STATUS_MAP.get(batch_status, job.status)
+        if batch_status == job.batch_status and new_status == job.status:
+            continue
+        
+        job.batch_status = batch_status
+        job.status = new_status
+        job.updated_at = now
+        if new_status == 'failed':
+            reason = description.get('statusReason') or 'AWS Batch job failed'
+            job.error_message = f"AWS Batch error: {reason}"[:500]
+            stats['failed'] += 1
+        changed.append(job)
+    
+    if changed:
+        AnalysisJob.objects.bulk_update(
+            changed, ['status', 'batch_status', 'error_message', 'updated_at'], batch_size=500
+        )
+    
+    # Ingestion is per job; the state change is still written in bulk
+    for job, description in succeeded:
+        try:
+            on_success(job, description)
+            job.status = 'completed'
+            job.completed_at = now
+            stats['completed'] += 1
+        except Exception as e:
+            logger.exception(f"Result ingestion failed for job {job.job_id}: {e}")
+            job.status = 'failed'
+            job.error_message = f"Result ingestion failed: {e}"[:500]
+            stats['failed'] += 1
+        job.batch_status = 'SUCCEEDED'
+        job.updated_at = now
+    
+    if succeeded:
+        AnalysisJob.objects.bulk_update(
+            [job for job, _ in succeeded],
+            ['status', 'batch_status', 'error_message', 'completed_at', 'updated_at'],
+            batch_size=500,
+        )
+    
+    stats['updated'] = len(changed) + len(succeeded)
+    logger.info(
+        f"Reconciled {stats['checked']} Batch jobs: {stats['updated']} updated, "
+        f"{stats['completed']} completed, {stats['failed']} failed, {stats['missing']} missing"
+    )
+    return stats
@@ -0,0 +1,236 @@
+"""
+Cross-job comparison of ASV tables
+
+Each job's dada2/ASV_table.tsv is loaded once as a sparse samples x ASVs
+matrix and kept in a small LRU cache, keyed by job and invalidated when
+the table (or taxonomy) file changes, e.g. after samples were added.
+Jobs are aligned on ASV_ID (the md5 of the ASV sequence) or on a
+taxonomic rank by remapping column indices, so a comparison costs time in
+proportion to the non-zero counts rather than to samples x features.
+"""
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from scipy import sparse
+from .taxonomy import load_taxonomy
+
+logger = logging.getLogger(__name__)
+
+RANKS = ['phylum', 'class', 'order', 'family', 'genus', 'species']
+LOAD_CHUNK_CELLS = 2_000_000  # ASV table cells (ASVs x samples) parsed at a time
+
+# counts: CSR matrix, one row per sample and one column per feature (ASV_ID or taxon)
+CountMatrix = namedtuple('CountMatrix', ['samples', 'features', 'counts'])
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class CompareError(ValueError):
+    """A job has no table to compare"""
+
+
+def asv_table_path(job):
+    return Path(settings.MEDIA_ROOT) / 'uploads' / str(job.job_id) / 'results' / 'dada2' / 'ASV_table.tsv'
+
+
+def taxonomy_path(job):
+    """The job's DADA2 taxonomy table (with species when available), or None"""
+    dada2_dir = asv_table_path(job).parent
+    candidates = sorted(dada2_dir.glob('ASV_tax_species.*.tsv')) or sorted(dada2_dir.glob('ASV_tax.*.tsv'))
+    return candidates[0] if candidates else None
+
+
+def load_counts(path):
+    """
+    CountMatrix of an ASV_table.tsv
+
+    The table is parsed about LOAD_CHUNK_CELLS counts at a time and only
+    each chunk's non-zero counts are kept, so memory grows with the non-zero
+    counts rather than with samples x ASVs.
+    """
+    samples = [str(column) for column in pd.read_csv(path, sep='\t', index_col='ASV_ID', nrows=0).columns]
+    chunk_rows = max(1, LOAD_CHUNK_CELLS // max(1, len(samples)))
+    features, sample_rows, asv_columns, values = [], [], [], []
+    offset = 0
+    for chunk in pd.read_csv(path, sep='\t', index_col='ASV_ID', chunksize=chunk_rows):
+        counts = chunk.to_numpy(dtype=np.int64)
+        asvs, sample_indices = np.nonzero(counts)
+        sample_rows.append(sample_indices)
+        asv_columns.append(asvs + offset)
+        values.append(counts[asvs, sample_indices])
+        features.append(chunk.index.to_numpy(dtype=str))
+        offset += len(chunk)
+
+    def joined(arrays, dtype):
+        return np.concatenate(arrays) if arrays else np.empty(0, dtype=dtype)
+
+    return CountMatrix(
+        samples=samples,
+        features=joined(features, str),
+        counts=sparse.csr_matrix(
+            (joined(values, np.int64), (joined(sample_rows, np.int64), joined(asv_columns, np.int64))),
+            shape=(len(samples), offset),
+            dtype=np.int64,
+        ),
+    )
+
+
+def collapse_to_rank(matrix, path, rank):
+    """
+    Sum a job's ASV counts per taxon at a rank
+
+    ASVs without a name at that rank are counted as 'Unclassified'.
+    """
+    column = rank.capitalize()
+    names = load_taxonomy(path, ranks=[column])[column].astype(object)
+    labels = names.reindex(matrix.features).fillna('Unclassified').replace('', 'Unclassified').to_numpy(dtype=str)
+    taxa, inverse = np.unique(labels, return_inverse=True)
+    indicator = sparse.csr_matrix(
+        (np.ones(len(labels), dtype=np.int64), (np.arange(len(labels)), inverse)),
+        shape=(len(labels), len(taxa)),
+    )
+    return CountMatrix(matrix.samples, taxa, (matrix.counts @ indicator).tocsr())
+
+
+def _signature(paths):
+    return tuple((path.stat().st_mtime_ns, path.stat().st_size) for path in paths)
+
+
+def get_job_counts(job, rank='asv'):
+    """
+    CountMatrix of a job at 'asv' level or at a taxonomic rank, from the cache when current
+
+    Raises:
+        CompareError: when the job has no ASV table, or no taxonomy for a rank
+    """
+    table_path = asv_table_path(job)
+    if not table_path.exists():
+        raise CompareError(f"Job {job.job_id} has no ASV table")
+    paths = [table_path]
+    if rank != 'asv':
+        tax_path = taxonomy_path(job)
+        if tax_path is None:
+            raise CompareError(f"Job {job.job_id} has no taxonomy table")
+        paths.append(tax_path)
+
+    key = (str(job.job_id), rank)
+    signature = _signature(paths)
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None and cached[0] == signature:
+            _cache.move_to_end(key)
+            return cached[1]
+
+    if rank == 'asv':
+        matrix = load_counts(table_path)
+    else:
+        matrix = collapse_to_rank(get_job_counts(job), paths[1], rank)
+    logger.debug(f"Loaded {rank} counts of job {job.job_id}: {matrix.counts.shape}, {matrix.counts.nnz} non-zero")
+
+    with _cache_lock:
+        _cache[key] = (signature, matrix)
+        _cache.move_to_end(key)
+        while len(_cache) > settings.COMPARE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return matrix
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+
+
+def align(matrices):
+    """
+    Put count matrices on one feature axis
+
+    Returns:
+        (features, counts) - the sorted union of features, and each job's
+        counts as CSR with columns remapped onto it
+    """
+    features, inverse = np.unique(np.concatenate([m.features for m in matrices]), return_inverse=True)
+    aligned = []
+    offset = 0
+    for m in matrices:
+        columns = inverse[offset:offset + len(m.features)]
+        offset += len(m.features)
+        aligned.append(sparse.csr_matrix(
+            (m.counts.data, columns[m.counts.indices], m.counts.indptr),
+            shape=(m.counts.shape[0], len(features)),
+        ))
+    return features, aligned
+
+
+def _pairwise(values):
+    return [[round(float(v), 6) for v in row] for row in values]
+
+
+def compare_counts(matrices, include_table=False):
+    """
+    Shared and unique features and distances between jobs
+
+    Distances are between the jobs' pooled compositions: Bray-Curtis on
+    relative abundances and Jaccard on presence.
+
+    Args:
+        matrices: one CountMatrix per job
+
+    Returns:
+        dict with features, shared_features, unique_features (per job),
+        shared_matrix, distances and, with include_table, the merged table
+        as sparse (row, column, count) triplets
+    """
+    features, aligned = align(matrices)
+
+    # One pooled row per job, kept sparse
+    pooled = sparse.vstack([
+        sparse.csr_matrix(np.ones((1, counts.shape[0]), dtype=np.int64)) @ counts for counts in aligned
+    ], format='csr')
+    presence = (pooled > 0).astype(np.int64)
+    shared = (presence @ presence.T).toarray()
+    jobs_per_feature = np.asarray(presence.sum(axis=0)).ravel()
+    observed = np.diag(shared)
+    unique = [
+        int((jobs_per_feature[presence.indices[presence.indptr[i]:presence.indptr[i + 1]]] == 1).sum())
+        for i in range(len(matrices))
+    ]
+
+    totals = np.asarray(pooled.sum(axis=1)).ravel()
+    scale = np.divide(1.0, totals, out=np.zeros(len(totals)), where=totals > 0)
+    relative = sparse.diags(scale) @ pooled
+    n = len(matrices)
+    bray_curtis = np.zeros((n, n))
+    jaccard = np.zeros((n, n))
+    for i in range(n):
+        for j in range(i + 1, n):
+            bray_curtis[i, j] = bray_curtis[j, i] = 1.0 - relative[i].minimum(relative[j]).sum()
+            union = observed[i] + observed[j] - shared[i, j]
+            jaccard[i, j] = jaccard[j, i] = 1.0 - shared[i, j] / union if union else 0.0
+
+    comparison = {
+        'features': len(features),
+        'shared_features': int((jobs_per_feature == n).sum()),
+        'unique_features': unique,
+        'observed_features': [int(v) for v in observed],
+        'total_reads': [int(v) for v in totals],
+        'shared_matrix': shared.tolist(),
+        'distances': {
+            'bray_curtis': _pairwise(bray_curtis),
+            'jaccard': _pairwise(jaccard),
+        },
+    }
+
+    if include_table:
+        merged = sparse.vstack(aligned, format='coo')
+        comparison['table'] = {
+            'features': features.tolist(),
+            'rows': merged.row.tolist(),
+            'columns': merged.col.tolist(),
+            'counts': merged.data.tolist(),
+        }
+    return comparison
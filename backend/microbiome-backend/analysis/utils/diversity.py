@@ -0,0 +1,157 @@
+"""
+Alpha and beta diversity straight from the ASV table
+
+Test-data runs skip ampliseq's QIIME2 diversity steps, and no run fills
+AnalysisResult.alpha_diversity_data / beta_diversity_data. Here they are
+computed from dada2/ASV_table.tsv held as a sparse samples x ASVs matrix:
+
+- alpha (per sample): observed ASVs, Shannon (base 2, as QIIME2's
+  shannon_entropy), Simpson (1 - dominance) and bias-corrected Chao1
+- beta (per pair of samples): Bray-Curtis on counts and Jaccard on presence
+
+For beta diversity, sample i only needs the ASVs it contains, so each row
+is compared against the other samples' columns for those ASVs, in row
+blocks of at most DIVERSITY_BLOCK_ELEMENTS cells. Memory stays at the
+block size plus the two n x n result matrices.
+"""
+import logging
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.core.files import File
+from .compare import load_counts
+
+logger = logging.getLogger(__name__)
+
+ALPHA_FILE_NAME = 'alpha_diversity.tsv'
+BETA_FILE_NAME = 'beta_diversity.tsv'
+
+
+def alpha_diversity(counts):
+    """
+    Per-sample alpha diversity
+
+    Args:
+        counts: CSR matrix, samples x ASVs
+
+    Returns:
+        dict of arrays: observed, shannon, simpson, chao1 (NaN for empty samples)
+    """
+    counts = counts.tocsr()
+    counts.eliminate_zeros()
+    n = counts.shape[0]
+    data = counts.data.astype(np.float64)
+    row = np.repeat(np.arange(n), np.diff(counts.indptr))
+
+    totals = np.bincount(row, weights=data, minlength=n)
+    observed = np.diff(counts.indptr)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = data / totals[row]
+        shannon = -np.bincount(row, weights=p * np.log2(p), minlength=n)
+        simpson = 1.0 - np.bincount(row, weights=p * p, minlength=n)
+    singletons = np.bincount(row, weights=data == 1, minlength=n)
+    doubletons = np.bincount(row, weights=data == 2, minlength=n)
+    chao1 = observed + singletons * (singletons - 1) / (2 * (doubletons + 1))
+
+    empty = totals == 0
+    for values in (shannon, simpson, chao1):
+        values[empty] = np.nan
+    return {'observed': observed, 'shannon': shannon, 'simpson': simpson, 'chao1': chao1}
+
+
+def beta_diversity(counts, block_elements=None):
+    """
+    Bray-Curtis and Jaccard distances between all samples
+
+    Args:
+        counts: CSR matrix, samples x ASVs
+        block_elements: largest dense block to materialise (default DIVERSITY_BLOCK_ELEMENTS)
+
+    Returns:
+        (bray_curtis, jaccard) - symmetric n x n arrays; 0 between two empty samples
+    """
+    block_elements = block_elements or settings.DIVERSITY_BLOCK_ELEMENTS
+    counts = counts.tocsr()
+    counts.eliminate_zeros()
+    by_asv = counts.tocsc()
+    n = counts.shape[0]
+    totals = np.asarray(counts.sum(axis=1), dtype=np.float64).ravel()
+    observed = np.diff(counts.indptr)
+
+    bray_curtis = np.zeros((n, n))
+    jaccard = np.zeros((n, n))
+    for i in range(n - 1):
+        asvs = counts.indices[counts.indptr[i]:counts.indptr[i + 1]]
+        values = counts.data[counts.indptr[i]:counts.indptr[i + 1]]
+        # Only samples after i: the matrices are filled symmetrically
+        others = by_asv[:, asvs].tocsr()[i + 1:]
+        rows = max(1, block_elements // max(1, len(asvs)))
+        for start in range(0, n - i - 1, rows):
+            block = others[start:start + rows].toarray()
+            j = slice(i + 1 + start, i + 1 + start + len(block))
+            shared_counts = np.minimum(block, values).sum(axis=1)
+            shared_asvs = (block > 0).sum(axis=1)
+
+            depth = totals[i] + totals[j]
+            union = observed[i] + observed[j] - shared_asvs
+            with np.errstate(divide='ignore', invalid='ignore'):
+                bc = np.where(depth > 0, 1.0 - 2.0 * shared_counts / depth, 0.0)
+                jac = np.where(union > 0, 1.0 - shared_asvs / union, 0.0)
+            bray_curtis[i, j] = bray_curtis[j, i] = bc
+            jaccard[i, j] = jaccard[j, i] = jac
+    return bray_curtis, jaccard
+
+
+def compute_diversity(table_path):
+    """
+    Alpha and beta diversity of an ASV_table.tsv
+
+    Returns:
+        (alpha, beta) DataFrames: alpha indexed by sample; beta with one row
+        per pair of samples (sample_a, sample_b, bray_curtis, jaccard)
+    """
+    matrix = load_counts(table_path)
+    alpha = pd.DataFrame(alpha_diversity(matrix.counts), index=pd.Index(matrix.samples, name='sample'))
+    bray_curtis, jaccard = beta_diversity(matrix.counts)
+
+    a, b = np.triu_indices(len(matrix.samples), k=1)
+    samples = np.asarray(matrix.samples, dtype=object)
+    beta = pd.DataFrame({
+        'sample_a': samples[a],
+        'sample_b': samples[b],
+        'bray_curtis': bray_curtis[a, b],
+        'jaccard': jaccard[a, b],
+    })
+    return alpha, beta
+
+
+def write_diversity(results_dir):
+    """
+    Compute diversity from a run's ASV table into alpha_diversity.tsv and beta_diversity.tsv
+
+    Returns:
+        (alpha_path, beta_path), or None when the run has no ASV table
+    """
+    results_dir = Path(results_dir)
+    table_path = results_dir / 'dada2' / 'ASV_table.tsv'
+    if not table_path.exists():
+        logger.warning(f"No ASV table in {results_dir}, skipping diversity")
+        return None
+
+    alpha, beta = compute_diversity(table_path)
+    alpha_path = results_dir / ALPHA_FILE_NAME
+    beta_path = results_dir / BETA_FILE_NAME
+    alpha.to_csv(alpha_path, sep='\t', float_format='%.6g')
+    beta.to_csv(beta_path, sep='\t', index=False, float_format='%.6g')
+    logger.info(f"Diversity computed for {len(alpha)} samples ({len(beta)} pairs)")
+    return alpha_path, beta_path
+
+
+def attach_diversity(result_obj, alpha_path, beta_path):
+    """Store the diversity tables on an AnalysisResult (without saving it)"""
+    job_id = result_obj.job_id
+    with open(alpha_path, 'rb') as f:
+        result_obj.alpha_diversity_data.save(f'alpha_diversity_{job_id}.tsv', File(f), save=False)
+    with open(beta_path, 'rb') as f:
+        result_obj.beta_diversity_data.save(f'beta_diversity_{job_id}.tsv', File(f), save=False)
@@ -0,0 +1,234 @@
+"""
+Execution backends for Nextflow runs
+
+Every backend implements submit / poll / cancel / fetch_outputs:
+- LocalProcessExecutor: nextflow as a child process of the backend
+- LocalContainerExecutor: nextflow inside a docker container on this host
+- BatchExecutor: the whole run on AWS Batch, tracked by the reconciler
+
+The backend is chosen per job by total input size (get_executor_for_job).
+"""
+import logging
+import subprocess
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# poll() states
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+UNKNOWN = 'unknown'
+
+
+class PipelineExecutor(ABC):
+    """Base class for pipeline execution backends"""
+
+    name = None
+    # Remote backends return from submit() immediately and are
+    # tracked asynchronously (see batch_reconciler)
+    is_remote = False
+
+    @abstractmethod
+    def submit(self, job, cmd=None, cwd=None, env=None):
+        """Start the pipeline for a job, returns a backend-specific run ID"""
+
+    @abstractmethod
+    def poll(self, job):
+        """Return one of RUNNING, SUCCEEDED, FAILED or UNKNOWN"""
+
+    @abstractmethod
+    def cancel(self, job):
+        """Stop a running pipeline, returns True if something was cancelled"""
+
+    def fetch_outputs(self, job):
+        """Make the run's results available locally and return their directory"""
+        return Path(settings.MEDIA_ROOT) / 'uploads' / str(job.job_id) / 'results'
+
+
+class LocalProcessExecutor(PipelineExecutor):
+    """Run nextflow as a child process on this host"""
+
+    name = 'local'
+
+    def __init__(self):
+        self._processes = {}
+        self._lock = threading.Lock()
+
+    def build_command(self, job, cmd, cwd):
+        return cmd
+
+    def submit(self, job, cmd=None, cwd=None, env=None):
+        process = subprocess.Popen(
+            self.build_command(job, cmd, cwd),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            cwd=str(cwd) if cwd else None,
+            env=env,
+        )
+        with self._lock:
+            self._processes[str(job.job_id)] = process
+        logger.info(f"Started {self.name} run for job {job.job_id} (pid {process.pid})")
+        return str(process.pid)
+
+    def _get_process(self, job):
+        with self._lock:
+            return self._processes.get(str(job.job_id))
+
+    def poll(self, job):
+        process = self._get_process(job)
+        if process is None:
+            return UNKNOWN
+        returncode = process.poll()
+        if returncode is None:
+            return RUNNING
+        return SUCCEEDED if returncode == 0 else FAILED
+
+    def wait(self, job, timeout=None):
+        """
+        Wait for a submitted run to finish
+
+        Returns:
+            subprocess.CompletedProcess with returncode, stdout and stderr
+
+        Raises:
+            subprocess.TimeoutExpired: the run was cancelled after timeout seconds
+        """
+        process = self._get_process(job)
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.cancel(job)
+            process.communicate()
+            raise
+        finally:
+            if process.returncode is not None:
+                with self._lock:
+                    self._processes.pop(str(job.job_id), None)
+        return subprocess.CompletedProcess(process.args, process.returncode, stdout, stderr)
+
+    def cancel(self, job):
+        process = self._get_process(job)
+        if process is None or process.poll() is not None:
+            return False
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        logger.info(f"Cancelled {self.name} run for job {job.job_id}")
+        return True
+
+
+class LocalContainerExecutor(LocalProcessExecutor):
+    """Run nextflow inside a docker container, with the job directory mounted at the same path"""
+
+    name = 'container'
+
+    def _container_name(self, job):
+        return f"nextflow-{job.job_id}"
+
+    def build_command(self, job, cmd, cwd):
+        media_root = str(Path(settings.MEDIA_ROOT).resolve())
+        return [
+            'docker', 'run', '--rm',
+            '--name', self._container_name(job),
+            '-v', f'{media_root}:{media_root}',
+            '-v', '/var/run/docker.sock:/var/run/docker.sock',
+            '-w', str(cwd),
+            '-e', 'NXF_ANSI_LOG=false',
+            settings.NEXTFLOW_CONTAINER_IMAGE,
+        ] + list(cmd)
+
+    def cancel(self, job):
+        if self.poll(job) != RUNNING:
+            return False
+        subprocess.run(['docker', 'kill', self._container_name(job)], capture_output=True, timeout=60)
+        super().cancel(job)
+        return True
+
+
+class BatchExecutor(PipelineExecutor):
+    """Run the pipeline on AWS Batch; state is synced by the reconciler"""
+
+    name = 'batch'
+    is_remote = True
+
+    STATUS_MAP = {
+        'SUBMITTED': RUNNING,
+        'PENDING': RUNNING,
+        'RUNNABLE': RUNNING,
+        'STARTING': RUNNING,
+        'RUNNING': RUNNING,
+        'SUCCEEDED': SUCCEEDED,
+        'FAILED': FAILED,
+    }
+
+    @property
+    def client(self):
+        from .aws_batch import batch_client
+        return batch_client
+
+    def submit(self, job, cmd=None, cwd=None, env=None):
+        from .aws_batch import submit_batch_analysis
+        from .s3_transfer import sync_job_inputs
+        stats = sync_job_inputs(job)
+        logger.info(f"Synced inputs for job {job.job_id}: {stats}")
+        return submit_batch_analysis(job, client=self.client)
+
+    def poll(self, job):
+        if not job.batch_job_id:
+            return UNKNOWN
+        info = self.client.get_job_status(job.batch_job_id)
+        if info is None:
+            return UNKNOWN
+        return self.STATUS_MAP.get(info['status'], UNKNOWN)
+
+    def cancel(self, job):
+        if not job.batch_job_id:
+            return False
+        return self.client.cancel_job(job.batch_job_id)
+
+    def fetch_outputs(self, job):
+        from .s3_transfer import download_job_results
+        stats = download_job_results(job, subtrees=settings.BATCH_RESULT_SUBTREES)
+        logger.info(f"Fetched results for job {job.job_id}: {stats}")
+        return super().fetch_outputs(job)
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+EXECUTOR_CLASSES = {
+    LocalProcessExecutor.name: LocalProcessExecutor,
+    LocalContainerExecutor.name: LocalContainerExecutor,
+    BatchExecutor.name: BatchExecutor,
+}
+
+
+def get_executor(name):
+    """Shared executor instance for a backend name"""
+    with _executors_lock:
+        if name not in _executors:
+            _executors[name] = EXECUTOR_CLASSES[name]()
+        return _executors[name]
+
+
+def get_executor_for_job(job):
+    """
+    Pick the backend for a job: big inputs go to AWS Batch when it is
+    enabled, everything else (and test data) stays on this host
+    """
+    if job.executor:
+        return get_executor(job.executor)
+
+    if settings.PIPELINE_BATCH_ENABLED and not job.is_test_data:
+        total_size = sum(f.file_size for f in job.files.all())
+        if total_size >= settings.PIPELINE_BATCH_MIN_INPUT_BYTES:
+            return get_executor(BatchExecutor.name)
+
+    return get_executor(settings.PIPELINE_LOCAL_EXECUTOR)
@@ -0,0 +1,356 @@
+"""
+Preflight validation and read statistics for uploaded FASTQ files
+
+Every input is streamed once before the pipeline starts, several files
+at a time. Gzipped files are decompressed by pigz (multi-threaded) when
+it is installed, otherwise by the gzip module. Records are parsed in
+large batches so the per-read work stays in C (slicing, map, Counter,
+numpy), and R1/R2 pairing is checked by read count and by a digest of
+the read IDs, so the two files never have to be read in lockstep.
+The same pass can reservoir-sample reads for a preview run.
+"""
+import gzip
+import hashlib
+import logging
+import math
+import random
+import shutil
+import subprocess
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from django.conf import settings
+from ..models import UploadedFile
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 4 * 1024 * 1024
+PHRED_OFFSET = 33
+# IUPAC nucleotide codes, either case, plus '.' used by some instruments for no-calls
+VALID_BASES = b'ACGTUNRYSWKMBDHVacgtunryswkmbdhv.'
+
+PREFLIGHT_FIELDS = [
+    'read_count', 'base_count', 'min_read_length', 'max_read_length',
+    'mean_quality', 'read_length_histogram', 'preflight_error',
+]
+
+
+class FastqError(ValueError):
+    """An input file is not a valid FASTQ file"""
+
+
+def find_read_pair(files):
+    """
+    Pick the R1 and R2 files of a paired-end upload by name
+
+    Args:
+        files: UploadedFile objects
+
+    Returns:
+        (r1, r2), either of which is None when not found
+    """
+    r1 = r2 = None
+    for file_obj in files:
+        if '_R1' in file_obj.file_name or '_1' in file_obj.file_name:
+            r1 = file_obj
+        elif '_R2' in file_obj.file_name or '_2' in file_obj.file_name:
+            r2 = file_obj
+    return r1, r2
+
+
+def _read_id(header):
+    """
+    Read ID shared by both mates: up to the first space, without a /1 or /2
+    suffix or the mate field of SRA IDs (SRR10070139.1.1 and SRR10070139.1.2)
+    """
+    read_id = header[1:].split(None, 1)[0] if len(header) > 1 else b''
+    if read_id[-2:] in (b'/1', b'/2'):
+        read_id = read_id[:-2]
+    elif read_id[-2:] in (b'.1', b'.2') and read_id.count(b'.') >= 2:
+        read_id = read_id[:-2]
+    return read_id
+
+
+def _batches(stream):
+    """Lines of the stream in lists holding whole 4-line records (the last may be partial)"""
+    carry = b''
+    pending = []
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        if b'\r' in chunk:
+            chunk = chunk.replace(b'\r', b'')
+        lines = (carry + chunk).split(b'\n')
+        carry = lines.pop()
+        pending.extend(lines)
+        whole = len(pending) - len(pending) % 4
+        if whole:
+            yield pending[:whole]
+            pending = pending[whole:]
+    if carry:
+        pending.append(carry)
+    # A trailing newline on the last record leaves nothing over
+    if pending:
+        yield pending
+
+
+class _Reservoir:
+    """
+    Uniform sample of `size` records from a stream of unknown length (Algorithm L)
+
+    Which records are kept depends only on the seed and the record
+    positions, so R1 and R2 sampled with the same seed keep the same pairs.
+    """
+
+    def __init__(self, size, seed):
+        self.size = size
+        self.records = []
+        self.rng = random.Random(seed)
+        self.next_index = None
+
+    def _uniform(self):
+        while True:
+            u = self.rng.random()
+            if u > 0:
+                return u
+
+    def _skip(self):
+        self.weight *= math.exp(math.log(self._uniform()) / self.size)
+        return math.floor(math.log(self._uniform()) / math.log(1 - self.weight)) + 1
+
+    def offer(self, start, lines):
+        """Records start, start+1, ... given as their lines (4 per record)"""
+        n = len(lines) // 4
+        i = 0
+        while len(self.records) < self.size and i < n:
+            self.records.append(lines[4 * i:4 * i + 4])
+            i += 1
+            if len(self.records) == self.size:
+                self.weight = 1.0
+                self.next_index = start + i - 1 + self._skip()
+        while self.next_index is not None and self.next_index < start + n:
+            j = self.next_index - start
+            self.records[self.rng.randrange(self.size)] = lines[4 * j:4 * j + 4]
+            self.next_index += self._skip()
+
+
+def _first_mismatch(values, expected):
+    return next(i for i, value in enumerate(values) if value != expected)
+
+
+def _scan(stream, name, reservoir=None):
+    read_count = 0
+    base_count = 0
+    quality_sum = 0
+    lengths = Counter()
+    ids = hashlib.blake2b(digest_size=16)
+
+    for lines in _batches(stream):
+        if read_count == 0 and lines[0][:1] != b'@':
+            raise FastqError(f"{name}: not a FASTQ file (first line does not start with '@')")
+        if len(lines) % 4:
+            raise FastqError(f"{name}: truncated record {read_count + len(lines) // 4 + 1}")
+        headers, seqs, separators, quals = lines[0::4], lines[1::4], lines[2::4], lines[3::4]
+        n = len(headers)
+
+        marks = [h[:1] for h in headers]
+        if marks.count(b'@') != n:
+            raise FastqError(f"{name}: record {read_count + _first_mismatch(marks, b'@') + 1} header does not start with '@'")
+        marks = [s[:1] for s in separators]
+        if marks.count(b'+') != n:
+            raise FastqError(f"{name}: record {read_count + _first_mismatch(marks, b'+') + 1} has no '+' separator line")
+
+        seq_lengths = list(map(len, seqs))
+        qual_lengths = list(map(len, quals))
+        if seq_lengths != qual_lengths:
+            i = next(i for i, (a, b) in enumerate(zip(seq_lengths, qual_lengths)) if a != b)
+            raise FastqError(
+                f"{name}: record {read_count + i + 1} has {seq_lengths[i]} bases but {qual_lengths[i]} quality scores"
+            )
+
+        bases = b''.join(seqs)
+        if bases.translate(None, VALID_BASES):
+            bad = bases.translate(None, VALID_BASES)[:1].decode('latin-1')
+            raise FastqError(f"{name}: invalid base {bad!r} in records {read_count + 1}-{read_count + n}")
+        scores = np.frombuffer(b''.join(quals), dtype=np.uint8)
+        if scores.size and scores.min() < PHRED_OFFSET:
+            raise FastqError(f"{name}: quality scores below Phred+33 range in records {read_count + 1}-{read_count + n}")
+
+        if reservoir is not None:
+            reservoir.offer(read_count, lines)
+        read_count += n
+        base_count += len(bases)
+        quality_sum += int(scores.sum(dtype=np.uint64))
+        lengths.update(seq_lengths)
+        ids.update(b'\n'.join(map(_read_id, headers)) + b'\n')
+
+    if read_count == 0:
+        raise FastqError(f"{name}: contains no reads")
+    if base_count == 0:
+        raise FastqError(f"{name}: all {read_count} reads are empty (zero length)")
+
+    return {
+        'read_count': read_count,
+        'base_count': base_count,
+        'min_length': min(lengths),
+        'max_length': max(lengths),
+        'mean_quality': quality_sum / base_count - PHRED_OFFSET,
+        'length_histogram': {str(length): count for length, count in sorted(lengths.items())},
+        'id_digest': ids.hexdigest(),
+    }
+
+
+def scan_fastq(path, threads=1, sample_size=0, seed=0):
+    """
+    Validate a FASTQ(.gz) file in one pass and collect read statistics
+
+    Args:
+        path: file to read; gzip is detected from the content, not the name
+        threads: decompression threads (used when pigz is installed)
+        sample_size: reads to reservoir-sample (0 for none)
+        seed: sampling seed; files sampled with the same seed keep the same read positions
+
+    Returns:
+        dict with read_count, base_count, min_length, max_length,
+        mean_quality, length_histogram, id_digest (of the read IDs, in order)
+        and sample (lists of 4 lines per sampled read, None unless sample_size)
+
+    Raises:
+        FastqError: on a malformed, truncated or non-FASTQ file
+    """
+    path = Path(path)
+    name = path.name
+    with open(path, 'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+
+    pigz = shutil.which('pigz') if gzipped and threads > 1 else None
+    process = None
+    if pigz:
+        process = subprocess.Popen(
+            [pigz, '-dc', '-p', str(threads), str(path)], stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        stream = process.stdout
+    elif gzipped:
+        stream = gzip.open(path, 'rb')
+    else:
+        stream = open(path, 'rb')
+
+    reservoir = _Reservoir(sample_size, seed) if sample_size else None
+    finished = False
+    try:
+        stats = _scan(stream, name, reservoir)
+        stats['sample'] = reservoir.records if reservoir else None
+        finished = True
+    except (EOFError, zlib.error, gzip.BadGzipFile) as e:
+        raise FastqError(f"{name}: corrupt or truncated gzip ({e})")
+    finally:
+        stream.close()
+        if process is not None:
+            if not finished:
+                process.kill()
+            process.wait()
+
+    if process is not None and process.returncode != 0:
+        message = process.stderr.read().decode(errors='replace').strip()
+        raise FastqError(f"{name}: corrupt or truncated gzip ({message or f'pigz exited with {process.returncode}'})")
+    return stats
+
+
+def head_sequences(path, limit):
+    """
+    Sequences of the first `limit` reads of a FASTQ(.gz) file
+
+    Only the start of the file is decompressed, so this is cheap on any input size.
+    """
+    with open(path, 'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+    opener = gzip.open if gzipped else open
+    sequences = []
+    with opener(path, 'rb') as f:
+        for line_number, line in enumerate(f):
+            if line_number % 4 == 1:
+                sequences.append(line.rstrip(b'\r\n'))
+                if len(sequences) >= limit:
+                    break
+    return sequences
+
+
+def write_fastq(path, records):
+    """Write records (4 lines each, without newlines) as a gzipped FASTQ file"""
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with gzip.open(path, 'wb', compresslevel=1) as f:
+        for record in records:
+            f.write(b'\n'.join(record) + b'\n')
+
+
+def preflight_job(job, sample_dir=None):
+    """
+    Scan a job's uploaded files in parallel, store their read statistics
+    and check R1/R2 pairing
+
+    Files that are not on local disk (e.g. direct-to-S3 uploads) are skipped.
+    With sample_dir, PREVIEW_READ_PAIRS reads of every file are sampled in the
+    same pass and written there under the file's name.
+
+    Returns:
+        list of problems; empty when every input is usable
+    """
+    media_root = Path(settings.MEDIA_ROOT)
+    files = [f for f in job.files.all() if (media_root / f.file.name).is_file()]
+    if not files:
+        return []
+
+    threads = settings.FASTQ_PREFLIGHT_THREADS
+    sample_size = settings.PREVIEW_READ_PAIRS if sample_dir else 0
+    seed = job.job_id.int & 0xFFFFFFFF
+    with ThreadPoolExecutor(max_workers=min(len(files), settings.FASTQ_PREFLIGHT_WORKERS)) as pool:
+        futures = [
+            (f, pool.submit(scan_fastq, media_root / f.file.name, threads, sample_size, seed))
+            for f in files
+        ]
+
+    problems = []
+    scanned = {}
+    for file_obj, future in futures:
+        try:
+            stats = future.result()
+        except (FastqError, OSError) as e:
+            problems.append(str(e))
+            file_obj.preflight_error = str(e)
+            continue
+
+        scanned[file_obj.pk] = stats
+        file_obj.read_count = stats['read_count']
+        file_obj.base_count = stats['base_count']
+        file_obj.min_read_length = stats['min_length']
+        file_obj.max_read_length = stats['max_length']
+        file_obj.mean_quality = stats['mean_quality']
+        file_obj.read_length_histogram = stats['length_histogram']
+        file_obj.preflight_error = None
+        logger.info(
+            f"Preflight {file_obj.file_name}: {stats['read_count']} reads, "
+            f"length {stats['min_length']}-{stats['max_length']}, mean quality {stats['mean_quality']:.1f}"
+        )
+
+    # All files' results in one statement rather than a write per file
+    UploadedFile.objects.bulk_update(files, PREFLIGHT_FIELDS)
+
+    if job.data_type == 'paired-end' and not problems:
+        r1, r2 = find_read_pair(files)
+        if r1 is not None and r2 is not None:
+            s1, s2 = scanned[r1.pk], scanned[r2.pk]
+            if s1['read_count'] != s2['read_count']:
+                problems.append(
+                    f"{r1.file_name} has {s1['read_count']} reads but {r2.file_name} has {s2['read_count']}"
+                )
+            elif s1['id_digest'] != s2['id_digest']:
+                problems.append(f"Read IDs of {r1.file_name} and {r2.file_name} do not match")
+
+    if sample_dir and not problems:
+        for file_obj in files:
+            write_fastq(Path(sample_dir) / file_obj.file_name, scanned[file_obj.pk]['sample'])
+
+    return problems
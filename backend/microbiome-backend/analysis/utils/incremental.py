@@ -0,0 +1,362 @@
+"""
+Adding samples to a finished study without reprocessing it
+
+POST /api/jobs/{job_id}/samples/ creates an increment job holding only the
+new samples. ampliseq runs on those alone, with independent per-sample
+inference and without taxonomy or the downstream steps. ASV_IDs are md5
+hashes of the ASV sequences, so the delta's ASV table merges into the
+study's by ID. Only ASVs the study has never seen go through a second,
+taxonomy-only ampliseq run (--input_fasta). Taxonomy tables, sequences and
+DADA2 stats are appended to, and the genus summary (bacteria_summary.tsv)
+is updated with the delta's counts instead of being recomputed. Diversity
+spans all pairs of samples and is recomputed from the merged table.
+
+The merged files are written next to the study's as temporary copies and
+moved into place together at the end, the ASV table last, so a merge that
+fails leaves the study as it was and can be retried.
+"""
+import logging
+import os
+import re
+import shutil
+from pathlib import Path
+import pandas as pd
+from django.conf import settings
+from django.core.files import File
+from .diversity import attach_diversity, write_diversity
+from .kmer_index import add_sequences
+from .sequences import build_index, index_path, read_fasta
+from .taxon_index import index_job_taxa
+from .taxonomy import load_taxonomy
+
+logger = logging.getLogger(__name__)
+
+# Denoising only: taxonomy runs afterwards on the new ASVs, and the
+# study-wide steps (QIIME2, diversity, reports) would only see the delta
+INCREMENT_FLAGS = [
+    '--skip_taxonomy',
+    '--skip_fastqc',
+    '--skip_barrnap',
+    '--skip_qiime',
+    '--skip_barplot',
+    '--skip_abundance_tables',
+    '--skip_alpha_rarefaction',
+    '--skip_diversity_indices',
+    '--skip_ancom',
+    '--skip_multiqc',
+]
+# Pooled inference would make the delta's ASVs depend on the other samples
+INCREMENT_OPTIONS = ['--sample_inference', 'independent']
+
+# <sample>[_R1|_R2|_1|_2][_001].fastq[.gz]
+_READ_FILE = re.compile(r'(_R?([12]))?(_001)?\.f(ast)?q(\.gz)?$', re.IGNORECASE)
+
+SUMMARY_RANKS = ['Genus', 'Family', 'Phylum']
+
+
+def study_results_dir(study):
+    return Path(settings.MEDIA_ROOT) / 'uploads' / str(study.job_id) / 'results'
+
+
+def sample_id(file_name):
+    """ampliseq sample ID for a read file: the name without mate and extension"""
+    name = re.sub(r'[^A-Za-z0-9_]', '_', _READ_FILE.sub('', file_name))
+    return name if name[:1].isalpha() else f's{name}'
+
+
+def group_samples(file_names, data_type):
+    """
+    Group read files into samples by name
+
+    Returns:
+        {sample_id: (r1_name, r2_name)}; r2_name is None for single-end data
+
+    Raises:
+        ValueError: on a file that is not FASTQ or a sample without its mates
+    """
+    samples = {}
+    for name in file_names:
+        match = _READ_FILE.search(name)
+        if match is None:
+            raise ValueError(f"{name} is not a FASTQ file name")
+        mate = match.group(2) or '1'
+        mates = samples.setdefault(sample_id(name), {})
+        if mate in mates:
+            raise ValueError(f"Sample {sample_id(name)} has more than one R{mate} file")
+        mates[mate] = name
+
+    grouped = {}
+    for sample, mates in samples.items():
+        if data_type == 'paired-end':
+            if set(mates) != {'1', '2'}:
+                raise ValueError(f"Sample {sample} needs both an R1 and an R2 file")
+            grouped[sample] = (mates['1'], mates['2'])
+        else:
+            if len(mates) != 1:
+                raise ValueError(f"Sample {sample} has {len(mates)} files; single-end samples take one")
+            grouped[sample] = (next(iter(mates.values())), None)
+    return grouped
+
+
+def study_sample_ids(study):
+    """Sample columns of the study's ASV table (only its header is read)"""
+    with open(study_results_dir(study) / 'dada2' / 'ASV_table.tsv', encoding='utf-8') as f:
+        return f.readline().rstrip('\n').split('\t')[1:]
+
+
+def write_samples_samplesheet(job, samplesheet_path):
+    """Samplesheet with one row per sample of an increment job"""
+    files = {f.file_name: f for f in job.files.all()}
+    media_root = Path(settings.MEDIA_ROOT)
+    with open(samplesheet_path, 'w', newline='', encoding='utf-8') as f:
+        f.write('sampleID,forwardReads,reverseReads,run\n')
+        for sample, (r1, r2) in group_samples(files, job.data_type).items():
+            r2_path = str(media_root / files[r2].file.name) if r2 else ''
+            f.write(f"{sample},{media_root / files[r1].file.name},{r2_path},A\n")
+    return samplesheet_path
+
+
+def increment_command(cmd):
+    """The study run's command reduced to denoising the new samples"""
+    return list(cmd) + [flag for flag in INCREMENT_FLAGS if flag not in cmd] + INCREMENT_OPTIONS
+
+
+def taxonomy_command(cmd, fasta_path, results_dir):
+    """An increment's command turned into a taxonomy-only run on the ASVs in fasta_path"""
+    replacements = {
+        '--outdir': str(results_dir),
+        '-with-trace': str(results_dir / 'pipeline_info' / 'execution_trace.txt'),
+        '-with-report': str(results_dir / 'pipeline_info' / 'execution_report.html'),
+    }
+    dropped = {'--input', '--FW_primer', '--RV_primer'}
+    taxonomy_cmd = []
+    args = iter(cmd)
+    for arg in args:
+        if arg in dropped:
+            next(args, None)
+        elif arg == '--skip_taxonomy':
+            continue
+        elif arg in replacements:
+            taxonomy_cmd += [arg, replacements[arg]]
+            next(args, None)
+        else:
+            taxonomy_cmd.append(arg)
+    return taxonomy_cmd + ['--input_fasta', str(fasta_path)]
+
+
+def read_asv_table(path):
+    return pd.read_csv(path, sep='\t', index_col='ASV_ID')
+
+
+def merge_asv_tables(study, delta):
+    """
+    Add the delta's sample columns to the study's ASV table
+
+    Rows are matched by ASV_ID; ASVs new to the study are appended at the
+    end and every missing count is 0.
+
+    Raises:
+        ValueError: when a sample is already in the study
+    """
+    duplicates = sorted(set(study.columns) & set(delta.columns))
+    if duplicates:
+        raise ValueError(f"Samples already in the study: {', '.join(duplicates)}")
+    index = study.index.append(delta.index.difference(study.index, sort=False))
+    return pd.concat([study.reindex(index, fill_value=0), delta.reindex(index, fill_value=0)], axis=1)
+
+
+def update_genus_summary(summary, delta, taxonomy):
+    """
+    Add the delta's samples to a bacteria_summary.tsv table
+
+    Args:
+        summary: the study's genus summary, indexed by (Genus, Family, Phylum)
+        delta: the delta's ASV table
+        taxonomy: ranks per ASV_ID, covering at least the delta's ASVs
+
+    Returns:
+        the summary with a column per new sample, Total recomputed, most abundant first
+    """
+    ranks = taxonomy.reindex(delta.index)[SUMMARY_RANKS].fillna('Unclassified')
+    delta_summary = delta.join(ranks).groupby(SUMMARY_RANKS)[list(delta.columns)].sum()
+    samples = summary.drop(columns='Total')
+    index = samples.index.append(delta_summary.index.difference(samples.index, sort=False))
+    merged = pd.concat(
+        [samples.reindex(index, fill_value=0), delta_summary.reindex(index, fill_value=0)], axis=1
+    )
+    merged['Total'] = merged.sum(axis=1)
+    return merged.sort_values('Total', ascending=False, kind='stable')
+
+
+def _summary_taxonomy_file(dada2_dir):
+    """The taxonomy create_bacteria_barplot.py built the summary from"""
+    for name in ['ASV_tax_species.silva_138_2.tsv', 'ASV_tax.silva_138_2.tsv']:
+        if (dada2_dir / name).exists():
+            return dada2_dir / name
+    candidates = sorted(dada2_dir.glob('ASV_tax*.tsv'))
+    return candidates[0] if candidates else None
+
+
+def _staged_path(path):
+    """Where the merged version of a study file is written before it replaces the file"""
+    return path.with_name(f'.{path.name}.tmp')
+
+
+def _append_rows(path, source, ids):
+    """
+    Copy a TSV file with the rows of source whose ASV_ID is in ids and not
+    yet in path appended (same header)
+
+    Returns:
+        (path of the copy, number of rows appended)
+    """
+    with open(path, encoding='utf-8') as f:
+        header = f.readline()
+        existing = {line.split('\t', 1)[0] for line in f}
+    with open(source, encoding='utf-8') as f:
+        if f.readline() != header:
+            raise ValueError(f"{source.name} columns differ from the study's")
+        rows = [line for line in f if line.split('\t', 1)[0] in ids and line.split('\t', 1)[0] not in existing]
+    staged = _staged_path(path)
+    shutil.copyfile(path, staged)
+    with open(staged, 'a', encoding='utf-8') as f:
+        f.writelines(row if row.endswith('\n') else row + '\n' for row in rows)
+    return staged, len(rows)
+
+
+def _append_sequences(path, sequences, ids):
+    """Copy a FASTA file with the records of ids it does not have yet appended; returns the copy"""
+    with open(path, encoding='utf-8') as f:
+        existing = {line[1:].split()[0] for line in f if line.startswith('>') and line[1:].strip()}
+    staged = _staged_path(path)
+    shutil.copyfile(path, staged)
+    with open(staged, 'a', encoding='utf-8') as f:
+        f.writelines(f">{asv_id}\n{sequences[asv_id]}\n" for asv_id in sorted(ids) if asv_id not in existing)
+    return staged
+
+
+def _write_tsv(frame, path):
+    """Write a table to the staged copy of path; returns the copy"""
+    staged = _staged_path(path)
+    frame.to_csv(staged, sep='\t')
+    return staged
+
+
+def merge_increment(job, delta_dir, cmd, executor, env=None, cwd=None):
+    """
+    Merge a finished increment run into its study
+
+    Classifies the ASVs new to the study (a taxonomy-only run through the
+    same executor), then extends the study's ASV table, taxonomy tables,
+    sequences, DADA2 stats and genus summary. None of these change unless
+    all of them were merged.
+
+    Args:
+        delta_dir: the increment run's --outdir
+        cmd: the increment run's nextflow command
+
+    Returns:
+        number of ASVs added to the study
+    """
+    study = job.parent
+    study_dada2 = study_results_dir(study) / 'dada2'
+    delta_dada2 = Path(delta_dir) / 'dada2'
+    cwd = Path(cwd)
+
+    study_table = read_asv_table(study_dada2 / 'ASV_table.tsv')
+    delta_table = read_asv_table(delta_dada2 / 'ASV_table.tsv')
+    merged = merge_asv_tables(study_table, delta_table)
+    new_ids = set(delta_table.index.difference(study_table.index))
+    logger.info(
+        f"Increment {job.job_id}: {len(delta_table.columns)} samples, {len(delta_table)} ASVs, "
+        f"{len(new_ids)} new to study {study.job_id}"
+    )
+
+    # Taxonomy for the new ASVs only
+    if new_ids:
+        sequences = read_fasta(delta_dada2 / 'ASV_seqs.fasta')
+        fasta_path = cwd / 'new_asvs.fasta'
+        with open(fasta_path, 'w', encoding='utf-8') as f:
+            f.writelines(f">{asv_id}\n{sequences[asv_id]}\n" for asv_id in sorted(new_ids))
+
+        taxonomy_dir = cwd / 'taxonomy'
+        (taxonomy_dir / 'pipeline_info').mkdir(parents=True, exist_ok=True)
+        executor.submit(job, taxonomy_command(cmd, fasta_path, taxonomy_dir), cwd=cwd, env=env)
+        result = executor.wait(job, timeout=3600)
+        if result.returncode != 0:
+            raise RuntimeError(f"Taxonomy of new ASVs failed: {result.stderr[-500:]}")
+
+    # {study file: its merged copy}, moved into place once everything is merged
+    staged = {}
+    study_fasta = study_dada2 / 'ASV_seqs.fasta'
+    indexed_size = study_fasta.stat().st_size if study_fasta.exists() else 0
+    try:
+        if new_ids:
+            for study_taxonomy in sorted(study_dada2.glob('ASV_tax*.tsv')):
+                new_taxonomy = taxonomy_dir / 'dada2' / study_taxonomy.name
+                if not new_taxonomy.exists():
+                    raise FileNotFoundError(f"Taxonomy run produced no {study_taxonomy.name}")
+                staged[study_taxonomy], _ = _append_rows(study_taxonomy, new_taxonomy, new_ids)
+            staged[study_fasta] = _append_sequences(study_fasta, sequences, new_ids)
+
+        if (study_dada2 / 'DADA2_stats.tsv').exists() and (delta_dada2 / 'DADA2_stats.tsv').exists():
+            staged[study_dada2 / 'DADA2_stats.tsv'], _ = _append_rows(
+                study_dada2 / 'DADA2_stats.tsv', delta_dada2 / 'DADA2_stats.tsv', set(delta_table.columns)
+            )
+
+        # Genus summary: add the delta's counts per genus
+        summary_path = study_dada2.parent / 'bacteria_summary.tsv'
+        taxonomy_file = _summary_taxonomy_file(study_dada2)
+        if summary_path.exists() and taxonomy_file:
+            summary = pd.read_csv(summary_path, sep='\t', index_col=list(range(len(SUMMARY_RANKS))))
+            # The merged copy, which has the new ASVs' ranks
+            taxonomy = load_taxonomy(staged.get(taxonomy_file, taxonomy_file), ranks=SUMMARY_RANKS).astype(object)
+            staged[summary_path] = _write_tsv(update_genus_summary(summary, delta_table, taxonomy), summary_path)
+        else:
+            logger.warning(f"No genus summary to update for study {study.job_id}")
+
+        # Last: once the study's ASV table has the new samples, a retry is rejected
+        staged[study_dada2 / 'ASV_table.tsv'] = _write_tsv(merged, study_dada2 / 'ASV_table.tsv')
+    except Exception:
+        for staged_path in staged.values():
+            staged_path.unlink(missing_ok=True)
+        raise
+
+    for path, staged_path in staged.items():
+        os.replace(staged_path, path)
+
+    if study_fasta in staged:
+        # Index only the appended records when the study already has an index
+        build_index(study_fasta, start=indexed_size if index_path(study_fasta).exists() else 0)
+
+    # Diversity covers every pair of samples, so it is recomputed for the study
+    diversity_files = None
+    if settings.DIVERSITY_ENABLED:
+        try:
+            diversity_files = write_diversity(study_dada2.parent)
+        except Exception as e:
+            logger.warning(f"Could not compute diversity for study {study.job_id}: {e}")
+
+    # The study's existing ASVs are in the k-mer index already
+    if new_ids and settings.KMER_INDEX_ENABLED:
+        try:
+            add_sequences(study.job_id, {asv_id: sequences[asv_id] for asv_id in sorted(new_ids)})
+        except Exception as e:
+            logger.warning(f"Could not add new ASVs of study {study.job_id} to the k-mer index: {e}")
+
+    # Every abundance of the study changes with the new samples
+    try:
+        index_job_taxa(study)
+    except Exception as e:
+        logger.warning(f"Could not index taxa of study {study.job_id}: {e}")
+
+    result_obj = getattr(study, 'result', None)
+    if result_obj is not None:
+        if summary_path.exists():
+            with open(summary_path, 'rb') as f:
+                result_obj.taxonomy_data.save(f'bacteria_summary_{study.job_id}.tsv', File(f), save=False)
+        if diversity_files:
+            attach_diversity(result_obj, *diversity_files)
+        result_obj.save()
+
+    return len(new_ids)
@@ -0,0 +1,156 @@
+"""
+Collect pipeline outputs into an AnalysisResult
+"""
+import logging
+import subprocess
+from pathlib import Path
+from django.conf import settings
+from django.core.files import File
+from ..models import AnalysisResult
+from .diversity import attach_diversity, write_diversity
+from .kmer_index import index_job
+from .taxon_index import index_job_taxa
+from .nextflow_trace import find_trace_file, import_trace
+from .profiling import profile_stage
+from .sequences import build_index
+
+logger = logging.getLogger(__name__)
+
+
+def generate_bacteria_plot(results_dir):
+    """
+    Run create_bacteria_barplot.py on a results directory
+
+    Returns:
+        Path to bacteria_composition.png, or None if it could not be generated
+    """
+    try:
+        script_path = Path(settings.BASE_DIR).parent.parent / 'analysis_bioinf' / 'create_bacteria_barplot.py'
+        if script_path.exists():
+            logger.info(f"Generating bacteria composition plot...")
+            plot_result = subprocess.run(
+                ['python3', str(script_path), str(results_dir)],
+                capture_output=True,
+                text=True,
+                timeout=60
+            )
+            if plot_result.returncode == 0:
+                bacteria_plot_path = Path(results_dir) / 'bacteria_composition.png'
+                logger.info(f"Bacteria plot generated: {bacteria_plot_path}")
+                return bacteria_plot_path
+            logger.warning(f"Could not generate bacteria plot: {plot_result.stderr}")
+    except Exception as e:
+        logger.warning(f"Error generating bacteria plot: {e}")
+    return None
+
+
+def ingest_results(job, results_dir, execution_time=None):
+    """
+    Save report, plot and summary files of a finished run on the job's AnalysisResult
+
+    Args:
+        job: AnalysisJob whose pipeline finished successfully
+        results_dir: Nextflow --outdir of the run
+        execution_time: Pipeline wall time in seconds
+
+    Returns:
+        AnalysisResult
+    """
+    job_id = job.job_id
+    results_dir = Path(results_dir)
+    
+    # Look for key output files
+    summary_report = results_dir / 'summary_report' / 'summary_report.html'
+    
+    # Generate bacteria composition plot
+    with profile_stage(job, 'plot generation'):
+        bacteria_plot_path = generate_bacteria_plot(results_dir)
+    
+    # Alpha/beta diversity from the ASV table, also for runs that skip the QIIME2 steps
+    diversity_files = None
+    if settings.DIVERSITY_ENABLED:
+        with profile_stage(job, 'diversity'):
+            try:
+                diversity_files = write_diversity(results_dir)
+            except Exception as e:
+                logger.warning(f"Could not compute diversity for job {job_id}: {e}")
+    
+    # faidx index for random access to ASV sequences
+    fasta = results_dir / 'dada2' / 'ASV_seqs.fasta'
+    if fasta.exists():
+        with profile_stage(job, 'sequence index'):
+            try:
+                build_index(fasta)
+            except Exception as e:
+                logger.warning(f"Could not index sequences for job {job_id}: {e}")
+        
+        # Cross-job search index
+        if settings.KMER_INDEX_ENABLED:
+            with profile_stage(job, 'kmer index'):
+                try:
+                    index_job(job)
+                except Exception as e:
+                    logger.warning(f"Could not add job {job_id} to the k-mer index: {e}")
+    
+    # Cross-job taxon search index
+    with profile_stage(job, 'taxon index'):
+        try:
+            index_job_taxa(job)
+        except Exception as e:
+            logger.warning(f"Could not index taxa of job {job_id}: {e}")
+    
+    with profile_stage(job, 'artifact ingestion'):
+        # Create AnalysisResult record
+        result_obj, _ = AnalysisResult.objects.get_or_create(job=job)
+        
+        # Save summary report if exists
+        if summary_report.exists():
+            with open(summary_report, 'rb') as f:
+                result_obj.report_html.save(
+                    f'summary_report_{job_id}.html',
+                    File(f),
+                    save=False
+                )
+            logger.info(f"Summary report saved")
+        
+        # Save bacteria composition plot if generated
+        if bacteria_plot_path and bacteria_plot_path.exists():
+            with open(bacteria_plot_path, 'rb') as f:
+                result_obj.taxonomy_plot.save(
+                    f'bacteria_composition_{job_id}.png',
+                    File(f),
+                    save=False
+                )
+            logger.info(f"Bacteria composition plot saved")
+        
+        # Save bacteria summary TSV if generated
+        bacteria_summary_path = results_dir / 'bacteria_summary.tsv'
+        if bacteria_summary_path.exists():
+            with open(bacteria_summary_path, 'rb') as f:
+                result_obj.taxonomy_data.save(
+                    f'bacteria_summary_{job_id}.tsv',
+                    File(f),
+                    save=False
+                )
+            logger.info(f"Bacteria summary data saved")
+        
+        # Save diversity tables if computed
+        if diversity_files:
+            attach_diversity(result_obj, *diversity_files)
+            logger.info(f"Diversity data saved")
+        
+        # Save execution info
+        result_obj.execution_time = execution_time
+        result_obj.save()
+        
+        # Per-task metrics from the Nextflow trace
+        trace_path = find_trace_file(results_dir)
+        if trace_path:
+            try:
+                import_trace(job, trace_path)
+            except Exception as e:
+                logger.warning(f"Could not import trace {trace_path}: {e}")
+        else:
+            logger.warning(f"No execution trace found in {results_dir}")
+    
+    return result_obj
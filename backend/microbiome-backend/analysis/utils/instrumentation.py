@@ -0,0 +1,191 @@
+"""
+Prometheus metrics for the API, the job queue and pipeline runs
+
+Event metrics (request latency, pipeline durations, queue wait, upload
+bytes) are prometheus_client counters/histograms. Under gunicorn set
+PROMETHEUS_MULTIPROC_DIR so every worker writes them to shared mmap files
+(see gunicorn.conf.py). State metrics (jobs by status, queue depth,
+running pipelines, disk usage) are read from the database and disk when
+/metrics is scraped, so they are always consistent across workers.
+"""
+import logging
+import os
+import shutil
+import threading
+import time
+from django.conf import settings
+from django.db.models import Count, Min
+from django.utils import timezone
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram,
+    generate_latest, multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+PIPELINE_BUCKETS = (60, 300, 600, 1200, 1800, 3600, 7200, 14400, 28800, 86400)
+QUEUE_WAIT_BUCKETS = (1, 5, 15, 60, 300, 900, 1800, 3600, 7200, 21600)
+
+REQUEST_LATENCY = Histogram(
+    'microbiome_http_request_duration_seconds',
+    'API request latency by view and DRF action',
+    ['view', 'action', 'method', 'status'],
+    buckets=LATENCY_BUCKETS,
+)
+PIPELINE_DURATION = Histogram(
+    'microbiome_pipeline_duration_seconds',
+    'Wall time of finished pipeline runs',
+    ['executor', 'outcome'],
+    buckets=PIPELINE_BUCKETS,
+)
+QUEUE_WAIT = Histogram(
+    'microbiome_queue_wait_seconds',
+    'Time jobs spent pending before their pipeline started',
+    ['executor'],
+    buckets=QUEUE_WAIT_BUCKETS,
+)
+UPLOAD_BYTES = Counter(
+    'microbiome_upload_bytes',
+    'Bytes of input files received (rate() gives upload bytes/sec)',
+    ['source'],
+)
+JOB_WRITE_WAIT = Histogram(
+    'microbiome_job_write_wait_seconds',
+    'Time job state writes waited for the process\'s writer',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+JOB_WRITE_BATCH = Histogram(
+    'microbiome_job_write_batch_jobs',
+    'Jobs written per job state transaction',
+    buckets=(1, 2, 5, 10, 20, 50, 100),
+)
+DB_LOCK_RETRIES = Counter(
+    'microbiome_db_lock_retries',
+    'Job state writes retried after "database is locked"',
+)
+DB_LOCK_ERRORS = Counter(
+    'microbiome_db_lock_errors',
+    'Job state writes that failed with "database is locked" after every retry',
+)
+
+
+def observe_request(request, response, seconds):
+    """Record one request against the view/action it resolved to"""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        view, action = 'unmatched', ''
+    else:
+        func = match.func
+        view = getattr(getattr(func, 'cls', None), '__name__', None) or match.url_name or func.__name__
+        action = (getattr(func, 'actions', None) or {}).get(request.method.lower(), '')
+    REQUEST_LATENCY.labels(view, action, request.method, str(response.status_code)).observe(seconds)
+
+
+def observe_pipeline(executor, outcome, seconds):
+    PIPELINE_DURATION.labels(executor, outcome).observe(seconds)
+
+
+def observe_queue_wait(job):
+    """Record how long a job waited between creation and its pipeline starting"""
+    wait = (timezone.now() - job.created_at).total_seconds()
+    QUEUE_WAIT.labels(job.executor or 'unknown').observe(max(wait, 0.0))
+
+
+def count_upload_bytes(source, size):
+    UPLOAD_BYTES.labels(source).inc(size)
+
+
+def observe_job_write(wait, jobs):
+    JOB_WRITE_WAIT.observe(wait)
+    JOB_WRITE_BATCH.observe(jobs)
+
+
+def count_lock_retry():
+    DB_LOCK_RETRIES.inc()
+
+
+def count_lock_error():
+    DB_LOCK_ERRORS.inc()
+
+
+class _DiskUsageCache:
+    """MEDIA_ROOT size, recomputed at most every MEDIA_DISK_USAGE_TTL seconds"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = None
+        self._computed_at = 0.0
+
+    def get(self):
+        with self._lock:
+            if self._value is None or time.monotonic() - self._computed_at >= settings.MEDIA_DISK_USAGE_TTL:
+                from .scratch import disk_usage
+                self._value = disk_usage(settings.MEDIA_ROOT) if os.path.isdir(settings.MEDIA_ROOT) else 0
+                self._computed_at = time.monotonic()
+            return self._value
+
+
+_disk_usage_cache = _DiskUsageCache()
+
+
+class JobStateCollector:
+    """Gauges read from the database and disk at scrape time"""
+
+    def collect(self):
+        from ..models import AnalysisJob
+
+        jobs = GaugeMetricFamily('microbiome_jobs', 'Analysis jobs by status', labels=['status'])
+        counts = dict(AnalysisJob.objects.order_by().values_list('status').annotate(n=Count('job_id')))
+        for job_status, _ in AnalysisJob.STATUS_CHOICES:
+            jobs.add_metric([job_status], counts.get(job_status, 0))
+        yield jobs
+
+        yield GaugeMetricFamily(
+            'microbiome_queue_depth', 'Jobs waiting for a pipeline to start',
+            value=counts.get('pending', 0),
+        )
+
+        oldest = AnalysisJob.objects.filter(status='pending').aggregate(oldest=Min('created_at'))['oldest']
+        yield GaugeMetricFamily(
+            'microbiome_queue_oldest_wait_seconds', 'Age of the oldest pending job',
+            value=(timezone.now() - oldest).total_seconds() if oldest else 0,
+        )
+
+        running = GaugeMetricFamily(
+            'microbiome_pipelines_running', 'Jobs with a pipeline in progress', labels=['executor'],
+        )
+        by_executor = AnalysisJob.objects.filter(status='processing').order_by() \
+            .values_list('executor').annotate(n=Count('job_id'))
+        for executor, n in by_executor:
+            running.add_metric([executor or 'unknown'], n)
+        yield running
+
+        yield GaugeMetricFamily(
+            'microbiome_media_bytes', 'Bytes used under MEDIA_ROOT',
+            value=_disk_usage_cache.get(),
+        )
+        if os.path.isdir(settings.MEDIA_ROOT):
+            fs = shutil.disk_usage(settings.MEDIA_ROOT)
+            yield GaugeMetricFamily('microbiome_media_fs_free_bytes', 'Free bytes on the MEDIA_ROOT filesystem', value=fs.free)
+            yield GaugeMetricFamily('microbiome_media_fs_size_bytes', 'Size of the MEDIA_ROOT filesystem', value=fs.total)
+
+
+def render_metrics():
+    """
+    Exposition text for /metrics
+
+    Returns:
+        (body, content_type)
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        # Merge the values written by every gunicorn worker
+        events = CollectorRegistry()
+        multiprocess.MultiProcessCollector(events)
+    else:
+        events = REGISTRY
+
+    state = CollectorRegistry()
+    state.register(JobStateCollector())
+    return generate_latest(events) + generate_latest(state), CONTENT_TYPE_LATEST
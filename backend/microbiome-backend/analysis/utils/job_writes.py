@@ -0,0 +1,107 @@
+"""
+Job state writes that are safe on SQLite
+
+Background job threads used to save() whole AnalysisJob rows. That rewrote
+every column, clobbering fields another thread or the Batch reconciler
+had changed in the meantime, and made every thread compete for SQLite's
+single write lock. update_job writes only the fields it is given, with an
+UPDATE, and all job writes of a process go through one writer at a time:
+the thread holding the writer lock writes every update queued so far (the
+latest value per job and field) in one transaction while the others wait
+for it. Jobs changing state at the same moment share one commit instead
+of queueing for the lock one by one.
+
+A write that still hits "database is locked" (another process kept the
+lock past the busy timeout) is retried with backoff. Waits, batch sizes,
+retries and failures are Prometheus metrics.
+
+Inside an atomic block an update is written straight away on the caller's
+connection, so it commits (or rolls back) with the caller's transaction.
+"""
+import logging
+import random
+import threading
+import time
+from django.conf import settings
+from django.db import OperationalError, transaction
+from django.utils import timezone
+from ..models import AnalysisJob
+from .instrumentation import count_lock_error, count_lock_retry, observe_job_write
+
+logger = logging.getLogger(__name__)
+
+_pending = {}  # job pk -> {field: value}
+_pending_lock = threading.Lock()
+_writer_lock = threading.Lock()
+
+
+def is_lock_error(error):
+    return isinstance(error, OperationalError) and 'locked' in str(error).lower()
+
+
+def update_job(job, **fields):
+    """
+    Set fields of a job and write them, with updated_at
+
+    Returns once the fields are committed (or, inside an atomic block,
+    written in the caller's transaction).
+
+    Raises:
+        OperationalError: when the database stays locked through every retry
+    """
+    fields['updated_at'] = timezone.now()
+    for name, value in fields.items():
+        setattr(job, name, value)
+
+    if transaction.get_connection().in_atomic_block:
+        _write({job.pk: fields})
+        return
+    with _pending_lock:
+        _pending.setdefault(job.pk, {}).update(fields)
+    flush()
+
+
+def flush():
+    """Write every queued job update in one transaction"""
+    started = time.monotonic()
+    with _writer_lock:
+        waited = time.monotonic() - started
+        with _pending_lock:
+            batch = dict(_pending)
+            _pending.clear()
+        if not batch:
+            # Written by the thread that held the writer before
+            return
+        observe_job_write(waited, len(batch))
+        try:
+            _write(batch)
+        except Exception:
+            _requeue(batch)
+            raise
+
+
+def _requeue(batch):
+    """Put back updates that failed to write; anything queued since is newer and wins"""
+    with _pending_lock:
+        for pk, fields in batch.items():
+            _pending[pk] = {**fields, **_pending.get(pk, {})}
+
+
+def _write(batch):
+    for attempt in range(settings.JOB_WRITE_RETRIES + 1):
+        try:
+            with transaction.atomic():
+                for pk, fields in batch.items():
+                    AnalysisJob.objects.filter(pk=pk).update(**fields)
+            return
+        except OperationalError as e:
+            if not is_lock_error(e):
+                raise
+            if attempt == settings.JOB_WRITE_RETRIES:
+                count_lock_error()
+                logger.error(f"Job state write of {len(batch)} jobs failed: {e}")
+                raise
+            count_lock_retry()
+            delay = min(0.1 * 2 ** attempt, 2.0) * random.uniform(0.5, 1.5)
+            logger.warning(f"Database locked writing {len(batch)} jobs, retrying in {delay:.2f}s")
+            time.sleep(delay)
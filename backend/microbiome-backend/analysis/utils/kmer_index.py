@@ -0,0 +1,379 @@
+"""
+Cross-job k-mer index of ASV sequences
+
+Answers "which jobs contain this sequence, or a close relative" by counting
+the k-mers a query shares with every indexed ASV. The index lives in
+MEDIA_ROOT/kmer_index/ as immutable segments, listed in manifest.json:
+
+- kmers.npy     sorted unique k-mers, 2 bits per base in a uint64 (k <= 32)
+- offsets.npy   posting list bounds: k-mer i occurs in postings[offsets[i]:offsets[i + 1]]
+- postings.npy  ASV ordinals (uint32), sorted within each k-mer
+- asv_jobs.npy  job ordinal of each ASV, into job_ids.json
+- asv_ids.npy   ASV_ID of each ASV
+
+Arrays are memory-mapped, so a search touches only the pages of the query's
+k-mers and their posting lists. Every finished job adds a segment, and
+segments are merged, smallest first, once there are more than
+KMER_MAX_SEGMENTS. K-mers are taken on the sequence as stored: ASVs are
+oriented by their primers, so reverse complements are not indexed.
+
+K-mers shared by more than KMER_MAX_POSTINGS ASVs (conserved 16S regions)
+are left out of the scores, which keeps search time bounded and loses
+little: they do not tell ASVs apart.
+"""
+import fcntl
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+from pathlib import Path
+import numpy as np
+from django.conf import settings
+from .sequences import fasta_path, read_fasta
+
+logger = logging.getLogger(__name__)
+
+Segment = namedtuple('Segment', ['name', 'kmers', 'offsets', 'postings', 'asv_jobs', 'asv_ids', 'job_ids'])
+
+# Sequences encoded per batch when building a segment
+ENCODE_BATCH = 50_000
+
+_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _bases in enumerate([b'Aa', b'Cc', b'Gg', b'Tt']):
+    for _base in _bases:
+        _CODES[_base] = _code
+
+_write_lock = threading.Lock()
+_read_lock = threading.Lock()
+_manifest_cache = {}
+_segment_cache = {}
+
+
+def index_dir():
+    return Path(settings.MEDIA_ROOT) / 'kmer_index'
+
+
+def encode_kmers(sequences, k):
+    """
+    All k-mers of the sequences, 2-bit encoded
+
+    Windows with a base other than A/C/G/T are skipped.
+
+    Returns:
+        (kmers, owner) - uint64 k-mers and the index of the sequence each came from
+    """
+    lengths = np.array([len(s) for s in sequences], dtype=np.int64)
+    if not len(lengths) or lengths.sum() < k:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+    codes = _CODES[np.frombuffer(''.join(sequences).encode('ascii', 'replace'), dtype=np.uint8)]
+    windows = len(codes) - k + 1
+
+    owner = np.repeat(np.arange(len(lengths)), lengths)
+    invalid = np.concatenate([[0], np.cumsum(codes > 3)])
+    valid = (owner[:windows] == owner[k - 1:]) & (invalid[k:] == invalid[:windows])
+
+    bits = (codes & 3).astype(np.uint64)
+    kmers = np.zeros(windows, dtype=np.uint64)
+    for j in range(k):
+        kmers = (kmers << np.uint64(2)) | bits[j:j + windows]
+    return kmers[valid], owner[:windows][valid]
+
+
+def _postings(kmers, asvs):
+    """Sorted unique k-mers, offsets and postings of (k-mer, ASV) pairs"""
+    order = np.lexsort((asvs, kmers))
+    kmers, asvs = kmers[order], asvs[order]
+    keep = np.ones(len(kmers), dtype=bool)
+    keep[1:] = (kmers[1:] != kmers[:-1]) | (asvs[1:] != asvs[:-1])
+    kmers, asvs = kmers[keep], asvs[keep]
+    unique, starts = np.unique(kmers, return_index=True)
+    offsets = np.append(starts, len(kmers)).astype(np.uint64)
+    return unique, offsets, asvs.astype(np.uint32)
+
+
+def _write_segment(root, kmers, offsets, postings, asv_jobs, asv_ids, job_ids):
+    name = f'seg-{uuid.uuid4().hex[:12]}'
+    partial = root / f'.{name}'
+    partial.mkdir(parents=True)
+    np.save(partial / 'kmers.npy', kmers)
+    np.save(partial / 'offsets.npy', offsets)
+    np.save(partial / 'postings.npy', postings)
+    np.save(partial / 'asv_jobs.npy', np.asarray(asv_jobs, dtype=np.uint32))
+    np.save(partial / 'asv_ids.npy', np.asarray(asv_ids, dtype=np.bytes_))
+    with open(partial / 'job_ids.json', 'w', encoding='utf-8') as f:
+        json.dump(list(job_ids), f)
+    os.replace(partial, root / name)
+    return name
+
+
+def _open_segment(root, name):
+    path = root / name
+    with open(path / 'job_ids.json', encoding='utf-8') as f:
+        job_ids = json.load(f)
+    return Segment(
+        name=name,
+        job_ids=job_ids,
+        **{
+            field: np.load(path / f'{field}.npy', mmap_mode='r')
+            for field in ['kmers', 'offsets', 'postings', 'asv_jobs', 'asv_ids']
+        },
+    )
+
+
+def _read_manifest(root):
+    path = root / 'manifest.json'
+    if not path.exists():
+        return {'k': settings.KMER_SIZE, 'segments': [], 'jobs': []}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_manifest(root, manifest):
+    partial = root / 'manifest.json.part'
+    with open(partial, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(partial, root / 'manifest.json')
+
+
+@contextmanager
+def _locked(root):
+    """Serialise writers across threads and processes"""
+    root.mkdir(parents=True, exist_ok=True)
+    with _write_lock, open(root / '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _merge_segments(root, names):
+    """Write one segment with the postings of several"""
+    segments = [_open_segment(root, name) for name in names]
+    job_ids = list(dict.fromkeys(job for seg in segments for job in seg.job_ids))
+    job_ordinal = {job: i for i, job in enumerate(job_ids)}
+
+    kmers, asvs, asv_jobs, asv_ids = [], [], [], []
+    base = 0
+    for seg in segments:
+        kmers.append(np.repeat(np.asarray(seg.kmers), np.diff(np.asarray(seg.offsets)).astype(np.int64)))
+        asvs.append(np.asarray(seg.postings, dtype=np.int64) + base)
+        remap = np.array([job_ordinal[job] for job in seg.job_ids], dtype=np.uint32)
+        asv_jobs.append(remap[np.asarray(seg.asv_jobs)])
+        asv_ids.append(np.asarray(seg.asv_ids))
+        base += len(seg.asv_ids)
+
+    unique, offsets, postings = _postings(np.concatenate(kmers), np.concatenate(asvs))
+    width = max(ids.dtype.itemsize for ids in asv_ids)
+    return _write_segment(
+        root, unique, offsets, postings,
+        np.concatenate(asv_jobs), np.concatenate([ids.astype(f'S{width}') for ids in asv_ids]), job_ids,
+    )
+
+
+def _compact(root, manifest):
+    """Merge the smallest segments while there are more than KMER_MAX_SEGMENTS"""
+    segments = manifest['segments']
+    excess = len(segments) - settings.KMER_MAX_SEGMENTS
+    if excess <= 0:
+        return []
+    sizes = {name: (root / name / 'postings.npy').stat().st_size for name in segments}
+    smallest = sorted(segments, key=sizes.get)[:excess + 1]
+    merged = _merge_segments(root, smallest)
+    manifest['segments'] = [name for name in segments if name not in smallest] + [merged]
+    logger.info(f"Merged {len(smallest)} k-mer index segments into {merged}")
+    return smallest
+
+
+def add_sequences(job_id, sequences, root=None):
+    """
+    Index ASV sequences of a job as a new segment
+
+    Args:
+        job_id: job the ASVs belong to
+        sequences: {asv_id: sequence}
+
+    Returns:
+        number of ASVs indexed
+    """
+    root = root or index_dir()
+    job_id = str(job_id)
+    if not sequences:
+        return 0
+
+    with _locked(root):
+        manifest = _read_manifest(root)
+        k = manifest['k']
+        asv_ids = list(sequences)
+        kmers, asvs = [], []
+        for start in range(0, len(asv_ids), ENCODE_BATCH):
+            batch = asv_ids[start:start + ENCODE_BATCH]
+            batch_kmers, owner = encode_kmers([sequences[a] for a in batch], k)
+            kmers.append(batch_kmers)
+            asvs.append(owner + start)
+        unique, offsets, postings = _postings(np.concatenate(kmers), np.concatenate(asvs))
+        name = _write_segment(
+            root, unique, offsets, postings, np.zeros(len(asv_ids), dtype=np.uint32), asv_ids, [job_id]
+        )
+
+        manifest['segments'].append(name)
+        if job_id not in manifest['jobs']:
+            manifest['jobs'].append(job_id)
+        merged = _compact(root, manifest)
+        _write_manifest(root, manifest)
+        # Readers that still map merged segments keep their (unlinked) files
+        for old in merged:
+            shutil.rmtree(root / old, ignore_errors=True)
+
+    logger.info(f"k-mer index: {len(asv_ids)} ASVs of job {job_id}, {len(unique)} distinct {k}-mers")
+    return len(asv_ids)
+
+
+def index_job(job, asv_ids=None):
+    """
+    Add a completed job's ASVs to the k-mer index
+
+    Args:
+        asv_ids: only these ASVs (e.g. those new to a study after adding
+            samples); by default the whole job, unless it is indexed already
+
+    Returns:
+        number of ASVs indexed
+    """
+    path = fasta_path(job)
+    if not path.exists():
+        return 0
+    if asv_ids is None and str(job.job_id) in _read_manifest(index_dir())['jobs']:
+        return 0
+    sequences = read_fasta(path)
+    if asv_ids is not None:
+        sequences = {asv_id: sequences[asv_id] for asv_id in asv_ids if asv_id in sequences}
+    return add_sequences(job.job_id, sequences)
+
+
+def load_index(root=None):
+    """
+    (manifest, segments) of the index, memory-mapped and cached until the manifest changes
+    """
+    root = root or index_dir()
+    path = root / 'manifest.json'
+    if not path.exists():
+        return _read_manifest(root), []
+    stat = path.stat()
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _read_lock:
+        cached = _manifest_cache.get(str(root))
+        if cached is not None and cached[0] == signature:
+            return cached[1], cached[2]
+
+    manifest = _read_manifest(root)
+    segments = []
+    with _read_lock:
+        for name in manifest['segments']:
+            key = (str(root), name)
+            if key not in _segment_cache:
+                _segment_cache[key] = _open_segment(root, name)
+            segments.append(_segment_cache[key])
+        live = {(str(root), name) for name in manifest['segments']}
+        for key in [key for key in _segment_cache if key[0] == str(root) and key not in live]:
+            del _segment_cache[key]
+        _manifest_cache[str(root)] = (signature, manifest, segments)
+    return manifest, segments
+
+
+def clear_cache():
+    with _read_lock:
+        _manifest_cache.clear()
+        _segment_cache.clear()
+
+
+def search(sequence, limit=20, min_fraction=0.0, root=None):
+    """
+    Indexed ASVs and jobs ranked by k-mers shared with a query sequence
+
+    Args:
+        sequence: query (DNA, any length >= k)
+        limit: ASVs and jobs to return
+        min_fraction: least fraction of the query's k-mers an ASV must
+            share to count as a hit (always at least one)
+
+    Returns:
+        dict with k, query_kmers, ignored_kmers (too common to score),
+        asvs [(job_id, asv_id, shared)] and jobs [(job_id, best_shared,
+        matching_asvs)], both best first
+
+    Raises:
+        ValueError: when the query has no valid k-mer
+    """
+    manifest, segments = load_index(root)
+    k = manifest['k']
+    query = np.unique(encode_kmers([sequence], k)[0])
+    if not len(query):
+        raise ValueError(f"Sequence has no {k}-mer of A/C/G/T")
+    min_shared = max(1, int(np.ceil(min_fraction * len(query))))
+
+    # Posting list bounds of each query k-mer in each segment
+    located = []
+    postings_per_kmer = np.zeros(len(query), dtype=np.int64)
+    for seg in segments:
+        pos = np.searchsorted(seg.kmers, query)
+        found = pos < len(seg.kmers)
+        found[found] = seg.kmers[pos[found]] == query[found]
+        starts = np.zeros(len(query), dtype=np.int64)
+        ends = np.zeros(len(query), dtype=np.int64)
+        starts[found] = seg.offsets[pos[found]]
+        ends[found] = seg.offsets[pos[found] + 1]
+        postings_per_kmer += ends - starts
+        located.append((seg, starts, ends))
+    scored = postings_per_kmer <= settings.KMER_MAX_POSTINGS
+
+    asv_hits = []
+    job_hits = {}
+    for seg, starts, ends in located:
+        spans = [(s, e) for s, e, use in zip(starts, ends, scored) if use and e > s]
+        if not spans:
+            continue
+        asvs, shared = np.unique(np.concatenate([seg.postings[s:e] for s, e in spans]), return_counts=True)
+        hit = shared >= min_shared
+        asvs, shared = asvs[hit], shared[hit]
+        if not len(asvs):
+            continue
+
+        top = np.argsort(-shared, kind='stable')[:limit]
+        asv_hits.extend(
+            (seg.job_ids[seg.asv_jobs[a]], seg.asv_ids[a].decode(), int(s))
+            for a, s in zip(asvs[top], shared[top])
+        )
+        jobs = np.asarray(seg.asv_jobs[asvs])
+        best = np.zeros(len(seg.job_ids), dtype=np.int64)
+        np.maximum.at(best, jobs, shared)
+        counts = np.bincount(jobs, minlength=len(seg.job_ids))
+        for ordinal in np.flatnonzero(counts):
+            job_id = seg.job_ids[ordinal]
+            previous_best, previous_count = job_hits.get(job_id, (0, 0))
+            job_hits[job_id] = (max(previous_best, int(best[ordinal])), previous_count + int(counts[ordinal]))
+
+    asv_hits.sort(key=lambda hit: -hit[2])
+    ranked_jobs = sorted(job_hits.items(), key=lambda item: (-item[1][0], -item[1][1]))
+    return {
+        'k': k,
+        'query_kmers': len(query),
+        'ignored_kmers': int((~scored).sum()),
+        'asvs': asv_hits[:limit],
+        'jobs': [(job_id, best, count) for job_id, (best, count) in ranked_jobs[:limit]],
+    }
+
+
+def rebuild(jobs):
+    """Replace the index with one over the given jobs; returns ASVs indexed"""
+    root = index_dir()
+    with _locked(root):
+        manifest = _read_manifest(root)
+        _write_manifest(root, {'k': settings.KMER_SIZE, 'segments': [], 'jobs': []})
+        for name in manifest['segments']:
+            shutil.rmtree(root / name, ignore_errors=True)
+    return sum(index_job(job) for job in jobs)
@@ -0,0 +1,210 @@
+"""
+Nextflow execution trace parsing and per-process metrics
+
+Runs started by run_nextflow_analysis write a raw trace (milliseconds,
+bytes) with the fields below. Traces produced elsewhere, e.g. nf-core's
+own pipeline_info/execution_trace_<timestamp>.txt from Batch runs, use
+human-readable values ("57.5s", "16.9 MB", "226.3%") and are parsed too.
+"""
+import csv
+import logging
+import re
+from pathlib import Path
+import numpy as np
+from django.db import transaction
+from ..models import ProcessMetric
+
+logger = logging.getLogger(__name__)
+
+TRACE_FILE_NAME = 'execution_trace.txt'
+REPORT_FILE_NAME = 'execution_report.html'
+
+TRACE_FIELDS = [
+    'task_id', 'hash', 'native_id', 'process', 'name', 'status', 'exit', 'attempt',
+    'submit', 'duration', 'realtime', '%cpu', 'peak_rss', 'peak_vmem', 'rchar', 'wchar',
+]
+
+# Metrics summarised per process, and the percentiles reported for each
+SUMMARY_FIELDS = ['realtime', 'duration', 'cpu_percent', 'peak_rss', 'read_bytes', 'write_bytes']
+PERCENTILES = [50, 90, 95]
+
+_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+_MEMORY_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4, 'PB': 1024 ** 5}
+_DURATION_RE = re.compile(r'([\d.]+)\s*(ms|s|m|h|d)')
+
+
+def write_trace_config(job_dir):
+    """
+    Write the config that makes trace output raw and complete
+
+    Returns:
+        Path of the config file, to pass with -c
+    """
+    config_path = Path(job_dir) / 'metrics.config'
+    config_path.write_text(
+        "// Written by the backend: machine-readable trace for ProcessMetric\n"
+        "trace {\n"
+        "    overwrite = true\n"
+        "    raw = true\n"
+        f"    fields = '{','.join(TRACE_FIELDS)}'\n"
+        "}\n"
+        "report.overwrite = true\n"
+    )
+    return config_path
+
+
+def _is_missing(value):
+    return value is None or value.strip() in ('', '-')
+
+
+def parse_duration(value):
+    """'1h 2m 3s' / '57.5s' / '120ms' / raw milliseconds -> seconds"""
+    if _is_missing(value):
+        return None
+    value = value.strip()
+    try:
+        return float(value) / 1000.0  # raw trace
+    except ValueError:
+        pass
+    parts = _DURATION_RE.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def parse_memory(value):
+    """'16.9 MB' / '512 KB' / raw bytes -> bytes"""
+    if _is_missing(value):
+        return None
+    value = value.strip()
+    try:
+        return int(float(value))
+    except ValueError:
+        pass
+    number, _, unit = value.partition(' ')
+    try:
+        return int(float(number) * _MEMORY_UNITS[unit.strip().upper()])
+    except (KeyError, ValueError):
+        return None
+
+
+def parse_percent(value):
+    """'226.3%' / raw number -> float"""
+    if _is_missing(value):
+        return None
+    try:
+        return float(value.strip().rstrip('%'))
+    except ValueError:
+        return None
+
+
+def parse_int(value):
+    if _is_missing(value):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def process_name(row):
+    """Short process name: the 'process' field, else the task name without workflow path and tag"""
+    if not _is_missing(row.get('process')):
+        return row['process'].strip().split(':')[-1]
+    name = row.get('name', '').split(' (')[0]
+    return name.split(':')[-1]
+
+
+def parse_trace(trace_path):
+    """
+    Parse a Nextflow trace file
+
+    Returns:
+        List of unsaved ProcessMetric instances (without job)
+    """
+    metrics = []
+    with open(trace_path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f, delimiter='\t'):
+            task_id = parse_int(row.get('task_id'))
+            if task_id is None:
+                continue
+            metrics.append(ProcessMetric(
+                task_id=task_id,
+                process=process_name(row)[:255],
+                name=row.get('name', '')[:512],
+                status=row.get('status', '').strip(),
+                exit_status=parse_int(row.get('exit')),
+                attempt=parse_int(row.get('attempt')) or 1,
+                duration=parse_duration(row.get('duration')),
+                realtime=parse_duration(row.get('realtime')),
+                cpu_percent=parse_percent(row.get('%cpu')),
+                peak_rss=parse_memory(row.get('peak_rss')),
+                peak_vmem=parse_memory(row.get('peak_vmem')),
+                read_bytes=parse_memory(row.get('rchar')),
+                write_bytes=parse_memory(row.get('wchar')),
+            ))
+    return metrics
+
+
+def find_trace_file(results_dir):
+    """Trace written by our -with-trace, else the newest nf-core execution trace"""
+    pipeline_info = Path(results_dir) / 'pipeline_info'
+    trace_path = pipeline_info / TRACE_FILE_NAME
+    if trace_path.exists():
+        return trace_path
+    candidates = sorted(pipeline_info.glob('execution_trace*.txt'), key=lambda p: p.stat().st_mtime)
+    return candidates[-1] if candidates else None
+
+
+def import_trace(job, trace_path):
+    """
+    Replace a job's ProcessMetric rows with the tasks of a trace file
+
+    Returns:
+        Number of tasks imported
+    """
+    metrics = parse_trace(trace_path)
+    for metric in metrics:
+        metric.job = job
+    with transaction.atomic():
+        ProcessMetric.objects.filter(job=job).delete()
+        ProcessMetric.objects.bulk_create(metrics, batch_size=500)
+    logger.info(f"Imported {len(metrics)} trace records for job {job.job_id}")
+    return len(metrics)
+
+
+def summarize_metrics(metrics):
+    """
+    Per-process task counts, totals and percentiles
+
+    Args:
+        metrics: ProcessMetric queryset
+
+    Returns:
+        List of dicts, one per process, slowest (by total realtime) first
+    """
+    by_process = {}
+    for row in metrics.values('process', 'status', 'attempt', *SUMMARY_FIELDS):
+        by_process.setdefault(row['process'], []).append(row)
+
+    summary = []
+    for process, tasks in by_process.items():
+        entry = {
+            'process': process,
+            'tasks': len(tasks),
+            'failed': sum(1 for t in tasks if t['status'] == 'FAILED'),
+            'retried': sum(1 for t in tasks if (t['attempt'] or 1) > 1),
+            'total_realtime': sum(t['realtime'] or 0 for t in tasks),
+        }
+        for field in SUMMARY_FIELDS:
+            values = np.array([t[field] for t in tasks if t[field] is not None], dtype=float)
+            if values.size == 0:
+                entry[field] = None
+                continue
+            stats = {f'p{p}': float(v) for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))}
+            stats['max'] = float(values.max())
+            entry[field] = stats
+        summary.append(entry)
+
+    summary.sort(key=lambda e: e['total_realtime'], reverse=True)
+    return summary
@@ -0,0 +1,157 @@
+"""
+Quick-look preview runs on subsampled reads
+
+For jobs uploaded with preview=true, the FASTQ preflight reservoir-samples
+PREVIEW_READ_PAIRS read pairs into uploads/<job_id>/preview/reads/. Before
+the full run, ampliseq runs on those with every optional step skipped, and
+the genus-level composition of the result is stored on the job
+(GET /api/jobs/{job_id}/preview/). The full run starts right after, in the
+same directory, so it reuses the pipeline download and conda environments.
+A failed preview never fails the job.
+"""
+import csv
+import logging
+import subprocess
+import time
+from pathlib import Path
+import pandas as pd
+from django.conf import settings
+from django.utils import timezone
+from .fastq import find_read_pair
+from .job_writes import update_job
+from .taxonomy import load_taxonomy
+
+logger = logging.getLogger(__name__)
+
+# Everything downstream of DADA2 taxonomy (as for test data, plus QIIME2)
+PREVIEW_SKIP_FLAGS = [
+    '--skip_fastqc',
+    '--skip_barrnap',
+    '--skip_qiime',
+    '--skip_barplot',
+    '--skip_abundance_tables',
+    '--skip_alpha_rarefaction',
+    '--skip_diversity_indices',
+    '--skip_ancom',
+    '--skip_multiqc',
+]
+
+
+def preview_dir(job):
+    return Path(settings.MEDIA_ROOT) / 'uploads' / str(job.job_id) / 'preview'
+
+
+def write_preview_samplesheet(job):
+    """
+    Samplesheet for the sampled reads, or None when they were not written
+    """
+    reads_dir = preview_dir(job) / 'reads'
+    files = [f for f in job.files.all() if (reads_dir / f.file_name).exists()]
+    if job.data_type == 'paired-end':
+        r1, r2 = find_read_pair(files)
+        if r1 is None or r2 is None:
+            return None
+        row = ['sample1', str(reads_dir / r1.file_name), str(reads_dir / r2.file_name), 'A']
+    else:
+        if not files:
+            return None
+        row = ['sample1', str(reads_dir / files[0].file_name), '', 'A']
+
+    samplesheet_path = preview_dir(job) / 'samplesheet.csv'
+    with open(samplesheet_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, delimiter=',', lineterminator='\n')
+        writer.writerow(['sampleID', 'forwardReads', 'reverseReads', 'run'])
+        writer.writerow(row)
+    return samplesheet_path
+
+
+def preview_command(cmd, samplesheet_path, results_dir):
+    """The full run's command pointed at the sampled reads, with optional steps skipped"""
+    replacements = {
+        '--input': str(samplesheet_path),
+        '--outdir': str(results_dir),
+        '-with-trace': str(results_dir / 'pipeline_info' / 'execution_trace.txt'),
+        '-with-report': str(results_dir / 'pipeline_info' / 'execution_report.html'),
+    }
+    preview_cmd = list(cmd)
+    for i, arg in enumerate(preview_cmd[:-1]):
+        if arg in replacements:
+            preview_cmd[i + 1] = replacements[arg]
+    return preview_cmd + [flag for flag in PREVIEW_SKIP_FLAGS if flag not in preview_cmd]
+
+
+def genus_composition(results_dir):
+    """
+    Reads per genus across all samples, from the DADA2 ASV table and taxonomy
+
+    Returns:
+        list of {genus, family, phylum, reads, percent}, most abundant first
+    """
+    dada2_dir = Path(results_dir) / 'dada2'
+    taxonomy_files = sorted(dada2_dir.glob('ASV_tax.*.tsv')) or sorted(dada2_dir.glob('ASV_tax_species.*.tsv'))
+    if not taxonomy_files:
+        raise FileNotFoundError(f"No ASV taxonomy table in {dada2_dir}")
+
+    reads = pd.read_csv(dada2_dir / 'ASV_table.tsv', sep='\t', index_col='ASV_ID').sum(axis=1)
+    taxonomy = load_taxonomy(taxonomy_files[0], ranks=['Phylum', 'Family', 'Genus'])
+    ranks = taxonomy.reindex(reads.index).astype(object).fillna('Unknown').replace('', 'Unknown')
+    ranks['reads'] = reads
+    genera = ranks.groupby(['Genus', 'Family', 'Phylum'])['reads'].sum().sort_values(ascending=False)
+    total = float(reads.sum()) or 1.0
+
+    return [
+        {
+            'genus': genus,
+            'family': family,
+            'phylum': phylum,
+            'reads': int(count),
+            'percent': round(100 * count / total, 2),
+        }
+        for (genus, family, phylum), count in genera.items()
+        if count > 0
+    ]
+
+
+def run_preview(job, cmd, executor, env=None, cwd=None):
+    """
+    Run the reduced pipeline on the sampled reads and store the composition
+
+    Args:
+        cmd: the full run's nextflow command
+        executor: a local executor (the preview finishes before the full run is submitted)
+    """
+    samplesheet_path = write_preview_samplesheet(job)
+    if samplesheet_path is None:
+        logger.warning(f"No sampled reads for the preview of job {job.job_id}")
+        update_job(job, preview_status='failed')
+        return
+
+    results_dir = preview_dir(job) / 'results'
+    (results_dir / 'pipeline_info').mkdir(parents=True, exist_ok=True)
+    update_job(job, preview_status='running')
+
+    started = time.monotonic()
+    try:
+        executor.submit(job, preview_command(cmd, samplesheet_path, results_dir), cwd=cwd, env=env)
+        result = executor.wait(job, timeout=settings.PREVIEW_TIMEOUT)
+        if result.returncode != 0:
+            raise RuntimeError(f"preview pipeline exited with {result.returncode}: {result.stderr[-500:]}")
+        job.preview_composition = genus_composition(results_dir)
+        job.preview_status = 'completed'
+        job.preview_completed_at = timezone.now()
+        logger.info(
+            f"Preview for job {job.job_id} ready in {time.monotonic() - started:.0f}s "
+            f"({len(job.preview_composition)} genera)"
+        )
+    except subprocess.TimeoutExpired:
+        logger.warning(f"Preview for job {job.job_id} timed out after {settings.PREVIEW_TIMEOUT}s")
+        job.preview_status = 'failed'
+    except Exception as e:
+        logger.warning(f"Preview for job {job.job_id} failed: {e}")
+        job.preview_status = 'failed'
+    update_job(
+        job,
+        preview_status=job.preview_status,
+        preview_composition=job.preview_composition,
+        preview_completed_at=job.preview_completed_at,
+    )
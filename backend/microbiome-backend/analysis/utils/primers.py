@@ -0,0 +1,178 @@
+"""
+Amplicon primer detection from the first reads of a job's inputs
+
+ampliseq trims primers with cutadapt anchored at the 5' end of each read,
+so reads from another region than the configured primers are almost all
+discarded. Here the first PRIMER_SAMPLE_READS reads of R1 (and R2) are
+compared against a panel of common primer pairs before the pipeline
+starts. Reads and IUPAC primers are encoded as 4-bit base masks, and
+every primer is matched at the read start against the whole sample at
+once with numpy, allowing cutadapt's default 10% mismatches.
+"""
+import logging
+from collections import namedtuple
+from pathlib import Path
+import numpy as np
+from django.conf import settings
+from .fastq import find_read_pair, head_sequences
+from .job_writes import update_job
+
+logger = logging.getLogger(__name__)
+
+PrimerPair = namedtuple('PrimerPair', ['name', 'region', 'forward', 'reverse', 'supported'])
+
+# supported=False: recognised so the job can be rejected with a reason, but the
+# pipeline runs with a 16S reference taxonomy (--dada_ref_taxonomy gtdb)
+PRIMER_PANEL = [
+    PrimerPair('515F-806R', '16S V4', 'GTGYCAGCMGCCGCGGTAA', 'GGACTACNVGGGTWTCTAAT', True),
+    PrimerPair('341F-805R', '16S V3-V4', 'CCTACGGGNGGCWGCAG', 'GACTACHVGGGTATCTAATCC', True),
+    PrimerPair('27F-338R', '16S V1-V2', 'AGAGTTTGATCMTGGCTCAG', 'TGCTGCCTCCCGTAGGAGT', True),
+    PrimerPair('515F-926R', '16S V4-V5', 'GTGYCAGCMGCCGCGGTAA', 'CCGYCAATTYMTTTRAGTTT', True),
+    PrimerPair('799F-1193R', '16S V5-V7', 'AACMGGATTAGATACCCKG', 'ACGTCATCCCCACCTTCC', True),
+    PrimerPair('967F-1391R', '16S V6-V8', 'CAACGCGAAGAACCTTACC', 'GACGGGCGGTGWGTRCA', True),
+    PrimerPair('ITS1F-ITS2', 'fungal ITS1', 'CTTGGTCATTTAGAGGAAGTAA', 'GCTGCGTTCTTCATCGATGC', False),
+    PrimerPair('fITS7-ITS4', 'fungal ITS2', 'GTGARTCATCGAATCTTTG', 'TCCTCCGCTTATTGATATGC', False),
+    PrimerPair('TAReuk454FWD1-TAReukREV3', '18S V4', 'CCAGCASCYGCGGTAATTCC', 'ACTTTCGTTCTTGATYRA', False),
+]
+DEFAULT_PRIMER_PAIR = PRIMER_PANEL[0]
+
+IUPAC = {
+    'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T', 'U': 'T',
+    'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT', 'M': 'AC',
+    'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT',
+}
+_BIT = {'A': 1, 'C': 2, 'G': 4, 'T': 8}
+
+# Read bytes -> base mask; N (and anything unknown) matches every primer base
+_READ_MASKS = np.full(256, 15, dtype=np.uint8)
+for _base, _bit in _BIT.items():
+    _READ_MASKS[ord(_base)] = _READ_MASKS[ord(_base.lower())] = _bit
+_READ_MASKS[ord('U')] = _READ_MASKS[ord('u')] = _BIT['T']
+
+
+class PrimerDetectionError(ValueError):
+    """No usable primer pair was found in the reads"""
+
+
+def get_primer_pair(name):
+    """Panel entry by name, DEFAULT_PRIMER_PAIR for an empty name"""
+    if not name:
+        return DEFAULT_PRIMER_PAIR
+    return next(pair for pair in PRIMER_PANEL if pair.name == name)
+
+
+def _primer_mask(primer):
+    return np.array([sum(_BIT[b] for b in IUPAC[base]) for base in primer.upper()], dtype=np.uint8)
+
+
+def encode_reads(sequences, length):
+    """(reads x length) matrix of base masks; shorter reads are padded with 0 (never matches)"""
+    matrix = np.zeros((len(sequences), length), dtype=np.uint8)
+    for i, seq in enumerate(sequences):
+        prefix = seq[:length]
+        matrix[i, :len(prefix)] = _READ_MASKS[np.frombuffer(prefix, dtype=np.uint8)]
+    return matrix
+
+
+def match_primer(reads, primer, max_error_rate):
+    """
+    Which reads start with the primer
+
+    Args:
+        reads: matrix from encode_reads, at least as wide as the primer
+        primer: IUPAC primer sequence
+        max_error_rate: mismatches allowed per primer base (cutadapt's -e)
+
+    Returns:
+        boolean array, one entry per read
+    """
+    mask = _primer_mask(primer)
+    mismatches = ((reads[:, :len(mask)] & mask) == 0).sum(axis=1)
+    return mismatches <= int(len(mask) * max_error_rate)
+
+
+def detect_primers(r1_sequences, r2_sequences=None, max_error_rate=0.1):
+    """
+    Score every panel pair against sampled reads
+
+    Paired-end: the fraction of read pairs with the forward primer at the
+    start of R1 and the reverse primer at the start of R2. Single-end: the
+    fraction of reads starting with the forward primer (pairs sharing a
+    forward primer tie, and the earlier panel entry wins).
+
+    Returns:
+        list of (PrimerPair, fraction), best first
+    """
+    width = max(max(len(p.forward), len(p.reverse)) for p in PRIMER_PANEL)
+    r1 = encode_reads(r1_sequences, width)
+    r2 = encode_reads(r2_sequences[:len(r1_sequences)], width) if r2_sequences else None
+    if r2 is not None:
+        r1 = r1[:len(r2)]
+    if not len(r1):
+        return []
+
+    cache = {}
+
+    def hits(reads, which, primer):
+        key = (which, primer)
+        if key not in cache:
+            cache[key] = match_primer(reads, primer, max_error_rate)
+        return cache[key]
+
+    scores = []
+    for pair in PRIMER_PANEL:
+        matched = hits(r1, 'r1', pair.forward)
+        if r2 is not None:
+            matched = matched & hits(r2, 'r2', pair.reverse)
+        scores.append((pair, float(matched.mean())))
+    # Stable sort keeps panel order among ties
+    return sorted(scores, key=lambda score: -score[1])
+
+
+def detect_job_primers(job):
+    """
+    Pick the primer pair for a job from the first reads of its inputs and
+    store it on the job
+
+    Returns:
+        the chosen PrimerPair, or None when the inputs are not on local disk
+
+    Raises:
+        PrimerDetectionError: when no pair matches enough reads, or the best
+            pair targets a region the pipeline does not analyse
+    """
+    media_root = Path(settings.MEDIA_ROOT)
+    files = [f for f in job.files.all() if (media_root / f.file.name).is_file()]
+    if job.data_type == 'paired-end':
+        r1, r2 = find_read_pair(files)
+    else:
+        r1, r2 = (files[0] if files else None), None
+    if r1 is None or (job.data_type == 'paired-end' and r2 is None):
+        return None
+
+    limit = settings.PRIMER_SAMPLE_READS
+    r1_sequences = head_sequences(media_root / r1.file.name, limit)
+    r2_sequences = head_sequences(media_root / r2.file.name, limit) if r2 else None
+    scores = detect_primers(r1_sequences, r2_sequences, max_error_rate=settings.PRIMER_MAX_ERROR_RATE)
+    if not scores:
+        raise PrimerDetectionError("No reads to detect primers from")
+
+    best, fraction = scores[0]
+    unit = 'read pairs' if r2 else 'reads'
+    summary = ', '.join(f"{pair.name} {share:.0%}" for pair, share in scores[:3])
+    logger.info(f"Primer detection for job {job.job_id} ({len(r1_sequences)} {unit}): {summary}")
+
+    if fraction < settings.PRIMER_MIN_MATCH_FRACTION:
+        raise PrimerDetectionError(
+            f"No known primer pair found at the start of the reads "
+            f"(best: {best.name} {best.region} in {fraction:.0%} of {unit}; "
+            f"{settings.PRIMER_MIN_MATCH_FRACTION:.0%} needed). Are primers already trimmed?"
+        )
+    if not best.supported:
+        raise PrimerDetectionError(
+            f"Reads carry {best.name} ({best.region}) primers ({fraction:.0%} of {unit}); "
+            f"only 16S rRNA amplicons are supported"
+        )
+
+    update_job(job, primer_set=best.name, primer_match_fraction=fraction)
+    return best
@@ -0,0 +1,144 @@
+"""
+On-demand profiling of requests and job stages, stored as Profile rows
+
+pyinstrument (a sampling profiler, in requirements.txt) is used; cProfile,
+with its per-call overhead, only when it is missing. Only one profile runs at a time per process: the
+interpreter allows a single active profiler, and tracemalloc is global.
+"""
+import cProfile
+import io
+import logging
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from ..models import Profile
+
+try:
+    from pyinstrument import Profiler as SamplingProfiler
+except ImportError:  # optional, falls back to cProfile
+    SamplingProfiler = None
+
+logger = logging.getLogger(__name__)
+
+CPROFILE_LINES = 40
+TRACEMALLOC_TOP = 15
+
+_active = threading.Lock()
+
+
+class _Run:
+    """One profiling session of the current thread"""
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.started_tracemalloc = False
+        self.profiler_name = 'pyinstrument' if SamplingProfiler else 'cprofile'
+        self.report = ''
+        self.report_html = ''
+        self.memory_peak = None
+        self.memory_top = ''
+        self.duration = 0.0
+
+    def start(self):
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracemalloc = True
+            tracemalloc.reset_peak()
+        if SamplingProfiler:
+            self.profiler = SamplingProfiler()
+            self.profiler.start()
+        else:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.started = time.perf_counter()
+
+    def stop(self):
+        self.duration = time.perf_counter() - self.started
+        if SamplingProfiler:
+            self.profiler.stop()
+            self.report = self.profiler.output_text(unicode=True, color=False)
+            self.report_html = self.profiler.output_html()
+        else:
+            self.profiler.disable()
+            stream = io.StringIO()
+            pstats.Stats(self.profiler, stream=stream).sort_stats('cumulative').print_stats(CPROFILE_LINES)
+            self.report = stream.getvalue()
+
+        if self.trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            self.memory_peak = tracemalloc.get_traced_memory()[1]
+            stats = snapshot.statistics('lineno')[:TRACEMALLOC_TOP]
+            self.memory_top = '\n'.join(str(stat) for stat in stats)
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+
+
+@contextmanager
+def profiling(trace_memory=False):
+    """
+    Profile the enclosed block of the current thread
+
+    Yields a run whose report, duration and memory fields are filled in on
+    exit, or None when another profile is already running in this process.
+    """
+    if not _active.acquire(blocking=False):
+        logger.debug("Profiler busy, skipping")
+        yield None
+        return
+    run = _Run(trace_memory=trace_memory)
+    try:
+        try:
+            run.start()
+        except Exception as e:
+            # e.g. a debugger or coverage tool already holds the profiling hook
+            logger.warning(f"Could not start profiler: {e}")
+            yield None
+            return
+        try:
+            yield run
+        finally:
+            run.stop()
+    finally:
+        _active.release()
+
+
+def save_profile(run, kind, name, **fields):
+    """Store a finished run as a Profile"""
+    try:
+        return Profile.objects.create(
+            kind=kind,
+            name=name[:255],
+            profiler=run.profiler_name,
+            duration=run.duration,
+            report=run.report,
+            report_html=run.report_html,
+            memory_peak=run.memory_peak,
+            memory_top=run.memory_top,
+            **fields,
+        )
+    except Exception as e:
+        logger.warning(f"Could not save profile {name}: {e}")
+        return None
+
+
+@contextmanager
+def profile_stage(job, stage):
+    """
+    Profile a stage of a job's orchestration (with tracemalloc) if the job
+    has profiling switched on; a no-op otherwise
+    """
+    if not job.profile:
+        yield
+        return
+    run = None
+    try:
+        with profiling(trace_memory=True) as run:
+            yield
+    finally:
+        # Failed stages are saved too
+        if run is not None:
+            save_profile(run, 'job', f"{stage} ({job.job_id})", job=job)
+            logger.info(f"Profiled {stage} for job {job.job_id} in {run.duration:.2f}s")
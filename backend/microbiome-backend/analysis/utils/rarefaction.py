@@ -0,0 +1,184 @@
+"""
+Alpha rarefaction curves without QIIME2
+
+Each sample's ASV counts are subsampled without replacement at a grid of
+depths with numpy's multivariate hypergeometric sampler, `iterations`
+times per depth in one call, and observed ASVs and Shannon entropy are
+averaged over the iterations. Samples are spread over a process pool.
+Every sample gets its own random stream spawned from the seed, so results
+do not depend on the number of workers.
+
+Curves of a job are cached as JSON under results/rarefaction/, keyed by
+the ASV table's modification time and the parameters. The cache is bounded:
+curves of an older ASV table are dropped, and only the
+RAREFACTION_CACHE_SIZE most recently used parameter sets are kept per job.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import numpy as np
+from django.conf import settings
+from .compare import asv_table_path, load_counts
+
+logger = logging.getLogger(__name__)
+
+METRICS = ['observed', 'shannon']
+
+
+def depth_grid(max_depth, steps, min_depth=1):
+    """Evenly spaced integer depths from min_depth to max_depth (as QIIME2 alpha-rarefaction)"""
+    return np.unique(np.linspace(min_depth, max_depth, steps).round().astype(np.int64))
+
+
+def rarefy_sample(values, depths, iterations, seed):
+    """
+    Rarefaction curve of one sample
+
+    Args:
+        values: the sample's non-zero ASV counts
+        depths: sorted subsampling depths
+        iterations: subsamples per depth
+        seed: int or numpy SeedSequence
+
+    Returns:
+        array (metric, mean/sd, depth); NaN at depths above the sample's reads
+    """
+    rng = np.random.default_rng(seed)
+    values = np.asarray(values, dtype=np.int64)
+    curve = np.full((len(METRICS), 2, len(depths)), np.nan)
+    total = values.sum()
+    for k, depth in enumerate(depths):
+        if depth > total:
+            break
+        draws = rng.multivariate_hypergeometric(values, depth, size=iterations)
+        observed = (draws > 0).sum(axis=1)
+        p = draws / depth
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shannon = -np.where(p > 0, p * np.log2(p), 0.0).sum(axis=1)
+        curve[0, :, k] = observed.mean(), observed.std()
+        curve[1, :, k] = shannon.mean(), shannon.std()
+    return curve
+
+
+def _rarefy_chunk(tasks):
+    return [rarefy_sample(*task) for task in tasks]
+
+
+def _json_values(array):
+    return [[None if np.isnan(v) else round(float(v), 4) for v in row] for row in array]
+
+
+def rarefaction_curves(counts, samples, depths, iterations, seed=0, workers=1):
+    """
+    Rarefaction curves of all samples
+
+    Args:
+        counts: CSR matrix, samples x ASVs
+        samples: sample names, one per row
+        workers: processes to use; small inputs are rarefied in this process
+
+    Returns:
+        dict with depths, samples, and per metric 'mean' and 'sd' arrays
+        (one list per sample, one value per depth, None above its reads)
+    """
+    counts = counts.tocsr()
+    seeds = np.random.SeedSequence(seed).spawn(counts.shape[0])
+    tasks = [
+        (counts.data[counts.indptr[i]:counts.indptr[i + 1]], depths, iterations, seeds[i])
+        for i in range(counts.shape[0])
+    ]
+
+    if workers > 1 and len(tasks) >= settings.RAREFACTION_PARALLEL_MIN_SAMPLES:
+        chunks = [chunk for chunk in np.array_split(np.arange(len(tasks)), workers * 4) if len(chunk)]
+        # spawn: the caller may be a threaded web worker
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as pool:
+            results = pool.map(_rarefy_chunk, [[tasks[i] for i in chunk] for chunk in chunks])
+            curves = [curve for chunk in results for curve in chunk]
+    else:
+        curves = _rarefy_chunk(tasks)
+
+    stacked = np.stack(curves) if curves else np.empty((0, len(METRICS), 2, len(depths)))
+    return {
+        'depths': [int(d) for d in depths],
+        'iterations': iterations,
+        'seed': seed,
+        'samples': list(samples),
+        **{
+            metric: {'mean': _json_values(stacked[:, m, 0]), 'sd': _json_values(stacked[:, m, 1])}
+            for m, metric in enumerate(METRICS)
+        },
+    }
+
+
+def _evict_cached_curves(cache_path):
+    """Remove curves of older ASV tables and all but the most recently used ones"""
+    table_key = cache_path.name.split('-', 1)[0]
+    cached = []
+    for path in cache_path.parent.glob('*.json'):
+        try:
+            if not path.name.startswith(f'{table_key}-'):
+                path.unlink(missing_ok=True)
+            else:
+                cached.append((path.stat().st_mtime_ns, path))
+        except OSError:
+            # Removed by a concurrent request
+            continue
+    cached.sort(reverse=True)
+    for _, path in cached[max(settings.RAREFACTION_CACHE_SIZE, 1):]:
+        if path != cache_path:
+            path.unlink(missing_ok=True)
+
+
+def get_job_rarefaction(job, steps=None, iterations=None, max_depth=None, seed=0):
+    """
+    Rarefaction curves of a job's ASV table, from the cache when current
+
+    max_depth defaults to the deepest sample.
+
+    Raises:
+        FileNotFoundError: when the job has no ASV table
+    """
+    table_path = asv_table_path(job)
+    if not table_path.exists():
+        raise FileNotFoundError(f"Job {job.job_id} has no ASV table")
+    steps = steps or settings.RAREFACTION_STEPS
+    iterations = iterations or settings.RAREFACTION_ITERATIONS
+
+    stat = table_path.stat()
+    table_key = hashlib.sha1(f"{stat.st_mtime_ns}:{stat.st_size}".encode()).hexdigest()[:12]
+    params_key = hashlib.sha1(f"{steps}:{iterations}:{max_depth}:{seed}".encode()).hexdigest()[:16]
+    cache_path = table_path.parent.parent / 'rarefaction' / f'{table_key}-{params_key}.json'
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            curves = json.load(f)
+    except FileNotFoundError:
+        pass
+    else:
+        try:
+            # Mark as recently used for eviction
+            os.utime(cache_path)
+        except OSError:
+            pass
+        return curves
+
+    matrix = load_counts(table_path)
+    reads = np.asarray(matrix.counts.sum(axis=1)).ravel()
+    depths = depth_grid(max_depth or max(int(reads.max(initial=0)), 1), steps)
+    curves = rarefaction_curves(
+        matrix.counts, matrix.samples, depths, iterations, seed=seed, workers=settings.RAREFACTION_WORKERS
+    )
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # A temporary file of its own, so concurrent requests never share one
+    with tempfile.NamedTemporaryFile(
+        'w', encoding='utf-8', dir=cache_path.parent, prefix=f'.{cache_path.name}.', suffix='.part', delete=False
+    ) as f:
+        json.dump(curves, f, separators=(',', ':'))
+    os.replace(f.name, cache_path)
+    _evict_cached_curves(cache_path)
+    logger.info(f"Rarefaction of job {job.job_id}: {len(matrix.samples)} samples, {len(depths)} depths")
+    return curves
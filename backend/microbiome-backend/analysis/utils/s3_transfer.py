@@ -0,0 +1,366 @@
+"""
+Parallel multipart transfers between MEDIA_ROOT and S3
+
+Job inputs are synced up to s3://<bucket>/uploads/<job_id>/ and selected
+result subtrees are synced down from s3://<bucket>/results/<job_id>/.
+Files uploaded straight to S3 (DirectUpload) are downloaded for runs on
+this host.
+Objects whose size and ETag already match are skipped.
+"""
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """Shared S3 client, created on first use"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            import boto3
+            _client = boto3.client(
+                's3',
+                region_name=settings.AWS_S3_REGION_NAME,
+                endpoint_url=settings.AWS_S3_ENDPOINT_URL or None,
+            )
+        return _client
+
+
+def compute_etag(path, part_size, part_count=None):
+    """
+    ETag S3 gives an object uploaded from path with the given part size
+
+    Single-part objects have the plain MD5; multipart objects have the MD5
+    of the concatenated part MD5s followed by '-<part count>'.
+    """
+    size = os.path.getsize(path)
+    if part_count is None:
+        part_count = 1 if size <= part_size else math.ceil(size / part_size)
+
+    part_digests = []
+    whole = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(part_size)
+            if not chunk:
+                break
+            if part_count == 1:
+                whole.update(chunk)
+            else:
+                part_digests.append(hashlib.md5(chunk).digest())
+
+    if part_count == 1:
+        return f'"{whole.hexdigest()}"'
+    return f'"{hashlib.md5(b"".join(part_digests)).hexdigest()}-{len(part_digests)}"'
+
+
+def etag_matches(path, etag, part_size):
+    """Check a local file against a remote ETag, inferring the remote part size"""
+    etag = etag.strip('"')
+    if '-' not in etag:
+        return compute_etag(path, part_size, part_count=1).strip('"') == etag
+
+    part_count = int(etag.rsplit('-', 1)[1])
+    size = os.path.getsize(path)
+    candidates = [part_size, math.ceil(size / part_count / MB) * MB]
+    for candidate in dict.fromkeys(candidates):
+        if math.ceil(size / candidate) == part_count:
+            if compute_etag(path, candidate, part_count=part_count).strip('"') == etag:
+                return True
+    return False
+
+
+class TransferStats:
+    """Counters for one sync run"""
+
+    def __init__(self, direction):
+        self.direction = direction
+        self.files_transferred = 0
+        self.files_skipped = 0
+        self.bytes_transferred = 0
+        self.bytes_skipped = 0
+        self.errors = []
+        self.started = time.monotonic()
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add_transferred(self, size):
+        with self._lock:
+            self.files_transferred += 1
+            self.bytes_transferred += size
+
+    def add_skipped(self, size):
+        with self._lock:
+            self.files_skipped += 1
+            self.bytes_skipped += size
+
+    def add_error(self, name, error):
+        with self._lock:
+            self.errors.append(f"{name}: {error}")
+
+    def finish(self):
+        self.seconds = time.monotonic() - self.started
+        return self
+
+    @property
+    def throughput_mb_s(self):
+        if not self.seconds:
+            return 0.0
+        return self.bytes_transferred / MB / self.seconds
+
+    def as_dict(self):
+        return {
+            'direction': self.direction,
+            'files_transferred': self.files_transferred,
+            'files_skipped': self.files_skipped,
+            'bytes_transferred': self.bytes_transferred,
+            'bytes_skipped': self.bytes_skipped,
+            'seconds': round(self.seconds, 3),
+            'throughput_mb_s': round(self.throughput_mb_s, 2),
+            'errors': list(self.errors),
+        }
+
+    def __str__(self):
+        return (
+            f"{self.direction}: {self.files_transferred} files / {self.bytes_transferred / MB:.1f} MB "
+            f"transferred, {self.files_skipped} skipped, {self.seconds:.1f}s "
+            f"({self.throughput_mb_s:.1f} MB/s), {len(self.errors)} errors"
+        )
+
+
+class S3Transfer:
+    """Concurrent multipart uploads/downloads with skip-if-unchanged"""
+
+    def __init__(self, client=None, part_size=None, concurrency=None, file_concurrency=None):
+        self.client = client or get_s3_client()
+        self.part_size = max(part_size or settings.S3_TRANSFER_PART_SIZE, 5 * MB)
+        self.concurrency = concurrency or settings.S3_TRANSFER_CONCURRENCY
+        self.file_concurrency = file_concurrency or settings.S3_TRANSFER_FILE_CONCURRENCY
+
+    @property
+    def transfer_config(self):
+        from boto3.s3.transfer import TransferConfig
+        return TransferConfig(
+            multipart_threshold=self.part_size,
+            multipart_chunksize=self.part_size,
+            max_concurrency=self.concurrency,
+            use_threads=self.concurrency > 1,
+        )
+
+    def list_objects(self, bucket, prefix):
+        """Map key -> (size, etag) for every object under a prefix"""
+        objects = {}
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                objects[obj['Key']] = (obj['Size'], obj['ETag'])
+        return objects
+
+    def _unchanged(self, path, remote):
+        if remote is None:
+            return False
+        size, etag = remote
+        return os.path.getsize(path) == size and etag_matches(path, etag, self.part_size)
+
+    def _run(self, tasks, stats, transfer):
+        """Run (name, size, fn-args) tasks across file_concurrency threads"""
+        def run_one(task):
+            name, size, args = task
+            try:
+                transfer(*args)
+                stats.add_transferred(size)
+            except Exception as e:
+                logger.error(f"Transfer of {name} failed: {e}")
+                stats.add_error(name, e)
+
+        with ThreadPoolExecutor(max_workers=self.file_concurrency) as pool:
+            list(pool.map(run_one, tasks))
+        return stats.finish()
+
+    def upload_files(self, files, bucket):
+        """
+        Upload local files to S3
+
+        Args:
+            files: iterable of (local_path, key)
+
+        Returns:
+            TransferStats
+        """
+        files = list(files)
+        stats = TransferStats('upload')
+        prefix = os.path.commonprefix([key for _, key in files]) if files else ''
+        remote = self.list_objects(bucket, prefix) if files else {}
+        config = self.transfer_config
+
+        tasks = []
+        for path, key in files:
+            size = os.path.getsize(path)
+            if self._unchanged(path, remote.get(key)):
+                stats.add_skipped(size)
+                continue
+            tasks.append((key, size, (str(path), bucket, key)))
+
+        result = self._run(
+            tasks, stats,
+            lambda path, bucket, key: self.client.upload_file(path, bucket, key, Config=config),
+        )
+        logger.info(f"s3://{bucket}/{prefix} {result}")
+        return result
+
+    def upload_dir(self, local_dir, bucket, prefix):
+        """Upload every file under local_dir to s3://bucket/prefix/"""
+        local_dir = Path(local_dir)
+        prefix = prefix.rstrip('/') + '/'
+        files = [
+            (path, prefix + path.relative_to(local_dir).as_posix())
+            for path in sorted(local_dir.rglob('*')) if path.is_file()
+        ]
+        return self.upload_files(files, bucket)
+
+    def download_prefix(self, bucket, prefix, local_dir, subtrees=None):
+        """
+        Download objects under s3://bucket/prefix/ into local_dir
+
+        Args:
+            subtrees: optional relative subdirectories to restrict the download to
+                (e.g. ['dada2', 'summary_report'])
+
+        Returns:
+            TransferStats
+        """
+        local_dir = Path(local_dir)
+        prefix = prefix.rstrip('/') + '/'
+        subtrees = [s.strip('/') for s in subtrees or [] if s.strip('/')]
+        stats = TransferStats('download')
+        config = self.transfer_config
+
+        tasks = []
+        for key, (size, etag) in sorted(self.list_objects(bucket, prefix).items()):
+            rel_path = key[len(prefix):]
+            if not rel_path or rel_path.endswith('/'):
+                continue
+            if subtrees and not any(rel_path == s or rel_path.startswith(s + '/') for s in subtrees):
+                continue
+            path = local_dir / rel_path
+            if not path.resolve().is_relative_to(local_dir.resolve()):
+                stats.add_error(key, 'refusing to write outside the target directory')
+                continue
+            if path.is_file() and self._unchanged(path, (size, etag)):
+                stats.add_skipped(size)
+                continue
+            tasks.append((key, size, (bucket, key, path, config)))
+
+        result = self._run(tasks, stats, self._download)
+        logger.info(f"s3://{bucket}/{prefix} {result}")
+        return result
+
+    def download_files(self, files, bucket):
+        """
+        Download S3 objects to local files
+
+        Args:
+            files: iterable of (key, local_path)
+
+        Returns:
+            TransferStats
+        """
+        files = list(files)
+        stats = TransferStats('download')
+        prefix = os.path.commonprefix([key for key, _ in files]) if files else ''
+        remote = self.list_objects(bucket, prefix) if files else {}
+        config = self.transfer_config
+
+        tasks = []
+        for key, path in files:
+            path = Path(path)
+            if key not in remote:
+                stats.add_error(key, 'no such object')
+                continue
+            size, etag = remote[key]
+            if path.is_file() and self._unchanged(path, (size, etag)):
+                stats.add_skipped(size)
+                continue
+            tasks.append((key, size, (bucket, key, path, config)))
+
+        result = self._run(tasks, stats, self._download)
+        logger.info(f"s3://{bucket}/{prefix} {result}")
+        return result
+
+    def _download(self, bucket, key, path, config):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.client.download_file(bucket, key, str(path), Config=config)
+
+
+def sync_job_inputs(job, transfer=None):
+    """
+    Upload a job's input files to s3://<bucket>/uploads/<job_id>/
+
+    Direct-to-S3 uploads, and other files not on disk whose storage key is
+    the destination, are already there and are left out.
+    """
+    transfer = transfer or S3Transfer()
+    uploaded = direct_upload_keys(job)
+    files = []
+    for f in job.files.all():
+        path = Path(settings.MEDIA_ROOT) / f.file.name
+        key = f"uploads/{job.job_id}/{f.file_name}"
+        if f.file.name in uploaded or (f.file.name == key and not path.is_file()):
+            continue
+        files.append((path, key))
+    stats = transfer.upload_files(files, settings.AWS_STORAGE_BUCKET_NAME)
+    if stats.errors:
+        raise IOError(f"Failed to upload inputs for job {job.job_id}: {'; '.join(stats.errors)}")
+    return stats
+
+
+def download_job_inputs(job, transfer=None):
+    """
+    Download a job's direct-to-S3 uploads to their paths under MEDIA_ROOT,
+    for a run on this host
+
+    Returns:
+        TransferStats, or None when the job has no direct uploads
+    """
+    keys = direct_upload_keys(job)
+    if not keys:
+        return None
+    transfer = transfer or S3Transfer()
+    files = [(f.file.name, Path(settings.MEDIA_ROOT) / f.file.name) for f in job.files.all() if f.file.name in keys]
+    stats = transfer.download_files(files, settings.AWS_STORAGE_BUCKET_NAME)
+    if stats.errors:
+        raise IOError(f"Failed to download inputs for job {job.job_id}: {'; '.join(stats.errors)}")
+    return stats
+
+
+def direct_upload_keys(job):
+    """S3 keys of the job's completed direct-to-S3 uploads"""
+    return set(job.direct_uploads.filter(status='completed').values_list('key', flat=True))
+
+
+def download_job_results(job, subtrees=None, transfer=None):
+    """Download s3://<bucket>/results/<job_id>/ subtrees into the job's results directory"""
+    transfer = transfer or S3Transfer()
+    results_dir = Path(settings.MEDIA_ROOT) / 'uploads' / str(job.job_id) / 'results'
+    stats = transfer.download_prefix(
+        settings.AWS_STORAGE_BUCKET_NAME,
+        f"results/{job.job_id}/",
+        results_dir,
+        subtrees=subtrees,
+    )
+    if stats.errors:
+        raise IOError(f"Failed to download results for job {job.job_id}: {'; '.join(stats.errors)}")
+    return stats
@@ -0,0 +1,163 @@
+"""
+Presigned multipart uploads straight from the browser to S3
+"""
+import hashlib
+import logging
+import math
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+MIN_PART_SIZE = 5 * 1024 * 1024  # S3 minimum for all parts but the last
+MAX_PARTS = 10000  # S3 maximum number of parts per upload
+
+
+class UploadVerificationError(Exception):
+    """Raised when uploaded parts don't match what the client declared"""
+
+
+def get_part_size(file_size):
+    """Part size for a file, growing past the default to stay under MAX_PARTS"""
+    part_size = max(settings.DIRECT_UPLOAD_PART_SIZE, MIN_PART_SIZE)
+    if file_size > part_size * MAX_PARTS:
+        mb = 1024 * 1024
+        part_size = math.ceil(file_size / MAX_PARTS / mb) * mb
+    return part_size
+
+
+def get_part_count(file_size, part_size):
+    return max(1, math.ceil(file_size / part_size))
+
+
+def multipart_etag(part_etags):
+    """ETag S3 assigns to a completed multipart object with the given part ETags"""
+    digest = hashlib.md5()
+    for etag in part_etags:
+        digest.update(bytes.fromhex(etag.strip('"')))
+    return f'"{digest.hexdigest()}-{len(part_etags)}"'
+
+
+class DirectUploadClient:
+    """Create, sign, verify and complete multipart uploads"""
+
+    def __init__(self):
+        self._s3 = None
+
+    @property
+    def s3(self):
+        if self._s3 is None:
+            import boto3
+            self._s3 = boto3.client(
+                's3',
+                region_name=settings.AWS_S3_REGION_NAME,
+                endpoint_url=settings.AWS_S3_ENDPOINT_URL or None,
+            )
+        return self._s3
+
+    @property
+    def bucket(self):
+        return settings.AWS_STORAGE_BUCKET_NAME
+
+    def start_upload(self, key, file_size):
+        """
+        Initiate a multipart upload and presign a URL for every part
+
+        Returns:
+            dict with upload_id, part_size and parts [{part_number, url}]
+        """
+        part_size = get_part_size(file_size)
+        part_count = get_part_count(file_size, part_size)
+
+        response = self.s3.create_multipart_upload(Bucket=self.bucket, Key=key)
+        upload_id = response['UploadId']
+
+        parts = [
+            {
+                'part_number': part_number,
+                'url': self.s3.generate_presigned_url(
+                    'upload_part',
+                    Params={
+                        'Bucket': self.bucket,
+                        'Key': key,
+                        'UploadId': upload_id,
+                        'PartNumber': part_number,
+                    },
+                    ExpiresIn=settings.DIRECT_UPLOAD_URL_EXPIRY,
+                ),
+            }
+            for part_number in range(1, part_count + 1)
+        ]
+        logger.info(f"Started multipart upload {upload_id} for s3://{self.bucket}/{key} ({part_count} parts)")
+        return {'upload_id': upload_id, 'part_size': part_size, 'parts': parts}
+
+    def _list_parts(self, key, upload_id):
+        parts = []
+        kwargs = {'Bucket': self.bucket, 'Key': key, 'UploadId': upload_id}
+        while True:
+            response = self.s3.list_parts(**kwargs)
+            parts.extend(response.get('Parts', []))
+            if not response.get('IsTruncated'):
+                return parts
+            kwargs['PartNumberMarker'] = response['NextPartNumberMarker']
+
+    def complete_upload(self, key, upload_id, file_size, client_parts):
+        """
+        Verify the uploaded parts against the client's ETags and the
+        declared size, then complete the upload.
+
+        Args:
+            client_parts: list of {part_number, etag} reported by the browser
+
+        Raises:
+            UploadVerificationError: on missing parts, ETag or size mismatch
+        """
+        expected_count = get_part_count(file_size, get_part_size(file_size))
+        client_etags = {int(p['part_number']): p['etag'].strip('"') for p in client_parts}
+        if sorted(client_etags) != list(range(1, expected_count + 1)):
+            raise UploadVerificationError(
+                f"{key}: expected parts 1..{expected_count}, got {sorted(client_etags)}"
+            )
+
+        stored = {p['PartNumber']: p for p in self._list_parts(key, upload_id)}
+        for part_number, etag in client_etags.items():
+            part = stored.get(part_number)
+            if part is None:
+                raise UploadVerificationError(f"{key}: part {part_number} was never uploaded")
+            if part['ETag'].strip('"') != etag:
+                raise UploadVerificationError(f"{key}: ETag mismatch for part {part_number}")
+
+        uploaded_size = sum(stored[n]['Size'] for n in client_etags)
+        if uploaded_size != file_size:
+            raise UploadVerificationError(
+                f"{key}: uploaded {uploaded_size} bytes, expected {file_size}"
+            )
+
+        ordered = sorted(client_etags.items())
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': f'"{e}"'} for n, e in ordered]},
+        )
+
+        head = self.s3.head_object(Bucket=self.bucket, Key=key)
+        if head['ContentLength'] != file_size:
+            raise UploadVerificationError(
+                f"{key}: stored object is {head['ContentLength']} bytes, expected {file_size}"
+            )
+        if head['ETag'] != multipart_etag([e for _, e in ordered]):
+            raise UploadVerificationError(f"{key}: object ETag does not match uploaded parts")
+
+        logger.info(f"Completed multipart upload {upload_id} for s3://{self.bucket}/{key}")
+        return head['ETag']
+
+    def abort_upload(self, key, upload_id):
+        try:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            logger.info(f"Aborted multipart upload {upload_id} for s3://{self.bucket}/{key}")
+        except Exception as e:
+            logger.warning(f"Failed to abort multipart upload {upload_id}: {e}")
+
+
+# Singleton instance (boto3 client is created on first use)
+direct_upload_client = DirectUploadClient()
@@ -0,0 +1,187 @@
+"""
+Lifecycle of Nextflow scratch data under media/uploads/<job_id>/
+
+Every run leaves a work/ tree, the .nextflow cache and logs, and conda
+environments next to its inputs and results. Scratch is removed:
+- for completed jobs, once their outputs are registered (AnalysisResult exists)
+- for failed jobs, after SCRATCH_FAILED_GRACE_HOURS (until then -resume can reuse work/)
+- oldest first, whenever total scratch exceeds SCRATCH_DISK_BUDGET_BYTES
+
+Inputs, samplesheets and results/ are never touched, nor are jobs that
+are still pending or processing.
+"""
+import logging
+import os
+import shutil
+import uuid
+from datetime import timedelta
+from pathlib import Path
+from django.conf import settings
+from django.utils import timezone
+from ..models import AnalysisJob, AnalysisResult
+
+logger = logging.getLogger(__name__)
+
+# Entries of a job directory that only the pipeline run needs
+SCRATCH_DIRS = ('work', '.nextflow', 'conda')
+SCRATCH_FILE_PATTERN = '.nextflow.log*'
+
+ACTIVE_STATUSES = ('pending', 'processing')
+
+
+def get_uploads_root():
+    return Path(settings.MEDIA_ROOT) / 'uploads'
+
+
+def get_scratch_paths(job_dir):
+    """Scratch entries present in a job directory"""
+    job_dir = Path(job_dir)
+    paths = [job_dir / name for name in SCRATCH_DIRS if (job_dir / name).is_dir()]
+    paths.extend(entry for entry in sorted(job_dir.glob(SCRATCH_FILE_PATTERN)) if entry.is_file())
+    return paths
+
+
+def disk_usage(path):
+    """
+    Bytes used by a file or directory tree.
+
+    Symlinks are not followed: Nextflow work dirs link back to the inputs,
+    which must not be counted (or deleted) as scratch.
+    """
+    path = Path(path)
+    if path.is_symlink() or path.is_file():
+        return path.lstat().st_size
+
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            total += entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return total
+
+
+def _remove(path):
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        path.unlink(missing_ok=True)
+
+
+def collect_scratch():
+    """
+    Scratch usage for every job directory that belongs to a known job
+
+    Returns:
+        List of dicts with job, paths, bytes and last_used (oldest first)
+    """
+    job_dirs = {}
+    uploads_root = get_uploads_root()
+    if not uploads_root.is_dir():
+        return []
+
+    for entry in uploads_root.iterdir():
+        # Skip upload_to date folders and anything else that isn't a job directory
+        try:
+            job_dirs[uuid.UUID(entry.name)] = entry
+        except ValueError:
+            continue
+
+    jobs = AnalysisJob.objects.filter(job_id__in=job_dirs).select_related('result')
+    candidates = []
+    for job in jobs:
+        paths = get_scratch_paths(job_dirs[job.job_id])
+        if not paths:
+            continue
+        candidates.append({
+            'job': job,
+            'paths': paths,
+            'bytes': sum(disk_usage(p) for p in paths),
+            'last_used': job.completed_at or job.updated_at,
+        })
+    candidates.sort(key=lambda c: c['last_used'])
+    return candidates
+
+
+def _has_registered_outputs(job):
+    try:
+        return job.result is not None
+    except AnalysisResult.DoesNotExist:
+        return False
+
+
+def cleanup_scratch(budget_bytes=None, failed_grace=None, dry_run=False, now=None):
+    """
+    Remove scratch data that is no longer needed, then evict the oldest
+    remaining scratch until the total fits in the disk budget.
+
+    Args:
+        budget_bytes: max total scratch size (default SCRATCH_DISK_BUDGET_BYTES)
+        failed_grace: timedelta to keep failed jobs' scratch for -resume
+            (default SCRATCH_FAILED_GRACE_HOURS)
+        dry_run: only report what would be removed
+
+    Returns:
+        dict with scanned, removed (job IDs), reclaimed_bytes and remaining_bytes
+    """
+    if budget_bytes is None:
+        budget_bytes = settings.SCRATCH_DISK_BUDGET_BYTES
+    if failed_grace is None:
+        failed_grace = timedelta(hours=settings.SCRATCH_FAILED_GRACE_HOURS)
+    now = now or timezone.now()
+
+    candidates = collect_scratch()
+    stats = {
+        'scanned': len(candidates),
+        'removed': [],
+        'reclaimed_bytes': 0,
+        'remaining_bytes': sum(c['bytes'] for c in candidates),
+    }
+
+    def evict(candidate, reason):
+        job = candidate['job']
+        logger.info(
+            f"{'Would remove' if dry_run else 'Removing'} {candidate['bytes']} bytes of scratch "
+            f"for job {job.job_id} ({reason})"
+        )
+        if not dry_run:
+            for path in candidate['paths']:
+                _remove(path)
+        stats['removed'].append(str(job.job_id))
+        stats['reclaimed_bytes'] += candidate['bytes']
+        stats['remaining_bytes'] -= candidate['bytes']
+
+    # Lifecycle rules
+    evictable = []
+    for candidate in candidates:
+        job = candidate['job']
+        if job.status in ACTIVE_STATUSES:
+            continue
+        if job.status == 'completed' and _has_registered_outputs(job):
+            evict(candidate, 'completed')
+        elif job.status == 'failed' and now - candidate['last_used'] >= failed_grace:
+            evict(candidate, 'failed, grace period expired')
+        else:
+            evictable.append(candidate)
+
+    # Disk budget: oldest first, never touching active runs
+    for candidate in evictable:
+        if stats['remaining_bytes'] <= budget_bytes:
+            break
+        evict(candidate, 'over disk budget')
+
+    if stats['remaining_bytes'] > budget_bytes:
+        logger.warning(
+            f"Scratch usage {stats['remaining_bytes']} bytes is still over the budget "
+            f"of {budget_bytes} bytes (remaining scratch belongs to active jobs)"
+        )
+    return stats
@@ -0,0 +1,215 @@
+"""
+Random access to ASV sequences through a faidx index
+
+dada2/ASV_seqs.fasta gets a samtools-compatible .fai index next to it when
+the job is ingested: one line per record with its name, sequence length,
+byte offset of the first base, bases per line and bytes per line. A lookup
+seeks straight to the record and reads only its bytes, so the cost does not
+depend on the size of the FASTA file. Indexes are kept parsed in an LRU
+cache, invalidated when the .fai file changes. An index whose last record
+ends before the end of the FASTA file is out of date and is not used.
+
+Records appended to the FASTA (samples added to a study) are indexed by
+scanning from the old end of the file only.
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+FaiEntry = namedtuple('FaiEntry', ['length', 'offset', 'line_bases', 'line_width'])
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class SequenceIndexError(ValueError):
+    """A FASTA file has no usable index"""
+
+
+def fasta_path(job):
+    return Path(settings.MEDIA_ROOT) / 'uploads' / str(job.job_id) / 'results' / 'dada2' / 'ASV_seqs.fasta'
+
+
+def index_path(path):
+    path = Path(path)
+    return path.with_name(path.name + '.fai')
+
+
+def read_fasta(path):
+    """{id: sequence} of a FASTA file"""
+    sequences = {}
+    name = None
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                name = line[1:].split()[0]
+                sequences[name] = ''
+            elif name is not None:
+                sequences[name] += line
+    return sequences
+
+
+def _scan(f, start):
+    """Yield (name, FaiEntry) of the records from byte offset start (at a '>' line)"""
+    f.seek(start)
+    offset = start
+    name = None
+    length = seq_offset = line_bases = line_width = 0
+    last_short = False
+    for line in f:
+        if line.startswith(b'>'):
+            if name is not None:
+                yield name, FaiEntry(length, seq_offset, line_bases, line_width)
+            name = line[1:].split()[0].decode()
+            length = line_bases = line_width = 0
+            seq_offset = offset + len(line)
+            last_short = False
+        elif name is not None:
+            bases = len(line.rstrip(b'\r\n'))
+            if bases:
+                if last_short or (line_bases and bases > line_bases):
+                    raise SequenceIndexError(f"Record {name} has lines of different lengths")
+                if not line_bases:
+                    line_bases, line_width = bases, len(line)
+                last_short = bases < line_bases
+                length += bases
+        offset += len(line)
+    if name is not None:
+        yield name, FaiEntry(length, seq_offset, line_bases, line_width)
+
+
+def build_index(path, start=0):
+    """
+    Write the .fai index of a FASTA file
+
+    Args:
+        path: FASTA file
+        start: byte offset of the first record to index; with start > 0 the
+            records from there on are appended to the existing index
+
+    Returns:
+        number of records indexed
+
+    Raises:
+        SequenceIndexError: when a record's lines are not of equal length
+            (all but the last), which faidx cannot represent
+    """
+    path = Path(path)
+    fai = index_path(path)
+    partial_path = fai.with_name(fai.name + '.part')
+    records = 0
+    with open(path, 'rb') as f, open(partial_path, 'w', encoding='utf-8') as out:
+        if start:
+            with open(fai, encoding='utf-8') as existing:
+                out.writelines(existing)
+        for name, entry in _scan(f, start):
+            out.write(f"{name}\t{entry.length}\t{entry.offset}\t{entry.line_bases}\t{entry.line_width}\n")
+            records += 1
+    os.replace(partial_path, fai)
+    logger.info(f"Indexed {records} sequences of {path}")
+    return records
+
+
+def load_index(path):
+    """
+    Index of a FASTA file, from the cache when current
+
+    Returns:
+        DataFrame indexed by record name, with the FaiEntry fields as columns
+
+    Raises:
+        FileNotFoundError: when the FASTA file does not exist
+        SequenceIndexError: when the FASTA has no index, or records the index does not cover
+    """
+    path = Path(path)
+    fai = index_path(path)
+    if not path.exists():
+        raise FileNotFoundError(f"No FASTA file {path}")
+    if not fai.exists():
+        raise SequenceIndexError(f"{path.name} has no sequence index")
+
+    stat = fai.stat()
+    key = str(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None and cached[0] == signature:
+            _cache.move_to_end(key)
+            index, end = cached[1]
+        else:
+            index = None
+
+    if index is None:
+        index = pd.read_csv(
+            fai,
+            sep='\t',
+            header=None,
+            names=['name', *FaiEntry._fields],
+            usecols=range(5),
+            index_col='name',
+            dtype={'name': str, **{field: np.int64 for field in FaiEntry._fields}},
+        )
+        # Offset of the last base + 1, over all records (line breaks included)
+        line_bases = index['line_bases'].clip(lower=1)
+        full_lines, rest = np.divmod(index['length'], line_bases)
+        record_bytes = np.where(index['line_bases'] > 0, full_lines * index['line_width'] + rest, 0)
+        end = int((index['offset'] + record_bytes).max()) if len(index) else 0
+        with _cache_lock:
+            _cache[key] = (signature, (index, end))
+            _cache.move_to_end(key)
+            while len(_cache) > settings.SEQUENCE_INDEX_CACHE_SIZE:
+                _cache.popitem(last=False)
+
+    # Allow for the last line's line break
+    if path.stat().st_size > end + 2:
+        raise SequenceIndexError(f"Sequence index of {path.name} is out of date")
+    return index
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+
+
+def _record_bytes(entry):
+    """Bytes from the first base to the last (line breaks included, except the last one when it is a short line)"""
+    if not entry.line_bases:
+        return 0
+    full_lines, rest = divmod(entry.length, entry.line_bases)
+    return full_lines * entry.line_width + rest
+
+
+def _read_record(f, entry):
+    if not entry.length:
+        return ''
+    f.seek(entry.offset)
+    data = f.read(_record_bytes(entry))
+    return data.replace(b'\n', b'').replace(b'\r', b'').decode()
+
+
+def fetch_sequences(path, names):
+    """
+    Sequences of the named records
+
+    Records are read in file order, one seek each.
+
+    Returns:
+        ({name: sequence}, [names not in the index])
+    """
+    index = load_index(path)
+    names = list(dict.fromkeys(names))
+    found = [name for name in names if name in index.index]
+    sequences = {}
+    with open(path, 'rb') as f:
+        for entry in index.loc[found].sort_values('offset').itertuples():
+            sequences[entry.Index] = _read_record(f, entry)
+    missing = [name for name in names if name not in sequences]
+    return sequences, missing
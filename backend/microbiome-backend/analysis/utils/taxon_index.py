@@ -0,0 +1,137 @@
+"""
+Taxon -> job index for searching taxa across all completed jobs
+
+When a job's results are ingested, its reads per taxon at every rank are
+written to TaxonAbundance rows (rank, taxon, job, reads, relative
+abundance). Searches filter on rank, a taxon-name prefix and a minimum
+relative abundance, and page with a keyset cursor over the composite index
+(rank, taxon_key, -relative_abundance, id), so a page costs an index range
+scan over the matches rather than a pass over every job.
+
+The prefix is turned into a range on taxon_key (>= prefix, < prefix with
+its last character incremented) instead of LIKE, which SQLite would not
+answer from the index.
+"""
+import base64
+import binascii
+import json
+import logging
+import numpy as np
+from django.db import transaction
+from django.db.models import Q
+from ..models import TaxonAbundance
+from .compare import RANKS, CompareError, get_job_counts, taxonomy_path
+from .taxonomy import read_header
+
+logger = logging.getLogger(__name__)
+
+UNCLASSIFIED = 'Unclassified'
+
+
+def job_taxon_rows(job):
+    """
+    Unsaved TaxonAbundance rows of a job, from its ASV table and taxonomy
+
+    ASVs without a name at a rank, and ranks the taxonomy table lacks, are
+    left out; abundances are relative to all of the job's reads.
+
+    Raises:
+        CompareError: when the job has no ASV or taxonomy table
+    """
+    tax_path = taxonomy_path(job)
+    if tax_path is None:
+        raise CompareError(f"Job {job.job_id} has no taxonomy table")
+    header = read_header(tax_path)
+
+    rows = []
+    for rank in [rank for rank in RANKS if rank.capitalize() in header]:
+        matrix = get_job_counts(job, rank)
+        reads = np.asarray(matrix.counts.sum(axis=0)).ravel()
+        total = reads.sum()
+        if not total:
+            continue
+        for taxon, taxon_reads in zip(matrix.features, reads):
+            if taxon == UNCLASSIFIED or not taxon_reads:
+                continue
+            rows.append(TaxonAbundance(
+                job=job,
+                rank=rank,
+                taxon=taxon[:255],
+                taxon_key=taxon[:255].lower(),
+                reads=int(taxon_reads),
+                relative_abundance=float(taxon_reads / total),
+            ))
+    return rows
+
+
+def index_job_taxa(job):
+    """
+    Replace a job's rows in the taxon index
+
+    Returns:
+        number of rows written; 0 when the job has no ASV or taxonomy table
+    """
+    try:
+        rows = job_taxon_rows(job)
+    except CompareError as e:
+        logger.warning(f"Not indexing taxa of job {job.job_id}: {e}")
+        return 0
+    with transaction.atomic():
+        TaxonAbundance.objects.filter(job=job).delete()
+        TaxonAbundance.objects.bulk_create(rows, batch_size=500)
+    logger.info(f"Indexed {len(rows)} taxa of job {job.job_id}")
+    return len(rows)
+
+
+def encode_cursor(row):
+    key = [row.taxon_key, row.relative_abundance, row.id]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    (taxon_key, relative_abundance, id) of a cursor
+
+    Raises:
+        ValueError: when the cursor is malformed
+    """
+    try:
+        taxon_key, abundance, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(taxon_key), float(abundance), int(row_id)
+    except (binascii.Error, UnicodeError, TypeError, ValueError) as e:
+        raise ValueError('Invalid cursor') from e
+
+
+def search_taxa(rank, prefix='', min_abundance=0.0, cursor=None, limit=50):
+    """
+    One page of taxon hits, by taxon name and then abundance (highest first)
+
+    Args:
+        rank: one of RANKS
+        prefix: case-insensitive start of the taxon name ('' for all)
+        min_abundance: least relative abundance (0-1)
+        cursor: next_cursor of the previous page
+
+    Returns:
+        (rows, next_cursor) - next_cursor is None on the last page
+
+    Raises:
+        ValueError: when the cursor is malformed
+    """
+    rows = TaxonAbundance.objects.filter(rank=rank).select_related('job')
+    prefix = prefix.lower()
+    if prefix:
+        rows = rows.filter(taxon_key__gte=prefix, taxon_key__lt=prefix[:-1] + chr(ord(prefix[-1]) + 1))
+    if min_abundance:
+        rows = rows.filter(relative_abundance__gte=min_abundance)
+    if cursor:
+        taxon_key, abundance, row_id = decode_cursor(cursor)
+        rows = rows.filter(
+            Q(taxon_key__gt=taxon_key)
+            | Q(taxon_key=taxon_key, relative_abundance__lt=abundance)
+            | Q(taxon_key=taxon_key, relative_abundance=abundance, id__gt=row_id)
+        )
+
+    page = list(rows.order_by('taxon_key', '-relative_abundance', 'id')[:limit + 1])
+    next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+    return page[:limit], next_cursor
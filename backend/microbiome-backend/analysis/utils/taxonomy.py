@@ -0,0 +1,130 @@
+"""
+Shared loader for DADA2 taxonomy tables (ASV_tax*.tsv, bacteria_summary.tsv)
+
+Taxonomy tables carry a sequence column of hundreds of bytes per ASV and
+seven rank columns of heavily repeated names. load_taxonomy reads only the
+ranks asked for and keeps them as categoricals (integer codes plus one
+dictionary of names per rank). Sequences stay on disk unless requested.
+Parsed tables are kept in an LRU cache keyed by file and ranks, and
+invalidated when the file's modification time or size changes. Cached
+frames are shared between callers and must not be modified.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+import pandas as pd
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+TAXONOMY_RANKS = ['Kingdom', 'Phylum', 'Class', 'Order', 'Family', 'Genus', 'Species']
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def read_header(path):
+    with open(path, encoding='utf-8') as f:
+        return f.readline().rstrip('\r\n').split('\t')
+
+
+def _read(path, ranks, sequences):
+    header = read_header(path)
+    columns = [rank for rank in ranks if rank in header]
+    if sequences and 'sequence' in header:
+        columns.append('sequence')
+    index = 'ASV_ID' if 'ASV_ID' in header else None
+    return pd.read_csv(
+        path,
+        sep='\t',
+        usecols=([index] if index else []) + columns,
+        index_col=index,
+        dtype={rank: 'category' for rank in columns if rank != 'sequence'},
+    )
+
+
+def load_taxonomy(path, ranks=TAXONOMY_RANKS, sequences=False):
+    """
+    Load rank columns of a taxonomy table
+
+    Args:
+        path: tab-separated table with rank columns (Kingdom ... Species)
+        ranks: rank columns to load; ranks the file lacks are left out
+        sequences: also load the sequence column (such loads are not cached)
+
+    Returns:
+        DataFrame with ranks as categoricals (missing names are NaN),
+        indexed by ASV_ID when the table has that column
+    """
+    path = Path(path)
+    if sequences:
+        return _read(path, ranks, sequences=True)
+
+    stat = path.stat()
+    key = (str(path), tuple(ranks))
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None and cached[0] == signature:
+            _cache.move_to_end(key)
+            return cached[1]
+
+    table = _read(path, ranks, sequences=False)
+    logger.debug(f"Loaded taxonomy {path.name}: {len(table)} rows, {table.memory_usage(deep=True).sum()} bytes")
+
+    with _cache_lock:
+        _cache[key] = (signature, table)
+        _cache.move_to_end(key)
+        while len(_cache) > settings.TAXONOMY_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return table
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+
+
+def bacteria_taxonomy_file(job, result):
+    """
+    Taxonomy table behind a job's bacteria composition, or None
+
+    The result's taxonomy_data when set, else the GTDB table in the job's
+    dada2 results.
+    """
+    if result.taxonomy_data:
+        path = Path(result.taxonomy_data.path)
+        return path if path.exists() else None
+    dada2_dir = Path(settings.MEDIA_ROOT) / 'uploads' / str(job.job_id) / 'results' / 'dada2'
+    for path in [dada2_dir / 'ASV_tax.gtdb.tsv', dada2_dir / 'ASV_tax_species.gtdb.tsv']:
+        if path.exists():
+            return path
+    return None
+
+
+def genus_composition(path):
+    """
+    ASVs per genus (with family and phylum), most frequent first
+
+    Returns:
+        list of {genus, family, phylum, total_reads} dicts; missing names are 'Unknown'
+
+    Raises:
+        ValueError: when the table lacks the Phylum, Family or Genus column
+    """
+    df = load_taxonomy(path, ranks=['Phylum', 'Family', 'Genus'])
+    if not {'Genus', 'Family', 'Phylum'} <= set(df.columns):
+        raise ValueError('Taxonomy file does not have expected columns')
+
+    genus_counts = df.groupby(['Genus', 'Family', 'Phylum'], observed=True).size().reset_index(name='total_reads')
+    genus_counts = genus_counts.sort_values('total_reads', ascending=False)
+    return [
+        {
+            'genus': row['Genus'] if pd.notna(row['Genus']) and row['Genus'] else 'Unknown',
+            'family': row['Family'] if pd.notna(row['Family']) and row['Family'] else 'Unknown',
+            'phylum': row['Phylum'] if pd.notna(row['Phylum']) and row['Phylum'] else 'Unknown',
+            'total_reads': int(row['total_reads']),
+        }
+        for _, row in genus_counts.iterrows()
+    ]
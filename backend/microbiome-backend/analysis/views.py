@@ -4,19 +4,51 @@ from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from django.shortcuts import get_object_or_404
 from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.core.exceptions import ValidationError
 from django.utils import timezone
 import shutil
 import os
 import threading
 import subprocess
+import time
 import logging
 import csv
+from datetime import timedelta
 from pathlib import Path
-from .models import AnalysisJob, UploadedFile, AnalysisResult
+from .models import AnalysisJob, UploadedFile, DirectUpload, AnalysisResult, ProcessMetric
 from .serializers import (
     AnalysisJobSerializer, UploadedFileSerializer,
-    AnalysisResultSerializer, UploadRequestSerializer
+    AnalysisResultSerializer, UploadRequestSerializer,
+    UploadSessionRequestSerializer, UploadSessionCompleteSerializer,
+    DirectUploadSerializer, ProcessMetricSerializer, AddSamplesRequestSerializer,
+    TaxonAbundanceSerializer
 )
+from .utils.archive import get_results_archive
+from .utils.compare import RANKS, CompareError, compare_counts, get_job_counts
+from .utils.executors import get_executor_for_job
+from .utils.fastq import find_read_pair, preflight_job
+from .utils.incremental import (
+    group_samples, increment_command, merge_increment, study_sample_ids, write_samples_samplesheet
+)
+from .utils.ingest import ingest_results
+from .utils.job_writes import update_job
+from .utils.kmer_index import search as kmer_search
+from .utils.primers import PrimerDetectionError, detect_job_primers, get_primer_pair
+from .utils.preview import preview_dir, run_preview
+from .utils.rarefaction import get_job_rarefaction
+from .utils.sequences import SequenceIndexError, fasta_path, fetch_sequences
+from .utils.taxon_index import search_taxa
+from .utils.taxonomy import bacteria_taxonomy_file, genus_composition
+from .utils.profiling import profile_stage
+from .utils.instrumentation import (
+    observe_pipeline, observe_queue_wait, count_upload_bytes, render_metrics
+)
+from .utils.nextflow_trace import (
+    TRACE_FILE_NAME, REPORT_FILE_NAME, write_trace_config, summarize_metrics, find_trace_file, import_trace
+)
+from .utils.s3_uploads import direct_upload_client, UploadVerificationError
+from .utils.s3_transfer import download_job_inputs
 
 logger = logging.getLogger(__name__)
 
@@ -31,57 +63,112 @@ def run_nextflow_analysis(job_id):
         
         logger.info(f"Starting Nextflow analysis for job {job_id}")
         
+        # Pick the execution backend for this job (by input size)
+        executor = get_executor_for_job(job)
+        
+        # Files uploaded straight to S3 are read from MEDIA_ROOT by every local step
+        if not executor.is_remote:
+            with profile_stage(job, 'input download'):
+                download_job_inputs(job)
+        
+        # Fail bad inputs in seconds rather than after pipeline setup; the same
+        # pass samples the reads for a preview run
+        if settings.FASTQ_PREFLIGHT_ENABLED or job.preview:
+            with profile_stage(job, 'preflight'):
+                problems = preflight_job(job, sample_dir=preview_dir(job) / 'reads' if job.preview else None)
+            if problems:
+                logger.warning(f"Preflight failed for job {job_id}: {problems}")
+                update_job(job, status='failed', error_message=f"Input validation failed: {'; '.join(problems)}"[:500])
+                return
+        
+        # Match the reads against known amplicon primers instead of assuming 515F-806R
+        if settings.PRIMER_DETECTION_ENABLED:
+            try:
+                with profile_stage(job, 'primer detection'):
+                    detect_job_primers(job)
+            except PrimerDetectionError as e:
+                logger.warning(f"Primer detection failed for job {job_id}: {e}")
+                update_job(job, status='failed', error_message=f"Primer detection failed: {e}"[:500])
+                return
+        
+        # ASVs of another amplicon region would never match the study's
+        if job.parent_id and job.primer_set != job.parent.primer_set:
+            primers, study_primers = get_primer_pair(job.primer_set), get_primer_pair(job.parent.primer_set)
+            update_job(job, status='failed', error_message=(
+                f"New samples carry {primers.name} ({primers.region}) primers but the study "
+                f"used {study_primers.name} ({study_primers.region})"
+            ))
+            return
+        
+        if executor.is_remote:
+            # Remote backends take the run from here; the reconciler syncs its state
+            fields = {'executor': executor.name}
+            if job.preview:
+                logger.info(f"Skipping preview for job {job_id}: previews run locally only")
+                fields['preview_status'] = 'failed'
+            executor.submit(job)
+            update_job(job, **fields)
+            logger.info(f"Submitted job {job_id} to {executor.name} executor")
+            return
+        
         # Update status to processing
-        job.status = 'processing'
-        job.save()
+        update_job(job, status='processing', executor=executor.name)
+        observe_queue_wait(job)
         
         # Get uploaded files
         files = job.files.all()
         job_dir = Path(settings.MEDIA_ROOT) / 'uploads' / str(job_id)
+        job_dir.mkdir(parents=True, exist_ok=True)  # API uploads are stored under uploads/%Y/%m/%d/
         
         # Create samplesheet.csv (comma-separated, not tab-separated)
-        samplesheet_path = job_dir / 'samplesheet.csv'
-        with open(samplesheet_path, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f, delimiter=',', lineterminator='\n')
-            writer.writerow(['sampleID', 'forwardReads', 'reverseReads', 'run'])
-            
-            if job.data_type == 'paired-end':
-                # Find R1 and R2 files
-                file_list = list(files)
-                r1_file = None
-                r2_file = None
-                
-                for file_obj in file_list:
-                    file_path = Path(settings.MEDIA_ROOT) / file_obj.file.name
-                    if '_R1' in file_obj.file_name or '_1' in file_obj.file_name:
-                        r1_file = str(file_path)
-                    elif '_R2' in file_obj.file_name or '_2' in file_obj.file_name:
-                        r2_file = str(file_path)
-                
-                if r1_file and r2_file:
-                    writer.writerow(['sample1', r1_file, r2_file, 'A'])
-                else:
-                    raise ValueError("Could not find R1 and R2 files")
+        with profile_stage(job, 'samplesheet'):
+            samplesheet_path = job_dir / 'samplesheet.csv'
+            if job.parent_id:
+                write_samples_samplesheet(job, samplesheet_path)
             else:
-                # Single-end
-                file_obj = file_list[0]
-                file_path = str(Path(settings.MEDIA_ROOT) / file_obj.file.name)
-                writer.writerow(['sample1', file_path, '', 'A'])
+                with open(samplesheet_path, 'w', newline='', encoding='utf-8') as f:
+                    writer = csv.writer(f, delimiter=',', lineterminator='\n')
+                    writer.writerow(['sampleID', 'forwardReads', 'reverseReads', 'run'])
+                    
+                    file_list = list(files)
+                    if job.data_type == 'paired-end':
+                        # Find R1 and R2 files
+                        r1, r2 = find_read_pair(file_list)
+                        
+                        if r1 and r2:
+                            r1_file = str(Path(settings.MEDIA_ROOT) / r1.file.name)
+                            r2_file = str(Path(settings.MEDIA_ROOT) / r2.file.name)
+                            writer.writerow(['sample1', r1_file, r2_file, 'A'])
+                        else:
+                            raise ValueError("Could not find R1 and R2 files")
+                    else:
+                        # Single-end
+                        file_obj = file_list[0]
+                        file_path = str(Path(settings.MEDIA_ROOT) / file_obj.file.name)
+                        writer.writerow(['sample1', file_path, '', 'A'])
         
         # Create output directory
         results_dir = job_dir / 'results'
         results_dir.mkdir(exist_ok=True)
         
+        # Trace and report go to results/pipeline_info for ProcessMetric
+        pipeline_info_dir = results_dir / 'pipeline_info'
+        pipeline_info_dir.mkdir(exist_ok=True)
+        
         # Prepare Nextflow command
+        primers = get_primer_pair(job.primer_set)
         cmd = [
-            'nextflow', 'run', 'nf-core/ampliseq',
+            settings.NEXTFLOW_BIN, 'run', 'nf-core/ampliseq',
             '-r', '2.15.0',  # Latest stable version
             '-resume',  # Resume from previous failed runs
             '--input', str(samplesheet_path),
             '--outdir', str(results_dir),
-            '--FW_primer', 'GTGYCAGCMGCCGCGGTAA',
-            '--RV_primer', 'GGACTACNVGGGTWTCTAAT',
+            '--FW_primer', primers.forward,
+            '--RV_primer', primers.reverse,
             '--dada_ref_taxonomy', 'gtdb',  # Specify reference database explicitly
+            '-with-trace', str(pipeline_info_dir / TRACE_FILE_NAME),
+            '-with-report', str(pipeline_info_dir / REPORT_FILE_NAME),
+            '-c', str(write_trace_config(job_dir)),
         ]
         
         # For test data, skip optional steps to speed up analysis
@@ -103,10 +190,15 @@ def run_nextflow_analysis(job_id):
             logger.info(f"Using real user data mode - running full analysis pipeline")
             # For real user data, run full pipeline with appropriate resources
             cmd.extend([
+                '--skip_alpha_rarefaction',  # Served by GET /api/jobs/{job_id}/rarefaction/
                 '--max_cpus', '8',  # More CPUs for real analysis
                 '--max_memory', '16.GB',  # More memory for real analysis
             ])
         
+        # New samples for a finished study: denoise them alone, merge afterwards
+        if job.parent_id:
+            cmd = increment_command(cmd)
+        
         # Check if running locally (detect by checking available memory)
         # If running on laptop/local machine, add strict memory limits
         try:
@@ -184,17 +276,20 @@ process {
         env = os.environ.copy()
         env['NXF_ANSI_LOG'] = 'false'  # Disable ANSI colors in logs
         
+        # Quick look on the sampled reads first; the full run follows
+        if job.preview:
+            with profile_stage(job, 'preview'):
+                run_preview(job, cmd, executor, env=env, cwd=job_dir)
+        
         # Run Nextflow
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            cwd=str(job_dir),
-            env=env,
-            timeout=3600  # 1 hour timeout
-        )
+        started = time.monotonic()
+        executor.submit(job, cmd, cwd=job_dir, env=env)
+        result = executor.wait(job, timeout=3600)  # 1 hour timeout
+        execution_time = time.monotonic() - started
+        observe_pipeline(executor.name, 'succeeded' if result.returncode == 0 else 'failed', execution_time)
         
-        logger.info(f"Nextflow stdout: {result.stdout}")
+        logger.debug(f"Nextflow stdout: {result.stdout}")
+        logger.info(f"Nextflow stdout (last 2000 chars): {result.stdout[-2000:]}")
         if result.stderr:
             logger.warning(f"Nextflow stderr: {result.stderr}")
         
@@ -202,104 +297,52 @@ process {
             logger.info(f"Nextflow completed successfully for job {job_id}")
             
             # Parse and save results
-            # Look for key output files
-            summary_report = results_dir / 'summary_report' / 'summary_report.html'
-            
-            # Generate bacteria composition plot
-            bacteria_plot_path = None
-            try:
-                from django.core.files import File
-                
-                # Run the bacteria composition script
-                script_path = Path(settings.BASE_DIR).parent.parent / 'analysis_bioinf' / 'create_bacteria_barplot.py'
-                if script_path.exists():
-                    logger.info(f"Generating bacteria composition plot...")
-                    plot_result = subprocess.run(
-                        ['python3', str(script_path), str(results_dir)],
-                        capture_output=True,
-                        text=True,
-                        timeout=60
-                    )
-                    if plot_result.returncode == 0:
-                        bacteria_plot_path = results_dir / 'bacteria_composition.png'
-                        logger.info(f"Bacteria plot generated: {bacteria_plot_path}")
-                    else:
-                        logger.warning(f"Could not generate bacteria plot: {plot_result.stderr}")
-            except Exception as e:
-                logger.warning(f"Error generating bacteria plot: {e}")
-            
-            # Create AnalysisResult record
-            result_obj = AnalysisResult.objects.create(job=job)
-            
-            # Save summary report if exists
-            if summary_report.exists():
-                with open(summary_report, 'rb') as f:
-                    from django.core.files import File
-                    result_obj.report_html.save(
-                        f'summary_report_{job_id}.html',
-                        File(f),
-                        save=False
-                    )
-                logger.info(f"Summary report saved")
-            
-            # Save bacteria composition plot if generated
-            if bacteria_plot_path and bacteria_plot_path.exists():
-                with open(bacteria_plot_path, 'rb') as f:
-                    from django.core.files import File
-                    result_obj.taxonomy_plot.save(
-                        f'bacteria_composition_{job_id}.png',
-                        File(f),
-                        save=False
-                    )
-                logger.info(f"Bacteria composition plot saved")
-            
-            # Save bacteria summary TSV if generated
-            bacteria_summary_path = results_dir / 'bacteria_summary.tsv'
-            if bacteria_summary_path.exists():
-                with open(bacteria_summary_path, 'rb') as f:
-                    from django.core.files import File
-                    result_obj.taxonomy_data.save(
-                        f'bacteria_summary_{job_id}.tsv',
-                        File(f),
-                        save=False
-                    )
-                logger.info(f"Bacteria summary data saved")
-            
-            # Save execution info
-            result_obj.execution_time = result.stdout.count('Completed')  # Simple metric
-            result_obj.save()
+            results_dir = executor.fetch_outputs(job)
+            if job.parent_id:
+                with profile_stage(job, 'merge'):
+                    job.new_asv_count = merge_increment(job, results_dir, cmd, executor, env=env, cwd=job_dir)
+                AnalysisResult.objects.update_or_create(job=job, defaults={'execution_time': execution_time})
+                trace_path = find_trace_file(results_dir)
+                if trace_path:
+                    import_trace(job, trace_path)
+            else:
+                ingest_results(job, results_dir, execution_time=execution_time)
             
             # Update job status
-            job.status = 'completed'
-            job.completed_at = timezone.now()
-            job.save()
+            update_job(job, status='completed', completed_at=timezone.now(), new_asv_count=job.new_asv_count)
             
             logger.info(f"Results saved for job {job_id}")
             
         else:
             # Pipeline failed
             logger.error(f"Nextflow failed for job {job_id}: {result.stderr}")
-            job.status = 'failed'
-            job.error_message = f"Nextflow error: {result.stderr[:500]}"
-            job.save()
+            update_job(job, status='failed', error_message=f"Nextflow error: {result.stderr[:500]}")
     
     except subprocess.TimeoutExpired:
         logger.error(f"Nextflow timeout for job {job_id}")
-        job.status = 'failed'
-        job.error_message = "Analysis timed out after 1 hour"
-        job.save()
+        observe_pipeline(job.executor, 'timeout', time.monotonic() - started)
+        update_job(job, status='failed', error_message="Analysis timed out after 1 hour")
     
     except Exception as e:
         logger.exception(f"Error running Nextflow for job {job_id}: {str(e)}")
         try:
             job = AnalysisJob.objects.get(job_id=job_id)
-            job.status = 'failed'
-            job.error_message = str(e)[:500]
-            job.save()
+            update_job(job, status='failed', error_message=str(e)[:500])
         except:
             pass
 
 
+def start_analysis(job):
+    """
+    Start the Nextflow pipeline for a job in a background thread
+    """
+    thread = threading.Thread(target=run_nextflow_analysis, args=(job.job_id,))
+    thread.daemon = True
+    thread.start()
+    
+    logger.info(f"Started background Nextflow thread for job {job.job_id}")
+
+
 class AnalysisJobViewSet(viewsets.ModelViewSet):
     """
     ViewSet for managing analysis jobs
@@ -330,6 +373,9 @@ class AnalysisJobViewSet(viewsets.ModelViewSet):
             data_type=data.get('data_type', 'paired-end'),
             send_email=data.get('send_email', True),
             is_test_data=use_test_data,
+            profile=data.get('profile', False) and request.user.is_staff,
+            preview=data.get('preview', False),
+            preview_status='pending' if data.get('preview', False) else '',
             status='pending'
         )
         
@@ -382,13 +428,80 @@ class AnalysisJobViewSet(viewsets.ModelViewSet):
                     file_name=file.name,
                     file_size=file.size
                 )
+                count_upload_bytes('api', file.size)
         
         # Trigger Nextflow pipeline in background thread
-        thread = threading.Thread(target=run_nextflow_analysis, args=(job.job_id,))
-        thread.daemon = True
-        thread.start()
+        start_analysis(job)
         
-        logger.info(f"Started background Nextflow thread for job {job.job_id}")
+        response_serializer = AnalysisJobSerializer(job)
+        return Response(response_serializer.data, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['post'], url_path='samples')
+    def add_samples(self, request, job_id=None):
+        """
+        Add samples to a completed job without reprocessing its existing ones
+        POST /api/jobs/{job_id}/samples/
+        """
+        study = self.get_object()
+        study = study.parent or study
+        
+        serializer = AddSamplesRequestSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        if study.status != 'completed':
+            return Response(
+                {'error': 'Analysis not completed yet'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            existing_samples = study_sample_ids(study)
+        except FileNotFoundError:
+            return Response(
+                {'error': 'No ASV table to add samples to'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        
+        if study.increments.filter(status__in=['pending', 'processing']).exists():
+            return Response(
+                {'error': 'Samples are already being added to this job'},
+                status=status.HTTP_409_CONFLICT
+            )
+        
+        files = request.FILES.getlist('files')
+        try:
+            samples = group_samples([f.name for f in files], study.data_type)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        duplicates = sorted(set(samples) & set(existing_samples))
+        if duplicates:
+            return Response(
+                {'error': f"Samples already in the study: {', '.join(duplicates)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # The merge needs the study's results on local disk, so increments never go to Batch
+        job = AnalysisJob.objects.create(
+            project_name=study.project_name,
+            email=study.email,
+            data_type=study.data_type,
+            send_email=serializer.validated_data['send_email'],
+            parent=study,
+            executor=settings.PIPELINE_LOCAL_EXECUTOR,
+            status='pending'
+        )
+        for file in files:
+            UploadedFile.objects.create(
+                job=job,
+                file=file,
+                file_name=file.name,
+                file_size=file.size
+            )
+            count_upload_bytes('api', file.size)
+        
+        start_analysis(job)
         
         response_serializer = AnalysisJobSerializer(job)
         return Response(response_serializer.data, status=status.HTTP_201_CREATED)
@@ -450,59 +563,17 @@ class AnalysisJobViewSet(viewsets.ModelViewSet):
         try:
             result = job.result
             
-            # Try to use taxonomy_data if available
-            taxonomy_file = None
-            if result.taxonomy_data:
-                taxonomy_file = Path(result.taxonomy_data.path)
-            else:
-                # Fallback: Look for ASV_tax.gtdb.tsv in results directory
-                job_dir = Path(settings.MEDIA_ROOT) / 'uploads' / str(job.job_id)
-                results_dir = job_dir / 'results'
-                potential_files = [
-                    results_dir / 'dada2' / 'ASV_tax.gtdb.tsv',
-                    results_dir / 'dada2' / 'ASV_tax_species.gtdb.tsv',
-                ]
-                for f in potential_files:
-                    if f.exists():
-                        taxonomy_file = f
-                        break
-            
-            if not taxonomy_file or not taxonomy_file.exists():
+            taxonomy_file = bacteria_taxonomy_file(job, result)
+            if taxonomy_file is None:
                 return Response(
                     {'error': 'No bacteria data available'},
                     status=status.HTTP_404_NOT_FOUND
                 )
             
-            # Read and parse the TSV file
-            import pandas as pd
-            df = pd.read_csv(taxonomy_file, sep='\t')
-            
-            # Count unique taxa at genus level
-            bacteria_list = []
-            if 'Genus' in df.columns and 'Phylum' in df.columns and 'Family' in df.columns:
-                # Group by Genus, Family, Phylum and count occurrences
-                genus_counts = df.groupby(['Genus', 'Family', 'Phylum']).size().reset_index(name='total_reads')
-                
-                # Sort by count descending
-                genus_counts = genus_counts.sort_values('total_reads', ascending=False)
-                
-                # Convert to list of dicts
-                for _, row in genus_counts.iterrows():
-                    genus = row['Genus'] if pd.notna(row['Genus']) and row['Genus'] else 'Unknown'
-                    family = row['Family'] if pd.notna(row['Family']) and row['Family'] else 'Unknown'
-                    phylum = row['Phylum'] if pd.notna(row['Phylum']) and row['Phylum'] else 'Unknown'
-                    
-                    bacteria_list.append({
-                        'genus': genus,
-                        'family': family,
-                        'phylum': phylum,
-                        'total_reads': int(row['total_reads'])
-                    })
-            else:
-                return Response(
-                    {'error': 'Taxonomy file does not have expected columns'},
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
+            try:
+                bacteria_list = genus_composition(taxonomy_file)
+            except ValueError as e:
+                return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
             
             return Response({
                 'bacteria': bacteria_list,
@@ -519,3 +590,574 @@ class AnalysisJobViewSet(viewsets.ModelViewSet):
                 {'error': f'Failed to read bacteria data: {str(e)}'},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
+
+    @action(detail=True, methods=['get'], url_path='preview')
+    def get_preview(self, request, job_id=None):
+        """
+        Get the preliminary genus composition from the preview run
+        GET /api/jobs/{job_id}/preview/
+        """
+        job = self.get_object()
+        
+        if not job.preview:
+            return Response(
+                {'error': 'No preview was requested for this job'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        
+        bacteria = job.preview_composition or []
+        read_counts = [f.read_count for f in job.files.all() if f.read_count is not None]
+        return Response({
+            'job_id': str(job.job_id),
+            'preview_status': job.preview_status,
+            'read_pairs_sampled': min([settings.PREVIEW_READ_PAIRS] + read_counts) if read_counts else None,
+            'completed_at': job.preview_completed_at,
+            'bacteria': bacteria,
+            'total_count': len(bacteria)
+        })
+
+    @action(detail=True, methods=['get'], url_path='rarefaction')
+    def get_rarefaction(self, request, job_id=None):
+        """
+        Get alpha rarefaction curves (observed ASVs and Shannon) per sample
+        GET /api/jobs/{job_id}/rarefaction/?steps=10&iterations=10&max_depth=5000&seed=0
+        """
+        job = self.get_object()
+        
+        if job.status != 'completed':
+            return Response(
+                {'error': 'Analysis not completed yet'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        params = {}
+        for name, low, high in [('steps', 2, 100), ('iterations', 1, 100), ('max_depth', 1, None), ('seed', 0, None)]:
+            value = request.query_params.get(name)
+            if value is None:
+                continue
+            try:
+                value = int(value)
+            except ValueError:
+                value = None
+            if value is None or value < low or (high is not None and value > high):
+                limit = f'{low}-{high}' if high else f'>= {low}'
+                return Response(
+                    {'error': f'{name} must be an integer ({limit})'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            params[name] = value
+        
+        try:
+            curves = get_job_rarefaction(job, **params)
+        except FileNotFoundError:
+            return Response(
+                {'error': 'No ASV table available'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        
+        return Response({'job_id': str(job.job_id), **curves})
+
+    @action(detail=True, methods=['get'], url_path=r'asvs/(?P<asv_id>[^/.]+)/sequence')
+    def get_asv_sequence(self, request, job_id=None, asv_id=None):
+        """
+        Get the sequence of one ASV
+        GET /api/jobs/{job_id}/asvs/{asv_id}/sequence/
+        """
+        job = self.get_object()
+        
+        if job.status != 'completed':
+            return Response(
+                {'error': 'Analysis not completed yet'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            sequences, _ = fetch_sequences(fasta_path(job), [asv_id])
+        except FileNotFoundError:
+            return Response({'error': 'No ASV sequences available'}, status=status.HTTP_404_NOT_FOUND)
+        except SequenceIndexError as e:
+            return Response({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+        
+        if asv_id not in sequences:
+            return Response(
+                {'error': f'ASV {asv_id} not found'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        sequence = sequences[asv_id]
+        return Response({'asv_id': asv_id, 'length': len(sequence), 'sequence': sequence})
+
+    @action(detail=True, methods=['get', 'post'], url_path='asvs/sequences')
+    def get_asv_sequences(self, request, job_id=None):
+        """
+        Get the sequences of several ASVs
+        GET /api/jobs/{job_id}/asvs/sequences/?ids=<asv_id>,<asv_id>
+        POST /api/jobs/{job_id}/asvs/sequences/ {"ids": [...]}
+        """
+        job = self.get_object()
+        
+        if job.status != 'completed':
+            return Response(
+                {'error': 'Analysis not completed yet'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        if request.method == 'POST':
+            asv_ids = request.data.get('ids')
+        else:
+            asv_ids = [i for i in request.query_params.get('ids', '').split(',') if i]
+        if (not isinstance(asv_ids, list) or not 1 <= len(asv_ids) <= settings.SEQUENCE_LOOKUP_MAX_IDS
+                or not all(isinstance(i, str) for i in asv_ids)):
+            return Response(
+                {'error': f'ids must list 1 to {settings.SEQUENCE_LOOKUP_MAX_IDS} ASV IDs'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            sequences, missing = fetch_sequences(fasta_path(job), asv_ids)
+        except FileNotFoundError:
+            return Response({'error': 'No ASV sequences available'}, status=status.HTTP_404_NOT_FOUND)
+        except SequenceIndexError as e:
+            return Response({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+        
+        return Response({
+            'job_id': str(job.job_id),
+            'sequences': sequences,
+            'missing': missing,
+        })
+
+    @action(detail=True, methods=['get'], url_path='archive')
+    def archive(self, request, job_id=None):
+        """
+        Download the complete results directory as a single archive
+        GET /api/jobs/{job_id}/archive/?archive_format=zip|tar.gz&include=dada2,qiime2&exclude=qiime2/alpha-rarefaction
+        """
+        job = self.get_object()
+        
+        if job.status != 'completed':
+            return Response(
+                {'error': 'Analysis not completed yet'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        archive_format = request.query_params.get('archive_format', 'zip')
+        include = [p for p in request.query_params.get('include', '').split(',') if p]
+        exclude = [p for p in request.query_params.get('exclude', '').split(',') if p]
+        
+        try:
+            archive = get_results_archive(job, archive_format, include=include, exclude=exclude)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except FileNotFoundError as e:
+            return Response({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+        
+        if 'path' in archive:
+            response = FileResponse(
+                open(archive['path'], 'rb'),
+                as_attachment=True,
+                filename=archive['filename'],
+                content_type=archive['content_type'],
+            )
+        else:
+            response = StreamingHttpResponse(archive['stream'], content_type=archive['content_type'])
+            response['Content-Disposition'] = f'attachment; filename="{archive["filename"]}"'
+        return response
+
+    @action(detail=True, methods=['get'], url_path='process-metrics')
+    def process_metrics(self, request, job_id=None):
+        """
+        Per-task Nextflow metrics of a job, with per-process percentiles
+        GET /api/jobs/{job_id}/process-metrics/
+        """
+        job = self.get_object()
+        metrics = job.process_metrics.all()
+        
+        execution_time = None
+        if hasattr(job, 'result'):
+            execution_time = job.result.execution_time
+        
+        return Response({
+            'job_id': str(job.job_id),
+            'execution_time': execution_time,
+            'processes': summarize_metrics(metrics),
+            'tasks': ProcessMetricSerializer(metrics, many=True).data,
+        })
+
+
+class ProcessMetricViewSet(viewsets.ViewSet):
+    """
+    Per-process percentiles across all jobs
+    GET /api/process-metrics/?process=DADA2_TAXONOMY&status=COMPLETED&days=30
+    """
+    
+    def list(self, request):
+        metrics = ProcessMetric.objects.all()
+        
+        process = request.query_params.get('process')
+        if process:
+            metrics = metrics.filter(process=process)
+        
+        task_status = request.query_params.get('status', 'COMPLETED')
+        if task_status != 'all':
+            metrics = metrics.filter(status=task_status)
+        
+        days = request.query_params.get('days')
+        if days:
+            try:
+                since = timezone.now() - timedelta(days=float(days))
+            except ValueError:
+                return Response({'error': 'days must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+            metrics = metrics.filter(job__created_at__gte=since)
+        
+        return Response({
+            'jobs': metrics.values('job').distinct().count(),
+            'processes': summarize_metrics(metrics),
+        })
+
+
+class CompareViewSet(viewsets.ViewSet):
+    """
+    Compare the ASV (or taxon) counts of several completed jobs
+    GET /api/compare/?jobs=<id>,<id>[,...]&rank=asv|phylum|...|species&table=true
+    """
+    
+    def list(self, request):
+        job_ids = [j for j in request.query_params.get('jobs', '').split(',') if j]
+        if not 2 <= len(set(job_ids)) <= settings.COMPARE_MAX_JOBS:
+            return Response(
+                {'error': f'jobs must list 2 to {settings.COMPARE_MAX_JOBS} job IDs'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        job_ids = list(dict.fromkeys(job_ids))
+        
+        rank = request.query_params.get('rank', 'asv').lower()
+        if rank != 'asv' and rank not in RANKS:
+            return Response(
+                {'error': f"rank must be asv or one of {', '.join(RANKS)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            jobs = {str(job.job_id): job for job in AnalysisJob.objects.filter(job_id__in=job_ids)}
+        except ValidationError:
+            return Response({'error': 'Invalid job ID'}, status=status.HTTP_400_BAD_REQUEST)
+        missing = [j for j in job_ids if j not in jobs]
+        if missing:
+            return Response(
+                {'error': f"Jobs not found: {', '.join(missing)}"},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        jobs = [jobs[j] for j in job_ids]
+        
+        not_completed = [str(job.job_id) for job in jobs if job.status != 'completed']
+        if not_completed:
+            return Response(
+                {'error': f"Analysis not completed yet: {', '.join(not_completed)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            matrices = [get_job_counts(job, rank) for job in jobs]
+        except CompareError as e:
+            return Response({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+        
+        include_table = request.query_params.get('table', 'false').lower() == 'true'
+        comparison = compare_counts(matrices, include_table=include_table)
+        
+        job_summaries = [
+            {
+                'job_id': str(job.job_id),
+                'project_name': job.project_name,
+                'samples': matrix.samples,
+                'features': comparison['observed_features'][i],
+                'unique_features': comparison['unique_features'][i],
+                'total_reads': comparison['total_reads'][i],
+            }
+            for i, (job, matrix) in enumerate(zip(jobs, matrices))
+        ]
+        response = {
+            'rank': rank,
+            'jobs': job_summaries,
+            'features': comparison['features'],
+            'shared_features': comparison['shared_features'],
+            'shared_matrix': comparison['shared_matrix'],
+            'distances': comparison['distances'],
+        }
+        if include_table:
+            # Rows are the samples of all jobs, in the order listed under jobs
+            response['table'] = comparison['table']
+        return Response(response)
+
+
+class TaxonSearchViewSet(viewsets.ViewSet):
+    """
+    Find completed jobs by taxon and relative abundance
+    GET /api/taxa/?rank=genus&taxon=Bacteroid&min_abundance=0.05&limit=50&cursor=...
+    """
+    
+    def list(self, request):
+        rank = request.query_params.get('rank', 'genus').lower()
+        if rank not in RANKS:
+            return Response(
+                {'error': f"rank must be one of {', '.join(RANKS)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            min_abundance = float(request.query_params.get('min_abundance', 0))
+            limit = int(request.query_params.get('limit', 50))
+        except ValueError:
+            min_abundance = limit = None
+        if min_abundance is None or not 0 <= min_abundance <= 1 or not 1 <= limit <= settings.TAXON_SEARCH_MAX_LIMIT:
+            return Response(
+                {'error': f'min_abundance must be 0-1 and limit 1-{settings.TAXON_SEARCH_MAX_LIMIT}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            rows, next_cursor = search_taxa(
+                rank,
+                prefix=request.query_params.get('taxon', '').strip(),
+                min_abundance=min_abundance,
+                cursor=request.query_params.get('cursor'),
+                limit=limit,
+            )
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        return Response({
+            'results': TaxonAbundanceSerializer(rows, many=True).data,
+            'next_cursor': next_cursor,
+        })
+
+
+class SequenceSearchViewSet(viewsets.ViewSet):
+    """
+    Find completed jobs with an ASV equal or close to a sequence, by shared k-mers
+    GET /api/search/?sequence=ACGT...&limit=20&min_fraction=0.1
+    POST /api/search/ {"sequence": "ACGT...", "limit": 20, "min_fraction": 0.1}
+    """
+    
+    def list(self, request):
+        return self._search(request.query_params)
+    
+    def create(self, request):
+        return self._search(request.data)
+    
+    def _search(self, params):
+        sequence = str(params.get('sequence') or '').strip()
+        if not sequence:
+            return Response({'error': 'sequence is required'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        try:
+            limit = int(params.get('limit', 20))
+            min_fraction = float(params.get('min_fraction', 0.1))
+        except (TypeError, ValueError):
+            limit = min_fraction = None
+        if limit is None or not 1 <= limit <= settings.KMER_SEARCH_MAX_RESULTS or not 0 <= min_fraction <= 1:
+            return Response(
+                {'error': f'limit must be 1-{settings.KMER_SEARCH_MAX_RESULTS} and min_fraction 0-1'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            hits = kmer_search(sequence, limit=limit, min_fraction=min_fraction)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        # Jobs deleted since they were indexed are left out
+        jobs = {
+            str(job_id): project_name
+            for job_id, project_name in AnalysisJob.objects.filter(
+                job_id__in=[job_id for job_id, _, _ in hits['jobs']] + [job_id for job_id, _, _ in hits['asvs']]
+            ).values_list('job_id', 'project_name')
+        }
+        query_kmers = hits['query_kmers']
+        return Response({
+            'k': hits['k'],
+            'query_kmers': query_kmers,
+            'ignored_kmers': hits['ignored_kmers'],
+            'jobs': [
+                {
+                    'job_id': job_id,
+                    'project_name': jobs[job_id],
+                    'best_shared_kmers': best,
+                    'best_fraction': round(best / query_kmers, 4),
+                    'matching_asvs': count,
+                }
+                for job_id, best, count in hits['jobs'] if job_id in jobs
+            ],
+            'asvs': [
+                {
+                    'job_id': job_id,
+                    'asv_id': asv_id,
+                    'shared_kmers': shared,
+                    'fraction': round(shared / query_kmers, 4),
+                }
+                for job_id, asv_id, shared in hits['asvs'] if job_id in jobs
+            ],
+        })
+
+
+class UploadSessionViewSet(viewsets.ViewSet):
+    """
+    Direct-to-S3 uploads: the browser PUTs file parts to presigned URLs,
+    Django only handles metadata
+    """
+    lookup_field = 'job_id'
+    parser_classes = [JSONParser]
+
+    def create(self, request):
+        """
+        Create a job and presigned multipart upload URLs for its files
+        POST /api/upload-sessions/
+        """
+        serializer = UploadSessionRequestSerializer(data=request.data)
+        
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        data = serializer.validated_data
+        
+        job = AnalysisJob.objects.create(
+            project_name=data['project_name'],
+            email=data['email'],
+            data_type=data.get('data_type', 'paired-end'),
+            send_email=data.get('send_email', True),
+            status='pending'
+        )
+        
+        files = []
+        try:
+            for file_spec in data['files']:
+                key = f"uploads/{job.job_id}/{file_spec['file_name']}"
+                upload = direct_upload_client.start_upload(key, file_spec['file_size'])
+                DirectUpload.objects.create(
+                    job=job,
+                    file_name=file_spec['file_name'],
+                    file_size=file_spec['file_size'],
+                    key=key,
+                    upload_id=upload['upload_id'],
+                    part_size=upload['part_size'],
+                )
+                files.append({'file_name': file_spec['file_name'], 'key': key, **upload})
+        except Exception as e:
+            logger.error(f"Failed to start upload session for job {job.job_id}: {e}")
+            for upload in job.direct_uploads.all():
+                direct_upload_client.abort_upload(upload.key, upload.upload_id)
+            job.delete()
+            return Response(
+                {'error': f'Failed to start upload session: {str(e)}'},
+                status=status.HTTP_502_BAD_GATEWAY
+            )
+        
+        logger.info(f"Started upload session for job {job.job_id} ({len(files)} files)")
+        
+        return Response({
+            'job_id': str(job.job_id),
+            'status': job.status,
+            'files': files,
+        }, status=status.HTTP_201_CREATED)
+
+    def retrieve(self, request, job_id=None):
+        """
+        Get upload progress of a session
+        GET /api/upload-sessions/{job_id}/
+        """
+        job = get_object_or_404(AnalysisJob, job_id=job_id)
+        return Response({
+            'job_id': str(job.job_id),
+            'status': job.status,
+            'files': DirectUploadSerializer(job.direct_uploads.all(), many=True).data,
+        })
+
+    @action(detail=True, methods=['post'], url_path='complete')
+    def complete(self, request, job_id=None):
+        """
+        Verify uploaded parts, register the files and enqueue the job
+        POST /api/upload-sessions/{job_id}/complete/
+        """
+        job = get_object_or_404(AnalysisJob, job_id=job_id)
+        
+        serializer = UploadSessionCompleteSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        uploads = {u.file_name: u for u in job.direct_uploads.exclude(status='aborted')}
+        reported = {f['file_name']: f['parts'] for f in serializer.validated_data['files']}
+        
+        if set(reported) != set(uploads):
+            return Response(
+                {'error': 'Completion must list exactly the files of the session'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            for file_name, upload in uploads.items():
+                if upload.status == 'completed':
+                    continue
+                upload.etag = direct_upload_client.complete_upload(
+                    upload.key, upload.upload_id, upload.file_size, reported[file_name]
+                )
+                upload.status = 'completed'
+                upload.completed_at = timezone.now()
+                upload.save(update_fields=['etag', 'status', 'completed_at'])
+                count_upload_bytes('direct', upload.file_size)
+        except UploadVerificationError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            logger.error(f"Failed to complete upload session for job {job.job_id}: {e}")
+            return Response(
+                {'error': f'Failed to complete upload: {str(e)}'},
+                status=status.HTTP_502_BAD_GATEWAY
+            )
+        
+        if job.files.exists():
+            # Callback retried after the job was already enqueued
+            return Response(AnalysisJobSerializer(job).data)
+        
+        for upload in uploads.values():
+            UploadedFile.objects.create(
+                job=job,
+                file=upload.key,
+                file_name=upload.file_name,
+                file_size=upload.file_size
+            )
+        
+        start_analysis(job)
+        
+        return Response(AnalysisJobSerializer(job).data, status=status.HTTP_201_CREATED)
+
+    def destroy(self, request, job_id=None):
+        """
+        Abort all unfinished uploads of a session
+        DELETE /api/upload-sessions/{job_id}/
+        """
+        job = get_object_or_404(AnalysisJob, job_id=job_id)
+        
+        if job.files.exists():
+            return Response(
+                {'error': 'Upload session already completed'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        for upload in job.direct_uploads.filter(status='uploading'):
+            direct_upload_client.abort_upload(upload.key, upload.upload_id)
+            upload.status = 'aborted'
+            upload.save(update_fields=['status'])
+        
+        update_job(job, status='failed', error_message='Upload aborted')
+        
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+def metrics_view(request):
+    """
+    Prometheus scrape endpoint
+    GET /metrics
+    """
+    token = settings.METRICS_AUTH_TOKEN
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return HttpResponse('Unauthorized', status=401, content_type='text/plain')
+    
+    body, content_type = render_metrics()
+    return HttpResponse(body, content_type=content_type)
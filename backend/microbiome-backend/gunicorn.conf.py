@@ -0,0 +1,22 @@
+"""
+gunicorn settings picked up automatically from the working directory
+
+Prometheus metrics run in multiprocess mode: every worker writes its
+counters/histograms to PROMETHEUS_MULTIPROC_DIR and /metrics merges them.
+"""
+import os
+import shutil
+
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/prometheus_multiproc')
+
+
+def on_starting(server):
+    # Values left by a previous master would be merged into the new ones
+    multiproc_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(multiproc_dir, ignore_errors=True)
+    os.makedirs(multiproc_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -3,6 +3,12 @@ ASGI config for mysite project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Requests under ASYNC_API_PREFIX (the native async endpoints of
+analysis/async_views.py) are served by their own handler, whose middleware
+chain is ASYNC_MIDDLEWARE: only fully async middleware, so a request never
+leaves the event loop for Django's sync middleware (sessions, CSRF, auth,
+messages, ...). Everything else goes through the full MIDDLEWARE stack.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/6.0/howto/deployment/asgi/
 """
@@ -13,4 +19,32 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from django.conf import settings  # noqa: E402
+from django.core.handlers.asgi import ASGIHandler  # noqa: E402
+
+ASYNC_API_PREFIX = '/api/async/'
+
+
+class AsyncAPIHandler(ASGIHandler):
+    """ASGI handler with ASYNC_MIDDLEWARE in place of MIDDLEWARE"""
+
+    def load_middleware(self, is_async=False):
+        # BaseHandler reads the chain from settings.MIDDLEWARE; swap it for the
+        # duration of the load (at import time, before any request is served)
+        middleware = settings.MIDDLEWARE
+        settings.MIDDLEWARE = settings.ASYNC_MIDDLEWARE
+        try:
+            super().load_middleware(is_async)
+        finally:
+            settings.MIDDLEWARE = middleware
+
+
+async_api_application = AsyncAPIHandler()
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http' and scope['path'].startswith(ASYNC_API_PREFIX):
+        return await async_api_application(scope, receive, send)
+    return await django_application(scope, receive, send)
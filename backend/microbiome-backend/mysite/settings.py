@@ -46,17 +46,31 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'analysis.middleware.PrometheusMetricsMiddleware',  # First, so it times the whole stack
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',  # Add WhiteNoise for static files
+    'analysis.middleware.StaticFilesMiddleware',  # WhiteNoise, for static files (async-capable)
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',  # Add CORS before CommonMiddleware
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'analysis.middleware.ProfilingMiddleware',  # Needs request.user
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Middleware of the async endpoints (/api/async/) under ASGI, see mysite/asgi.py.
+# Only middleware that stays on the event loop: anything else would run on a
+# thread per call
+ASYNC_MIDDLEWARE = [
+    'analysis.middleware.PrometheusMetricsMiddleware',
+    'analysis.middleware.SecurityMiddleware',
+    'analysis.middleware.SessionMiddleware',
+    'corsheaders.middleware.CorsMiddleware',
+    'analysis.middleware.AuthenticationMiddleware',
+    'analysis.middleware.ProfilingMiddleware',  # Needs request.auser
+]
+
 ROOT_URLCONF = 'mysite.urls'
 
 TEMPLATES = [
@@ -82,13 +96,31 @@ WSGI_APPLICATION = 'mysite.wsgi.application'
 
 import dj_database_url
 
+# SQLite (local deployments): WAL lets readers run alongside the writer, the
+# busy timeout makes a writer wait for the lock rather than fail with "database
+# is locked", and IMMEDIATE transactions take the write lock when they begin,
+# so one never fails halfway when upgrading a read lock
+SQLITE_WAL = os.environ.get('SQLITE_WAL', 'True') == 'True'
+SQLITE_BUSY_TIMEOUT = float(os.environ.get('SQLITE_BUSY_TIMEOUT', 20))  # seconds
+
+
+def configure_sqlite(database):
+    if database.get('ENGINE') == 'django.db.backends.sqlite3':
+        options = database.setdefault('OPTIONS', {})
+        options.setdefault('timeout', SQLITE_BUSY_TIMEOUT)
+        options.setdefault('transaction_mode', 'IMMEDIATE')
+        if SQLITE_WAL:
+            options.setdefault('init_command', 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;')
+    return database
+
+
 # Default to SQLite for development
 DATABASES = {
-    'default': dj_database_url.config(
+    'default': configure_sqlite(dj_database_url.config(
         default=f'sqlite:///{BASE_DIR / "database" / "db.sqlite3"}',
-        conn_max_age=600,
+        conn_max_age=int(os.environ.get('DB_CONN_MAX_AGE', '600')),
         conn_health_checks=True,
-    )
+    ))
 }
 
 
@@ -134,6 +166,91 @@ MEDIA_URL = '/media/'
 # Allow overriding MEDIA_ROOT for Docker-in-Docker Nextflow compatibility
 MEDIA_ROOT = os.environ.get('MEDIA_ROOT', str(BASE_DIR / 'media'))
 
+# S3 direct uploads (presigned multipart URLs, browser -> S3)
+AWS_STORAGE_BUCKET_NAME = os.environ.get('AWS_STORAGE_BUCKET_NAME', 'microbiome-uploads')
+AWS_S3_REGION_NAME = os.environ.get('AWS_S3_REGION_NAME', 'us-east-1')
+AWS_S3_ENDPOINT_URL = os.environ.get('AWS_S3_ENDPOINT_URL', '')  # e.g. http://localhost:9000 for MinIO
+DIRECT_UPLOAD_PART_SIZE = int(os.environ.get('DIRECT_UPLOAD_PART_SIZE', 64 * 1024 * 1024))
+DIRECT_UPLOAD_URL_EXPIRY = int(os.environ.get('DIRECT_UPLOAD_URL_EXPIRY', 6 * 3600))  # seconds
+
+# S3 transfers of job inputs/results (analysis/utils/s3_transfer.py)
+S3_TRANSFER_PART_SIZE = int(os.environ.get('S3_TRANSFER_PART_SIZE', 16 * 1024 * 1024))
+S3_TRANSFER_CONCURRENCY = int(os.environ.get('S3_TRANSFER_CONCURRENCY', 8))  # parts in flight per file
+S3_TRANSFER_FILE_CONCURRENCY = int(os.environ.get('S3_TRANSFER_FILE_CONCURRENCY', 4))  # files in flight
+BATCH_RESULT_SUBTREES = os.environ.get(
+    'BATCH_RESULT_SUBTREES', 'dada2,summary_report,pipeline_info,multiqc'
+).split(',')
+
+# Pipeline execution backends (see analysis/utils/executors.py)
+PIPELINE_LOCAL_EXECUTOR = os.environ.get('PIPELINE_LOCAL_EXECUTOR', 'local')  # 'local' or 'container'
+NEXTFLOW_BIN = os.environ.get('NEXTFLOW_BIN', 'nextflow')  # e.g. benchmarks/stub_nextflow/nextflow
+NEXTFLOW_CONTAINER_IMAGE = os.environ.get('NEXTFLOW_CONTAINER_IMAGE', 'nextflow/nextflow:24.10.4')
+PIPELINE_BATCH_ENABLED = os.environ.get('PIPELINE_BATCH_ENABLED', 'False') == 'True'
+PIPELINE_BATCH_MIN_INPUT_BYTES = int(os.environ.get('PIPELINE_BATCH_MIN_INPUT_BYTES', 2 * 1024 ** 3))
+AWS_BATCH_JOB_QUEUE = os.environ.get('AWS_BATCH_JOB_QUEUE', 'microbiome-job-queue')
+AWS_BATCH_JOB_DEFINITION = os.environ.get('AWS_BATCH_JOB_DEFINITION', 'nextflow-ampliseq')
+
+# FASTQ preflight before a pipeline starts (analysis/utils/fastq.py)
+FASTQ_PREFLIGHT_ENABLED = os.environ.get('FASTQ_PREFLIGHT_ENABLED', 'True') == 'True'
+FASTQ_PREFLIGHT_WORKERS = int(os.environ.get('FASTQ_PREFLIGHT_WORKERS', 4))  # files scanned at once
+FASTQ_PREFLIGHT_THREADS = int(os.environ.get('FASTQ_PREFLIGHT_THREADS', 2))  # pigz threads per file
+
+# Preview runs on subsampled reads (analysis/utils/preview.py)
+PREVIEW_READ_PAIRS = int(os.environ.get('PREVIEW_READ_PAIRS', 5000))  # per sample
+PREVIEW_TIMEOUT = int(os.environ.get('PREVIEW_TIMEOUT', 900))  # seconds before the full run starts anyway
+
+# Primer detection from the first reads (analysis/utils/primers.py)
+PRIMER_DETECTION_ENABLED = os.environ.get('PRIMER_DETECTION_ENABLED', 'True') == 'True'
+PRIMER_SAMPLE_READS = int(os.environ.get('PRIMER_SAMPLE_READS', 10000))
+PRIMER_MIN_MATCH_FRACTION = float(os.environ.get('PRIMER_MIN_MATCH_FRACTION', 0.5))  # of reads (pairs)
+PRIMER_MAX_ERROR_RATE = float(os.environ.get('PRIMER_MAX_ERROR_RATE', 0.1))  # cutadapt's default -e
+
+# Diversity from the ASV table (analysis/utils/diversity.py)
+DIVERSITY_ENABLED = os.environ.get('DIVERSITY_ENABLED', 'True') == 'True'
+DIVERSITY_BLOCK_ELEMENTS = int(os.environ.get('DIVERSITY_BLOCK_ELEMENTS', 4 * 1024 * 1024))  # cells per dense block
+
+# Rarefaction curves (analysis/utils/rarefaction.py)
+RAREFACTION_STEPS = int(os.environ.get('RAREFACTION_STEPS', 10))  # depths per curve
+RAREFACTION_ITERATIONS = int(os.environ.get('RAREFACTION_ITERATIONS', 10))  # subsamples per depth
+RAREFACTION_WORKERS = int(os.environ.get('RAREFACTION_WORKERS', min(4, os.cpu_count() or 1)))
+RAREFACTION_PARALLEL_MIN_SAMPLES = int(os.environ.get('RAREFACTION_PARALLEL_MIN_SAMPLES', 48))
+RAREFACTION_CACHE_SIZE = int(os.environ.get('RAREFACTION_CACHE_SIZE', 16))  # cached parameter sets per job
+
+# Parsed taxonomy tables kept per process (analysis/utils/taxonomy.py)
+TAXONOMY_CACHE_SIZE = int(os.environ.get('TAXONOMY_CACHE_SIZE', 32))
+
+# ASV sequence lookups (analysis/utils/sequences.py)
+SEQUENCE_INDEX_CACHE_SIZE = int(os.environ.get('SEQUENCE_INDEX_CACHE_SIZE', 16))
+SEQUENCE_LOOKUP_MAX_IDS = int(os.environ.get('SEQUENCE_LOOKUP_MAX_IDS', 1000))
+
+# Cross-job k-mer index of ASV sequences (analysis/utils/kmer_index.py)
+KMER_INDEX_ENABLED = os.environ.get('KMER_INDEX_ENABLED', 'True') == 'True'
+KMER_SIZE = int(os.environ.get('KMER_SIZE', 21))
+KMER_MAX_SEGMENTS = int(os.environ.get('KMER_MAX_SEGMENTS', 8))
+KMER_MAX_POSTINGS = int(os.environ.get('KMER_MAX_POSTINGS', 50000))
+KMER_SEARCH_MAX_RESULTS = int(os.environ.get('KMER_SEARCH_MAX_RESULTS', 100))
+
+# Cross-job taxon search (analysis/utils/taxon_index.py)
+TAXON_SEARCH_MAX_LIMIT = int(os.environ.get('TAXON_SEARCH_MAX_LIMIT', 500))
+
+# Job state writes (analysis/utils/job_writes.py)
+JOB_WRITE_RETRIES = int(os.environ.get('JOB_WRITE_RETRIES', 5))  # further attempts when the database stays locked
+
+# Cross-job comparisons (analysis/utils/compare.py)
+COMPARE_MAX_JOBS = int(os.environ.get('COMPARE_MAX_JOBS', 20))
+COMPARE_CACHE_SIZE = int(os.environ.get('COMPARE_CACHE_SIZE', 64))  # job count matrices kept per process
+
+# Nextflow scratch cleanup (python manage.py cleanup_scratch)
+SCRATCH_DISK_BUDGET_BYTES = int(os.environ.get('SCRATCH_DISK_BUDGET_BYTES', 50 * 1024 ** 3))
+SCRATCH_FAILED_GRACE_HOURS = float(os.environ.get('SCRATCH_FAILED_GRACE_HOURS', 72))  # keep work/ for -resume
+
+# Prometheus /metrics (analysis/utils/instrumentation.py)
+METRICS_AUTH_TOKEN = os.environ.get('METRICS_AUTH_TOKEN', '')  # require "Authorization: Bearer <token>" if set
+MEDIA_DISK_USAGE_TTL = int(os.environ.get('MEDIA_DISK_USAGE_TTL', 300))  # seconds between MEDIA_ROOT walks
+
+# Request profiling (X-Profile: 1 / ?profile=1 for staff users, plus random sampling)
+PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', 0.0))  # e.g. 0.001 = 1 request in 1000
+
 # CORS Configuration
 CORS_ALLOWED_ORIGINS = os.environ.get(
     'CORS_ALLOWED_ORIGINS',
@@ -23,11 +23,11 @@ SECURE_HSTS_PRELOAD = True
 
 # Database - PostgreSQL on RDS
 DATABASES = {
-    'default': dj_database_url.config(
+    'default': configure_sqlite(dj_database_url.config(
         default=os.environ.get('DATABASE_URL', 'sqlite:///db.sqlite3'),
         conn_max_age=600,
         conn_health_checks=True,
-    )
+    ))
 }
 
 # S3 Storage for media files
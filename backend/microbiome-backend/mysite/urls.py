@@ -18,10 +18,12 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from analysis.views import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('analysis.urls')),
+    path('metrics', metrics_view, name='metrics'),
 ]
 
 # Serve media files in development
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Compare two benchmark result files
+
+Usage:
+    python benchmarks/compare.py results/base.json results/new.json [--threshold 1.1]
+
+Prints wall time and peak RSS per (case, path) with new/base ratios and
+exits with status 1 if any wall time got slower than the threshold.
+"""
+import argparse
+import json
+import sys
+
+
+def load(path):
+    with open(path) as f:
+        report = json.load(f)
+    results = {(r['case'], r['path']): r for r in report['results'] if 'error' not in r}
+    return report['environment'], results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark runs')
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=1.1, help='Slowdown ratio that counts as a regression')
+    args = parser.parse_args()
+
+    base_env, base = load(args.base)
+    new_env, new = load(args.new)
+    print(f"base: {(base_env.get('commit') or '?')[:8]}  {base_env.get('timestamp')}")
+    print(f"new:  {(new_env.get('commit') or '?')[:8]}  {new_env.get('timestamp')}\n")
+
+    print(f"{'case':<28} {'path':<13} {'base s':>9} {'new s':>9} {'ratio':>6} {'base MB':>9} {'new MB':>9} {'ratio':>6}")
+    regressions = 0
+    for key in sorted(set(base) & set(new)):
+        b, n = base[key], new[key]
+        time_ratio = n['wall_s'] / b['wall_s'] if b['wall_s'] else float('inf')
+        mem_ratio = n['peak_rss_mb'] / b['peak_rss_mb'] if b['peak_rss_mb'] else float('inf')
+        flag = ''
+        if time_ratio > args.threshold:
+            flag = '  <-- slower'
+            regressions += 1
+        print(
+            f"{key[0]:<28} {key[1]:<13} {b['wall_s']:>9.3f} {n['wall_s']:>9.3f} {time_ratio:>6.2f} "
+            f"{b['peak_rss_mb']:>9.1f} {n['peak_rss_mb']:>9.1f} {mem_ratio:>6.2f}{flag}"
+        )
+
+    for key in sorted(set(base) ^ set(new)):
+        print(f"{key[0]:<28} {key[1]:<13} only in {'base' if key in base else 'new'}")
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
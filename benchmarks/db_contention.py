@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+SQLite write contention benchmark for job state updates
+
+Runs the job state writes of many concurrent jobs against one SQLite file,
+the way several gunicorn workers with a thread per job do, without HTTP or
+a pipeline in between:
+
+    --processes worker processes, each running --threads jobs in threads;
+    each job, for --iterations rounds, writes its preview_status, reads its
+    status back (a poll), and every 10th round replaces 300 ProcessMetric
+    rows in one transaction (a trace import); then it marks itself completed
+
+    a reconciler process meanwhile sets batch_status on every job 10 times,
+    50 ms apart, with QuerySet.update() (like the AWS Batch reconciler)
+
+--writes update (the default) goes through analysis.utils.job_writes with
+the database settings of mysite.settings (WAL, busy timeout, IMMEDIATE
+transactions). --writes save reproduces the old write path: job.save() of
+the whole row with Django's default SQLite options.
+
+Reported:
+    lock_errors       "database is locked" errors the jobs and the reconciler saw
+    lost_updates      jobs whose batch_status is not the reconciler's last value
+                      (overwritten by a stale save())
+    write_s           latency of each job state write
+    elapsed_s         wall time of the whole run
+
+Usage:
+    python benchmarks/db_contention.py                           # 4 x 5 jobs
+    python benchmarks/db_contention.py --writes save             # the old write path
+    python benchmarks/db_contention.py --processes 8 --iterations 300
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+REPO_ROOT = BENCHMARKS_DIR.parent
+BACKEND_DIR = REPO_ROOT / 'backend' / 'microbiome-backend'
+
+sys.path.insert(0, str(BENCHMARKS_DIR))
+from run import environment  # noqa: E402
+
+RECONCILES = 10
+RECONCILE_INTERVAL = 0.05
+METRIC_ROWS = 300
+
+
+def setup_django(database, writes):
+    sys.path.insert(0, str(BACKEND_DIR))
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'mysite.settings'
+    os.environ['DATABASE_URL'] = f'sqlite:///{database}'
+    from django.conf import settings
+    import django
+    if writes == 'save':
+        settings.DATABASES['default']['OPTIONS'] = {}
+    django.setup()
+
+
+def run_worker(database, writes, job_pks, iterations, results):
+    setup_django(database, writes)
+    from django.db import OperationalError, connection, transaction
+    from django.utils import timezone
+    from analysis.models import AnalysisJob, ProcessMetric
+    from analysis.utils.job_writes import is_lock_error, update_job
+
+    lock_errors = []
+    write_times = []
+
+    def write(job, **fields):
+        started = time.perf_counter()
+        try:
+            if writes == 'save':
+                for name, value in fields.items():
+                    setattr(job, name, value)
+                job.save()
+            else:
+                update_job(job, **fields)
+        except OperationalError as e:
+            if not is_lock_error(e):
+                raise
+            lock_errors.append(str(e))
+        write_times.append(time.perf_counter() - started)
+
+    def run_job(pk):
+        job = AnalysisJob.objects.get(pk=pk)
+        for i in range(iterations):
+            write(job, preview_status=('running', 'pending')[i % 2])
+            AnalysisJob.objects.filter(pk=pk).values('status').first()
+            if i % 10 == 5:
+                try:
+                    with transaction.atomic():
+                        ProcessMetric.objects.filter(job=job).delete()
+                        ProcessMetric.objects.bulk_create([
+                            ProcessMetric(job=job, task_id=n, process='BENCH', name=f'BENCH ({n})', status='COMPLETED')
+                            for n in range(METRIC_ROWS)
+                        ])
+                except OperationalError as e:
+                    if not is_lock_error(e):
+                        raise
+                    lock_errors.append(str(e))
+        write(job, status='completed', completed_at=timezone.now())
+        connection.close()
+
+    threads = [threading.Thread(target=run_job, args=(pk,)) for pk in job_pks]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put({'lock_errors': lock_errors, 'write_s': write_times})
+
+
+def run_reconciler(database, writes, job_pks, results):
+    setup_django(database, writes)
+    from django.db import OperationalError
+    from analysis.models import AnalysisJob
+
+    lock_errors = []
+    for i in range(RECONCILES):
+        try:
+            AnalysisJob.objects.filter(pk__in=job_pks).update(batch_status=f'RECONCILED-{i}')
+        except OperationalError as e:
+            lock_errors.append(str(e))
+        time.sleep(RECONCILE_INTERVAL)
+    results.put({'lock_errors': lock_errors, 'write_s': []})
+
+
+def distribution(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        'p50': statistics.median(values),
+        'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+        'max': values[-1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=4, help='Worker processes')
+    parser.add_argument('--threads', type=int, default=5, help='Jobs (threads) per worker process')
+    parser.add_argument('--iterations', type=int, default=150, help='State writes per job')
+    parser.add_argument('--writes', choices=['update', 'save'], default='update',
+                        help='update_job() with the configured SQLite options, or the old full save()')
+    parser.add_argument('--output', help='JSON output (default benchmarks/results/db-contention-<timestamp>-<commit>.json)')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary database')
+    args = parser.parse_args()
+
+    env = environment()
+    workdir = Path(tempfile.mkdtemp(prefix='db-contention-'))
+    database = workdir / 'db.sqlite3'
+    setup_django(database, args.writes)
+    from django.core.management import call_command
+    from django.db import connection
+    from analysis.models import AnalysisJob
+
+    call_command('migrate', verbosity=0)
+    job_pks = [
+        AnalysisJob.objects.create(project_name=f'Contention {i}', email='bench@example.com', data_type='paired-end').pk
+        for i in range(args.processes * args.threads)
+    ]
+    connection.close()
+
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(database, args.writes, job_pks[i::args.processes], args.iterations, results))
+        for i in range(args.processes)
+    ]
+    processes.append(multiprocessing.Process(target=run_reconciler, args=(database, args.writes, job_pks, results)))
+    started = time.monotonic()
+    for process in processes:
+        process.start()
+    outcomes = []
+    while len(outcomes) < len(processes):
+        try:
+            outcomes.append(results.get(timeout=1))
+        except queue.Empty:
+            crashed = [process.exitcode for process in processes if process.exitcode not in (None, 0)]
+            if crashed:
+                sys.exit(f"A worker process exited with status {crashed[0]}")
+    elapsed = time.monotonic() - started
+    for process in processes:
+        process.join()
+
+    jobs = list(AnalysisJob.objects.filter(pk__in=job_pks))
+    lock_errors = [error for outcome in outcomes for error in outcome['lock_errors']]
+    write_times = [t for outcome in outcomes for t in outcome['write_s']]
+    report = {
+        'environment': env,
+        'parameters': vars(args),
+        'jobs': len(jobs),
+        'elapsed_s': elapsed,
+        'lock_errors': len(lock_errors),
+        'lock_error_messages': sorted(set(lock_errors)),
+        'completed': sum(job.status == 'completed' for job in jobs),
+        'lost_updates': sum(job.batch_status != f'RECONCILED-{RECONCILES - 1}' for job in jobs),
+        'write_s': distribution(write_times),
+    }
+
+    print(f"{args.writes}: {report['jobs']} jobs in {args.processes} processes, {elapsed:.1f}s")
+    print(f"lock errors: {report['lock_errors']}, completed: {report['completed']}/{report['jobs']}, "
+          f"lost updates: {report['lost_updates']}")
+    if report['write_s']:
+        print(f"write_s: p50 {report['write_s']['p50']:.4f} p95 {report['write_s']['p95']:.4f} "
+              f"max {report['write_s']['max']:.4f}")
+
+    if args.keep:
+        print(f"Database kept in {workdir}")
+    else:
+        for path in workdir.iterdir():
+            path.unlink()
+        workdir.rmdir()
+
+    output = Path(args.output) if args.output else (
+        BENCHMARKS_DIR / 'results'
+        / f"db-contention-{env['timestamp'].replace(':', '').replace('+0000', 'Z')}-{(env['commit'] or 'nocommit')[:8]}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"\n✓ Results saved to: {output}")
+    sys.exit(1 if report['lock_errors'] or report['lost_updates'] else 0)
+
+
+if __name__ == '__main__':
+    main()
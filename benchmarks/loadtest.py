@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+Load-test a running backend with a mix of simulated clients
+
+A scenario file (see scenarios/) lists groups of virtual users. Each user
+repeats one task at a fixed interval, like the frontend's setInterval:
+
+    job_detail  GET /api/jobs/{id}/ (JobStatus.tsx polls this every 5s)
+    status      GET /api/jobs/{id}/status/
+    bacteria    GET /api/jobs/{id}/bacteria/ on completed jobs
+    upload      POST /api/jobs/upload/ with the analysis_bioinf/test_input reads
+    get         GET of a fixed "path"
+
+Jobs to poll come from "setup": existing "job_ids", and/or "seed_jobs"
+uploads made before the run starts. Jobs uploaded during the run are
+polled too. The read tasks (job_detail, status, bacteria) go to the
+scenario's or the group's "api" prefix, /api by default; /api/async
+polls the async endpoints instead. Reported per task: requests, throughput, p50/p95/p99/max
+latency and error rate. Scenario "thresholds" turn the run into a check
+(exit status 1 when one is exceeded).
+
+The server is not started here. Run it with the stub nextflow so uploads
+don't start real pipelines (see README.md), e.g.
+
+    NEXTFLOW_BIN=$PWD/benchmarks/stub_nextflow/nextflow python manage.py runserver --noreload
+
+Usage:
+    python benchmarks/loadtest.py benchmarks/scenarios/smoke.json
+    python benchmarks/loadtest.py benchmarks/scenarios/steady.json --url http://127.0.0.1:8000 --duration 600
+    python benchmarks/loadtest.py benchmarks/scenarios/pollers.json --api /api/async
+"""
+import argparse
+import asyncio
+import json
+import random
+import ssl
+import statistics
+import sys
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+TEST_INPUT_DIR = BENCHMARKS_DIR.parent / 'analysis_bioinf' / 'test_input'
+INPUT_FILES = ['1a_S103_L001_R1_001.fastq.gz', '1a_S103_L001_R2_001.fastq.gz']
+
+sys.path.insert(0, str(BENCHMARKS_DIR))
+from orchestration import multipart  # noqa: E402
+from run import environment  # noqa: E402
+
+TASKS = ['job_detail', 'status', 'bacteria', 'upload', 'get']
+PERCENTILES = (50, 95, 99)
+REPORT_EVERY = 10  # seconds between progress lines
+
+
+class HTTPError(Exception):
+    pass
+
+
+class Connection:
+    """Minimal keep-alive HTTP/1.1 client on asyncio streams (one per virtual user)"""
+
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.ssl = ssl.create_default_context() if parts.scheme == 'https' else None
+        self.timeout = timeout
+        self.reader = self.writer = None
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body=b'', headers=None):
+        """Returns (status, body); retries once if a kept-alive connection was closed by the server"""
+        for attempt in range(2):
+            reused = self.writer is not None
+            if not reused:
+                self.reader, self.writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port, ssl=self.ssl), self.timeout
+                )
+            try:
+                return await asyncio.wait_for(self._exchange(method, path, body, headers or {}), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError, HTTPError):
+                await self.close()
+                if attempt or not reused:
+                    raise
+            except BaseException:
+                await self.close()
+                raise
+
+    async def _exchange(self, method, path, body, headers):
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {self.host}:{self.port}', 'Connection: keep-alive']
+        lines += [f'{k}: {v}' for k, v in headers.items()]
+        if body or method in ('POST', 'PUT', 'PATCH'):
+            lines.append(f'Content-Length: {len(body)}')
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise HTTPError('connection closed before response')
+        version, code = status_line.decode('latin-1').split()[:2]
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append((await self.reader.readexactly(size + 2))[:-2])
+            content = b''.join(chunks)
+        elif 'content-length' in response_headers:
+            content = await self.reader.readexactly(int(response_headers['content-length']))
+        else:
+            content = await self.reader.read()
+            await self.close()
+            return int(code), content
+
+        connection = response_headers.get('connection', '').lower()
+        if connection == 'close' or (version == 'HTTP/1.0' and connection != 'keep-alive'):
+            await self.close()
+        return int(code), content
+
+
+class Stats:
+    """Latencies and outcomes per task"""
+
+    def __init__(self):
+        self.results = {}  # task -> list of (finished_at, latency, ok, outcome)
+
+    def record(self, task, latency, ok, outcome):
+        self.results.setdefault(task, []).append((time.monotonic(), latency, ok, outcome))
+
+    def summary(self, since=None, until=None):
+        report = {}
+        for task, results in sorted(self.results.items()):
+            window = [r for r in results if (since is None or r[0] >= since) and (until is None or r[0] <= until)]
+            if not window:
+                continue
+            latencies = sorted(r[1] for r in window)
+            errors = [r for r in window if not r[2]]
+            outcomes = {}
+            for r in window:
+                outcomes[str(r[3])] = outcomes.get(str(r[3]), 0) + 1
+            span = ((until or time.monotonic()) - since) if since is not None else None
+            report[task] = {
+                'requests': len(window),
+                'rps': len(window) / span if span else None,
+                'errors': len(errors),
+                'error_rate': len(errors) / len(window),
+                'outcomes': outcomes,
+                **{f'p{p}': latencies[min(len(latencies) - 1, int(round(p / 100 * (len(latencies) - 1))))]
+                   for p in PERCENTILES},
+                'mean': statistics.fmean(latencies),
+                'max': latencies[-1],
+            }
+        return report
+
+
+class JobPool:
+    """Job ids the virtual users pick from"""
+
+    def __init__(self, job_ids=(), completed=()):
+        self.all = list(job_ids)
+        self.completed = list(completed)
+
+    def pick(self, completed=False):
+        ids = self.completed if completed else self.all
+        return random.choice(ids) if ids else None
+
+
+def upload_body(use_test_data):
+    fields = {'project_name': 'Load test', 'email': 'load@example.com', 'data_type': 'paired-end', 'send_email': 'false'}
+    if use_test_data:
+        fields['use_test_data'] = 'true'
+        return multipart(fields, [])
+    return multipart(fields, [(name, (TEST_INPUT_DIR / name).read_bytes()) for name in INPUT_FILES])
+
+
+async def upload(conn, body, content_type):
+    code, content = await conn.request('POST', '/api/jobs/upload/', body, {'Content-Type': content_type})
+    return code, json.loads(content).get('job_id') if code == 201 else None
+
+
+async def setup(url, config, timeout):
+    """Seed jobs and optionally wait for them to complete; returns a JobPool"""
+    pool = JobPool(config.get('job_ids', []))
+    conn = Connection(url, timeout)
+    try:
+        seed = config.get('seed_jobs', 0)
+        if seed:
+            body, content_type = upload_body(config.get('use_test_data', False))
+            for _ in range(seed):
+                code, job_id = await upload(conn, body, content_type)
+                if job_id is None:
+                    raise RuntimeError(f'seed upload failed with HTTP {code}')
+                pool.all.append(job_id)
+            print(f"Seeded {seed} jobs")
+
+        deadline = time.monotonic() + config.get('wait_for_completed', 0)
+        waiting = list(pool.all)
+        while waiting:
+            for job_id in list(waiting):
+                code, content = await conn.request('GET', f'/api/jobs/{job_id}/status/')
+                job_status = json.loads(content).get('status') if code == 200 else None
+                if job_status == 'completed':
+                    pool.completed.append(job_id)
+                if job_status in ('completed', 'failed') or code == 404:
+                    waiting.remove(job_id)
+            if not waiting or time.monotonic() >= deadline:
+                break
+            await asyncio.sleep(1)
+        print(f"{len(pool.all)} jobs to poll, {len(pool.completed)} completed")
+    finally:
+        await conn.close()
+    return pool
+
+
+async def virtual_user(url, group, pool, stats, started, stop_at, timeout):
+    task = group['task']
+    name = group.get('name', task)
+    interval = group['interval']
+    jitter = group.get('jitter', 0.1)
+    expect = group.get('expect', [201] if task == 'upload' else [200])
+    if task == 'upload':
+        body, content_type = upload_body(group.get('use_test_data', False))
+
+    conn = Connection(url, timeout)
+    # Spread first requests over the ramp-up so users don't fire in lockstep
+    next_at = started + random.uniform(0, group.get('ramp_up', interval))
+    try:
+        while True:
+            now = time.monotonic()
+            if next_at >= stop_at:
+                return
+            await asyncio.sleep(max(0.0, next_at - now))
+
+            if task == 'get':
+                path = group['path']
+            else:
+                job_id = pool.pick(completed=(task == 'bacteria'))
+                if task != 'upload' and job_id is None:
+                    stats.record(name, 0.0, False, 'no job')
+                    next_at = max(next_at + interval, time.monotonic())
+                    continue
+                api = group['api']
+                path = {
+                    'job_detail': f'{api}/jobs/{job_id}/',
+                    'status': f'{api}/jobs/{job_id}/status/',
+                    'bacteria': f'{api}/jobs/{job_id}/bacteria/',
+                    'upload': '/api/jobs/upload/',
+                }[task]
+
+            request_started = time.monotonic()
+            try:
+                if task == 'upload':
+                    code, job_id = await upload(conn, body, content_type)
+                    if job_id:
+                        pool.all.append(job_id)
+                else:
+                    code, _ = await conn.request('GET', path)
+                stats.record(name, time.monotonic() - request_started, code in expect, code)
+            except asyncio.TimeoutError:
+                stats.record(name, time.monotonic() - request_started, False, 'timeout')
+            except (OSError, HTTPError, asyncio.IncompleteReadError, ValueError) as e:
+                stats.record(name, time.monotonic() - request_started, False, type(e).__name__)
+
+            # Fixed rate like setInterval; a slow response delays, it doesn't cause a burst
+            next_at = max(next_at + interval * (1 + random.uniform(-jitter, jitter)), time.monotonic())
+    finally:
+        await conn.close()
+
+
+async def progress(stats, started, stop_at):
+    while time.monotonic() < stop_at:
+        await asyncio.sleep(REPORT_EVERY)
+        now = time.monotonic()
+        window = stats.summary(since=now - REPORT_EVERY, until=now)
+        parts = [f"{task} {s['rps']:.1f}/s p95 {s['p95'] * 1000:.0f}ms err {s['errors']}" for task, s in window.items()]
+        print(f"[{now - started:>5.0f}s] " + ('  |  '.join(parts) or 'no requests'), flush=True)
+
+
+async def run_scenario(url, scenario, duration, timeout, api=None):
+    pool = await setup(url, scenario.get('setup', {}), timeout)
+    stats = Stats()
+    started = time.monotonic()
+    stop_at = started + duration
+    users = []
+    for group in scenario['users']:
+        if group['task'] not in TASKS:
+            raise ValueError(f"unknown task {group['task']!r} (expected one of {', '.join(TASKS)})")
+        group.setdefault('ramp_up', scenario.get('ramp_up', group['interval']))
+        group['api'] = (api or group.get('api') or scenario.get('api', '/api')).rstrip('/')
+        users += [virtual_user(url, group, pool, stats, started, stop_at, timeout) for _ in range(group['count'])]
+    print(f"Running {len(users)} virtual users for {duration:.0f}s against {url}")
+    reporter = asyncio.ensure_future(progress(stats, started, stop_at))
+    await asyncio.gather(*users)
+    reporter.cancel()
+    # Warm-up requests (ramp_up) are excluded from the report
+    return stats.summary(since=started + scenario.get('warmup', 0), until=time.monotonic())
+
+
+def check_thresholds(summary, thresholds):
+    """Returns a list of messages for thresholds that were exceeded"""
+    failures = []
+    for task, limits in thresholds.items():
+        if task not in summary:
+            failures.append(f"{task}: no requests")
+            continue
+        for metric, limit in limits.items():
+            value = summary[task].get(metric)
+            if value is not None and value > limit:
+                failures.append(f"{task}: {metric} {value:.4g} > {limit}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenario', help='Scenario JSON file')
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help='Base URL of the backend')
+    parser.add_argument('--duration', type=float, help='Seconds to run (overrides the scenario)')
+    parser.add_argument('--timeout', type=float, default=30, help='Per-request timeout in seconds')
+    parser.add_argument('--api', help='Path prefix of the read endpoints for every group, e.g. /api/async')
+    parser.add_argument('--seed', type=int, help='Random seed for start offsets, jitter and job choice')
+    parser.add_argument('--output', help='JSON output (default benchmarks/results/loadtest-<scenario>-<timestamp>-<commit>.json)')
+    args = parser.parse_args()
+
+    scenario_path = Path(args.scenario)
+    scenario = json.loads(scenario_path.read_text())
+    duration = args.duration or scenario.get('duration', 60)
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    env = environment()
+    summary = asyncio.run(run_scenario(args.url.rstrip('/'), scenario, duration, args.timeout, args.api))
+
+    print(f"\n{'task':<14} {'requests':>9} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'errors':>7}")
+    for task, s in summary.items():
+        print(
+            f"{task:<14} {s['requests']:>9} {s['rps']:>7.2f} {s['p50'] * 1000:>8.1f} {s['p95'] * 1000:>8.1f} "
+            f"{s['p99'] * 1000:>8.1f} {s['max'] * 1000:>8.1f} {s['error_rate']:>6.1%}"
+        )
+        failed_outcomes = {k: v for k, v in s['outcomes'].items() if k not in map(str, (200, 201))}
+        if failed_outcomes:
+            print(f"{'':<14} outcomes: {failed_outcomes}")
+
+    failures = check_thresholds(summary, scenario.get('thresholds', {}))
+    for failure in failures:
+        print(f"✗ threshold exceeded: {failure}")
+
+    output = Path(args.output) if args.output else (
+        BENCHMARKS_DIR / 'results'
+        / f"loadtest-{scenario_path.stem}-{env['timestamp'].replace(':', '').replace('+0000', 'Z')}-{(env['commit'] or 'nocommit')[:8]}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps({
+        'environment': env,
+        'parameters': {**vars(args), 'duration': duration},
+        'scenario': scenario,
+        'results': summary,
+        'threshold_failures': failures,
+    }, indent=2))
+    print(f"\n✓ Results saved to: {output}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+"""
+End-to-end orchestration benchmark with a stub Nextflow
+
+Starts the backend against a throwaway database and MEDIA_ROOT with
+NEXTFLOW_BIN pointing at stub_nextflow/nextflow, submits N uploads through
+POST /api/jobs/upload/ at once, and polls /api/jobs/{id}/status/ until
+every job finishes. The pipeline itself costs a fixed, configurable
+sleep, so what is left is the backend's own overhead:
+
+    upload_s      request latency of the multipart upload
+    pending_s     submit -> first seen pending
+    processing_s  submit -> first seen processing (queueing/thread start)
+    completed_s   submit -> first seen completed/failed
+    ingest_s      stub pipeline finished -> completed_at (result ingestion)
+
+plus "database is locked" errors in the server log and failed jobs,
+and peak thread and open file counts of the server and its children.
+Timings are taken over the jobs that reached the expected final status
+(completed, or failed with --exit-status); when none did, the run exits
+with an error instead of reporting timings of jobs that never ran the
+pipeline.
+Needs nothing beyond the backend's requirements: no Nextflow, Conda or
+network access.
+
+Usage:
+    python benchmarks/orchestration.py                        # 10 jobs, 5s pipeline
+    python benchmarks/orchestration.py --jobs 50 --duration 30 --jitter 0.2
+    python benchmarks/orchestration.py --server gunicorn --workers 4
+"""
+import argparse
+import http.client
+import json
+import os
+import re
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+REPO_ROOT = BENCHMARKS_DIR.parent
+BACKEND_DIR = REPO_ROOT / 'backend' / 'microbiome-backend'
+STUB_NEXTFLOW = BENCHMARKS_DIR / 'stub_nextflow' / 'nextflow'
+TEST_INPUT_DIR = REPO_ROOT / 'analysis_bioinf' / 'test_input'
+INPUT_FILES = ['1a_S103_L001_R1_001.fastq.gz', '1a_S103_L001_R2_001.fastq.gz']
+
+sys.path.insert(0, str(BENCHMARKS_DIR))
+from run import environment  # noqa: E402
+
+FINAL_STATUSES = ('completed', 'failed')
+LOCK_ERROR = re.compile(r'database (table )?is locked', re.IGNORECASE)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, workdir, port, log):
+    """Migrate a fresh database and start the server; returns the Popen"""
+    env = os.environ.copy()
+    env.update({
+        'DATABASE_URL': f"sqlite:///{workdir / 'db.sqlite3'}",
+        'MEDIA_ROOT': str(workdir / 'media'),
+        'NEXTFLOW_BIN': str(STUB_NEXTFLOW),
+        'PIPELINE_LOCAL_EXECUTOR': 'local',
+        'DEBUG': 'False',
+        'ALLOWED_HOSTS': '127.0.0.1,localhost',
+        'PROMETHEUS_MULTIPROC_DIR': str(workdir / 'prometheus'),
+        'STUB_NEXTFLOW_DURATION': str(args.duration),
+        'STUB_NEXTFLOW_JITTER': str(args.jitter),
+        'STUB_NEXTFLOW_EXIT': str(args.exit_status),
+        'STUB_NEXTFLOW_PUBLISH': args.publish,
+        'PYTHONUNBUFFERED': '1',
+    })
+    if args.server == 'runserver':
+        # Without multiprocess mode prometheus_client keeps metrics in memory
+        env.pop('PROMETHEUS_MULTIPROC_DIR')
+    (workdir / 'media').mkdir()
+
+    subprocess.run(
+        [sys.executable, 'manage.py', 'migrate', '--noinput'],
+        cwd=BACKEND_DIR, env=env, check=True, stdout=log, stderr=subprocess.STDOUT,
+    )
+    if args.server == 'gunicorn':
+        cmd = [
+            'gunicorn', 'mysite.wsgi', '-c', 'gunicorn.conf.py',
+            '-b', f'127.0.0.1:{port}', '-w', str(args.workers), '--threads', str(args.threads),
+        ]
+    else:
+        cmd = [sys.executable, 'manage.py', 'runserver', f'127.0.0.1:{port}', '--noreload']
+    return subprocess.Popen(
+        cmd, cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True,
+    )
+
+
+def wait_ready(port, server, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"server exited with code {server.returncode}")
+        try:
+            request(port, 'GET', '/api/jobs/')
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"server not ready after {timeout}s")
+
+
+def request(port, method, path, body=None, headers=None, timeout=60):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def multipart(fields, files):
+    """Encode form fields and (name, bytes) files as multipart/form-data"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        )
+    for file_name, data in files:
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="files"; filename="{file_name}"\r\n'
+            f'Content-Type: application/gzip\r\n\r\n'.encode() + data + b'\r\n'
+        )
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+class ResourceSampler(threading.Thread):
+    """Peak thread and open file counts of a process tree, read from /proc"""
+
+    def __init__(self, pid, interval):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.samples = []
+
+    @staticmethod
+    def _children():
+        parents = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    # Fields after the ")" closing the command name; ppid is the second
+                    parents[int(entry)] = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+        return parents
+
+    def _tree(self):
+        parents = self._children()
+        tree, frontier = [self.pid], [self.pid]
+        while frontier:
+            frontier = [pid for pid, ppid in parents.items() if ppid in frontier]
+            tree.extend(frontier)
+        return tree
+
+    @staticmethod
+    def _counts(pid):
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                threads = next(int(line.split()[1]) for line in f if line.startswith('Threads:'))
+            return threads, len(os.listdir(f'/proc/{pid}/fd'))
+        except (OSError, StopIteration):
+            return 0, 0
+
+    def sample(self):
+        tree = self._tree()
+        server_threads, server_fds = self._counts(self.pid)
+        counts = [self._counts(pid) for pid in tree]
+        return {
+            't': time.monotonic(),
+            'server_threads': server_threads,
+            'server_fds': server_fds,
+            'tree_processes': len(tree),
+            'tree_threads': sum(c[0] for c in counts),
+            'tree_fds': sum(c[1] for c in counts),
+        }
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.samples.append(self.sample())
+            self.stopped.wait(self.interval)
+
+    def summary(self):
+        if not self.samples:
+            return {}
+        keys = [k for k in self.samples[0] if k != 't']
+        return {
+            **{f'{k}_max': max(s[k] for s in self.samples) for k in keys},
+            'baseline': {k: self.samples[0][k] for k in keys},
+            'samples': len(self.samples),
+        }
+
+
+def submit(port, index, payload, start_barrier):
+    """One upload; returns the job record the rest of the run fills in"""
+    fields = {
+        'project_name': f'Orchestration benchmark {index}',
+        'email': 'bench@example.com',
+        'data_type': 'paired-end',
+        'send_email': 'false',
+    }
+    body, content_type = multipart(fields, payload)
+    start_barrier.wait()
+    submitted = time.monotonic()
+    try:
+        code, content = request(port, 'POST', '/api/jobs/upload/', body, {'Content-Type': content_type})
+    except OSError as e:
+        return {'index': index, 'error': f"{type(e).__name__}: {e}", 'submitted': submitted}
+    record = {'index': index, 'submitted': submitted, 'upload_s': time.monotonic() - submitted}
+    if code != 201:
+        record['error'] = f"HTTP {code}: {content[:200].decode(errors='replace')}"
+        return record
+    data = json.loads(content)
+    record['job_id'] = data['job_id']
+    record['seen'] = {data['status']: time.monotonic()}
+    return record
+
+
+def poll(port, jobs, interval, timeout):
+    """Record when each job is first seen in each status, until all finish"""
+    deadline = time.monotonic() + timeout
+    pending = [j for j in jobs if 'job_id' in j]
+    while pending and time.monotonic() < deadline:
+        for job in list(pending):
+            try:
+                code, content = request(port, 'GET', f"/api/jobs/{job['job_id']}/status/")
+            except OSError:
+                continue
+            now = time.monotonic()
+            if code != 200:
+                continue
+            data = json.loads(content)
+            job['seen'].setdefault(data['status'], now)
+            if data['status'] in FINAL_STATUSES:
+                job['status'] = data['status']
+                job['completed_at'] = data['completed_at']
+                job['error_message'] = data['error_message']
+                pending.remove(job)
+        time.sleep(interval)
+    for job in pending:
+        job['error'] = f"not finished after {timeout}s (last seen {list(job['seen'])[-1]})"
+
+
+def ingestion_seconds(media_root, job):
+    """completed_at minus the time the stub pipeline wrote its last output"""
+    timing = media_root / 'uploads' / job['job_id'] / 'results' / 'pipeline_info' / 'stub_timing.json'
+    if job.get('status') != 'completed' or not job.get('completed_at') or not timing.exists():
+        return None
+    finished = json.loads(timing.read_text())['finished']
+    completed = datetime.fromisoformat(job['completed_at']).timestamp()
+    return completed - finished
+
+
+def distribution(values):
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+
+    def pct(p):
+        return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+    return {
+        'n': len(values), 'mean': statistics.fmean(values),
+        'p50': pct(50), 'p90': pct(90), 'p95': pct(95), 'max': values[-1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=10, help='Uploads submitted at once')
+    parser.add_argument('--duration', type=float, default=5, help='Stub pipeline run time in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='+/- fraction applied to --duration per job')
+    parser.add_argument('--exit-status', type=int, default=0, help='Stub pipeline exit status (non-zero = failed jobs)')
+    parser.add_argument('--publish', choices=['copy', 'symlink'], default='copy',
+                        help='How the stub publishes results_test (symlink saves ~70MB per job)')
+    parser.add_argument('--server', choices=['runserver', 'gunicorn'], default='runserver')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=4, help='gunicorn threads per worker')
+    parser.add_argument('--poll-interval', type=float, default=0.25, help='Seconds between status sweeps')
+    parser.add_argument('--sample-interval', type=float, default=0.5, help='Seconds between thread/fd samples')
+    parser.add_argument('--timeout', type=float, default=900, help='Seconds to wait for all jobs to finish')
+    parser.add_argument('--output', help='JSON output (default benchmarks/results/orchestration-<timestamp>-<commit>.json)')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary database, media and server log')
+    args = parser.parse_args()
+
+    if not sys.platform.startswith('linux'):
+        parser.error('thread and file descriptor sampling reads /proc, so this runs on Linux only')
+
+    env = environment()
+    workdir = Path(tempfile.mkdtemp(prefix='microbiome-orchestration-'))
+    log_path = workdir / 'server.log'
+    port = free_port()
+    payload = [(name, (TEST_INPUT_DIR / name).read_bytes()) for name in INPUT_FILES]
+    print(f"Working directory: {workdir}")
+
+    server = None
+    try:
+        with open(log_path, 'w') as log:
+            server = start_server(args, workdir, port, log)
+            wait_ready(port, server)
+            sampler = ResourceSampler(server.pid, args.sample_interval)
+            sampler.samples.append(sampler.sample())
+            sampler.start()
+
+            print(f"Submitting {args.jobs} uploads ({args.duration}s stub pipeline, {args.server})")
+            started = time.monotonic()
+            barrier = threading.Barrier(args.jobs)
+            with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+                jobs = list(pool.map(lambda i: submit(port, i, payload, barrier), range(args.jobs)))
+            poll(port, jobs, args.poll_interval, args.timeout)
+            wall = time.monotonic() - started
+            sampler.stopped.set()
+            sampler.join()
+
+        server_log = log_path.read_text(errors='replace')
+        media_root = workdir / 'media'
+        for job in jobs:
+            seen = job.get('seen', {})
+            for state in ('pending', 'processing'):
+                if state in seen:
+                    job[f'{state}_s'] = seen[state] - job['submitted']
+            finished = [seen[s] for s in FINAL_STATUSES if s in seen]
+            if finished:
+                job['completed_s'] = finished[0] - job['submitted']
+            if 'job_id' in job:
+                job['ingest_s'] = ingestion_seconds(media_root, job)
+            job.pop('seen', None)
+            job.pop('submitted', None)
+
+        failed = [j for j in jobs if j.get('status') != 'completed']
+        # With --exit-status the stub fails on purpose; time the jobs that did
+        expected = 'completed' if args.exit_status == 0 else 'failed'
+        measured = [j for j in jobs if j.get('status') == expected]
+        report = {
+            'environment': env,
+            'parameters': vars(args),
+            'wall_s': wall,
+            'jobs': jobs,
+            'summary': {
+                metric: distribution(j.get(metric) for j in measured)
+                for metric in ('upload_s', 'pending_s', 'processing_s', 'completed_s', 'ingest_s')
+            },
+            'completed': len(jobs) - len(failed),
+            'failed': len(failed),
+            'lock_errors': {
+                'server_log': len(LOCK_ERROR.findall(server_log)),
+                'failed_jobs': sum(1 for j in failed if LOCK_ERROR.search(j.get('error_message') or j.get('error') or '')),
+            },
+            'resources': sampler.summary(),
+        }
+    finally:
+        if server is not None and server.poll() is None:
+            os.killpg(server.pid, signal.SIGTERM)
+            try:
+                server.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                os.killpg(server.pid, signal.SIGKILL)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if not measured:
+        for job in jobs:
+            print(f"  job {job['index']}: {job.get('error') or job.get('error_message') or job.get('status')}")
+        sys.exit(f"\nNo job reached '{expected}' (0/{args.jobs}); nothing to report. "
+                 f"Re-run with --keep to inspect {log_path}")
+
+    print(f"\n{report['completed']}/{args.jobs} completed in {wall:.1f}s")
+    print(f"{'':<14} {'p50':>8} {'p95':>8} {'max':>8}")
+    for metric, dist in report['summary'].items():
+        if dist:
+            print(f"{metric:<14} {dist['p50']:>8.3f} {dist['p95']:>8.3f} {dist['max']:>8.3f}")
+    resources = report['resources']
+    print(f"lock errors: {report['lock_errors']['server_log']} in server log, "
+          f"{report['lock_errors']['failed_jobs']} failed jobs")
+    if resources:
+        print(f"server threads max {resources['server_threads_max']} (baseline {resources['baseline']['server_threads']}), "
+              f"fds max {resources['server_fds_max']} (baseline {resources['baseline']['server_fds']}), "
+              f"process tree max {resources['tree_processes_max']} processes / {resources['tree_threads_max']} threads")
+    for job in failed:
+        print(f"  job {job['index']}: {job.get('error') or job.get('error_message')}")
+
+    output = Path(args.output) if args.output else (
+        BENCHMARKS_DIR / 'results'
+        / f"orchestration-{env['timestamp'].replace(':', '').replace('+0000', 'Z')}-{(env['commit'] or 'nocommit')[:8]}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"\n✓ Results saved to: {output}")
+    sys.exit(1 if failed and args.exit_status == 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Benchmark taxonomy aggregation and summary generation on synthetic data
+
+Code paths:
+    summary       analysis_bioinf/analyze_bacteria.py create_bacteria_summary
+    barplot       analysis_bioinf/create_bacteria_barplot.py create_bacteria_barplot
+    bacteria_api  GET /api/jobs/{job_id}/bacteria/ (full Django stack, in-memory DB)
+
+Every measurement runs in a fresh process, so peak RSS belongs to that
+code path alone. Results are written as JSON (see compare.py).
+
+Usage:
+    python benchmarks/run.py                                  # default grid
+    python benchmarks/run.py --asvs 1000,100000 --samples 10,1000 --paths summary
+    python benchmarks/run.py --quick
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from datetime import datetime, timezone
+from pathlib import Path
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+REPO_ROOT = BENCHMARKS_DIR.parent
+BACKEND_DIR = REPO_ROOT / 'backend' / 'microbiome-backend'
+BIOINF_DIR = REPO_ROOT / 'analysis_bioinf'
+
+sys.path.insert(0, str(BENCHMARKS_DIR))
+from synthetic import generate_dataset  # noqa: E402
+
+PATHS = ['summary', 'barplot', 'bacteria_api']
+DEFAULT_ASVS = [1000, 10000, 100000, 1000000]
+DEFAULT_SAMPLES = [1, 10, 100, 1000]
+DEFAULT_MAX_CELLS = 10 ** 8  # skip ASV x sample combinations above this
+
+
+def _rss_mb():
+    # ru_maxrss is KB on Linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def _prepare(path_name, results_dir):
+    """Import and set up a code path; returns a zero-argument callable"""
+    if path_name == 'summary':
+        sys.path.insert(0, str(BIOINF_DIR))
+        from analyze_bacteria import create_bacteria_summary
+        return lambda: create_bacteria_summary(results_dir)
+
+    if path_name == 'barplot':
+        os.environ['MPLBACKEND'] = 'Agg'
+        sys.path.insert(0, str(BIOINF_DIR))
+        import matplotlib.pyplot as plt
+        from create_bacteria_barplot import create_bacteria_barplot
+
+        def run():
+            create_bacteria_barplot(results_dir)
+            plt.close('all')
+        return run
+
+    if path_name == 'bacteria_api':
+        # MEDIA_ROOT is the parent of uploads/<job_id>/results
+        job_dir = Path(results_dir).parent
+        os.environ['MEDIA_ROOT'] = str(job_dir.parent.parent)
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
+        sys.path.insert(0, str(BACKEND_DIR))
+        import django
+        django.setup()
+        from django.db import connection
+        from django.test.utils import setup_test_environment
+        from rest_framework.test import APIClient
+        from analysis.models import AnalysisJob, AnalysisResult
+
+        setup_test_environment()
+        connection.creation.create_test_db(verbosity=0)
+        job = AnalysisJob.objects.create(
+            job_id=job_dir.name, project_name='Benchmark', email='bench@example.com',
+            data_type='paired-end', status='completed',
+        )
+        AnalysisResult.objects.create(job=job)
+        client = APIClient()
+        url = f'/api/jobs/{job.job_id}/bacteria/'
+        # Warm up URL resolution and middleware so only the request itself is timed
+        client.get('/api/jobs/00000000-0000-0000-0000-000000000000/status/')
+
+        def run():
+            response = client.get(url)
+            if response.status_code != 200:
+                raise RuntimeError(f"{url} returned {response.status_code}: {response.content[:200]}")
+        return run
+
+    raise ValueError(f"Unknown code path: {path_name}")
+
+
+def _measure(path_name, results_dir, queue):
+    """Child process: set up, run once, report wall time and memory"""
+    warnings.simplefilter('ignore')
+    logging.disable(logging.WARNING)
+    try:
+        run = _prepare(path_name, results_dir)
+        setup_rss = _rss_mb()
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                started = time.perf_counter()
+                run()
+                wall = time.perf_counter() - started
+            finally:
+                sys.stdout = stdout
+        queue.put({'wall_s': wall, 'peak_rss_mb': _rss_mb(), 'setup_rss_mb': setup_rss})
+    except Exception as e:
+        queue.put({'error': f"{type(e).__name__}: {e}"})
+
+
+def measure(path_name, results_dir, repeat, timeout):
+    """Run a code path `repeat` times in fresh processes"""
+    ctx = multiprocessing.get_context('spawn')
+    runs = []
+    for _ in range(repeat):
+        queue = ctx.Queue()
+        process = ctx.Process(target=_measure, args=(path_name, str(results_dir), queue))
+        process.start()
+        process.join(timeout)
+        if process.is_alive():
+            process.kill()
+            process.join()
+            return {'error': f'timed out after {timeout}s'}
+        if queue.empty():
+            return {'error': f'process exited with code {process.exitcode}'}
+        result = queue.get()
+        if 'error' in result:
+            return result
+        runs.append(result)
+
+    walls = [r['wall_s'] for r in runs]
+    return {
+        'wall_s': statistics.median(walls),
+        'wall_s_min': min(walls),
+        'wall_s_all': walls,
+        'peak_rss_mb': max(r['peak_rss_mb'] for r in runs),
+        'setup_rss_mb': max(r['setup_rss_mb'] for r in runs),
+    }
+
+
+def environment():
+    def version(module):
+        try:
+            return __import__(module).__version__
+        except Exception:
+            return None
+
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True, timeout=10
+        ).stdout.strip() or None
+        dirty = bool(subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=REPO_ROOT, capture_output=True, text=True, timeout=30,
+        ).stdout.strip())
+    except Exception:
+        commit, dirty = None, None
+
+    return {
+        'commit': commit,
+        'dirty': dirty,
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': version('numpy'),
+        'pandas': version('pandas'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--asvs', default=','.join(map(str, DEFAULT_ASVS)), help='Comma-separated ASV counts')
+    parser.add_argument('--samples', default=','.join(map(str, DEFAULT_SAMPLES)), help='Comma-separated sample counts')
+    parser.add_argument('--paths', default=','.join(PATHS), help=f'Comma-separated code paths ({", ".join(PATHS)})')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement (median is reported)')
+    parser.add_argument('--max-cells', type=int, default=DEFAULT_MAX_CELLS, help='Skip cases with more ASV x sample cells')
+    parser.add_argument('--timeout', type=float, default=1800, help='Seconds before a run is abandoned')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON output (default benchmarks/results/<timestamp>-<commit>.json)')
+    parser.add_argument('--workdir', help='Where to generate datasets (default: a temp dir, removed afterwards)')
+    parser.add_argument('--quick', action='store_true', help='Small smoke-test grid')
+    args = parser.parse_args()
+
+    if args.quick:
+        args.asvs, args.samples, args.repeat = '1000,10000', '1,10', 1
+
+    asv_counts = [int(x) for x in args.asvs.split(',')]
+    sample_counts = [int(x) for x in args.samples.split(',')]
+    paths = [p for p in args.paths.split(',') if p]
+    unknown = set(paths) - set(PATHS)
+    if unknown:
+        parser.error(f"unknown code paths: {', '.join(sorted(unknown))}")
+
+    env = environment()
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix='microbiome-bench-'))
+    report = {'environment': env, 'parameters': vars(args), 'results': []}
+
+    try:
+        for n_asvs in asv_counts:
+            for n_samples in sample_counts:
+                case = f"asvs={n_asvs},samples={n_samples}"
+                if n_asvs * n_samples > args.max_cells:
+                    print(f"- {case}: skipped (over --max-cells)")
+                    continue
+
+                # MEDIA_ROOT/uploads/<job_id>/results, so the API path finds it
+                job_id = '00000000-0000-4000-8000-000000000000'
+                results_dir = workdir / case.replace(',', '_').replace('=', '') / 'uploads' / job_id / 'results'
+                if results_dir.exists():
+                    shutil.rmtree(results_dir)
+                started = time.perf_counter()
+                dataset = generate_dataset(results_dir, n_asvs, n_samples, seed=args.seed)
+                print(f"{case}: generated in {time.perf_counter() - started:.1f}s (density {dataset['density']:.3f})")
+
+                for path_name in paths:
+                    result = measure(path_name, results_dir, args.repeat, args.timeout)
+                    report['results'].append({
+                        'case': case,
+                        'path': path_name,
+                        'n_asvs': n_asvs,
+                        'n_samples': n_samples,
+                        'density': round(dataset['density'], 4),
+                        **result,
+                    })
+                    if 'error' in result:
+                        print(f"  {path_name:<13} ERROR {result['error']}")
+                    else:
+                        print(f"  {path_name:<13} {result['wall_s']:>9.3f}s  peak {result['peak_rss_mb']:>8.1f} MB")
+
+                shutil.rmtree(results_dir.parent.parent.parent, ignore_errors=True)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = Path(args.output) if args.output else (
+        BENCHMARKS_DIR / 'results'
+        / f"{env['timestamp'].replace(':', '').replace('+0000', 'Z')}-{(env['commit'] or 'nocommit')[:8]}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"\n✓ Results saved to: {output}")
+
+
+if __name__ == '__main__':
+    main()